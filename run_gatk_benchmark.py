@@ -0,0 +1,299 @@
+from run_gatk_standins import install_standin_tools
+import subprocess
+import argparse
+import logging
+import random
+import shutil
+import json
+import gzip
+import time
+import sys
+import os
+
+#Benchmark suite of the pipeline.
+#It generates a small synthetic reference genome and simulated paired reads, runs run_gatk_pipe.py end to end with the stand-in tools of run_gatk_standins.py and measures the orchestration of the run: startup and scheduling overhead, concurrency of the tools and throughput
+
+PIPELINE_SCRIPT=os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_gatk_pipe.py")
+
+COMPLEMENT=str.maketrans("ACGTN", "TGCAN")
+
+#------------------------------------------------------------------------
+#Function for generating a synthetic reference genome (random sequence, 60 bases per line)
+#Input: number of contigs and contig length -- Output: *.fasta
+def generate_reference(out_fasta, contigs=2, contig_length=100000, seed=1):
+    generator=random.Random(seed)
+    with open(out_fasta, "w") as fasta:
+        for i in range(1, contigs + 1):
+            sequence="".join(generator.choices("ACGT", k=contig_length))
+            fasta.write(f">chr{i}\n")
+            for start in range(0, contig_length, 60):
+                fasta.write(sequence[start:start + 60] + "\n")
+    return out_fasta
+
+#------------------------------------------------------------------------
+#Function for reading the sequences of a fasta file
+def read_reference(ref_genome):
+    sequences={}
+    with open(ref_genome) as fasta:
+        for line in fasta:
+            if line.startswith(">"):
+                name=line[1:].split()[0]
+                sequences[name]=[]
+            else:
+                sequences[name].append(line.strip())
+    return {name: "".join(lines) for name, lines in sequences.items()}
+
+#------------------------------------------------------------------------
+#Function for simulating paired-end reads from a reference genome.
+#The reads come from a sample that is heterozygous for random SNVs (snv_rate) and have random sequencing errors (error_rate). The number of read pairs gives the requested depth. Every read name holds the origin of the pair (sim<i>:<contig>:<position 1>:<position 2>), which the bwa stand-in uses for placing the pair.
+#It returns the number of read pairs
+#Input: reference genome (*.fasta) -- Output: (*_1.fastq.gz)-(*_2.fastq.gz)
+def simulate_reads(ref_genome, out_fastq_1, out_fastq_2, depth=10, read_length=100, insert_size=300, error_rate=0.001, snv_rate=0.001, seed=1):
+    generator=random.Random(seed)
+    sequences=read_reference(ref_genome)
+
+    #Alternative haplotype of the sample
+    haplotypes={}
+    for name, sequence in sequences.items():
+        alternative=list(sequence)
+        for position in range(len(alternative)):
+            if generator.random() < snv_rate:
+                alternative[position]=generator.choice([base for base in "ACGT" if base != alternative[position]])
+        haplotypes[name]=(sequence, "".join(alternative))
+
+    names=[name for name, sequence in sequences.items() if len(sequence) >= insert_size]
+    weights=[len(sequences[name]) for name in names]
+    read_pairs=int(depth * sum(weights) / (2 * read_length))
+    quality="I" * read_length
+
+    def add_errors(read):
+        if not error_rate:
+            return read
+        return "".join(generator.choice("ACGT") if generator.random() < error_rate else base for base in read)
+
+    with gzip.open(out_fastq_1, "wt", compresslevel=1) as fastq_1, gzip.open(out_fastq_2, "wt", compresslevel=1) as fastq_2:
+        for i in range(read_pairs):
+            name=generator.choices(names, weights)[0]
+            template=generator.choice(haplotypes[name])
+            start=generator.randrange(0, len(template) - insert_size + 1)
+            read_1=add_errors(template[start:start + read_length])
+            read_2=add_errors(template[start + insert_size - read_length:start + insert_size].translate(COMPLEMENT)[::-1])
+            read_name=f"sim{i}:{name}:{start + 1}:{start + insert_size - read_length + 1}"
+            fastq_1.write(f"@{read_name}/1\n{read_1}\n+\n{quality}\n")
+            fastq_2.write(f"@{read_name}/2\n{read_2}\n+\n{quality}\n")
+    return read_pairs
+
+#------------------------------------------------------------------------
+#Function for summarizing the trace of the stand-in tools of one run.
+#Busy time is the time at least one tool ran. The startup overhead is the time from the start of the run to the first tool, the shutdown overhead the time from the last tool to the end of the run, and the scheduling overhead the time between them in which no tool ran
+def summarize_trace(trace, run_start, run_end):
+    if not trace:
+        return {"tool_invocations": 0, "tool_time_s": 0.0, "busy_time_s": 0.0, "startup_overhead_s": round(run_end - run_start, 3), "scheduling_overhead_s": 0.0, "shutdown_overhead_s": 0.0, "mean_concurrency": 0.0, "peak_concurrency": 0}
+
+    intervals=sorted((step["start"], step["end"]) for step in trace)
+    busy_time=0.0
+    busy_start, busy_end=intervals[0]
+    for start, end in intervals[1:]:
+        if start > busy_end:
+            busy_time+=busy_end - busy_start
+            busy_start=start
+        busy_end=max(busy_end, end)
+    busy_time+=busy_end - busy_start
+
+    events=sorted([(start, 1) for start, end in intervals] + [(end, -1) for start, end in intervals], key=lambda event: (event[0], event[1]))
+    running=peak=0
+    for event_time, change in events:
+        running+=change
+        peak=max(peak, running)
+
+    tool_time=sum(end - start for start, end in intervals)
+    first_start=intervals[0][0]
+    last_end=max(end for start, end in intervals)
+    return {
+        "tool_invocations": len(intervals),
+        "tool_time_s": round(tool_time, 3),
+        "busy_time_s": round(busy_time, 3),
+        "startup_overhead_s": round(first_start - run_start, 3),
+        "scheduling_overhead_s": round((last_end - first_start) - busy_time, 3),
+        "shutdown_overhead_s": round(run_end - last_end, 3),
+        "mean_concurrency": round(tool_time / busy_time, 2) if busy_time else 0.0,
+        "peak_concurrency": peak}
+
+#------------------------------------------------------------------------
+#Function for running the pipeline once with the stand-in tools in run_dir
+#It returns the measurements of the run
+def run_pipeline_once(run_dir, bin_dir, ref_genome, fastq_1, fastq_2, read_pairs, pipeline_args, latency=0.0, seconds_per_mb=0.0, busy=False):
+    os.makedirs(run_dir)
+    run_ref_genome=os.path.join(run_dir, os.path.basename(ref_genome))
+    shutil.copyfile(ref_genome, run_ref_genome)
+    trace_file=os.path.join(run_dir, "standin_trace.jsonl")
+    metrics_report=os.path.join(run_dir, "gatk_pipe_metrics.json")
+
+    environment=dict(os.environ)
+    environment["PATH"]=f"{bin_dir}{os.pathsep}{environment.get('PATH', '')}"
+    environment["GATK_STANDIN_LATENCY"]=str(latency)
+    environment["GATK_STANDIN_SECONDS_PER_MB"]=str(seconds_per_mb)
+    environment["GATK_STANDIN_BUSY"]="1" if busy else "0"
+    environment["GATK_STANDIN_TRACE"]=trace_file
+
+    command=[sys.executable, PIPELINE_SCRIPT, "--fastq1", os.path.abspath(fastq_1), "--fastq2", os.path.abspath(fastq_2), "--ref_genome", os.path.basename(run_ref_genome), "--out_vcf", os.path.join(run_dir, "benchmark"), "--metrics_report", metrics_report, *pipeline_args]
+    logging.info(f"Benchmark run: {' '.join(command)}")
+
+    run_start=time.time()
+    result=subprocess.run(command, cwd=run_dir, env=environment, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    run_end=time.time()
+    if result.returncode != 0:
+        raise RuntimeError(f"Benchmark run in '{run_dir}' failed with error code {result.returncode}:\n{result.stdout[-2000:]}")
+
+    trace=[]
+    if os.path.exists(trace_file):
+        with open(trace_file) as trace_lines:
+            trace=[json.loads(line) for line in trace_lines if line.strip()]
+
+    measurements={"wall_time_s": round(run_end - run_start, 3), **summarize_trace(trace, run_start, run_end)}
+    measurements["read_pairs_per_s"]=round(read_pairs / measurements["wall_time_s"], 1)
+    #The output VCF file gets the extension of its format: block gzipped unless the run uses --vcf_format vcf
+    out_vcfs=[os.path.join(run_dir, name) for name in ("benchmark.vcf.gz", "benchmark.vcf")]
+    measurements["variants"]=count_variants(next((vcf for vcf in out_vcfs if os.path.exists(vcf)), out_vcfs[0]))
+    return measurements
+
+#------------------------------------------------------------------------
+#Function for counting the records of a VCF file (plain or block gzipped)
+def count_variants(vcf):
+    if not os.path.exists(vcf):
+        return 0
+    opener=gzip.open if vcf.endswith(".gz") else open
+    with opener(vcf, "rt") as records:
+        return sum(1 for line in records if line.strip() and not line.startswith("#"))
+
+#------------------------------------------------------------------------
+#Function for running the benchmark.
+#The synthetic data is generated once in work_dir/data, then the pipeline runs repeat times, every time in a new directory so that no step is skipped.
+#It returns the benchmark report: the settings, the measurements of every run and the median of every measurement
+def run_benchmark(work_dir, contigs=2, contig_length=100000, depth=10, read_length=100, seed=1, repeat=3, pipeline_args=(), latency=0.0, seconds_per_mb=0.0, busy=False):
+    #The pipeline runs in its own directory, so the paths it gets have to be absolute
+    work_dir=os.path.abspath(work_dir)
+    data_dir=os.path.join(work_dir, "data")
+    os.makedirs(data_dir, exist_ok=True)
+
+    generate_start=time.time()
+    ref_genome=generate_reference(os.path.join(data_dir, "synthetic.fasta"), contigs, contig_length, seed)
+    fastq_1=os.path.join(data_dir, "synthetic_1.fastq.gz")
+    fastq_2=os.path.join(data_dir, "synthetic_2.fastq.gz")
+    read_pairs=simulate_reads(ref_genome, fastq_1, fastq_2, depth=depth, read_length=read_length, seed=seed)
+    logging.info(f"Synthetic data: {contigs} contigs of {contig_length} bp, {read_pairs} read pairs ({time.time() - generate_start:.1f}s).")
+
+    bin_dir=install_standin_tools(os.path.join(work_dir, "bin"))
+    runs=[]
+    for i in range(1, repeat + 1):
+        run_dir=os.path.join(work_dir, f"run_{i:03d}")
+        if os.path.exists(run_dir):
+            shutil.rmtree(run_dir)
+        runs.append(run_pipeline_once(run_dir, bin_dir, ref_genome, fastq_1, fastq_2, read_pairs, list(pipeline_args), latency, seconds_per_mb, busy))
+        logging.info(f"Benchmark run {i}: {json.dumps(runs[-1])}")
+
+    median={key: sorted(run[key] for run in runs)[len(runs) // 2] for key in runs[0]}
+    return {
+        "settings": {"contigs": contigs, "contig_length": contig_length, "depth": depth, "read_length": read_length, "read_pairs": read_pairs, "repeat": repeat, "latency": latency, "seconds_per_mb": seconds_per_mb, "busy": busy, "pipeline_args": list(pipeline_args)},
+        "runs": runs,
+        "median": median}
+
+#------------------------------------------------------------------------
+#Function for parsing the output of python -X importtime.
+#It returns the self and cumulative import time in seconds of every imported module
+def parse_import_times(importtime_output):
+    import_times={}
+    for line in importtime_output.splitlines():
+        fields=line.removeprefix("import time:").split("|")
+        if not line.startswith("import time:") or len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        import_times[fields[2].strip()]={"self_s": int(fields[0]) / 1e6, "cumulative_s": int(fields[1]) / 1e6}
+    return import_times
+
+#------------------------------------------------------------------------
+#Function for running the startup benchmark.
+#Every repeat starts new interpreters in work_dir and measures the start of the interpreter alone, the import of run_gatk_pipe (with python -X importtime) and the run of run_gatk_pipe.py --help, which is the startup of the pipeline up to the argument parsing. It also checks that the import does not import Prefect.
+#It returns the benchmark report: the measurements of every repeat, their median and the slowest imports
+def run_startup_benchmark(work_dir, repeat=5):
+    work_dir=os.path.abspath(work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    environment=dict(os.environ)
+    environment["PYTHONPATH"]=os.pathsep.join(filter(None, [os.path.dirname(PIPELINE_SCRIPT), environment.get("PYTHONPATH")]))
+
+    def timed_run(command):
+        start=time.time()
+        result=subprocess.run(command, cwd=work_dir, env=environment, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"Startup benchmark command {' '.join(command)} failed with error code {result.returncode}:\n{result.stderr[-2000:]}")
+        return round(time.time() - start, 3), result
+
+    runs=[]
+    for i in range(repeat):
+        interpreter_time, result=timed_run([sys.executable, "-c", "pass"])
+        import_time, result=timed_run([sys.executable, "-X", "importtime", "-c", "import sys, run_gatk_pipe; print(any(module.split('.')[0] == 'prefect' for module in sys.modules))"])
+        startup_time, help_result=timed_run([sys.executable, PIPELINE_SCRIPT, "--help"])
+        import_times=parse_import_times(result.stderr)
+        runs.append({
+            "interpreter_s": interpreter_time,
+            "import_s": import_time,
+            "startup_s": startup_time,
+            "pipeline_import_s": round(import_times.get("run_gatk_pipe", {}).get("cumulative_s", 0.0), 3),
+            "prefect_imported": result.stdout.strip() == "True"})
+        logging.info(f"Startup benchmark run {i + 1}: {json.dumps(runs[-1])}")
+
+    slowest_imports=sorted(import_times.items(), key=lambda item: item[1]["self_s"], reverse=True)[:10]
+    return {
+        "settings": {"repeat": repeat, "python": sys.version.split()[0]},
+        "runs": runs,
+        "median": {key: sorted(run[key] for run in runs)[len(runs) // 2] for key in runs[0]},
+        "slowest_imports": [{"module": module, **times} for module, times in slowest_imports]}
+
+#------------------------------------------------------------------------
+#Function for comparing the median of a measurement (default: the wall time) of a benchmark with a baseline report.
+#It returns False when the measurement grew by more than tolerance (a fraction of the baseline)
+def check_regression(report, baseline, tolerance=0.2, key="wall_time_s"):
+    current=report["median"][key]
+    reference=baseline["median"][key]
+    if current > reference * (1 + tolerance):
+        logging.error(f"Benchmark regression: median {key} {current}s is more than {tolerance:.0%} above the baseline {reference}s.")
+        return False
+    logging.info(f"Median {key} {current}s, baseline {reference}s.")
+    return True
+
+def main():
+    parser=argparse.ArgumentParser(description="Benchmark of the GATK pipeline with synthetic data and stand-in tools. It measures the startup, scheduling and shutdown overhead of the pipeline, the concurrency of the tools and the throughput. Arguments after -- are passed to run_gatk_pipe.py (e.g. -- --threads 4 --shards 4).")
+    parser.add_argument("--work_dir", default="benchmark_run", help="Directory of the synthetic data and the benchmark runs.")
+    parser.add_argument("--contigs", type=int, default=2, help="Number of contigs of the synthetic reference genome.")
+    parser.add_argument("--contig_length", type=int, default=100000, help="Length of every contig in bp.")
+    parser.add_argument("--depth", type=float, default=10, help="Sequencing depth of the simulated reads.")
+    parser.add_argument("--read_length", type=int, default=100, help="Length of the simulated reads.")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the random generator.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of pipeline runs (the report holds every run and the median).")
+    parser.add_argument("--latency", type=float, default=0.0, help="Latency of every stand-in tool invocation in seconds (0 measures the pure orchestration overhead).")
+    parser.add_argument("--seconds_per_mb", type=float, default=0.0, help="Additional latency of the stand-in tools per MB of input.")
+    parser.add_argument("--busy", action="store_true", help="Spend the latency on the CPU instead of sleeping.")
+    parser.add_argument("--report", default="benchmark_report.json", help="Path of the JSON benchmark report.")
+    parser.add_argument("--startup", action="store_true", help="Run the startup benchmark instead: the import time of the pipeline and the time of run_gatk_pipe.py --help in new interpreters (--repeat times). With --baseline, the median startup time is compared.")
+    parser.add_argument("--baseline", default=None, help="Benchmark report of an earlier run. The benchmark fails when the median wall time grew by more than --tolerance.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed growth of the median wall time compared to the baseline (fraction).")
+    parser.add_argument("pipeline_args", nargs=argparse.REMAINDER, help="Arguments passed to run_gatk_pipe.py.")
+    args=parser.parse_args()
+
+    logging.basicConfig(format="{asctime} - {levelname} - {message}", style="{", level=logging.INFO)
+    pipeline_args=args.pipeline_args[1:] if args.pipeline_args[:1] == ["--"] else args.pipeline_args
+
+    if args.startup:
+        report=run_startup_benchmark(args.work_dir, args.repeat)
+    else:
+        report=run_benchmark(args.work_dir, args.contigs, args.contig_length, args.depth, args.read_length, args.seed, args.repeat, pipeline_args, args.latency, args.seconds_per_mb, args.busy)
+    with open(args.report, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+    logging.info(f"Benchmark report written to '{args.report}': {json.dumps(report['median'])}")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            if not check_regression(report, json.load(baseline_file), args.tolerance, key="startup_s" if args.startup else "wall_time_s"):
+                sys.exit(1)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,228 @@
+import subprocess
+import functools
+import threading
+import hashlib
+import logging
+import shutil
+import json
+import time
+import re
+import os
+
+#Files smaller than this are always identified by their content (e.g. intervals files that are rewritten on every run)
+SMALL_FILE_BYTES=1 << 20
+
+#Commands for asking the version of the tools that do not support --version
+VERSION_COMMANDS={"bwa": ["bwa"]}
+
+#Options of the commands whose value does not change the outputs of the step: the temporary files of samtools sort and the JVM, temporary directory and PairHMM threads of GATK (they depend on the scratch directory and the resources of the run)
+EXECUTION_OPTIONS={("samtools", "sort"): {"-T"}, ("gatk",): {"--java-options", "--tmp-dir", "--native-pair-hmm-threads"}}
+
+#Files that the tools read next to an input file without it being on the command line (index files, the reference index, dictionary and bwa index), by the extension of the input file
+SIDECAR_SUFFIXES={".bam": [".bai"], ".cram": [".crai"], ".vcf.gz": [".tbi"], ".vcf": [".idx"], ".fasta": [".fai", ".amb", ".ann", ".bwt", ".pac", ".sa"]}
+
+#------------------------------------------------------------------------
+#Function for finding the sidecar files of an input file that exist (e.g. reference.fasta.fai and reference.dict of reference.fasta, sorted.bam.bai of sorted.bam)
+def sidecar_files(path):
+    name=path.removesuffix(".gz") if path.endswith((".fasta.gz", ".fa.gz")) else path
+    extension=".fasta" if name.endswith((".fasta", ".fa")) else next((extension for extension in SIDECAR_SUFFIXES if path.endswith(extension)), None)
+    if extension is None:
+        return []
+    candidates=[f"{path}{suffix}" for suffix in SIDECAR_SUFFIXES[extension]]
+    if extension == ".fasta":
+        candidates.append(f"{os.path.splitext(name)[0]}.dict")
+    return [candidate for candidate in candidates if os.path.isfile(candidate)]
+
+#------------------------------------------------------------------------
+#Function for finding the version of a tool.
+#It runs "tool --version" (or the command in VERSION_COMMANDS) once per process and returns the first line that mentions a version, or "unknown" when the tool cannot tell
+@functools.lru_cache(maxsize=None)
+def tool_version(tool):
+    command=VERSION_COMMANDS.get(os.path.basename(tool), [tool, "--version"])
+    try:
+        result=subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=120)
+    except (OSError, subprocess.TimeoutExpired):
+        return "unknown"
+
+    lines=[line.strip() for line in result.stdout.splitlines() if line.strip()]
+    for line in lines:
+        if re.search(r"version|v?\d+\.\d+", line, re.IGNORECASE):
+            return line
+    return lines[0] if lines else "unknown"
+
+#------------------------------------------------------------------------
+#Class for caching the outputs of the pipeline steps in a content-addressed store.
+#A step is identified by a key that is the hash of its command lines (where every input file is replaced by its identity, and the identity of its sidecar files like the .bai index or the reference .fai and .dict, and every output file by its position), and of the version of every tool in the command lines. The identity of an input file is its checksum when checksum is True or when the file is small, otherwise the device, inode, size and modification time of the file (so a renamed file keeps its identity, while a new file with the same name does not).
+#The outputs of a step are stored once per content under objects/ and hard linked into the working directory when the step is restored. The least recently used objects are removed when the store is bigger than max_bytes. The last use of an object is recorded in an empty file under used/ instead of the modification time of the object, since the object is the same inode as the restored output and a new modification time would change the identity of the output as input of the next steps.
+class StepCache:
+    def __init__(self, cache_dir, max_bytes, checksum=False):
+        self.cache_dir=cache_dir
+        self.max_bytes=max_bytes
+        self.checksum=checksum
+        self.objects_dir=os.path.join(cache_dir, "objects")
+        self.steps_dir=os.path.join(cache_dir, "steps")
+        self.used_dir=os.path.join(cache_dir, "used")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.steps_dir, exist_ok=True)
+        os.makedirs(self.used_dir, exist_ok=True)
+        self._digests={}
+        self._lock=threading.Lock()
+
+    #Function for hashing the content of a file in large blocks
+    @staticmethod
+    def file_checksum(path, block_size=8 << 20):
+        digest=hashlib.sha256()
+        with open(path, "rb") as handle:
+            for block in iter(lambda: handle.read(block_size), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    #Function for finding the identity of an input file. Checksums are remembered for as long as the file does not change
+    def file_identity(self, path):
+        stat=os.stat(path)
+        stat_identity=f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+        if not self.checksum and stat.st_size >= SMALL_FILE_BYTES:
+            return f"stat:{stat_identity}"
+
+        with self._lock:
+            digest=self._digests.get(stat_identity)
+        if digest is None:
+            digest=self.file_checksum(path)
+            with self._lock:
+                self._digests[stat_identity]=digest
+        return f"sha256:{digest}"
+
+    #Function for computing the key of a step
+    def step_key(self, commands, outputs):
+        output_paths=[os.path.abspath(output) for output in outputs]
+        key_parts=[]
+        for command in commands:
+            key_parts.append(f"{command[0]} {tool_version(command[0])}")
+            execution_options=set().union(*[options for prefix, options in EXECUTION_OPTIONS.items() if tuple(command[:len(prefix)]) == prefix])
+            for i, arg in enumerate(command):
+                arg=str(arg)
+                if i > 0 and command[i - 1] in execution_options:
+                    key_parts.append("<execution>")
+                elif os.path.abspath(arg) in output_paths:
+                    key_parts.append(f"<output:{output_paths.index(os.path.abspath(arg))}>")
+                elif os.path.isfile(arg):
+                    key_parts.append(f"<input:{self.file_identity(arg)}>")
+                    for sidecar in sidecar_files(arg):
+                        if os.path.abspath(sidecar) not in output_paths:
+                            key_parts.append(f"<sidecar:{self.file_identity(sidecar)}>")
+                else:
+                    key_parts.append(arg)
+            key_parts.append("|")
+        #Only the extension of the outputs is part of the key, since tools choose the output format from it
+        key_parts+=[f"<output:{i}:{os.path.basename(output).partition('.')[2]}>" for i, output in enumerate(outputs)]
+        return hashlib.sha256("\0".join(key_parts).encode()).hexdigest()
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _manifest_path(self, key):
+        return os.path.join(self.steps_dir, f"{key}.json")
+
+    def _used_path(self, digest):
+        return os.path.join(self.used_dir, digest)
+
+    #Function for recording the last use of an object
+    def _mark_used(self, digest):
+        with open(self._used_path(digest), "a"):
+            pass
+        os.utime(self._used_path(digest), None)
+
+    #Function for finding the last use of an object: the time it was last restored, or the time it was created
+    def _last_used(self, object_path, stat):
+        try:
+            return max(stat.st_mtime, os.stat(self._used_path(os.path.basename(object_path))).st_mtime)
+        except OSError:
+            return stat.st_mtime
+
+    #Function for replacing a file with a hard link to another file (or a copy when hard links are not possible)
+    @staticmethod
+    def _link(source, destination):
+        tmp_destination=f"{destination}.tmp{os.getpid()}.{threading.get_ident()}"
+        try:
+            os.link(source, tmp_destination)
+        except OSError:
+            shutil.copy2(source, tmp_destination)
+        os.replace(tmp_destination, destination)
+
+    #Function for restoring the outputs of a step. It returns True if every output was restored from the store
+    def restore(self, commands, outputs):
+        manifest_path=self._manifest_path(self.step_key(commands, outputs))
+        try:
+            with open(manifest_path) as manifest_file:
+                manifest=json.load(manifest_file)
+        except (OSError, ValueError):
+            return False
+
+        object_paths=[self._object_path(digest) for digest in manifest["objects"]]
+        if len(object_paths) != len(outputs) or not all(os.path.exists(path) for path in object_paths):
+            #Some objects were evicted, so the step has to run again
+            if os.path.exists(manifest_path):
+                os.remove(manifest_path)
+            return False
+
+        for digest, object_path, output in zip(manifest["objects"], object_paths, outputs):
+            if not (os.path.exists(output) and os.path.samefile(object_path, output)):
+                self._link(object_path, output)
+            self._mark_used(digest)
+        return True
+
+    #Function for removing the outputs of a step before it runs, so that the tools write new files instead of truncating files that are hard linked to the store
+    @staticmethod
+    def release(outputs):
+        for output in outputs:
+            if os.path.isfile(output):
+                os.remove(output)
+
+    #Function for adding the outputs of a step to the store
+    def store(self, commands, outputs):
+        missing_outputs=[output for output in outputs if not os.path.isfile(output)]
+        if missing_outputs:
+            logging.warning(f"Step outputs not cached because they were not created: {', '.join(missing_outputs)}")
+            return False
+
+        key=self.step_key(commands, outputs)
+        digests=[]
+        for output in outputs:
+            digest=self.file_checksum(output)
+            object_path=self._object_path(digest)
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            if not os.path.exists(object_path):
+                self._link(output, object_path)
+            else:
+                self._mark_used(digest)
+            digests.append(digest)
+
+        manifest={"commands": [[str(arg) for arg in command] for command in commands], "objects": digests, "created": time.time()}
+        tmp_manifest_path=f"{self._manifest_path(key)}.tmp{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_manifest_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(tmp_manifest_path, self._manifest_path(key))
+
+        self.evict()
+        return True
+
+    #Function for removing the least recently used objects until the store is smaller than max_bytes
+    def evict(self):
+        with self._lock:
+            objects=[]
+            for root, dirs, files in os.walk(self.objects_dir):
+                for name in files:
+                    path=os.path.join(root, name)
+                    stat=os.stat(path)
+                    objects.append((self._last_used(path, stat), stat.st_size, path))
+
+            total_bytes=sum(size for last_used, size, path in objects)
+            for last_used, size, path in sorted(objects):
+                if total_bytes <= self.max_bytes:
+                    break
+                os.remove(path)
+                used_path=self._used_path(os.path.basename(path))
+                if os.path.exists(used_path):
+                    os.remove(used_path)
+                total_bytes-=size
+                logging.info(f"Step cache object '{os.path.basename(path)}' evicted ({size} bytes).")
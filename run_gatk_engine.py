@@ -0,0 +1,317 @@
+from run_gatk_progress import start_progress, finish_progress
+import contextlib
+import collections
+import subprocess
+import itertools
+import threading
+import asyncio
+import logging
+import signal
+import time
+import os
+
+#Process engine of the pipeline.
+#All the tool processes of a run are supervised by one asyncio event loop, which runs in its own thread. The flows and tasks hand their commands to the engine and wait for the results, so dozens of concurrent shard or sample processes do not need one thread each for reading their stderr, enforcing their timeouts and collecting their exit status.
+#The engine reaps every process with os.wait4, so the resource usage of the tools can still be recorded.
+#The stderr lines of the tools with progress output (bwa mem, HaplotypeCaller, samtools sort) are also parsed by their progress tracker (run_gatk_progress.py)
+
+#Maximum number of tool processes running at the same time (default)
+MAX_PROCESSES=64
+
+#Seconds between SIGTERM and SIGKILL when a process is stopped
+KILL_GRACE_SECONDS=10
+
+#Seconds the stderr of a finished process is still read (a child process of the tool can keep it open)
+STDERR_DRAIN_SECONDS=5
+
+#Number of last stderr lines kept in the result of a process
+STDERR_TAIL_LINES=20
+
+#------------------------------------------------------------------------
+#Exception raised for a process that was stopped by the engine because another process of its pipe or process group failed (or that was not started at all for that reason)
+class ProcessCancelled(subprocess.SubprocessError):
+
+    def __init__(self, cmd, reason):
+        self.cmd=cmd
+        self.reason=reason
+
+    def __str__(self):
+        return f"Command '{self.cmd}' was cancelled: {self.reason}"
+
+#------------------------------------------------------------------------
+#Class for running the tool processes of the pipeline on one event loop.
+#A job is one command or a pipe of commands (the stdout of every command goes to the stdin of the next one). The engine starts at most max_processes processes at the same time and stops every process that runs longer than the timeout of its tool.
+#When a process of a job fails, the other processes of the job are stopped. Jobs can be put in a process group: when a job of the group fails, the running jobs of the group are stopped too and the later jobs of the group are not started
+class ProcessEngine:
+
+    def __init__(self, max_processes=MAX_PROCESSES, timeouts=None):
+        self.max_processes=max(1, max_processes)
+        self.timeouts=dict(timeouts or {})
+        self.loop=None
+        self.start_lock=threading.Lock()
+        self.running=[]
+        self.failed_groups={}
+        self.closed=None
+
+    #Function for starting the event loop thread of the engine (on first use)
+    def start(self):
+        with self.start_lock:
+            if self.loop is None:
+                self.loop=asyncio.new_event_loop()
+                self.slots=asyncio.Semaphore(self.max_processes)
+                self.spawn_lock=asyncio.Lock()
+                threading.Thread(target=self.loop.run_forever, name="process-engine", daemon=True).start()
+            return self.loop
+
+    #Function for stopping the event loop thread of the engine
+    def stop(self):
+        with self.start_lock:
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.loop=None
+
+    #Function for finding the timeout of a tool: the longest tool name prefix given in timeouts (the empty prefix is the default timeout)
+    def step_timeout(self, tool):
+        matches=[prefix for prefix in self.timeouts if tool.lower().startswith(prefix.lower())]
+        return self.timeouts[max(matches, key=len)] if matches else None
+
+    #Function for running a job and waiting for it (from any thread).
+    #It returns one result dictionary per command (command, tool, returncode, resource usage, start and end time, timed_out, cancelled, stderr_tail). It raises FileNotFoundError if a tool does not exist and ProcessCancelled if the job is not started because its process group failed
+    def run(self, commands, tools, stdout=None, group=None):
+        return asyncio.run_coroutine_threadsafe(self.run_job(commands, tools, stdout, group), self.start()).result()
+
+    #Function for stopping the running jobs of a process group (all the jobs when group is None) from any thread.
+    #The later jobs of the group are not started. Without group, no job is started anymore by this engine
+    def cancel(self, group=None, reason="the pipeline failed"):
+        with self.start_lock:
+            loop=self.loop
+        if loop is None:
+            self.closed=self.closed or reason
+        else:
+            loop.call_soon_threadsafe(self.cancel_jobs, group, reason)
+
+    #------------------------------------------------------------------------
+    #Functions that run on the event loop
+    async def run_job(self, commands, tools, stdout, group):
+        job={"group": group, "stages": []}
+        slots=min(len(commands), self.max_processes)
+
+        #The slots of all the processes of a pipe are taken together, so that two pipes never wait for each other
+        async with self.spawn_lock:
+            for i in range(slots):
+                await self.slots.acquire()
+        try:
+            reason=self.closed or self.failed_groups.get(group)
+            if reason:
+                raise ProcessCancelled(" | ".join(" ".join(str(arg) for arg in command) for command in commands), reason)
+
+            try:
+                self.spawn(job, commands, tools, stdout)
+            except OSError:
+                for stage in job["stages"]:
+                    self.send_signal(stage, signal.SIGKILL)
+                    stage["process"].stderr.close()
+                for stage in job["stages"]:
+                    await self.wait_exit(stage)
+                raise
+
+            self.running.append(job)
+            try:
+                await asyncio.gather(*(self.supervise(job, stage) for stage in job["stages"]))
+            finally:
+                self.running.remove(job)
+        finally:
+            for i in range(slots):
+                self.slots.release()
+
+        return [{key: value for key, value in stage.items() if key not in ("process", "progress")} for stage in job["stages"]]
+
+    #Function for starting the processes of a job, connected through OS pipes
+    def spawn(self, job, commands, tools, stdout):
+        previous_stdout=None
+        try:
+            for i, (command, tool) in enumerate(zip(commands, tools)):
+                process=subprocess.Popen(command, stdin=previous_stdout, stdout=stdout if i == len(commands) - 1 else subprocess.PIPE, stderr=subprocess.PIPE)
+                #Close the parent's copy of the pipe so the upstream tool gets SIGPIPE if the downstream tool dies
+                if previous_stdout is not None:
+                    previous_stdout.close()
+                previous_stdout=process.stdout
+                job["stages"].append({
+                    "command": command,
+                    "tool": tool,
+                    "process": process,
+                    "start_time": time.time(),
+                    "end_time": None,
+                    "returncode": None,
+                    "usage": None,
+                    "timeout": self.step_timeout(tool),
+                    "timed_out": False,
+                    "cancelled": None,
+                    "stderr_tail": collections.deque(maxlen=STDERR_TAIL_LINES),
+                    "progress": start_progress(command, tool, process.pid)})
+        finally:
+            if previous_stdout is not None:
+                previous_stdout.close()
+
+    #Function for supervising one process: its stderr is logged line by line, it is stopped when its timeout expires and its failure stops the other processes of its job and group
+    async def supervise(self, job, stage):
+        stderr_task=asyncio.ensure_future(self.stream_stderr(stage))
+        exit_task=asyncio.ensure_future(self.wait_exit(stage))
+
+        done, pending=await asyncio.wait([exit_task], timeout=stage["timeout"])
+        if not done:
+            stage["timed_out"]=True
+            logging.error(f"{stage['tool']} timed out after {stage['timeout']}s. Stopping it.")
+            self.terminate(stage)
+        await exit_task
+
+        if stage["returncode"] != 0 and not stage["cancelled"]:
+            reason=f"{stage['tool']} timed out" if stage["timed_out"] else f"{stage['tool']} failed with exit code {stage['returncode']}"
+            self.fail(job, reason)
+
+        done, pending=await asyncio.wait([stderr_task], timeout=STDERR_DRAIN_SECONDS)
+        for task in pending:
+            task.cancel()
+
+    #Function for logging the stderr of a process line by line while it runs
+    async def stream_stderr(self, stage):
+        reader=asyncio.StreamReader()
+        transport, protocol=await asyncio.get_running_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), stage["process"].stderr)
+        buffer=b""
+        try:
+            while True:
+                data=await reader.read(65536)
+                if not data:
+                    break
+                lines=(buffer + data).replace(b"\r", b"\n").split(b"\n")
+                buffer=lines.pop()
+                for line in lines:
+                    self.log_stderr(stage, line)
+            self.log_stderr(stage, buffer)
+        finally:
+            transport.close()
+
+    def log_stderr(self, stage, line):
+        text=line.decode(errors="replace").rstrip()
+        if text:
+            stage["stderr_tail"].append(text)
+            logging.info(f"{stage['tool']}: {text}")
+            if stage["progress"]:
+                stage["progress"].parse_line(text)
+
+    #Function for waiting for a process to exit without blocking the event loop.
+    #A pidfd of the process becomes readable when it exits, then os.wait4 reaps it and returns its resource usage. Without pidfd support the process is polled
+    async def wait_exit(self, stage):
+        process=stage["process"]
+        try:
+            pidfd=os.pidfd_open(process.pid)
+        except (AttributeError, OSError):
+            pidfd=None
+
+        if pidfd is not None:
+            loop=asyncio.get_running_loop()
+            exited=loop.create_future()
+            loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+            try:
+                await exited
+            finally:
+                loop.remove_reader(pidfd)
+                os.close(pidfd)
+            pid, status, usage=os.wait4(process.pid, 0)
+        else:
+            while True:
+                pid, status, usage=os.wait4(process.pid, os.WNOHANG)
+                if pid:
+                    break
+                await asyncio.sleep(0.05)
+
+        process.returncode=stage["returncode"]=os.waitstatus_to_exitcode(status)
+        stage["usage"]=usage
+        stage["end_time"]=time.time()
+        finish_progress(stage.get("progress"))
+
+    #Function for sending a signal to a process that was not reaped yet.
+    #Popen.send_signal is not used, because it polls the process and would reap it before os.wait4
+    def send_signal(self, stage, signal_number):
+        if stage["returncode"] is None:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(stage["process"].pid, signal_number)
+
+    #Function for stopping a process: SIGTERM first and SIGKILL if it is still running after KILL_GRACE_SECONDS
+    def terminate(self, stage):
+        self.send_signal(stage, signal.SIGTERM)
+        asyncio.get_running_loop().call_later(KILL_GRACE_SECONDS, self.send_signal, stage, signal.SIGKILL)
+
+    #Function for stopping the running processes of a job
+    def stop_job(self, job, reason):
+        for stage in job["stages"]:
+            if stage["returncode"] is None and not stage["timed_out"] and not stage["cancelled"]:
+                stage["cancelled"]=reason
+                self.terminate(stage)
+
+    #Function for handling a failed process: the other processes of its job and the jobs of its process group are stopped
+    def fail(self, job, reason):
+        self.stop_job(job, reason)
+        if job["group"] is not None and job["group"] not in self.failed_groups:
+            logging.error(f"Process group '{job['group']}' failed: {reason}. Stopping its other processes.")
+            self.cancel_jobs(job["group"], reason)
+
+    def cancel_jobs(self, group, reason):
+        if group is None:
+            self.closed=self.closed or reason
+        else:
+            self.failed_groups.setdefault(group, reason)
+        for job in list(self.running):
+            if group is None or job["group"] == group:
+                self.stop_job(job, reason)
+
+#------------------------------------------------------------------------
+#Function for raising the error of a process result like subprocess.run(command, check=True): subprocess.TimeoutExpired for a timed out process, ProcessCancelled for a process stopped by the engine and subprocess.CalledProcessError for a failed process
+def check_result(result):
+    if result["timed_out"]:
+        raise subprocess.TimeoutExpired(result["command"], result["timeout"], stderr="\n".join(result["stderr_tail"]))
+    if result["cancelled"]:
+        raise ProcessCancelled(result["command"], result["cancelled"])
+    if result["returncode"] != 0:
+        raise subprocess.CalledProcessError(result["returncode"], result["command"], stderr="\n".join(result["stderr_tail"]))
+
+#------------------------------------------------------------------------
+#Function for reading the --step_timeout values of the command line.
+#Every value is SECONDS (default timeout of all the tools) or TOOL=SECONDS (timeout of the tools whose name starts with TOOL, e.g. "GATK HaplotypeCaller=7200"). It raises a ValueError for an invalid value
+def parse_step_timeouts(values):
+    timeouts={}
+    for value in values or []:
+        tool, separator, seconds=value.rpartition("=")
+        timeouts[tool.strip()]=float(seconds)
+        if timeouts[tool.strip()] <= 0:
+            raise ValueError(f"Step timeout '{value}' is not a positive number of seconds")
+    return timeouts
+
+#------------------------------------------------------------------------
+#Process engine of the run
+PROCESS_ENGINE=ProcessEngine()
+PROCESS_GROUP_IDS=itertools.count(1)
+
+#------------------------------------------------------------------------
+#Function for configuring the process engine of the run (at the start of the run, before any tool runs)
+def configure_process_engine(max_processes=MAX_PROCESSES, timeouts=None):
+    global PROCESS_ENGINE
+    PROCESS_ENGINE.stop()
+    PROCESS_ENGINE=ProcessEngine(max_processes, timeouts)
+    logging.info(f"Process engine: at most {PROCESS_ENGINE.max_processes} tool processes at the same time, step timeouts: {PROCESS_ENGINE.timeouts or 'none'}.")
+    return PROCESS_ENGINE
+
+#------------------------------------------------------------------------
+#Function for running a command or a pipe of commands with the process engine of the run
+def run_processes(commands, tools, stdout=None, group=None):
+    return PROCESS_ENGINE.run(commands, tools, stdout=stdout, group=group)
+
+#------------------------------------------------------------------------
+#Function for stopping the processes of a process group (all the processes of the run when group is None)
+def cancel_processes(group=None, reason="the pipeline failed"):
+    PROCESS_ENGINE.cancel(group, reason)
+
+#------------------------------------------------------------------------
+#Function for creating a new process group name (unique in the run)
+def new_process_group(name):
+    return f"{name} #{next(PROCESS_GROUP_IDS)}"
@@ -1,40 +1,166 @@
+from run_gatk_cache import StepCache
+from run_gatk_metrics import *
+from run_gatk_integrity import *
+from run_gatk_workspace import *
+import contextlib
 import subprocess
+import itertools
 import logging
+import json
+import gzip
+import math
+import re
+import csv
 import os
 
+#Minimum number of N bases of a reference gap at which a contig can be cut into interval shards
+SPLIT_GAP_BASES=1000
+
+#Step cache of the run (None when the step cache is not used)
+STEP_CACHE=None
+
+#------------------------------------------------------------------------
+#Function for enabling the step cache of the run.
+#The cache lives in cache_dir and keeps at most max_bytes of step outputs. When checksum is True the input files are identified by their checksum instead of their file system identity
+def configure_step_cache(cache_dir, max_bytes, checksum=False):
+    global STEP_CACHE
+    STEP_CACHE=StepCache(cache_dir, max_bytes, checksum=checksum) if cache_dir else None
+    if STEP_CACHE:
+        logging.info(f"Step cache enabled in '{cache_dir}' (max {max_bytes} bytes).")
+    return STEP_CACHE
+
+#------------------------------------------------------------------------
+#Function for deciding if the output of a step can be used without running the step.
+#It checks that the output file exists (and is not empty when non_empty is True) and passes the integrity check of its file type, so that a file left behind by a crashed run is not reused. An invalid output file is removed (unless remove_invalid is False, e.g. for planning a run). When inputs are given, the output is also not used if one of them is newer (it was created again after the output, e.g. by a resumed run). The step cache is only used by the steps that run: their tool commands are restored from the cache when they were run before with the same input files, command line and tool version
+def output_ready(path, non_empty=False, inputs=None, remove_invalid=True):
+    if not (os.path.exists(path) and (not non_empty or os.path.getsize(path) > 0)):
+        return False
+
+    valid, reason=check_output(path)
+    if not valid:
+        logging.warning(f"Output file '{path}' is not valid: {reason}. Running its step again.")
+        if remove_invalid:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        return False
+
+    newer_inputs=[input_file for input_file in inputs or [] if os.path.isfile(input_file) and os.path.isfile(path) and os.path.getmtime(input_file) > os.path.getmtime(path)]
+    if newer_inputs:
+        logging.info(f"Output file '{path}' is older than its input files {', '.join(newer_inputs)}. Running its step again.")
+        return False
+    return True
+
+#------------------------------------------------------------------------
+#Functions for writing the outputs of a step atomically.
+#The tools write to partial files next to the outputs (.partial.<name>), which are renamed to the outputs only when the step succeeded. A killed or failed step therefore never leaves an incomplete output under its final name
+PARTIAL_PREFIX=".partial."
+
+def partial_path(path):
+    directory, name=os.path.split(path)
+    return os.path.join(directory, f"{PARTIAL_PREFIX}{name}")
+
+#Function for finding the partial file of every output and the commands that write to them.
+#Outputs that are arguments of the commands (or always_partial, like a redirected stdout) are replaced by their partial file. Outputs that tools write next to another output (e.g. the .tbi index of a -O file) get the partial name of that output. Other outputs are written in place
+def partial_outputs(commands, outputs, always_partial=()):
+    arguments={str(arg) for command in commands for arg in command}
+    partials={output: partial_path(output) for output in outputs or [] if output in arguments or output in always_partial}
+    for output in outputs or []:
+        if output not in partials:
+            for base in sorted(partials, key=len, reverse=True):
+                if output.startswith(base):
+                    partials[output]=partials[base] + output[len(base):]
+                    break
+    commands=[[partials.get(arg, arg) if isinstance(arg, str) else arg for arg in command] for command in commands]
+    return commands, partials
+
+#Function for renaming the partial files of a successful step to its outputs
+def commit_outputs(partials):
+    for output, partial in partials.items():
+        if os.path.exists(partial):
+            os.replace(partial, output)
+
+#Function for removing the partial files of a failed step (or of a crashed run before the step runs again)
+def discard_outputs(partials):
+    for partial in partials.values():
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(partial)
+
+#------------------------------------------------------------------------
+#Function for restoring the outputs of a step from the step cache.
+#It returns True if the outputs were restored. Otherwise it removes the old outputs, so that the tools never write into files shared with the cache
+def restore_step_outputs(commands, outputs, tool):
+    if not STEP_CACHE or not outputs:
+        return False
+    if STEP_CACHE.restore(commands, outputs):
+        logging.info(f"------------------{tool} analysis-----------------")
+        logging.info(f"{tool} outputs restored from the step cache: {', '.join(outputs)}")
+        record_cached_step(commands, tool, outputs)
+        return True
+    STEP_CACHE.release(outputs)
+    return False
+
+#------------------------------------------------------------------------
+#Function for adding the outputs of a successful step to the step cache
+def store_step_outputs(commands, outputs):
+    if STEP_CACHE and outputs:
+        STEP_CACHE.store(commands, outputs)
+
+#------------------------------------------------------------------------
+#Function for logging why a step failed
+def log_step_error(command, error):
+    if isinstance(error, subprocess.CalledProcessError):
+        logging.error(f"Command failed: {command}. Error code: {error.returncode}")
+    elif isinstance(error, subprocess.TimeoutExpired):
+        logging.error(f"Command timed out after {error.timeout}s: {command}")
+    elif isinstance(error, ProcessCancelled):
+        logging.error(f"Command cancelled: {command}. Reason: {error.reason}")
+    else:
+        logging.error(f"Tool not found for command: {command}")
+
 #------------------------------------------------------------------------
 #Function for handling the subprocess operations.
-#This function executes a subprocess command and logs the analysis progress
-def run_subprocess(command, tool):
+#This function executes a subprocess command with the process engine, records its resource usage and logs the analysis progress (the stderr of the tool goes to the log line by line)
+#The output files of the command can be given with outputs, so that the step cache can restore them instead of running the command. The command can be put in a process group with process_group: when another command of the group fails, this one is stopped or not started
+def run_subprocess(command, tool, outputs=None, process_group=None):
+    if restore_step_outputs([command], outputs, tool):
+        return True
+    (partial_command,), partials=partial_outputs([command], outputs)
+    discard_outputs(partials)
     try:
         logging.info(f"------------------{tool} analysis starts-----------------")
-        subprocess.run(command, check=True)
+        run_measured(partial_command, tool, outputs=[partials.get(output, output) for output in outputs or []] or None, group=process_group)
+        commit_outputs(partials)
+        store_step_outputs([command], outputs)
         logging.info(f"{tool} completed successfully")
         logging.info(f"------------------{tool} analysis ends-----------------")
         return True
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Command failed: {command}. Error code: {e.returncode}")
-        return False
-    except FileNotFoundError:
-        logging.error(f"Tool not found for command: {command}")
+    except (subprocess.SubprocessError, FileNotFoundError) as e:
+        log_step_error(command, e)
+        discard_outputs(partials)
         return False
 
 #------------------------------------------------------------------------
 #Function for handling the subprocess operations.
-#This function executes a subprocess command that has to return an output file and logs the analysis progress
+#This function executes a subprocess command that has to return an output file, records its resource usage and logs the analysis progress
+#The output is written to a partial file, which is renamed to out_file only when the command succeeded
 def run_subprocess_out_file(command, out_file, tool, out_name):
-    with open(out_file, "w") as out_name:
+    if restore_step_outputs([command], [out_file], tool):
+        return True
+    (partial_command,), partials=partial_outputs([command], [out_file], always_partial=[out_file])
+    discard_outputs(partials)
+    with open(partials[out_file], "w") as out_name:
         try:
             logging.info(f"------------------{tool} analysis starts-----------------")
-            subprocess.run(command, stdout=out_name, check=True)
+            run_measured(partial_command, tool, outputs=[partials[out_file]], stdout=out_name)
             logging.info(f"{tool} completed successfully")
             logging.info(f"------------------{tool} analysis ends-----------------")
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Command failed: {command}. Error code: {e.returncode}")
-            return False
-        except FileNotFoundError:
-            logging.error(f"Tool not found for command: {command}")
+        except (subprocess.SubprocessError, FileNotFoundError) as e:
+            log_step_error(command, e)
+            discard_outputs(partials)
             return False
+    commit_outputs(partials)
+    store_step_outputs([command], [out_file])
+    return True
 
 #------------------------------------------------------------------------
 #Function for removing the extension in either .fastq.gz or .fq.gz files
@@ -42,3 +168,324 @@ def remove_extension(filename):
     base=os.path.basename(filename)
     if base.endswith(".fastq.gz"):
         return base[:-9]
+
+#------------------------------------------------------------------------
+#Function for handling chained subprocess operations.
+#This function connects the stdout of every command to the stdin of the next one through OS pipes (like "cmd1 | cmd2" in bash), so no intermediate files are written to disk. The stdout of the last command is written to out_file when given. Every stage is checked separately and each failing stage is logged with its own error code. When a stage fails, the process engine stops the other stages right away.
+#The output files of the pipe (out_file is always one of them) can be given with outputs for the step cache
+def run_subprocess_pipe(commands, tools, out_file=None, outputs=None, process_group=None):
+    pipe_name=" | ".join(tools)
+    outputs=list(outputs or [])
+    if out_file and out_file not in outputs:
+        outputs.append(out_file)
+    if restore_step_outputs(commands, outputs, pipe_name):
+        return True
+    partial_commands, partials=partial_outputs(commands, outputs, always_partial=[out_file] if out_file else [])
+    discard_outputs(partials)
+    out_handle=open(partials[out_file], "wb") if out_file else None
+    try:
+        logging.info(f"------------------{pipe_name} analysis starts-----------------")
+        results=run_processes(partial_commands, tools, stdout=out_handle, group=process_group)
+    except (ProcessCancelled, FileNotFoundError) as e:
+        log_step_error(" | ".join(" ".join(command) for command in commands), e)
+        discard_outputs(partials)
+        return False
+    finally:
+        if out_handle:
+            out_handle.close()
+
+    success=True
+    for i, result in enumerate(results):
+        record_process_metrics(result, [partials.get(output, output) for output in outputs] if i == len(results) - 1 else None)
+        if result["timed_out"]:
+            logging.error(f"{result['tool']} timed out in pipe after {result['timeout']}s. Command: {result['command']}")
+            success=False
+        elif result["cancelled"]:
+            logging.error(f"{result['tool']} stopped in pipe: {result['cancelled']}. Command: {result['command']}")
+            success=False
+        elif result["returncode"] != 0:
+            logging.error(f"{result['tool']} failed in pipe. Command failed: {result['command']}. Error code: {result['returncode']}")
+            success=False
+
+    if success:
+        commit_outputs(partials)
+        store_step_outputs(commands, outputs)
+        logging.info(f"{pipe_name} completed successfully")
+        logging.info(f"------------------{pipe_name} analysis ends-----------------")
+    else:
+        discard_outputs(partials)
+    return success
+
+#------------------------------------------------------------------------
+#Function for finding the gaps (runs of at least min_gap N bases) of a contig of the reference genome.
+#The contig is read from the FASTA file in blocks of lines with the offset and line lengths of its .fai entry (fields), so only the contigs that are searched are read. It returns the gaps as (start, end) pairs, 1-based and inclusive, or no gaps when the FASTA file does not exist
+def reference_gaps(reference_genome, fields, min_gap):
+    if not os.path.exists(reference_genome):
+        return []
+    length, offset, line_bases, line_width=(int(field) for field in fields[1:5])
+    lines=-(-length // line_bases)
+    opener=gzip.open if reference_genome.endswith(".gz") else open
+
+    gaps=[]
+    gap_start=None
+    position=0
+    with opener(reference_genome, "rb") as fasta:
+        fasta.seek(offset)
+        while position < length:
+            block=fasta.read(min(lines, 1 << 16) * line_width).replace(b"\n", b"").replace(b"\r", b"")[:length - position]
+            if not block:
+                break
+            #A gap of the previous block ends where this block does not start with N
+            if gap_start is not None and block[:1] not in (b"N", b"n"):
+                gaps.append((gap_start, position))
+                gap_start=None
+            for run in re.finditer(rb"[Nn]+", block):
+                if gap_start is None:
+                    gap_start=position + run.start() + 1
+                if run.end() < len(block):
+                    gaps.append((gap_start, position + run.end()))
+                    gap_start=None
+            position+=len(block)
+    if gap_start is not None:
+        gaps.append((gap_start, position))
+    return [(start, end) for start, end in gaps if end - start + 1 >= min_gap]
+
+#------------------------------------------------------------------------
+#Function for splitting the reference genome into balanced interval shards.
+#It reads the contig lengths from the reference .fai file and puts whole contigs into shards of (almost) equal total length, keeping the reference order (GatherVcfs needs the shards in genomic order). A contig longer than a shard is only cut in the middle of a gap of at least min_gap N bases of the reference FASTA file (next to the .fai file), where no read aligns, so no variant is called twice or missed at the cut. A long contig without such a gap stays whole.
+#Every shard is returned as a list of GATK style intervals (contig:start-end, 1-based and inclusive)
+def split_reference_intervals(reference_genome_index, shards, min_gap=SPLIT_GAP_BASES):
+    contigs=[]
+    with open(reference_genome_index) as fai:
+        for line in fai:
+            fields=line.rstrip("\n").split("\t")
+            if len(fields) >= 5:
+                contigs.append(fields)
+
+    total_length=sum(int(fields[1]) for fields in contigs)
+    shards=max(1, min(shards, total_length))
+    shard_size=total_length / shards
+
+    #Cut the contigs that are longer than a shard at the gaps closest to shard size pieces
+    pieces=[]
+    for fields in contigs:
+        contig, length=fields[0], int(fields[1])
+        cuts=[]
+        if length > shard_size:
+            gaps=reference_gaps(reference_genome_index.removesuffix(".fai"), fields, min_gap)
+            targets=[length * i / math.ceil(length / shard_size) for i in range(1, math.ceil(length / shard_size))]
+            cuts=sorted({min(((start + end) // 2 for start, end in gaps), key=lambda cut: abs(cut - target)) for target in targets} if gaps else set())
+        bounds=[1, *cuts, length + 1]
+        pieces.extend((contig, start, end - 1) for start, end in zip(bounds, bounds[1:]))
+
+    #Every piece goes to the shard that holds its middle base
+    shard_intervals=[[] for i in range(shards)]
+    filled=0
+    for contig, start, end in pieces:
+        shard=min(shards - 1, int((filled + (end - start + 1) / 2) // shard_size))
+        shard_intervals[shard].append(f"{contig}:{start}-{end}")
+        filled+=end - start + 1
+
+    return [intervals for intervals in shard_intervals if intervals]
+
+#------------------------------------------------------------------------
+#Function for writing a list of intervals to a GATK .intervals file (one contig:start-end per line)
+def write_intervals_file(intervals, out_intervals_file):
+    with open(out_intervals_file, "w") as out_intervals:
+        for interval in intervals:
+            out_intervals.write(f"{interval}\n")
+
+#------------------------------------------------------------------------
+#Function for removing the files of a directory whose name starts with prefix (and their partial files), e.g. the shards or chunks of an earlier split
+def remove_split_files(directory, prefix):
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        path=os.path.join(directory, name)
+        if name.startswith((prefix, f"{PARTIAL_PREFIX}{prefix}")) and os.path.isfile(path):
+            os.remove(path)
+
+#------------------------------------------------------------------------
+#Function for writing the intervals files of the HaplotypeCaller shards.
+#The intervals of every shard are written to shard_XXXX.intervals in shard_dir and listed in the shards.json file written at the end. When shard_dir already has the shards of the same intervals, the files are kept, so their shard VCF files can be reused. Otherwise (other shard count, other reference or an interrupted split) the files of the earlier shards are removed first, so that no shard VCF file of other intervals is gathered.
+#It returns the list of intervals files
+def write_shard_intervals(shard_intervals, shard_dir):
+    intervals_files=[os.path.join(shard_dir, f"shard_{i:04d}.intervals") for i in range(1, len(shard_intervals) + 1)]
+    shards_json=os.path.join(shard_dir, "shards.json")
+
+    if os.path.exists(shards_json):
+        with open(shards_json) as shards_file:
+            done=json.load(shards_file)
+        if done.get("intervals") == shard_intervals and all(os.path.exists(intervals_file) for intervals_file in intervals_files):
+            logging.info(f"Interval shards in '{shard_dir}' already exist. Keeping their shard VCF files.")
+            return intervals_files
+        os.remove(shards_json)
+
+    os.makedirs(shard_dir, exist_ok=True)
+    remove_split_files(shard_dir, "shard_")
+    for intervals, intervals_file in zip(shard_intervals, intervals_files):
+        write_intervals_file(intervals, intervals_file)
+    with open(shards_json, "w") as shards_file:
+        json.dump({"intervals": shard_intervals}, shards_file)
+    return intervals_files
+
+
+#------------------------------------------------------------------------
+#Function for building the bwa mem read group line of a sample
+def build_read_group(sample, read_group_id, library="lib1", platform="ILLUMINA", platform_unit="unit1"):
+    return f"@RG\\tID:{read_group_id}\\tSM:{sample}\\tLB:{library}\\tPL:{platform}\\tPU:{platform_unit}"
+
+#------------------------------------------------------------------------
+#Function for reading the duplication metrics written by samtools markdup -f (lines of "NAME: value").
+#It returns a dictionary of the counts with the duplication rate (duplicate primary reads / examined reads) and logs the rate
+def read_duplicate_metrics(metrics_file):
+    metrics={}
+    with open(metrics_file) as metrics_lines:
+        for line in metrics_lines:
+            name, separator, value=line.partition(":")
+            if separator and value.strip().isdigit():
+                metrics[name.strip()]=int(value)
+
+    examined=metrics.get("EXAMINED", 0)
+    metrics["DUPLICATION RATE"]=round(metrics.get("DUPLICATE PRIMARY TOTAL", 0) / examined, 6) if examined else 0.0
+    logging.info(f"Duplicate marking of '{metrics_file}': {metrics.get('DUPLICATE PRIMARY TOTAL', 0)} of {examined} reads are duplicates (duplication rate {metrics['DUPLICATION RATE']:.2%}).")
+    return metrics
+
+#------------------------------------------------------------------------
+#Function for reading the sample sheet of a cohort.
+#The sample sheet is a tab separated file with a header line and the columns sample, fastq1 and fastq2 (one line per sample).
+#With the optional lane column, every line is one sequencing lane of a sample (a sample has one line per lane) and the samples are returned with their lanes ({"sample": ..., "lanes": [{"lane": ..., "fastq1": ..., "fastq2": ...}, ...]}).
+#It returns a list of dictionaries, one per sample, and raises a ValueError if a column is missing or a sample name (or the lane of a sample) is used twice
+def read_sample_sheet(sample_sheet):
+    with open(sample_sheet, newline="") as sheet:
+        reader=csv.DictReader(sheet, delimiter="\t")
+        missing_columns={"sample", "fastq1", "fastq2"} - set(reader.fieldnames or [])
+        if missing_columns:
+            raise ValueError(f"Sample sheet '{sample_sheet}' is missing the columns: {', '.join(sorted(missing_columns))}")
+        samples=[{key: value.strip() for key, value in row.items() if key} for row in reader if any(row.values())]
+
+    row_keys=[(sample["sample"], sample.get("lane", "")) for sample in samples]
+    duplicates=sorted(set(" ".join(key).strip() for key in row_keys if row_keys.count(key) > 1))
+    if duplicates:
+        raise ValueError(f"Sample sheet '{sample_sheet}' has duplicate samples: {', '.join(duplicates)}")
+
+    if "lane" not in reader.fieldnames:
+        return samples
+
+    #Group the lanes of every sample (in the order of the sample sheet)
+    lane_samples={}
+    for row in samples:
+        if not row["lane"] or os.sep in row["lane"]:
+            raise ValueError(f"Sample sheet '{sample_sheet}' has an invalid lane '{row['lane']}' for sample '{row['sample']}'")
+        lane_samples.setdefault(row["sample"], {"sample": row["sample"], "lanes": []})["lanes"].append({"lane": row["lane"], "fastq1": row["fastq1"], "fastq2": row["fastq2"]})
+    return list(lane_samples.values())
+
+#------------------------------------------------------------------------
+#Functions for the lane manifest of a sample alignment file (<alignment file>.lanes.json), which lists the lanes merged into the alignment file.
+#A lane that is not in the manifest is merged into the existing alignment file without aligning the other lanes again
+def lane_manifest_path(bam_sorted):
+    return f"{bam_sorted}.lanes.json"
+
+def read_lane_manifest(bam_sorted):
+    try:
+        with open(lane_manifest_path(bam_sorted)) as manifest:
+            return json.load(manifest)["lanes"]
+    except (OSError, ValueError, KeyError):
+        return []
+
+def write_lane_manifest(bam_sorted, lanes):
+    manifest_file=lane_manifest_path(bam_sorted)
+    with open(f"{manifest_file}.tmp", "w") as manifest:
+        json.dump({"alignment": os.path.basename(bam_sorted), "lanes": list(lanes)}, manifest, indent=2)
+    os.replace(f"{manifest_file}.tmp", manifest_file)
+
+#------------------------------------------------------------------------
+#Function for opening a FASTQ file (gzipped or not) for reading in binary mode
+def open_fastq(fastq):
+    if fastq.endswith(".gz"):
+        return gzip.open(fastq, "rb")
+    return open(fastq, "rb")
+
+#------------------------------------------------------------------------
+#Function for finding the read name in a FASTQ header line (without the /1 or /2 mate suffix)
+def fastq_read_name(header):
+    name=header.split()[0] if header.strip() else b""
+    if name.endswith((b"/1", b"/2")):
+        name=name[:-2]
+    return name
+
+#------------------------------------------------------------------------
+#Function for splitting a pair of FASTQ files into read-aligned chunks.
+#The two files are read together in batches of batch_reads reads and the batches are written round-robin into chunks gzipped chunk pairs (fast compression), so every chunk gets the same reads from both files and about the same number of reads. The read names of the mates are checked at the start and the end of every batch.
+#When the chunk_dir already has the chunks of the same input files (checked with the chunks.json file written at the end), the splitting is skipped. Otherwise the files of the earlier chunks (also their sorted BAM files) are removed first, so that no alignment of other reads is merged. It returns the list of chunk pairs
+def split_fastq_pair(fastq_1, fastq_2, chunk_dir, chunks, batch_reads=100000):
+    chunk_pairs=[(os.path.join(chunk_dir, f"chunk_{i:04d}_1.fastq.gz"), os.path.join(chunk_dir, f"chunk_{i:04d}_2.fastq.gz")) for i in range(1, chunks + 1)]
+    inputs=[[os.path.abspath(fastq), os.path.getsize(fastq), os.stat(fastq).st_mtime_ns] for fastq in [fastq_1, fastq_2]]
+    chunks_json=os.path.join(chunk_dir, "chunks.json")
+
+    if os.path.exists(chunks_json):
+        with open(chunks_json) as chunks_file:
+            done=json.load(chunks_file)
+        if done.get("inputs") == inputs and done.get("chunks") == chunks and all(os.path.exists(chunk) for pair in chunk_pairs for chunk in pair):
+            logging.info(f"FASTQ chunks in '{chunk_dir}' already exist. Skipping the splitting of the FASTQ files.")
+            return chunk_pairs
+        os.remove(chunks_json)
+
+    os.makedirs(chunk_dir, exist_ok=True)
+    remove_split_files(chunk_dir, "chunk_")
+    logging.info(f"------------------Splitting FASTQ files into {chunks} chunks starts-----------------")
+    reads=0
+    with contextlib.ExitStack() as stack:
+        in_1=stack.enter_context(open_fastq(fastq_1))
+        in_2=stack.enter_context(open_fastq(fastq_2))
+        outs=[(stack.enter_context(gzip.open(chunk_1, "wb", compresslevel=1)), stack.enter_context(gzip.open(chunk_2, "wb", compresslevel=1))) for chunk_1, chunk_2 in chunk_pairs]
+
+        for batch in itertools.count():
+            lines_1=list(itertools.islice(in_1, 4 * batch_reads))
+            lines_2=list(itertools.islice(in_2, 4 * batch_reads))
+            if len(lines_1) != len(lines_2) or len(lines_1) % 4:
+                raise ValueError(f"FASTQ files '{fastq_1}' and '{fastq_2}' do not have the same number of reads.")
+            if not lines_1:
+                break
+            for header_index in [0, len(lines_1) - 4]:
+                if fastq_read_name(lines_1[header_index]) != fastq_read_name(lines_2[header_index]):
+                    raise ValueError(f"FASTQ files '{fastq_1}' and '{fastq_2}' are not paired: read '{lines_1[header_index].strip().decode()}' has mate '{lines_2[header_index].strip().decode()}'.")
+            out_1, out_2=outs[batch % chunks]
+            out_1.write(b"".join(lines_1))
+            out_2.write(b"".join(lines_2))
+            reads+=len(lines_1) // 4
+
+    with open(chunks_json, "w") as chunks_file:
+        json.dump({"inputs": inputs, "chunks": chunks, "reads": reads}, chunks_file)
+    logging.info(f"{reads} read pairs split into {chunks} chunks.")
+    logging.info(f"------------------Splitting FASTQ files ends-----------------")
+
+    return chunk_pairs
+
+#------------------------------------------------------------------------
+#Function for finding the critical path of a run.
+#stage_times has the start and end time of every stage and dependencies the stages every stage waits for. The path starts at the stage that ended last and goes back through the dependency that ended last, which is the one that held the stage back
+def critical_path(stage_times, dependencies):
+    if not stage_times:
+        return []
+    path=[max(stage_times, key=lambda stage: stage_times[stage]["end"])]
+    while True:
+        finished_dependencies=[stage for stage in dependencies.get(path[0], []) if stage in stage_times]
+        if not finished_dependencies:
+            return path
+        path.insert(0, max(finished_dependencies, key=lambda stage: stage_times[stage]["end"]))
+
+#------------------------------------------------------------------------
+#Function for logging the timeline of the stages of a run and its critical path
+def log_critical_path(stage_times, dependencies):
+    if not stage_times:
+        return
+    run_start=min(times["start"] for times in stage_times.values())
+    logging.info(f"------------------Pipeline stages-----------------")
+    for stage, times in sorted(stage_times.items(), key=lambda item: item[1]["start"]):
+        waits_for=", ".join(dependencies.get(stage, [])) or "-"
+        logging.info(f"{stage}: starts at {times['start'] - run_start:.1f}s, ends at {times['end'] - run_start:.1f}s ({times['end'] - times['start']:.1f}s), waits for: {waits_for}")
+
+    path=critical_path(stage_times, dependencies)
+    path_stages=" -> ".join(f"{stage} ({stage_times[stage]['end'] - stage_times[stage]['start']:.1f}s)" for stage in path)
+    logging.info(f"Critical path: {path_stages}, total {stage_times[path[-1]]['end'] - run_start:.1f}s")
@@ -1,7 +1,7 @@
 from run_gatk_tasks import *
 from run_gatk_extras import *
-from prefect import flow
-from prefect.task_runners import ThreadPoolTaskRunner
+from run_gatk_orchestration import flow, task, ThreadPoolTaskRunner, NONE
+import time
 import os
 
 #------------------------------------------------------------------------
@@ -13,7 +13,7 @@ import os
 def run_fastqc(fastq_1, fastq_2):
 
     #Check if output dir exists and if not, create it
-    fastqc_output_dir="fastqc_results"
+    fastqc_output_dir=work_path("fastqc_results")
     if not os.path.exists(fastqc_output_dir):
         os.makedirs(fastqc_output_dir)
         logging.info(f"Directory for FASTQC results, created.")
@@ -30,76 +30,377 @@ def run_fastqc(fastq_1, fastq_2):
     fastq_2_html=os.path.join(fastqc_output_dir, f"{fastq_2_base}_fastqc.html")
 
     #Check if FASTQC output files already exist
-    if all(os.path.exists(f) for f in [fastq_1_zip, fastq_1_html, fastq_2_zip, fastq_2_html]):
+    if all(output_ready(f) for f in [fastq_1_zip, fastq_1_html, fastq_2_zip, fastq_2_html]):
         logging.info (f"------------------FASTQC quality check-----------------")
         logging.info(f"FASTQC output files for {fastq_1} and {fastq_2} already exist. Skipping FASTQC analysis.")
     else:
-        fastqc_command=["fastqc", fastq_1, fastq_2, "-o", str(fastqc_output_dir)]
-        run_subprocess(fastqc_command, tool="FASTQC")
+        fastqc_resources=allocate("fastqc")
+        fastqc_command=["fastqc", "-t", str(fastqc_resources["threads"]), fastq_1, fastq_2, "-o", str(fastqc_output_dir)]
+        with reserve_resources(**fastqc_resources):
+            if not run_subprocess(fastqc_command, tool="FASTQC", outputs=[fastq_1_zip, fastq_1_html, fastq_2_zip, fastq_2_html]):
+                raise RuntimeError(f"FASTQC of '{fastq_1}' and '{fastq_2}' failed.")
+
+#------------------------------------------------------------------------
+#Function for the native quality control of the paired reads.
+#Input: Paired raw reads  (*_1.fastq.gz)-(*_2.fastq.gz)-- Output: *_qc.json
+#This prefect flow is the built-in alternative to run_fastqc. It streams both FASTQ files once and computes the per position quality, GC content, N content, length distribution and read pair consistency with NumPy in worker processes (workers processes, default: the cores the resource budget gives it), with bounded memory. The JSON report is written to qc_results/<fastq_1 name>_qc.json in the work directory and the step is skipped when the report already exists and is newer than both FASTQ files
+@flow
+def run_native_qc(fastq_1, fastq_2, workers=None, qc_output_dir=None):
+
+    qc_output_dir=qc_output_dir or work_path("qc_results")
+    os.makedirs(qc_output_dir, exist_ok=True)
+    qc_report=os.path.join(qc_output_dir, f"{remove_extension(fastq_1) or os.path.basename(fastq_1)}_qc.json")
+
+    if output_ready(qc_report, non_empty=True, inputs=[fastq_1, fastq_2]):
+        logging.info (f"------------------Native QC-----------------")
+        logging.info(f"Native QC report '{qc_report}' already exists. Skipping the native QC analysis.")
+        return qc_report
+
+    #NumPy is only imported by runs that use the native QC
+    from run_gatk_qc import run_fastq_qc
+
+    qc_resources=allocate("native qc", cores=workers)
+    logging.info (f"------------------Native QC analysis starts-----------------")
+    with reserve_resources(**qc_resources):
+        run_fastq_qc(fastq_1, fastq_2, qc_report, workers=qc_resources["threads"])
+    logging.info (f"------------------Native QC analysis ends-----------------")
+    return qc_report
+
+#------------------------------------------------------------------------
+#Function for validating the input files before the long steps of the run start.
+#Input: Pairs of FASTQ files, reference genome (*.fasta) and its index, dictionary and bwa index when they exist -- Output: None (the scans of the valid files are cached in cache_file)
+#This prefect flow streams every input file once in worker processes (workers processes, default: the cores the resource budget gives it, at most one per file): gzip/BGZF integrity and format of the FASTQ and FASTA files, same read counts and read names in both files of a pair, and a reference index, dictionary and bwa index that match the reference genome. It raises a RuntimeError listing the invalid inputs, so the run stops before aligning a truncated FASTQ file
+@flow
+def run_preflight(fastq_pairs, ref_genome, workers=None, cache_file=None):
+
+    from run_gatk_preflight import preflight_inputs
+
+    preflight_resources=allocate("preflight", cores=workers)
+    logging.info (f"------------------Pre-flight validation starts-----------------")
+    with reserve_resources(**preflight_resources):
+        report=preflight_inputs(fastq_pairs, ref_genome, workers=preflight_resources["threads"], cache_file=cache_file)
+    record_run_metric("preflight_wall_time_s", report["wall_time_s"])
+
+    for error in report["errors"]:
+        logging.error(error)
+    if report["errors"]:
+        raise RuntimeError(f"Pre-flight validation found {len(report['errors'])} invalid inputs: {' '.join(report['errors'])}")
+    logging.info(f"Pre-flight validation of {report['files']} input files done in {report['wall_time_s']}s ({report['scanned']} scanned, {report['cached']} from the pre-flight cache).")
+    logging.info (f"------------------Pre-flight validation ends-----------------")
+    return report
 
 #------------------------------------------------------------------------
 #Function for aligning the paired reads with a reference genome.
 #The Bwa mem tool is being used.
 #Input: Paired raw reads, reference genome (*.fasta) -- Output: *.SAM, *.BAM, *_sorted.BAM
 #This prefect flow initially checks if the the .SAM output file is present. If not, it proceeds with running the bwa mem alignment. Moreover, it calls 2 external tasks (convert_sam_to_bam and sort_bam to perfom some basic operations to the alignment output files. Both of these 2 functions only run if the correct output files are not present) 
+#The read group of the alignment can be given with read_group_info (default: the NA12878 read group of the exercise data).
+#When stream is True, the bwa mem output is piped straight into a multi-threaded samtools sort, so only the sorted BAM is written to disk (no SAM or unsorted BAM intermediates)
+#When chunks is bigger than 1, the reads are aligned in chunks by the run_bwa_sharded flow, which also writes only the sorted BAM.
+#When mark_duplicates is True, the duplicates are marked in the alignment stream (bwa mem | samtools fixmate -m | samtools sort | samtools markdup), so the analysis-ready BAM is written to disk only once, and the duplication metrics are written to dup_metrics. This always streams, also without stream.
+#When bam_sorted is a .cram file, the final alignment is written as CRAM, compressed against the reference genome, instead of BAM. This also always streams, so no SAM or unsorted BAM file is written. compression_threads sets the threads of the samtools command that writes (and compresses) the final alignment file (default: its share of the threads).
+#The SAM and unsorted BAM files are intermediates: each one is removed once the next step read it, and the temporary files of samtools sort are written to the scratch directory of the run.
+#The tools of the flow share the given threads, and their memory is reserved from the resource budget of the run
 @flow
-def run_bwa(fastq_1, fastq_2, ref_genome, threads, out_sam="gatk_pipeline.sam", bam="gatk_pipeline.bam", bam_sorted="gatk_pipeline_sorted.bam"):
+def run_bwa(fastq_1, fastq_2, ref_genome, threads, out_sam="gatk_pipeline.sam", bam="gatk_pipeline.bam", bam_sorted="gatk_pipeline_sorted.bam", stream=False, read_group_info=None, chunks=1, mark_duplicates=False, dup_metrics="gatk_pipeline_markdup_metrics.txt", compression_threads=None):
+
+    if read_group_info is None:
+        read_group_info=build_read_group("NA12878", "gatk_exercise")
+    bwa_command = ["bwa", "mem", "-t", str(threads), "-R", read_group_info, ref_genome, fastq_1, fastq_2]
+    bwa_memory_mb=allocate("bwa mem", cores=threads)["memory_mb"]
+    sort_resources=allocate("samtools sort", cores=threads)
+
+    #Run Bwa mem on chunks of the reads
+    if chunks > 1:
+        if output_ready(bam_sorted) and (not mark_duplicates or output_ready(dup_metrics)):
+            logging.info (f"------------------BWA mem sharded alignment-----------------")
+            logging.info(f"Output sorted BAM file '{bam_sorted}' already exists. Skipping the sharded alignment process.")
+        elif not run_bwa_sharded(fastq_1, fastq_2, ref_genome, threads, bam_sorted, chunks, read_group_info, mark_duplicates=mark_duplicates, dup_metrics=dup_metrics, compression_threads=compression_threads):
+            raise RuntimeError(f"Sharded alignment of '{fastq_1}' and '{fastq_2}' failed.")
+        if mark_duplicates:
+            read_duplicate_metrics(dup_metrics)
+        return
+
+    #Run Bwa mem piped into the duplicate marking
+    if mark_duplicates:
+        if output_ready(bam_sorted) and output_ready(dup_metrics):
+            logging.info (f"------------------BWA mem | Samtools fixmate | Samtools sort | Samtools markdup streaming alignment-----------------")
+            logging.info(f"Output sorted BAM file '{bam_sorted}' already exists. Skipping the streaming alignment and duplicate marking process.")
+        else:
+            fixmate_resources=allocate("samtools fixmate", cores=threads)
+            markdup_resources=allocate("samtools markdup", cores=threads)
+            markdup_commands=duplicate_marking_commands(bam_sorted, dup_metrics, fixmate_resources["threads"], sort_resources["threads"], sort_resources["memory_mb"], compression_threads or markdup_resources["threads"], ref_genome=ref_genome)
+
+            #All the tools run at the same time, so the memory of all of them is reserved
+            with reserve_resources(max(threads, compression_threads or 0), bwa_memory_mb + fixmate_resources["memory_mb"] + sort_resources["memory_mb"] + markdup_resources["memory_mb"]):
+                if not run_subprocess_pipe([bwa_command, *markdup_commands], tools=["BWA mem", "Samtools fixmate", "Samtools sort", "Samtools markdup"], outputs=[bam_sorted, dup_metrics]):
+                    raise RuntimeError(f"Streaming alignment and duplicate marking of '{fastq_1}' and '{fastq_2}' failed.")
+        read_duplicate_metrics(dup_metrics)
+        return
+
+    #Run Bwa mem piped into Samtools sort
+    if stream or bam_sorted.endswith(".cram"):
+        if output_ready(bam_sorted):
+            logging.info (f"------------------BWA mem | Samtools sort streaming alignment-----------------")
+            logging.info(f"Output sorted BAM file '{bam_sorted}' already exists. Skipping the streaming alignment process.")
+        else:
+            sort_threads=compression_threads or sort_resources["threads"]
+            samtools_sort_command=["samtools", "sort", *samtools_thread_args(sort_threads), *samtools_sort_memory_args(sort_threads, sort_resources["memory_mb"]), *sort_temp_args(bam_sorted), *alignment_format_args(bam_sorted, ref_genome), "-o", bam_sorted, "-"]
+
+            #Both tools run at the same time, so the memory of both is reserved
+            with reserve_resources(max(threads, compression_threads or 0), bwa_memory_mb + sort_resources["memory_mb"]):
+                if not run_subprocess_pipe([bwa_command, samtools_sort_command], tools=["BWA mem", "Samtools sort"], outputs=[bam_sorted]):
+                    raise RuntimeError(f"Streaming alignment of '{fastq_1}' and '{fastq_2}' failed.")
+        return
+
+    #The SAM and unsorted BAM files are removed once they are read, so a resumed run that has the sorted BAM file does not align again
+    if output_ready(bam_sorted):
+        logging.info (f"------------------BWA mem alignment-----------------")
+        logging.info(f"Output sorted BAM file '{bam_sorted}' already exists. Skipping the alignment process.")
+        return
 
     #Run Bwa mem
-    if os.path.exists(out_sam):
+    if output_ready(out_sam):
         logging.info (f"------------------BWA mem alignment-----------------")
         logging.info(f"Output SAM file '{out_sam}' already exists. Skipping the BWA alignment process.")
     else:
-        read_group_info = '@RG\\tID:gatk_exercise\\tSM:NA12878\\tLB:lib1\\tPL:ILLUMINA\\tPU:unit1'
-        bwa_command = ["bwa", "mem", "-t", str(threads), "-R", read_group_info, ref_genome, fastq_1, fastq_2]
-        
-        run_subprocess_out_file(bwa_command, out_sam, tool="BWA mem", out_name="bwa_output")
+        with reserve_resources(threads, bwa_memory_mb):
+            if not run_subprocess_out_file(bwa_command, out_sam, tool="BWA mem", out_name="bwa_output"):
+                raise RuntimeError(f"Alignment of '{fastq_1}' and '{fastq_2}' failed.")
 
     #Convert SAM to BAM
-    if os.path.exists(bam):
+    if output_ready(bam, inputs=[out_sam]):
         logging.info (f"------------------SAM to BAM analysis-----------------")
         logging.info(f"Output BAM file '{bam}' already exists. Skipping the BAM conversion process.")
     else:
-        convert_sam_to_bam(out_sam, bam)
+        convert_sam_to_bam(out_sam, bam, **allocate("samtools view", cores=threads))
+    remove_intermediates(out_sam)
 
     #Sort BAM
-    if os.path.exists(bam_sorted):
+    if output_ready(bam_sorted, inputs=[bam]):
         logging.info (f"------------------Samtools sort analysis-----------------")
         logging.info(f"Output sorted BAM file '{bam_sorted}' already exists. Skipping the BAM sorting process.")
     else:
-        sort_bam(bam, bam_sorted)
+        sort_bam(bam, bam_sorted, **sort_resources)
+    remove_intermediates(bam)
+
+#------------------------------------------------------------------------
+#Function for aligning the paired reads in chunks.
+#The Bwa mem and Samtools (sort, merge) tools are being used.
+#Input: Paired raw reads, reference genome (*.fasta) -- Output: *.fastq.gz and *_sorted.BAM per chunk, *_sorted.BAM
+#This prefect flow splits the paired reads into read-aligned chunks, aligns and sorts every chunk as an independent task (bwa mem piped into samtools sort) and merges the sorted chunks into the sorted BAM file. The chunks run concurrently and share the threads, and a failed chunk is retried on its own. Chunks whose sorted BAM file already exists are not aligned again, so a crashed run only aligns the missing chunks.
+#With mark_duplicates, samtools fixmate -m runs in the stream of every chunk and the merged chunks are piped into samtools markdup, which writes the duplication metrics to dup_metrics.
+#The chunks are always BAM files. A .cram bam_sorted is written as CRAM by the merge (or markdup) with compression_threads threads.
+#The chunks are written to the alignment_chunks directory of the scratch directory (default chunk_dir), which is removed after the merge
+@flow
+def run_bwa_sharded(fastq_1, fastq_2, ref_genome, threads, bam_sorted, chunks, read_group_info, chunk_dir=None, mark_duplicates=False, dup_metrics=None, compression_threads=None):
+
+    #Split the paired reads into chunks
+    chunk_dir=chunk_dir or scratch_path("alignment_chunks")
+    chunk_pairs=split_fastq_pair(fastq_1, fastq_2, chunk_dir, chunks)
+    chunk_suffix="_fixmate_sorted.bam" if mark_duplicates else "_sorted.bam"
+    chunk_bams=[chunk_1.replace("_1.fastq.gz", chunk_suffix) for chunk_1, chunk_2 in chunk_pairs]
+
+    #Align every chunk
+    chunk_resources=allocate("bwa mem", cores=threads, share=len(chunk_pairs))
+    chunk_resources["sort_memory_mb"]=allocate("samtools sort", cores=chunk_resources["threads"])["memory_mb"]
+    chunk_resources["fixmate"]=mark_duplicates
+    chunks_ok=align_chunks.with_options(task_runner=ThreadPoolTaskRunner(max_workers=len(chunk_pairs)))(chunk_pairs, chunk_bams, ref_genome, read_group_info, chunk_resources)
+
+    #Merge the sorted chunks
+    if not chunks_ok:
+        logging.error(f"Alignment failed for at least one chunk. Skipping the merging of the chunks.")
+        return False
+
+    merge_resources=allocate("samtools merge", cores=threads)
+    if mark_duplicates:
+        markdup_resources=allocate("samtools markdup", cores=threads)
+        merged=merge_mark_duplicates(chunk_bams, bam_sorted, dup_metrics, merge_resources["threads"], merge_resources["memory_mb"] + markdup_resources["memory_mb"], markdup_threads=compression_threads or markdup_resources["threads"], ref_genome=ref_genome)
+    else:
+        merged=merge_bams(chunk_bams, bam_sorted, threads=compression_threads or merge_resources["threads"], memory_mb=merge_resources["memory_mb"], ref_genome=ref_genome)
+
+    if merged:
+        remove_intermediates(chunk_dir)
+    return merged
+
+#------------------------------------------------------------------------
+#Function for aligning the chunks of the paired reads concurrently.
+#This prefect flow submits one align_chunk task per chunk to its ThreadPoolTaskRunner. It returns True only if every chunk was aligned successfully (after the retries of the failed chunks).
+@flow(task_runner=ThreadPoolTaskRunner())
+def align_chunks(chunk_pairs, chunk_bams, ref_genome, read_group_info, chunk_resources=None):
+
+    chunk_results=[]
+    for (chunk_1, chunk_2), chunk_bam in zip(chunk_pairs, chunk_bams):
+        if output_ready(chunk_bam, inputs=[chunk_1, chunk_2]):
+            logging.info(f"Output chunk BAM file '{chunk_bam}' already exists. Skipping the alignment of this chunk.")
+        else:
+            chunk_results.append(align_chunk.submit(chunk_1, chunk_2, ref_genome, read_group_info, chunk_bam, **(chunk_resources or {})))
+
+    return all([chunk_result.result(raise_on_failure=False) is True for chunk_result in chunk_results])
+
+#------------------------------------------------------------------------
+#Function for aligning the sequencing lanes of a sample and merging them into the sorted BAM file of the sample.
+#The Bwa mem and Samtools (sort, merge) tools are being used.
+#Input: Paired raw reads of every lane, reference genome (*.fasta) -- Output: *_sorted.BAM per lane in lane_dir, *_sorted.BAM and its lane manifest (*.lanes.json)
+#This prefect flow aligns every lane with its own read group (ID <sample>.<lane>, PU <lane>) as an independent task (bwa mem piped into samtools sort), like the chunks of run_bwa_sharded. The sorted BAM files of the lanes are kept in lane_dir, so a lane is aligned only once (again only when its FASTQ files are newer than its BAM file).
+#The lane manifest lists the lanes merged into bam_sorted. When new lanes arrive, only they are aligned and they are merged into the existing bam_sorted. When a merged lane was removed from the sample sheet or aligned again, bam_sorted is merged again from the BAM files of all the lanes.
+#With mark_duplicates, samtools fixmate -m runs in the stream of every lane and bam_sorted is always merged from all the lanes into samtools markdup, because the duplicates of a library span its lanes.
+#The lanes are always BAM files. A .cram bam_sorted is written as CRAM by the merge (or markdup) with compression_threads threads.
+#It returns True if bam_sorted contains all the lanes
+@flow
+def run_bwa_lanes(sample, lanes, ref_genome, threads, bam_sorted, lane_dir, mark_duplicates=False, dup_metrics=None, compression_threads=None):
+
+    if not os.path.exists(lane_dir):
+        os.makedirs(lane_dir)
+    lane_suffix="_fixmate_sorted.bam" if mark_duplicates else "_sorted.bam"
+    lane_bams={lane["lane"]: os.path.join(lane_dir, f"{sample}_{lane['lane']}{lane_suffix}") for lane in lanes}
+
+    #Align the lanes without sorted BAM file
+    lane_resources=allocate("bwa mem", cores=threads, share=len(lanes))
+    lane_resources["sort_memory_mb"]=allocate("samtools sort", cores=lane_resources["threads"])["memory_mb"]
+    lane_resources["fixmate"]=mark_duplicates
+    if not align_lanes.with_options(task_runner=ThreadPoolTaskRunner(max_workers=len(lanes)))(sample, lanes, lane_bams, ref_genome, lane_resources):
+        logging.error(f"Alignment failed for at least one lane of sample '{sample}'. Skipping the merging of the lanes.")
+        return False
+
+    #Find the lanes that are not merged into the sorted BAM file of the sample
+    merged_lanes=read_lane_manifest(bam_sorted) if output_ready(bam_sorted) else []
+    new_lanes=[lane for lane in lane_bams if lane not in merged_lanes]
+    changed_lanes=[lane for lane in merged_lanes if lane not in lane_bams or os.path.getmtime(lane_bams[lane]) > os.path.getmtime(bam_sorted)]
+    if merged_lanes and not new_lanes and not changed_lanes and (not mark_duplicates or output_ready(dup_metrics)):
+        logging.info (f"------------------Samtools merge lanes-----------------")
+        logging.info(f"Output sorted BAM file '{bam_sorted}' already contains the lanes {', '.join(merged_lanes)}. Skipping the merging of the lanes of sample '{sample}'.")
+        return True
+
+    merge_resources=allocate("samtools merge", cores=threads)
+    if mark_duplicates:
+        markdup_resources=allocate("samtools markdup", cores=threads)
+        merged=merge_mark_duplicates(list(lane_bams.values()), bam_sorted, dup_metrics, merge_resources["threads"], merge_resources["memory_mb"] + markdup_resources["memory_mb"], markdup_threads=compression_threads or markdup_resources["threads"], ref_genome=ref_genome)
+    elif merged_lanes and not changed_lanes:
+        #The merged BAM file is moved aside, because it is both an input and the output of the merge. It is moved back if the merge fails
+        logging.info(f"Merging the new lanes {', '.join(new_lanes)} into '{bam_sorted}' (merged lanes: {', '.join(merged_lanes)}).")
+        previous_bam=os.path.join(lane_dir, f"previous.{os.path.basename(bam_sorted)}")
+        os.replace(bam_sorted, previous_bam)
+        merged=merge_bams([previous_bam, *[lane_bams[lane] for lane in new_lanes]], bam_sorted, threads=compression_threads or merge_resources["threads"], memory_mb=merge_resources["memory_mb"], ref_genome=ref_genome)
+        if merged:
+            os.remove(previous_bam)
+        else:
+            os.replace(previous_bam, bam_sorted)
+    else:
+        merged=merge_bams(list(lane_bams.values()), bam_sorted, threads=compression_threads or merge_resources["threads"], memory_mb=merge_resources["memory_mb"], ref_genome=ref_genome)
+
+    if not merged:
+        return False
+    write_lane_manifest(bam_sorted, lane_bams)
+    if mark_duplicates:
+        read_duplicate_metrics(dup_metrics)
+    return True
+
+#------------------------------------------------------------------------
+#Function for aligning the lanes of a sample concurrently.
+#This prefect flow submits one align_chunk task per lane without sorted BAM file to its ThreadPoolTaskRunner, with the read group of the lane. It returns True only if every lane was aligned successfully (after the retries of the failed lanes).
+@flow(task_runner=ThreadPoolTaskRunner())
+def align_lanes(sample, lanes, lane_bams, ref_genome, lane_resources=None):
+
+    lane_results=[]
+    for lane in lanes:
+        lane_bam=lane_bams[lane["lane"]]
+        if output_ready(lane_bam, inputs=[lane["fastq1"], lane["fastq2"]]):
+            logging.info(f"Output lane BAM file '{lane_bam}' already exists. Skipping the alignment of lane '{lane['lane']}' of sample '{sample}'.")
+        else:
+            read_group_info=build_read_group(sample, f"{sample}.{lane['lane']}", platform_unit=lane["lane"])
+            lane_results.append(align_chunk.submit(lane["fastq1"], lane["fastq2"], ref_genome, read_group_info, lane_bam, **(lane_resources or {})))
+
+    return all([lane_result.result(raise_on_failure=False) is True for lane_result in lane_results])
+
+#------------------------------------------------------------------------
+#Function for preparing the reference genome files.
+#The Samtools faidx and Samtools dict tools are being used.
+#Input: reference genome (*.fasta) -- Output: *.fai, *.dict
+#This prefect flow creates the reference index and the reference dictionary at the same time, each one only if its output file is not present. It only depends on the reference genome, so the gatk flow runs it alongside the alignment.
+@flow(task_runner=ThreadPoolTaskRunner())
+def prepare_reference(ref_genome, reference_genome_index=None, reference_genome_dict=None):
+
+    reference_genome_index=reference_genome_index or reference_index_path(ref_genome)
+    reference_genome_dict=reference_genome_dict or reference_dict_path(ref_genome)
+
+    reference_results=[]
+    if output_ready(reference_genome_index):
+        logging.info(f"Output reference index file '{reference_genome_index}' already exists. Skipping the reference indexing process.")
+    else:
+        reference_results.append(index_reference.submit(ref_genome, reference_genome_index, **allocate("samtools faidx")))
+
+    if output_ready(reference_genome_dict):
+        logging.info(f"Output reference dict file '{reference_genome_dict}' already exists. Skipping the reference dict process.")
+    else:
+        reference_results.append(dict_reference.submit(ref_genome, reference_genome_dict, **allocate("samtools dict")))
+
+    for reference_result in reference_results:
+        reference_result.result()
+
+#------------------------------------------------------------------------
+#Function for preparing a reference genome in the reference store.
+#The Samtools faidx, Samtools dict and bwa index tools are being used.
+#Input: reference genome (*.fasta) -- Output: reference genome of the store with its *.fai, *.dict and bwa index files
+#This prefect flow builds the assets of the reference that are not in the store yet at the same time. Every asset is built only once per reference checksum, also when other runs on the node use the same store. With bwa_shm, the bwa index is also loaded into shared memory.
+#It returns the path of the reference genome in the store, which the other flows use instead of ref_genome
+@flow(task_runner=ThreadPoolTaskRunner())
+def prepare_reference_store(ref_genome, store_dir, bwa_shm=False):
+
+    store=ReferenceStore(store_dir)
+    reference_path=store.reference_path(ref_genome)
+    logging.info(f"Reference genome '{ref_genome}' is stored as '{reference_path}'.")
+
+    asset_tools={"fai": "samtools faidx", "dict": "samtools dict", "bwa": "bwa index"}
+    asset_results={asset: build_reference_asset.submit(store_dir, reference_path, asset, **allocate(asset_tools[asset])) for asset in REFERENCE_ASSETS}
+
+    failed_assets=[asset for asset, asset_result in asset_results.items() if not asset_result.result()]
+    if failed_assets:
+        raise RuntimeError(f"Building the reference assets {', '.join(failed_assets)} of '{ref_genome}' failed.")
+
+    if bwa_shm and not store.load_bwa_shm(reference_path):
+        logging.warning(f"Bwa index of '{reference_path}' could not be loaded into shared memory. Bwa mem loads it from disk.")
+
+    return reference_path
 
 #------------------------------------------------------------------------
 #Function for calling variants.
 #The GATK HaplotypeCaller tool is being used.
-#Input: reference genome (*.fasta), sorted BAM (*.sorted.BAM) -- Output: *.fai, *.dict, *.bam.bai, *.vcf
+#Input: reference genome (*.fasta), sorted BAM (*.sorted.BAM) -- Output: *.fai, *.dict, *.bam.bai, *.vcf.gz and *.vcf.gz.tbi (or *.vcf and *.vcf.idx)
 #This prefect flow initially perfomr some basic operations in order for GATK HaplotypeCaller to run. It runs the following functions only if the correct associated output files are not there: index_reference, dict_reference, index_bam. Then it proceeds with running the GATK HaplotypeCaller
+#When shards is bigger than 1, the variant calling is done in scatter-gather mode by the run_HaplotypeCaller_scatter flow
+#A sorted CRAM file (*.cram, indexed as *.cram.crai) is called directly, decoded with the reference genome
+#HaplotypeCaller writes out_vcf itself: a .vcf.gz file is block gzipped with a tabix index, so region queries read only the blocks of the region. A VCF file without index (e.g. from an older run) is indexed
 @flow(task_runner=ThreadPoolTaskRunner())
-def run_HaplotypeCaller(ref_genome, out_vcf, bam_sorted="gatk_pipeline_sorted.bam", reference_genome_index="data/Homo_sapiens_assembly38.fasta.fai", reference_genome_dict="data/Homo_sapiens_assembly38.dict", bam_index="gatk_pipeline_sorted.bam.bai"):
+def run_HaplotypeCaller(ref_genome, out_vcf, bam_sorted="gatk_pipeline_sorted.bam", reference_genome_index=None, reference_genome_dict=None, bam_index=None, shards=1, shard_concurrency=None):
+
+    bam_index=bam_index or alignment_index_path(bam_sorted)
+    reference_genome_index=reference_genome_index or reference_index_path(ref_genome)
+    reference_genome_dict=reference_genome_dict or reference_dict_path(ref_genome)
 
     #Run Samtools faidx for indexing the reference genome
-    if os.path.exists(reference_genome_index):
+    if output_ready(reference_genome_index):
         logging.info (f"------------------Samtools faidx Analysis-----------------")
         logging.info(f"Output reference index file '{reference_genome_index}' already exists. Skipping the reference indexing process.")
         index_ref_res=None
     else:
-        index_ref_res=index_reference.submit(ref_genome, reference_genome_index)
+        index_ref_res=index_reference.submit(ref_genome, reference_genome_index, **allocate("samtools faidx"))
     
     #Run Samtools dict for creating a .dict file for the reference genome
-    if os.path.exists(reference_genome_dict):
+    if output_ready(reference_genome_dict):
         logging.info (f"------------------Samtools Dict-----------------")
         logging.info(f"Output reference dict file '{reference_genome_dict}' already exists. Skipping the reference dict process.")
         dict_ref_res=None
     else:
-        dict_ref_res=dict_reference.submit(ref_genome, reference_genome_dict)
+        dict_ref_res=dict_reference.submit(ref_genome, reference_genome_dict, **allocate("samtools dict"))
     
     #Run Sammtols index for indexing the .BAM file
-    if os.path.exists(bam_index):
+    if output_ready(bam_index):
         logging.info (f"------------------SAMTOOLS index Analysis-----------------")
         logging.info(f"Output bam index file '{bam_index}' already exists. Skipping the BAM indexing process.")
         index_bam_res=None
     else:
-        index_bam_res=index_bam.submit(bam_sorted, bam_index)
+        index_bam_res=index_bam.submit(bam_sorted, bam_index, **allocate("samtools index"))
 
     if index_ref_res:
         index_ref_res.result()
@@ -111,10 +412,201 @@ def run_HaplotypeCaller(ref_genome, out_vcf, bam_sorted="gatk_pipeline_sorted.ba
         index_bam_res.result()
 
     #Run GATK HaplotypeCaller for variant call analysis
-    if os.path.exists(out_vcf) and os.path.getsize(out_vcf) > 0:
+    vcf_index=vcf_index_path(out_vcf)
+    if output_ready(out_vcf, non_empty=True, inputs=[bam_sorted]):
         logging.info (f"------------------GATK HaplotypeCaller Analysis-----------------")
         logging.info(f"Output vcf file '{out_vcf}' already exists. Skipping the variant calling process.")
+        if not output_ready(vcf_index) and not index_vcf(out_vcf, vcf_index, **allocate("gatk IndexFeatureFile")):
+            raise RuntimeError(f"Indexing of '{out_vcf}' failed.")
+    elif shards > 1:
+        if not run_HaplotypeCaller_scatter(ref_genome, out_vcf, bam_sorted, reference_genome_index, shards, shard_concurrency):
+            raise RuntimeError(f"Scatter-gather variant calling of '{bam_sorted}' failed.")
+    elif not haplotype_caller(ref_genome, bam_sorted, out_vcf, **allocate("gatk HaplotypeCaller")):
+        raise RuntimeError(f"Variant calling of '{bam_sorted}' failed.")
+
+#------------------------------------------------------------------------
+#Function for calling variants in scatter-gather mode.
+#The GATK HaplotypeCaller and GATK GatherVcfs tools are being used.
+#Input: reference genome (*.fasta), sorted BAM (*.sorted.BAM), reference index (*.fai) -- Output: *.intervals and *.vcf per shard, *.vcf
+#This prefect flow splits the genome into balanced interval shards by using the reference .fai file, then it runs one HaplotypeCaller per shard concurrently (at most shard_concurrency at the same time) and finally gathers the shard VCF files into the output VCF file. Shards whose VCF file already exists for the same intervals (checked with the shards.json file of shard_dir) and is newer than the sorted BAM file are not called again.
+#The cores and memory of the resource budget are divided between the shards that run at the same time. The shards share a process group of the process engine, so when a shard fails the running shards are stopped and the waiting shards are not started. With a worker pool the shards run in processes of the workers, where the process group does not reach the other shards: they run to the end and the gather is skipped.
+#The shards are written to the haplotypecaller_shards directory of the scratch directory (default shard_dir), which is removed after the gather. The gathered VCF file is indexed (tabix index for a .vcf.gz file)
+@flow
+def run_HaplotypeCaller_scatter(ref_genome, out_vcf, bam_sorted, reference_genome_index, shards, shard_concurrency=None, shard_dir=None):
+
+    #Split the genome into interval shards (the shard VCF files of other intervals are removed)
+    shard_dir=shard_dir or scratch_path("haplotypecaller_shards")
+    shard_intervals_files=write_shard_intervals(split_reference_intervals(reference_genome_index, shards), shard_dir)
+    shard_vcfs=[intervals_file.replace(".intervals", ".vcf") for intervals_file in shard_intervals_files]
+    logging.info(f"Genome split into {len(shard_vcfs)} interval shards.")
+
+    #Run GATK HaplotypeCaller for every shard (scatter)
+    max_workers=min(shard_concurrency, len(shard_vcfs)) if shard_concurrency else len(shard_vcfs)
+    shard_resources=allocate("gatk HaplotypeCaller", share=max_workers)
+    shard_resources["process_group"]=new_process_group("HaplotypeCaller shards")
+    shards_ok=call_HaplotypeCaller_shards.with_options(task_runner=ThreadPoolTaskRunner(max_workers=max_workers))(ref_genome, bam_sorted, shard_intervals_files, shard_vcfs, shard_resources)
+
+    #Run GATK GatherVcfs for merging the shard VCF files (gather)
+    if not shards_ok:
+        logging.error(f"HaplotypeCaller failed for at least one shard. Skipping the gathering of the shard VCF files.")
+        return False
+
+    #GatherVcfs writes no index, so the gathered VCF file is indexed afterwards
+    gathered=gather_vcfs(shard_vcfs, out_vcf, **allocate("gatk GatherVcfs")) and index_vcf(out_vcf, vcf_index_path(out_vcf), **allocate("gatk IndexFeatureFile"))
+    if gathered:
+        remove_intermediates(shard_dir)
+    return gathered
+
+#------------------------------------------------------------------------
+#Function for running the HaplotypeCaller shards concurrently.
+#This prefect flow submits one haplotype_caller_shard task per shard to its ThreadPoolTaskRunner, which limits how many shards run at the same time. It returns True only if every shard was called successfully.
+@flow(task_runner=ThreadPoolTaskRunner())
+def call_HaplotypeCaller_shards(ref_genome, bam_sorted, shard_intervals_files, shard_vcfs, shard_resources=None):
+
+    shard_results=[]
+    for intervals_file, shard_vcf in zip(shard_intervals_files, shard_vcfs):
+        if output_ready(shard_vcf, non_empty=True, inputs=[bam_sorted]):
+            logging.info(f"Output shard vcf file '{shard_vcf}' already exists. Skipping the variant calling of this shard.")
+        else:
+            shard_results.append(haplotype_caller_shard.submit(ref_genome, bam_sorted, intervals_file, shard_vcf, **(shard_resources or {})))
+
+    return all([shard_result.result() for shard_result in shard_results])
+
+
+#------------------------------------------------------------------------
+#Function for summarizing the variants of a VCF file.
+#Input: VCF file (*.vcf.gz or *.vcf) -- Output: *_summary.json
+#This prefect flow streams the VCF file once in batches of records, with bounded memory, and writes the variant counts by type and chromosome, the Ti/Tv ratio and the QUAL distribution to a JSON report next to the VCF file (default summary_report). The step is skipped when the report is newer than the VCF file
+@flow
+def run_vcf_summary(vcf, summary_report=None):
+
+    summary_report=summary_report or f"{vcf.removesuffix('.gz').removesuffix('.vcf')}_summary.json"
+    if output_ready(summary_report, non_empty=True, inputs=[vcf]):
+        logging.info (f"------------------VCF summary-----------------")
+        logging.info(f"VCF summary '{summary_report}' already exists. Skipping the VCF summary.")
+        return summary_report
+
+    from run_gatk_vcf_summary import write_vcf_summary
+
+    logging.info (f"------------------VCF summary starts-----------------")
+    with reserve_resources(**allocate("vcf summary")):
+        write_vcf_summary(vcf, summary_report)
+    logging.info (f"------------------VCF summary ends-----------------")
+    return summary_report
+
+#------------------------------------------------------------------------
+#Function for calling the variants of a cohort of samples.
+#The bwa mem, Samtools and GATK (HaplotypeCaller in GVCF mode, CombineGVCFs, GenotypeGVCFs) tools are being used.
+#Input: Sample sheet (sample, fastq1, fastq2), reference genome (*.fasta) -- Output: per sample *_sorted.BAM, *.bam.bai and *.g.vcf.gz, cohort *.g.vcf.gz, *.vcf
+#This prefect flow prepares the reference genome files once for the whole cohort, then it processes the samples concurrently (at most sample_concurrency samples at the same time) and finally it combines the sample GVCF files and joint genotypes the cohort. The cohort GVCF is always recreated, so that samples added to the sample sheet are included.
+@flow
+def run_cohort(sample_sheet, ref_genome, out_vcf, threads, sample_concurrency=None, stream=False, cohort_dir="cohort", mark_duplicates=False, alignment_format="bam", compression_threads=None):
+
+    samples=read_sample_sheet(sample_sheet)
+    logging.info(f"Sample sheet '{sample_sheet}' contains {len(samples)} samples.")
+
+    #Check if cohort dir exists and if not, create it
+    if not os.path.exists(cohort_dir):
+        os.makedirs(cohort_dir)
+        logging.info(f"Directory for cohort results, created.")
+
+    #Run Samtools faidx and Samtools dict once for the whole cohort
+    reference_genome_index=reference_index_path(ref_genome)
+    reference_genome_dict=reference_dict_path(ref_genome)
+    if output_ready(reference_genome_index):
+        logging.info(f"Output reference index file '{reference_genome_index}' already exists. Skipping the reference indexing process.")
     else:
-        haplotypecaller_command=["gatk", "HaplotypeCaller", "-R", ref_genome, "-I", bam_sorted, "-O", out_vcf]
+        index_reference(ref_genome, reference_genome_index, **allocate("samtools faidx"))
+
+    if output_ready(reference_genome_dict):
+        logging.info(f"Output reference dict file '{reference_genome_dict}' already exists. Skipping the reference dict process.")
+    else:
+        dict_reference(ref_genome, reference_genome_dict, **allocate("samtools dict"))
+
+    #Align and call every sample in GVCF mode (the threads are divided between the samples that run at the same time)
+    max_workers=min(sample_concurrency, len(samples)) if sample_concurrency else len(samples)
+    sample_threads=max(1, threads // max_workers)
+    gvcfs=process_samples.with_options(task_runner=ThreadPoolTaskRunner(max_workers=max_workers))(samples, ref_genome, sample_threads, cohort_dir, stream, mark_duplicates, alignment_format, compression_threads)
+
+    failed_samples=[sample["sample"] for sample, gvcf in zip(samples, gvcfs) if gvcf is None]
+    if failed_samples:
+        logging.error(f"Processing failed for the samples: {', '.join(failed_samples)}. Skipping the joint genotyping of the cohort.")
+        return False
+
+    #Run GATK CombineGVCFs and GATK GenotypeGVCFs for the joint genotyping of the cohort
+    cohort_gvcf=os.path.join(cohort_dir, "cohort.g.vcf.gz")
+    if not combine_gvcfs(ref_genome, gvcfs, cohort_gvcf, **allocate("gatk CombineGVCFs")):
+        return False
+
+    return genotype_gvcfs(ref_genome, cohort_gvcf, out_vcf, **allocate("gatk GenotypeGVCFs"))
 
-        run_subprocess_out_file(haplotypecaller_command, out_vcf, tool="GATK HaplotypeCaller", out_name="haplo_output")
\ No newline at end of file
+#------------------------------------------------------------------------
+#Function for processing the samples of a cohort concurrently.
+#This prefect flow submits one process_sample task per sample to its ThreadPoolTaskRunner, which limits how many samples run at the same time. It returns the GVCF file of every sample (None for the failed samples, also when a step of the sample raised an error).
+@flow(task_runner=ThreadPoolTaskRunner())
+def process_samples(samples, ref_genome, threads, cohort_dir, stream=False, mark_duplicates=False, alignment_format="bam", compression_threads=None):
+
+    sample_results=[process_sample.submit(sample, ref_genome, threads, cohort_dir, stream, mark_duplicates, alignment_format, compression_threads) for sample in samples]
+
+    gvcfs=[sample_result.result(raise_on_failure=False) for sample_result in sample_results]
+    return [gvcf if isinstance(gvcf, str) else None for gvcf in gvcfs]
+
+#------------------------------------------------------------------------
+#Function for processing one sample of a cohort.
+#Input: Sample from the sample sheet, reference genome (*.fasta) -- Output: *_sorted.BAM, *.bam.bai and *.g.vcf.gz in the sample directory (and lanes/*_sorted.BAM for a sample with lanes)
+#The SAM and unsorted BAM files of the sample are written to the scratch directory of the run
+#This prefect task aligns the reads with the run_bwa flow (using a read group with the sample name), indexes the sorted BAM and calls the variants of the sample in GVCF mode. Each step only runs if its output file is not present. It returns the GVCF file, or None if a step failed.
+#A sample with lanes is aligned per lane by the run_bwa_lanes flow (the lane BAM files are kept in the lanes directory of the sample), so a new lane is aligned alone and merged into the sorted BAM, and the GVCF file is called again from it
+#The alignment of the sample is written as a BAM or CRAM file (alignment_format)
+#It is a distributed task: with a worker pool, the samples run on the workers (preferring the workers that hold the FASTQ files of the sample)
+@task(distributed=True, locality=["sample"])
+def process_sample(sample, ref_genome, threads, cohort_dir, stream=False, mark_duplicates=False, alignment_format="bam", compression_threads=None):
+    name=sample["sample"]
+    sample_dir=os.path.join(cohort_dir, name)
+    if not os.path.exists(sample_dir):
+        os.makedirs(sample_dir)
+
+    out_sam=scratch_path("samples", name, f"{name}.sam")
+    bam=scratch_path("samples", name, f"{name}.bam")
+    bam_sorted=os.path.join(sample_dir, f"{name}_sorted.{alignment_format}")
+    bam_index=alignment_index_path(bam_sorted)
+    dup_metrics=os.path.join(sample_dir, f"{name}_markdup_metrics.txt")
+    gvcf=os.path.join(sample_dir, f"{name}.g.vcf.gz")
+
+    #Bwa mem alignment analysis (per lane for a sample with lanes, merged into the sorted BAM file of the sample)
+    if "lanes" in sample:
+        if not run_bwa_lanes(name, sample["lanes"], ref_genome, threads, bam_sorted, os.path.join(sample_dir, "lanes"), mark_duplicates=mark_duplicates, dup_metrics=dup_metrics, compression_threads=compression_threads):
+            logging.error(f"Alignment of the lanes of sample '{name}' failed.")
+            return None
+    else:
+        run_bwa(sample["fastq1"], sample["fastq2"], ref_genome, threads, out_sam=out_sam, bam=bam, bam_sorted=bam_sorted, stream=stream, read_group_info=build_read_group(name, name), mark_duplicates=mark_duplicates, dup_metrics=dup_metrics, compression_threads=compression_threads)
+    if not os.path.exists(bam_sorted):
+        logging.error(f"Alignment of sample '{name}' failed. Sorted BAM file '{bam_sorted}' was not created.")
+        return None
+
+    #Run Samtools index for indexing the .BAM file (again when new lanes were merged into it)
+    if not output_ready(bam_index, inputs=[bam_sorted]):
+        index_bam(bam_sorted, bam_index, **allocate("samtools index", cores=threads))
+
+    #Run GATK HaplotypeCaller in GVCF mode
+    if output_ready(gvcf, non_empty=True, inputs=[bam_sorted]):
+        logging.info(f"Output gvcf file '{gvcf}' already exists. Skipping the variant calling of sample '{name}'.")
+    elif not haplotype_caller_gvcf(ref_genome, bam_sorted, gvcf, **allocate("gatk HaplotypeCaller", cores=threads)):
+        return None
+
+    return gvcf
+
+#------------------------------------------------------------------------
+#Function for running one stage of the pipeline as a node of a dependency graph.
+#This prefect task calls the flow of the stage and records when the stage started and ended in stage_times, so that the critical path of the run can be logged at the end. The stages are submitted with wait_for, so every stage starts as soon as the stages it depends on are done.
+#When a stage fails, the tool processes of the other stages are stopped and no new tool is started, so the run fails promptly
+@task(cache_policy=NONE)
+def run_stage(stage, stage_times, stage_flow, *args, **kwargs):
+    start_time=time.time()
+    try:
+        return stage_flow(*args, **kwargs)
+    except Exception:
+        cancel_processes(reason=f"stage '{stage}' failed")
+        raise
+    finally:
+        stage_times[stage]={"start": start_time, "end": time.time()}
@@ -0,0 +1,108 @@
+import os
+
+#Cheap integrity checks of the output files of the steps.
+#They only read the start and the end of a file, so they can run on every resume: a file that a killed or failed tool left behind fails the check and its step runs again
+
+#Empty BGZF block at the end of every complete BGZF file (BAM, bgzipped VCF, tabix index)
+BGZF_EOF=bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+GZIP_MAGIC=b"\x1f\x8b"
+
+#EOF container at the end of every complete CRAM 3 file and the magic bytes at its start
+CRAM_EOF=bytes.fromhex("0f000000ffffffff0fe0454f4600000000010005bdd94f0001000606010001000100ee63014b")
+CRAM_MAGIC=b"CRAM"
+
+#Bytes read from the end of a text file for the tail check
+TAIL_BYTES=65536
+
+#Index files and the extension of the data file they index
+INDEX_EXTENSIONS=[".bai", ".tbi", ".fai", ".crai", ".csi", ".idx"]
+
+#------------------------------------------------------------------------
+#Functions for reading the start and the end of a file
+def read_head(path, size):
+    with open(path, "rb") as handle:
+        return handle.read(size)
+
+def read_tail(path, size):
+    with open(path, "rb") as handle:
+        handle.seek(max(0, os.path.getsize(path) - size))
+        return handle.read()
+
+#------------------------------------------------------------------------
+#Function for checking a BGZF file (BAM, *.vcf.gz, *.tbi): gzip header at the start and the BGZF EOF block at the end
+def check_bgzf(path):
+    if os.path.getsize(path) == 0:
+        return False, "empty file"
+    if read_head(path, 2) != GZIP_MAGIC:
+        return False, "no gzip header"
+    if read_tail(path, len(BGZF_EOF)) != BGZF_EOF:
+        return False, "no BGZF EOF marker (truncated)"
+    return True, None
+
+#------------------------------------------------------------------------
+#Function for checking a CRAM file: CRAM magic bytes at the start and the CRAM EOF container at the end
+def check_cram(path):
+    if os.path.getsize(path) == 0:
+        return False, "empty file"
+    if read_head(path, len(CRAM_MAGIC)) != CRAM_MAGIC:
+        return False, "no CRAM header"
+    if read_tail(path, len(CRAM_EOF)) != CRAM_EOF:
+        return False, "no CRAM EOF container (truncated)"
+    return True, None
+
+#------------------------------------------------------------------------
+#Function for checking a text file: the first line starts with header (when given), the file ends with a newline and the complete lines of its tail have at least min_fields tab separated fields
+def check_text(path, header=None, min_fields=1):
+    if os.path.getsize(path) == 0:
+        return False, "empty file"
+    if header and not read_head(path, len(header)) == header.encode():
+        return False, f"does not start with '{header}'"
+    tail=read_tail(path, TAIL_BYTES)
+    if not tail.endswith(b"\n"):
+        return False, "last line is incomplete (truncated)"
+    lines=tail.split(b"\n")[1:-1] if len(tail) == TAIL_BYTES else tail.split(b"\n")[:-1]
+    for line in lines:
+        if line and not line.startswith(b"#") and not line.startswith(b"@") and len(line.split(b"\t")) < min_fields:
+            return False, "last lines are incomplete"
+    return True, None
+
+#------------------------------------------------------------------------
+#Function for checking that an index file is not older than the file it indexes (data.bam for data.bam.bai, data.vcf.gz for data.vcf.gz.tbi)
+def check_index_age(path):
+    data_file, extension=os.path.splitext(path)
+    if extension in INDEX_EXTENSIONS and os.path.exists(data_file) and os.path.getmtime(path) < os.path.getmtime(data_file):
+        return False, f"older than '{data_file}'"
+    return True, None
+
+#------------------------------------------------------------------------
+#Function for checking an output file by its type.
+#It returns (True, None) for a valid file and (False, reason) otherwise. Files of other types are valid when they exist
+def check_output(path):
+    name=path.lower()
+    try:
+        if not os.path.isfile(path):
+            return True, None
+        if name.endswith((".bam", ".vcf.gz", ".tbi", ".bcf")):
+            valid, reason=check_bgzf(path)
+        elif name.endswith(".cram"):
+            valid, reason=check_cram(path)
+        elif name.endswith(".bai"):
+            valid, reason=(True, None) if read_head(path, 4) == b"BAI\x01" else (False, "no BAI header")
+        elif name.endswith(".crai"):
+            valid, reason=(True, None) if read_head(path, 2) == GZIP_MAGIC else (False, "no gzip header")
+        elif name.endswith(".fai"):
+            valid, reason=check_text(path, min_fields=5)
+        elif name.endswith(".dict"):
+            valid, reason=check_text(path, header="@HD")
+        elif name.endswith(".sam"):
+            valid, reason=check_text(path, header="@", min_fields=11)
+        elif name.endswith(".vcf"):
+            valid, reason=check_text(path, header="##fileformat=VCF", min_fields=8)
+        else:
+            valid, reason=True, None
+
+        if valid:
+            valid, reason=check_index_age(path)
+        return valid, reason
+    except OSError as e:
+        return False, f"cannot be read ({e})"
@@ -0,0 +1,153 @@
+from run_gatk_engine import *
+import threading
+import datetime
+import logging
+import json
+import csv
+import re
+import os
+
+#Metrics of the external tool invocations of the run (one dictionary per invocation)
+STEP_METRICS=[]
+STEP_METRICS_LOCK=threading.Lock()
+
+#Columns of the metrics report
+METRICS_FIELDS=["tool", "command", "start", "wall_time_s", "user_cpu_s", "system_cpu_s", "peak_rss_mb", "gc_time_s", "read_bytes", "write_bytes", "output_bytes", "returncode", "cached"]
+
+#Pattern of a garbage collection pause in the GC log of the JVM (unified logging, e.g. "[1.234s][info][gc] GC(3) Pause Young (Normal) (G1 Evacuation Pause) 120M->20M(512M) 4.213ms")
+GC_PAUSE_PATTERN=re.compile(r"\bPause\b.*?(\d+(?:\.\d+)?)ms\s*$")
+
+#Share of the wall time of a GATK step spent in garbage collection above which a bigger Java heap is recommended
+GC_WARNING_FRACTION=0.1
+
+#------------------------------------------------------------------------
+#Function for adding the metrics of a step to the metrics of the run
+def record_step_metrics(metrics):
+    with STEP_METRICS_LOCK:
+        STEP_METRICS.append(metrics)
+
+#Metrics of the whole run (e.g. the peak scratch usage), written to the JSON metrics report next to the steps
+RUN_METRICS={}
+
+#------------------------------------------------------------------------
+#Function for adding a metric of the whole run
+def record_run_metric(name, value):
+    with STEP_METRICS_LOCK:
+        RUN_METRICS[name]=value
+
+#------------------------------------------------------------------------
+#Function for finding the total size of the output files of a step (None when the outputs are not known)
+def output_size(outputs):
+    if not outputs:
+        return None
+    return sum(os.path.getsize(output) for output in outputs if os.path.isfile(output))
+
+#------------------------------------------------------------------------
+#Function for finding the GC log of the JVM of a command (the file of the -Xlog:gc option in its Java options), None when it does not write one
+def jvm_gc_log(command):
+    for arg in command:
+        for option in str(arg).split():
+            if option.startswith("-Xlog:gc") and ":file=" in option:
+                return option.split(":file=", 1)[1]
+    return None
+
+#------------------------------------------------------------------------
+#Function for finding the time in seconds that the JVM of a command spent in garbage collection pauses, from its GC log (None for a command without GC log)
+def gc_time_s(command):
+    gc_log=jvm_gc_log(command)
+    if not gc_log:
+        return None
+    pauses_ms=0.0
+    try:
+        with open(gc_log) as log:
+            for line in log:
+                match=GC_PAUSE_PATTERN.search(line)
+                if match:
+                    pauses_ms+=float(match.group(1))
+    except OSError:
+        return None
+    return round(pauses_ms / 1000, 3)
+
+#------------------------------------------------------------------------
+#Function for recording the resource usage of a finished tool process.
+#The process engine reaps the processes with os.wait4, which returns the resource usage of the process and of its own finished child processes (e.g. the java process started by the gatk wrapper script). Bytes read and written are the file system blocks (512 bytes) reported by the kernel. The GC time of a GATK step is read from the GC log of its JVM, and a warning is logged when garbage collection takes more than GC_WARNING_FRACTION of its wall time
+def record_process_metrics(result, outputs=None):
+    usage=result["usage"]
+    metrics={
+        "tool": result["tool"],
+        "command": " ".join(str(arg) for arg in result["command"]),
+        "start": datetime.datetime.fromtimestamp(result["start_time"]).isoformat(timespec="seconds"),
+        "wall_time_s": round(result["end_time"] - result["start_time"], 3),
+        "user_cpu_s": round(usage.ru_utime, 3),
+        "system_cpu_s": round(usage.ru_stime, 3),
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+        "gc_time_s": gc_time_s(result["command"]),
+        "read_bytes": usage.ru_inblock * 512,
+        "write_bytes": usage.ru_oublock * 512,
+        "output_bytes": output_size(outputs) if result["returncode"] == 0 else None,
+        "returncode": result["returncode"],
+        "cached": False}
+    record_step_metrics(metrics)
+    gc_info="" if metrics["gc_time_s"] is None else f", GC time {metrics['gc_time_s']}s"
+    logging.info(f"{metrics['tool']} metrics: wall time {metrics['wall_time_s']}s, user CPU {metrics['user_cpu_s']}s, system CPU {metrics['system_cpu_s']}s, peak RSS {metrics['peak_rss_mb']} MB{gc_info}")
+    if metrics["gc_time_s"] and metrics["wall_time_s"] and metrics["gc_time_s"] > GC_WARNING_FRACTION * metrics["wall_time_s"]:
+        logging.warning(f"{metrics['tool']} spent {metrics['gc_time_s'] / metrics['wall_time_s']:.0%} of its wall time in garbage collection. A bigger Java heap (--memory_gb) or fewer GATK processes at the same time (--shard_concurrency, --sample_concurrency) would make it faster.")
+
+#------------------------------------------------------------------------
+#Function for running a tool with the process engine and recording its resource usage.
+#It works like subprocess.run(command, check=True): it raises FileNotFoundError if the tool does not exist, subprocess.CalledProcessError if the tool fails, subprocess.TimeoutExpired if the tool runs longer than its step timeout and ProcessCancelled if the tool is stopped because its process group failed
+def run_measured(command, tool, outputs=None, stdout=None, group=None):
+    result,=run_processes([command], [tool], stdout=stdout, group=group)
+    record_process_metrics(result, outputs)
+    check_result(result)
+
+#------------------------------------------------------------------------
+#Function for recording a step whose outputs were restored from the step cache
+def record_cached_step(commands, tool, outputs):
+    record_step_metrics({
+        "tool": tool,
+        "command": " | ".join(" ".join(str(arg) for arg in command) for command in commands),
+        "start": datetime.datetime.now().isoformat(timespec="seconds"),
+        "wall_time_s": 0.0,
+        "user_cpu_s": 0.0,
+        "system_cpu_s": 0.0,
+        "peak_rss_mb": 0.0,
+        "gc_time_s": None,
+        "read_bytes": 0,
+        "write_bytes": 0,
+        "output_bytes": output_size(outputs),
+        "returncode": 0,
+        "cached": True})
+
+#------------------------------------------------------------------------
+#Function for writing the metrics report of the run.
+#The format is chosen from the extension of the report file: .csv for a CSV file, otherwise a JSON file
+def write_metrics_report(report_file):
+    with STEP_METRICS_LOCK:
+        metrics=list(STEP_METRICS)
+        run_metrics=dict(RUN_METRICS)
+
+    if report_file.endswith(".csv"):
+        with open(report_file, "w", newline="") as report:
+            writer=csv.DictWriter(report, fieldnames=METRICS_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(metrics)
+    else:
+        with open(report_file, "w") as report:
+            json.dump({"steps": metrics, "run": run_metrics}, report, indent=2)
+
+    logging.info(f"Metrics report of {len(metrics)} steps written to '{report_file}'.")
+
+#------------------------------------------------------------------------
+#Function for logging a summary table of the metrics of the run
+def log_metrics_summary():
+    with STEP_METRICS_LOCK:
+        metrics=list(STEP_METRICS)
+
+    logging.info(f"------------------Run metrics summary-----------------")
+    logging.info(f"{'Tool':<45} {'Wall(s)':>10} {'User(s)':>10} {'Sys(s)':>9} {'RSS(MB)':>9} {'GC(s)':>8} {'Read(MB)':>10} {'Write(MB)':>10} {'Out(MB)':>9}")
+    for step in metrics:
+        tool=f"{step['tool']} (cached)" if step["cached"] else step["tool"]
+        out_mb="-" if step["output_bytes"] is None else f"{step['output_bytes'] / 1024**2:.1f}"
+        gc_s="-" if step.get("gc_time_s") is None else f"{step['gc_time_s']:.1f}"
+        logging.info(f"{tool[:45]:<45} {step['wall_time_s']:>10.1f} {step['user_cpu_s']:>10.1f} {step['system_cpu_s']:>9.1f} {step['peak_rss_mb']:>9.1f} {gc_s:>8} {step['read_bytes'] / 1024**2:>10.1f} {step['write_bytes'] / 1024**2:>10.1f} {out_mb:>9}")
@@ -0,0 +1,223 @@
+import concurrent.futures
+import contextvars
+import functools
+import threading
+import inspect
+import logging
+import time
+import sys
+
+#Orchestration of the flows and tasks of the pipeline.
+#The flows and tasks are declared with the flow and task decorators of this module, which have the same options as the Prefect decorators. The engine of the run decides how they run:
+#- prefect: the functions become Prefect flows and tasks when they are first called, so Prefect is only imported (and its API server only used) when a run uses it
+#- local: an in-process scheduler runs the flows and tasks with thread pools. It needs no server and keeps the startup of short runs (single shards or samples on a batch scheduler) low
+#Both engines run a flow in the calling thread, run the submitted tasks of a flow on the thread pool of its task runner (waiting for the futures given with wait_for), retry failed tasks and wait for the submitted tasks at the end of the flow.
+#With both engines, the tasks declared with distributed=True run on the worker pool of the run when it has one (run_gatk_workers.py). The locality option names the arguments that hold the input files of the task, which decide the worker it prefers
+
+ORCHESTRATION_ENGINES=["prefect", "local"]
+
+#Engine of the run
+ORCHESTRATION_ENGINE="prefect"
+
+#------------------------------------------------------------------------
+#Function for choosing the engine of the run (before the first flow runs)
+def configure_orchestration(engine):
+    global ORCHESTRATION_ENGINE
+    if engine not in ORCHESTRATION_ENGINES:
+        raise ValueError(f"Unknown orchestration engine '{engine}' (engines: {', '.join(ORCHESTRATION_ENGINES)})")
+    ORCHESTRATION_ENGINE=engine
+    logging.info(f"Orchestration engine: {engine}.")
+    return engine
+
+#------------------------------------------------------------------------
+#Task runner of a flow: a pool of at most max_workers threads (no limit by default, like the Prefect ThreadPoolTaskRunner).
+#With the prefect engine it is converted to a Prefect ThreadPoolTaskRunner
+class ThreadPoolTaskRunner:
+
+    def __init__(self, max_workers=None):
+        self.max_workers=max_workers
+
+    def to_prefect(self):
+        from prefect.task_runners import ThreadPoolTaskRunner as PrefectThreadPoolTaskRunner
+        return PrefectThreadPoolTaskRunner(max_workers=self.max_workers)
+
+#Cache policy that disables the caching of a task (prefect.cache_policies.NONE with the prefect engine)
+NONE="NONE"
+
+#Error of a task that did not run because a task it waits for failed
+class UpstreamFailed(RuntimeError):
+    pass
+
+#Function for converting the options of the decorators to Prefect options
+def prefect_options(options):
+    options=dict(options)
+    if isinstance(options.get("task_runner"), ThreadPoolTaskRunner):
+        options["task_runner"]=options["task_runner"].to_prefect()
+    options.pop("distributed", None)
+    options.pop("locality", None)
+    if options.get("cache_policy") == NONE:
+        from prefect.cache_policies import NONE as PREFECT_NONE
+        options["cache_policy"]=PREFECT_NONE
+    return options
+
+#------------------------------------------------------------------------
+#Classes of the local engine
+
+#Future of a task submitted with the local engine
+class LocalFuture:
+
+    def __init__(self, future):
+        self.future=future
+
+    #It returns the result of the task, or its exception when raise_on_failure is False
+    def result(self, timeout=None, raise_on_failure=True):
+        exception=self.future.exception(timeout)
+        if exception is None:
+            return self.future.result()
+        if raise_on_failure:
+            raise exception
+        return exception
+
+    def wait(self, timeout=None):
+        concurrent.futures.wait([self.future], timeout)
+
+#Task runner of a running local flow. The thread pool is created on the first submitted task and the flow waits for all its tasks at the end
+class LocalTaskRunner:
+
+    def __init__(self, max_workers=None):
+        self.max_workers=max_workers or sys.maxsize
+        self.executor=None
+        self.lock=threading.Lock()
+
+    def submit(self, function, *args, **kwargs):
+        with self.lock:
+            if self.executor is None:
+                self.executor=concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="local-task")
+        #The task runs in the context of the flow, so the tasks it submits use the same task runner
+        return LocalFuture(self.executor.submit(contextvars.copy_context().run, function, *args, **kwargs))
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+#Task runner of the running local flow (None outside of a flow)
+CURRENT_TASK_RUNNER=contextvars.ContextVar("CURRENT_TASK_RUNNER", default=None)
+
+#Task runner for tasks submitted outside of a flow
+DEFAULT_TASK_RUNNER=LocalTaskRunner()
+
+#------------------------------------------------------------------------
+#Flow of the pipeline (flow decorator)
+class Flow:
+
+    def __init__(self, function, **options):
+        self.function=function
+        self.options=options
+        self.prefect_flow=None
+        functools.update_wrapper(self, function)
+
+    def with_options(self, **options):
+        return Flow(self.function, **{**self.options, **options})
+
+    def __call__(self, *args, **kwargs):
+        if ORCHESTRATION_ENGINE == "prefect":
+            if self.prefect_flow is None:
+                from prefect import flow
+                self.prefect_flow=flow(**prefect_options(self.options))(self.function)
+            return self.prefect_flow(*args, **kwargs)
+
+        task_runner=self.options.get("task_runner")
+        runner=LocalTaskRunner(task_runner.max_workers if task_runner else None)
+        token=CURRENT_TASK_RUNNER.set(runner)
+        try:
+            return self.function(*args, **kwargs)
+        finally:
+            CURRENT_TASK_RUNNER.reset(token)
+            runner.shutdown()
+
+#------------------------------------------------------------------------
+#Task of the pipeline (task decorator)
+class Task:
+
+    def __init__(self, function, **options):
+        self.function=function
+        self.options=options
+        self.prefect_task=None
+        functools.update_wrapper(self, function)
+
+    def with_options(self, **options):
+        return Task(self.function, **{**self.options, **options})
+
+    def to_prefect(self):
+        if self.prefect_task is None:
+            from prefect import task
+            function=self.function
+            if self.options.get("distributed"):
+                function=functools.update_wrapper(lambda *args, **kwargs: self.call(*args, **kwargs), self.function)
+            self.prefect_task=task(**prefect_options(self.options))(function)
+        return self.prefect_task
+
+    #Function for calling the function of the task, on the worker pool of the run for a distributed task
+    def call(self, *args, **kwargs):
+        if not self.options.get("distributed"):
+            return self.function(*args, **kwargs)
+        from run_gatk_workers import dispatch
+        return dispatch(self.function, args, kwargs, self.locality(args, kwargs))
+
+    #Function for finding the input files of a call (the string values of the arguments named by the locality option, also inside lists and dictionaries, e.g. the lanes of a sample)
+    def locality(self, args, kwargs):
+        arguments=inspect.signature(self.function).bind_partial(*args, **kwargs).arguments
+        values=[arguments.get(name) for name in self.options.get("locality") or []]
+        paths=[]
+        while values:
+            value=values.pop(0)
+            if isinstance(value, dict):
+                values.extend(value.values())
+            elif isinstance(value, (list, tuple)):
+                values.extend(value)
+            elif isinstance(value, str):
+                paths.append(value)
+        return paths
+
+    #Function for running the task with its retries (local engine)
+    def run_local(self, *args, **kwargs):
+        retries=self.options.get("retries") or 0
+        for attempt in range(retries + 1):
+            try:
+                return self.call(*args, **kwargs)
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                delay=self.options.get("retry_delay_seconds") or 0
+                logging.warning(f"Task {self.function.__name__} failed ({e}). Retry {attempt + 1}/{retries} in {delay}s.")
+                time.sleep(delay)
+
+    #Function for running the task after the futures in wait_for are done (local engine)
+    def run_after(self, wait_for, *args, **kwargs):
+        for future in wait_for:
+            if isinstance(future.result(raise_on_failure=False), Exception):
+                raise UpstreamFailed(f"Task {self.function.__name__} did not run because a task it waits for failed.")
+        return self.run_local(*args, **kwargs)
+
+    def __call__(self, *args, **kwargs):
+        if ORCHESTRATION_ENGINE == "prefect":
+            return self.to_prefect()(*args, **kwargs)
+        return self.run_local(*args, **kwargs)
+
+    def submit(self, *args, wait_for=None, **kwargs):
+        if ORCHESTRATION_ENGINE == "prefect":
+            return self.to_prefect().submit(*args, wait_for=wait_for, **kwargs)
+        runner=CURRENT_TASK_RUNNER.get() or DEFAULT_TASK_RUNNER
+        return runner.submit(self.run_after, list(wait_for or []), *args, **kwargs)
+
+#------------------------------------------------------------------------
+#Decorators for declaring flows and tasks (used as @flow, @flow(...), @task and @task(...))
+def flow(function=None, **options):
+    if function is None:
+        return lambda function: Flow(function, **options)
+    return Flow(function, **options)
+
+def task(function=None, **options):
+    if function is None:
+        return lambda function: Task(function, **options)
+    return Task(function, **options)
@@ -1,51 +1,223 @@
 from run_gatk_flows import *
-from prefect import flow
+from run_gatk_orchestration import *
+from run_gatk_workers import configure_worker_pool, WorkerLost
+from run_gatk_progress import start_progress_reporting, stop_progress_reporting, PROGRESS_LOG_SECONDS
+from run_gatk_planner import plan_run, format_plan, append_run_history, run_samples
 import argparse
 import logging
+import json
 
-#Logging config
-logging.basicConfig(
-    filename="gatk_pipe.log",
-    encoding="utf-8",
-    filemode="a",
-    format="{asctime} - {levelname} - {message}",
-    style="{",
-    datefmt="%Y-%m-%d %H:%M",
-    level=logging.INFO,
-    force=True)
-
-# Initial log message
-logging.info("###############################################################")
-logging.info("###############################################################")
-logging.info("#######################FANCY NEW RUN.##########################")
-
-@flow
+#------------------------------------------------------------------------
+#Function for configuring the log file of the run (appended to, in the directory the pipeline is started from).
+#It is only called when the pipeline runs from the command line, so importing the module (e.g. by the tests or the workers) writes no log file
+def configure_logging(log_file="gatk_pipe.log"):
+    logging.basicConfig(
+        filename=log_file,
+        encoding="utf-8",
+        filemode="a",
+        format="{asctime} - {levelname} - {message}",
+        style="{",
+        datefmt="%Y-%m-%d %H:%M",
+        level=logging.INFO,
+        force=True)
+
+    # Initial log message
+    logging.info("###############################################################")
+    logging.info("###############################################################")
+    logging.info("#######################FANCY NEW RUN.##########################")
+
+#------------------------------------------------------------------------
+#Function for running the pipeline from the command line.
+#It reads the arguments, chooses the orchestration engine and runs the run_gatk flow
 def gatk():
 
     #Initialize the argument parser for command line interface
     parser = argparse.ArgumentParser(description="GATK pipeline for genomic data analysis. The pipeline calls single nucleotide variants (SNVs) and insertions/deletions (InDels)")
 
     #Define command line arguments
-    parser.add_argument("--fastq1", required=True, help="Path to the first FASTQ file.")
-    parser.add_argument("--fastq2", required=True, help="Path to the second FASTQ file.")
+    parser.add_argument("--fastq1", help="Path to the first FASTQ file.")
+    parser.add_argument("--fastq2", help="Path to the second FASTQ file.")
+    parser.add_argument("--sample_sheet", help="Path to a tab separated sample sheet (columns: sample, fastq1, fastq2 and optionally lane, with one line per sequencing lane of a sample) for calling the variants of a cohort. Replaces --fastq1 and --fastq2.")
+    parser.add_argument("--sample_concurrency", type=int, default=None, help="Maximum number of cohort samples processed at the same time (default: all samples).")
     parser.add_argument("--ref_genome", required=True, help="Path to the reference genome file.")
     parser.add_argument("--out_vcf", required=True, help="Specify the name the output VCF file.")
-    parser.add_argument("--threads", type=int, default=1, help="Number of threads to use.")
+    parser.add_argument("--vcf_format", choices=["vcf.gz", "vcf"], default=None, help="Format of the output VCF file: block gzipped with a tabix index (.vcf.gz and .vcf.gz.tbi), so region queries do not read the whole file, or plain text (.vcf). The format comes from the extension of --out_vcf; this option only applies to an --out_vcf without .vcf or .vcf.gz extension, which gets the extension of the format (default: vcf.gz), and must match the extension otherwise.")
+    parser.add_argument("--threads", type=int, default=1, help="Number of threads to use. This is the total number of cores that the tools of the pipeline share.")
+    parser.add_argument("--memory_gb", type=float, default=None, help="Total memory in GB that the tools of the pipeline share (default: 80%% of the node memory).")
+    parser.add_argument("--shards", type=int, default=1, help="Number of genomic interval shards for running HaplotypeCaller in scatter-gather mode.")
+    parser.add_argument("--shard_concurrency", type=int, default=None, help="Maximum number of HaplotypeCaller shards running at the same time (default: all shards).")
+    parser.add_argument("--reference_store", default=None, help="Directory of the reference asset store. The reference index, dictionary and bwa index are built once per reference checksum and shared by all the runs that use the store (default: build them next to the reference genome).")
+    parser.add_argument("--bwa_shm", action="store_true", help="Load the bwa index of the reference store into shared memory (bwa shm), so that concurrent bwa mem processes do not load it from disk. Requires --reference_store.")
+    parser.add_argument("--cache_dir", default=None, help="Directory of the step cache. Steps whose input files (with their index files, and the index, dictionary and bwa index of the reference), command line and tool version did not change are restored from the cache instead of running again. Outputs that already exist in the work directory are still reused without the cache (default: no cache).")
+    parser.add_argument("--cache_max_gb", type=float, default=500, help="Maximum size of the step cache in GB. The least recently used outputs are removed first.")
+    parser.add_argument("--cache_checksum", action="store_true", help="Identify the input files of the steps by their checksum instead of their file system identity.")
+    parser.add_argument("--align_chunks", type=int, default=1, help="Number of chunks the paired reads are split into for aligning them concurrently. Every chunk is aligned, sorted and retried on its own before the chunks are merged.")
+    parser.add_argument("--qc_engine", choices=["fastqc", "native"], default="fastqc", help="Quality control of the reads: the FastQC tool or the built-in native QC, which streams the FASTQ files once and writes a JSON report (qc_results/*_qc.json).")
+    parser.add_argument("--qc_workers", type=int, default=None, help="Number of worker processes of the native QC (default: the cores the resource budget gives it).")
+    parser.add_argument("--stream", action="store_true", help="Pipe bwa mem directly into samtools sort, without writing the SAM and unsorted BAM files.")
+    parser.add_argument("--alignment_format", choices=["bam", "cram"], default="bam", help="Format of the sorted alignment file: BAM (with a .bai index) or CRAM compressed against the reference genome (with a .crai index), which is about half the size. HaplotypeCaller reads the CRAM file directly. CRAM output always streams the alignment, so no SAM or unsorted BAM file is written.")
+    parser.add_argument("--compression_threads", type=int, default=None, help="Threads of the samtools command that writes and compresses the sorted alignment file (default: its share of --threads).")
+    parser.add_argument("--mark_duplicates", action="store_true", help="Mark the duplicate reads in the alignment stream (bwa mem | samtools fixmate -m | samtools sort | samtools markdup), so the analysis-ready BAM is written in a single disk write. The duplication metrics are written to --dup_metrics.")
+    parser.add_argument("--dup_metrics", default="gatk_pipeline_markdup_metrics.txt", help="Path to the duplication metrics of samtools markdup (with --mark_duplicates; the samples of a cohort write theirs to their sample directory).")
+    parser.add_argument("--skip_preflight", action="store_true", help="Do not validate the input files before the run. By default the FASTQ files and the reference genome are streamed once in parallel before the long steps start: gzip/BGZF integrity, FASTQ and FASTA format, read counts and read names of the FASTQ pairs, and reference index, dictionary and bwa index that match the reference genome.")
+    parser.add_argument("--preflight_cache", default="gatk_preflight_cache.json", help="Path to the cache of the pre-flight validation (JSON), relative to the work directory unless absolute (default: gatk_preflight_cache.json). Input files whose path, inode, size and modification time did not change are not scanned again. An empty value disables it.")
+    parser.add_argument("--work_dir", default=".", help="Work directory of the run, which keeps the final outputs: sorted alignment and index, duplication metrics, QC reports, cohort sample files and (when given as relative paths) the output VCF and the metrics report.")
+    parser.add_argument("--scratch_dir", default=None, help="Scratch directory for the transient files (SAM and unsorted BAM files, alignment chunks, HaplotypeCaller shards, samtools sort temporary files), e.g. on node-local NVMe (default: <work_dir>/scratch). Intermediates are removed as soon as the steps that read them are done.")
+    parser.add_argument("--keep_intermediates", action="store_true", help="Keep the intermediate files in the scratch directory instead of removing them.")
+    parser.add_argument("--engine", choices=ORCHESTRATION_ENGINES, default="prefect", help="Orchestration engine of the flows and tasks: prefect (Prefect flows and tasks, tracked by the Prefect server) or local (in-process scheduler without Prefect, for a fast startup).")
+    parser.add_argument("--workers", action="append", default=[], metavar="HOST:PORT[,HOST:PORT...]", help="Workers (python run_gatk_workers.py on other nodes) that run the alignment chunks, HaplotypeCaller shards and cohort samples of the run. The nodes must share the file system and the authentication key in the GATK_WORKER_AUTHKEY environment variable. Can be given more than once (default: everything runs on this node).")
+    parser.add_argument("--java_gc", choices=JAVA_GC_CHOICES, default="auto", help="Garbage collector of the JVM of the GATK steps: parallel, g1 or auto (G1 for Java heaps of 16 GB and more, otherwise the parallel collector). The Java heap, the GC threads and the GATK temporary directory (in the scratch directory) are always derived from the memory and threads the resource budget gives the step, and the GC time of every GATK step is written to the metrics report.")
+    parser.add_argument("--pair_hmm", choices=PAIR_HMM_CHOICES, default="auto", help="PairHMM implementation of HaplotypeCaller: auto chooses the AVX implementation (with OpenMP threads) when the CPU has AVX, otherwise the Java implementation.")
+    parser.add_argument("--max_processes", type=int, default=MAX_PROCESSES, help="Maximum number of tool processes running at the same time. All the tool processes are supervised by one event loop, which logs their stderr line by line.")
+    parser.add_argument("--step_timeout", action="append", default=[], metavar="[TOOL=]SECONDS", help="Timeout of the tool processes in seconds. SECONDS sets the timeout of all the tools, TOOL=SECONDS the timeout of the tools whose name starts with TOOL (e.g. \"GATK HaplotypeCaller=7200\"). Can be given more than once (default: no timeout).")
+    parser.add_argument("--metrics_report", default="gatk_pipe_metrics.json", help="Path to the metrics report of the run (wall time, CPU time, peak RSS, I/O and output size of every tool). A .csv extension writes a CSV file, otherwise a JSON file is written.")
+    parser.add_argument("--progress_port", type=int, default=None, help="Port of the local HTTP endpoint (http://127.0.0.1:PORT/metrics) that serves the progress of the running steps in the Prometheus text format: processed reads or loci, throughput, progress and estimated remaining time of bwa mem and HaplotypeCaller, spills of samtools sort (default: no endpoint).")
+    parser.add_argument("--progress_interval", type=float, default=PROGRESS_LOG_SECONDS, help=f"Seconds between the progress lines (JSON) of the running steps in the log file, 0 disables them (default: {PROGRESS_LOG_SECONDS}).")
+    parser.add_argument("--metrics_summary", action="store_true", help="Write a summary table of the run metrics to the log file.")
+    parser.add_argument("--metrics_history", default="gatk_pipe_history.jsonl", help="Path to the metrics history (JSON lines), relative to the work directory unless absolute, so it is shared by the runs of the same work directory (default: gatk_pipe_history.jsonl). Every run appends its input sizes and the CPU time, wall time, threads and peak memory of its steps, which --plan uses for its predictions. Give an absolute path to share it between work directories. An empty value disables it.")
+    parser.add_argument("--plan", action="store_true", help="Plan the run without running it: print which steps would run or be skipped, their threads and memory and their runtime and peak memory predicted from the metrics history, and the recommended --threads, --memory_gb and --shards for this node.")
+    parser.add_argument("--plan_report", default=None, help="Path to a JSON file for the plan of --plan.")
     
     args = parser.parse_args()
+
+    if not args.sample_sheet and not (args.fastq1 and args.fastq2):
+        parser.error("either --sample_sheet or both --fastq1 and --fastq2 are required")
+    if args.bwa_shm and not args.reference_store:
+        parser.error("--bwa_shm requires --reference_store")
+    try:
+        step_timeouts=parse_step_timeouts(args.step_timeout)
+    except ValueError as e:
+        parser.error(f"invalid --step_timeout: {e}")
+    try:
+        out_vcf=vcf_output_path(args.out_vcf, args.vcf_format)
+    except ValueError as e:
+        parser.error(f"--vcf_format does not match --out_vcf: {e}")
+    if out_vcf != args.out_vcf:
+        print(f"The output VCF file is written as '{out_vcf}' (--out_vcf has no .vcf or .vcf.gz extension).")
+        logging.warning(f"Output VCF file '{args.out_vcf}' has no .vcf or .vcf.gz extension. It is written as '{out_vcf}'.")
+
+    #Plan of the run (nothing is run)
+    if args.plan:
+        return plan_gatk(args)
+
+    #Orchestration engine of the flows and tasks
+    configure_orchestration(args.engine)
+
+    #Worker pool of the distributed tasks
+    try:
+        configure_worker_pool([address for workers in args.workers for address in workers.split(",") if address])
+    except (ValueError, WorkerLost) as e:
+        parser.error(f"invalid --workers: {e}")
+
+    return run_gatk(args, step_timeouts)
+
+#------------------------------------------------------------------------
+#Function for planning the run: it prints the plan (and writes it to the plan report) and returns it
+def plan_gatk(args):
+    plan=plan_run(args, plan_path(args.work_dir, args.metrics_history) if args.metrics_history else None)
+    print(format_plan(plan))
+    if args.plan_report:
+        with open(args.plan_report, "w") as report:
+            json.dump(plan, report, indent=2)
+    logging.info(f"Plan of the run: {len([step for step in plan['steps'] if step['action'] == 'run'])} of {len(plan['steps'])} steps would run, predicted wall time {plan['predicted_wall_s']} s.")
+    return plan
+
+#------------------------------------------------------------------------
+#Function for running the analysis of a sample or of a cohort.
+#This flow configures the resources, the process engine, the step cache and the work and scratch directories of the run and starts the progress reporting, then it validates the input files and runs the stages of the pipeline (ending with the summary of the output VCF file) and writes the metrics report (with the peak scratch usage) and the record of the run in the metrics history at the end
+@flow(name="gatk", task_runner=ThreadPoolTaskRunner())
+def run_gatk(args, step_timeouts=None):
     
     #Main operations
 
-    #FASTQC analysis
-    run_fastqc(args.fastq1, args.fastq2)
-    
-    #Bwa mem alignment analysis
-    run_bwa(args.fastq1, args.fastq2, args.ref_genome, args.threads)
-    
-    #GATK HaplotypeCaller analysis
-    run_HaplotypeCaller(args.ref_genome, args.out_vcf)
+    #Work and scratch directories
+    configure_workspace(args.work_dir, args.scratch_dir, keep_intermediates=args.keep_intermediates)
+    out_vcf=vcf_output_path(work_path(args.out_vcf), args.vcf_format)
+    metrics_report=work_path(args.metrics_report)
+
+    #Resource budget of the tools
+    configure_resources(args.threads, int(args.memory_gb * 1024) if args.memory_gb else None)
+
+    #Execution profile of the GATK steps
+    configure_gatk_profile(args.java_gc, args.pair_hmm)
+
+    #Process engine of the tools
+    configure_process_engine(args.max_processes, step_timeouts)
+
+    #Step cache
+    configure_step_cache(args.cache_dir, int(args.cache_max_gb * 1024**3), checksum=args.cache_checksum)
+
+    start_scratch_monitor()
+    start_progress_reporting(args.progress_port, args.progress_interval)
+    try:
+        #Pre-flight validation of the input files (the pairs of FASTQ files of the sample or of every lane of the cohort samples)
+        if not args.skip_preflight:
+            fastqs=[fastq for sample in run_samples(args) for fastq in sample["fastqs"]]
+            run_preflight(list(zip(fastqs[0::2], fastqs[1::2])), args.ref_genome, cache_file=work_path(args.preflight_cache) if args.preflight_cache else None)
+
+        #Cohort analysis (per sample alignment and GVCF calling, joint genotyping)
+        if args.sample_sheet:
+            ref_genome=args.ref_genome
+            if args.reference_store:
+                ref_genome=prepare_reference_store(args.ref_genome, args.reference_store, bwa_shm=args.bwa_shm)
+            if not run_cohort(args.sample_sheet, ref_genome, out_vcf, args.threads, sample_concurrency=args.sample_concurrency, stream=args.stream, cohort_dir=work_path("cohort"), mark_duplicates=args.mark_duplicates, alignment_format=args.alignment_format, compression_threads=args.compression_threads):
+                raise RuntimeError(f"Cohort analysis of '{args.sample_sheet}' failed.")
+            run_vcf_summary(out_vcf)
+            return
+
+        #The stages run as a dependency graph: every stage starts as soon as the stages it depends on are done.
+        #FASTQC, the reference preparation and the alignment only depend on the input files, so they run at the same time
+        stage_times={}
+        stage_dependencies={"Reference preparation": [], "Alignment": [], "Variant calling": ["Alignment", "Reference preparation"], "VCF summary": ["Variant calling"]}
+
+        #FASTQC analysis (or the native QC)
+        if args.qc_engine == "native":
+            stage_dependencies["Native QC"]=[]
+            fastqc_stage=run_stage.submit("Native QC", stage_times, run_native_qc, args.fastq1, args.fastq2, workers=args.qc_workers)
+        else:
+            stage_dependencies["FASTQC"]=[]
+            fastqc_stage=run_stage.submit("FASTQC", stage_times, run_fastqc, args.fastq1, args.fastq2)
+
+        #Reference index and dictionary (with a reference store also the bwa index, so the alignment waits for it)
+        if args.reference_store:
+            ref_genome=ReferenceStore(args.reference_store).reference_path(args.ref_genome)
+            reference_stage=run_stage.submit("Reference preparation", stage_times, prepare_reference_store, args.ref_genome, args.reference_store, bwa_shm=args.bwa_shm)
+            stage_dependencies["Alignment"]=["Reference preparation"]
+            alignment_wait_for=[reference_stage]
+        else:
+            ref_genome=args.ref_genome
+            reference_stage=run_stage.submit("Reference preparation", stage_times, prepare_reference, args.ref_genome)
+            alignment_wait_for=[]
+
+        #Bwa mem alignment analysis
+        #The sorted alignment is a final output, the SAM and unsorted BAM files are intermediates
+        bam_sorted=work_path(f"gatk_pipeline_sorted.{args.alignment_format}")
+        alignment_stage=run_stage.submit("Alignment", stage_times, run_bwa, args.fastq1, args.fastq2, ref_genome, args.threads, out_sam=scratch_path("gatk_pipeline.sam"), bam=scratch_path("gatk_pipeline.bam"), bam_sorted=bam_sorted, stream=args.stream, chunks=args.align_chunks, mark_duplicates=args.mark_duplicates, dup_metrics=work_path(args.dup_metrics), compression_threads=args.compression_threads, wait_for=alignment_wait_for)
+
+        #GATK HaplotypeCaller analysis (waits only for the sorted BAM file and the reference files)
+        calling_stage=run_stage.submit("Variant calling", stage_times, run_HaplotypeCaller, ref_genome, out_vcf, bam_sorted=bam_sorted, shards=args.shards, shard_concurrency=args.shard_concurrency, wait_for=[alignment_stage, reference_stage])
+
+        #Streaming summary of the output VCF file (variant types, Ti/Tv, QUAL distribution)
+        summary_stage=run_stage.submit("VCF summary", stage_times, run_vcf_summary, out_vcf, wait_for=[calling_stage])
+
+        try:
+            for stage in [fastqc_stage, reference_stage, alignment_stage, calling_stage, summary_stage]:
+                stage.result()
+        finally:
+            log_critical_path(stage_times, stage_dependencies)
+    finally:
+        stop_progress_reporting()
+
+        #Run metrics report
+        record_run_metric("peak_scratch_bytes", stop_scratch_monitor())
+        write_metrics_report(metrics_report)
+        if args.metrics_summary:
+            log_metrics_summary()
+        if args.metrics_history:
+            append_run_history(work_path(args.metrics_history), args)
 
 
 if __name__=="__main__":
+    configure_logging()
     gatk()
     
\ No newline at end of file
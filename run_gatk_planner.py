@@ -0,0 +1,446 @@
+from run_gatk_tasks import *
+import statistics
+import datetime
+import logging
+import math
+import json
+import os
+
+#Execution planner of the pipeline.
+#Every run appends a record to the metrics history (JSON lines): the size of its inputs (FASTQ bytes, reference bases, size of the sorted alignment files) and the CPU time, wall time, threads and peak memory of every step. Before a run, the planner finds the steps that would run or be skipped (with the output checks of the flows, without changing any file) and predicts the runtime and memory of every step from the history with a linear model: the CPU time per input byte (or reference base) of the step times the input size of the run, divided by the cores the step gets and the parallel efficiency the step reached in the history. It also recommends the threads, memory and HaplotypeCaller shards of a run on this node
+
+#Steps of the history: the tools of the metrics without the file of the invocation (e.g. "BWA mem chunk_0001_1.fastq.gz" is "BWA mem"). Longest names first
+STEP_NAMES=["GATK HaplotypeCaller GVCF", "GATK HaplotypeCaller", "GATK GatherVcfs", "GATK IndexFeatureFile", "GATK CombineGVCFs", "GATK GenotypeGVCFs", "BWA mem", "Samtools view", "Samtools sort", "Samtools index", "Samtools merge", "Samtools fixmate", "Samtools markdup", "Samtools faidx", "Samtools dict", "Reference fai", "Reference dict", "Reference bwa", "FASTQC"]
+
+#Input size that the CPU time of every step grows with
+STEP_SIZES={
+    "FASTQC": "fastq_bytes",
+    "BWA mem": "fastq_bytes",
+    "Samtools view": "fastq_bytes",
+    "Samtools sort": "fastq_bytes",
+    "Samtools fixmate": "fastq_bytes",
+    "Samtools markdup": "fastq_bytes",
+    "Samtools merge": "fastq_bytes",
+    "Samtools index": "alignment_bytes",
+    "GATK HaplotypeCaller": "alignment_bytes",
+    "GATK HaplotypeCaller GVCF": "alignment_bytes",
+    "GATK GatherVcfs": "alignment_bytes",
+    "GATK IndexFeatureFile": "alignment_bytes",
+    "GATK CombineGVCFs": "alignment_bytes",
+    "GATK GenotypeGVCFs": "alignment_bytes",
+    "Samtools faidx": "reference_bases",
+    "Samtools dict": "reference_bases",
+    "Reference fai": "reference_bases",
+    "Reference dict": "reference_bases",
+    "Reference bwa": "reference_bases"}
+
+#Number of history records used for the predictions (the most recent ones)
+HISTORY_RECORDS=50
+
+#HaplotypeCaller CPU time below which one more shard is not worth its startup (JVM, reading the BAM header and the reference)
+MIN_SHARD_CPU_SECONDS=600
+
+#------------------------------------------------------------------------
+#Function for finding the step of a tool of the metrics
+def step_name(tool):
+    for name in STEP_NAMES:
+        if tool == name or tool.startswith(f"{name} "):
+            return name
+    return tool
+
+#------------------------------------------------------------------------
+#Function for finding the threads of a tool invocation from its command line (bwa and FastQC -t, samtools -@ additional threads, HaplotypeCaller PairHMM threads)
+def command_threads(command):
+    arguments=command.split()
+    for name, extra in (("--native-pair-hmm-threads", 0), ("-t", 0), ("-@", 1)):
+        if name in arguments[:-1]:
+            value=arguments[arguments.index(name) + 1]
+            if value.isdigit():
+                return int(value) + extra
+    return 1
+
+#------------------------------------------------------------------------
+#Function for finding the path of a file in the work directory without creating its directory (absolute paths are kept)
+def plan_path(work_dir, *names):
+    return os.path.normpath(os.path.join(work_dir, *names))
+
+#------------------------------------------------------------------------
+#Function for finding the number of bases of a reference genome (from its .fai index, or the size of the fasta file without index)
+def reference_bases(ref_genome):
+    reference_genome_index=reference_index_path(ref_genome)
+    if os.path.exists(reference_genome_index):
+        with open(reference_genome_index) as fai:
+            return sum(int(line.split("\t")[1]) for line in fai if line.strip())
+    return os.path.getsize(ref_genome) if os.path.exists(ref_genome) else 0
+
+#------------------------------------------------------------------------
+#Function for finding the samples of a run with their FASTQ files and sorted alignment file
+def run_samples(args):
+    if not args.sample_sheet:
+        return [{"sample": None, "fastqs": [args.fastq1, args.fastq2], "alignment": plan_path(args.work_dir, f"gatk_pipeline_sorted.{args.alignment_format}")}]
+    samples=[]
+    for sample in read_sample_sheet(args.sample_sheet):
+        fastqs=[fastq for lane in sample.get("lanes", [sample]) for fastq in (lane["fastq1"], lane["fastq2"])]
+        samples.append({"sample": sample["sample"], "lanes": sample.get("lanes"), "fastqs": fastqs, "alignment": plan_path(args.work_dir, "cohort", sample["sample"], f"{sample['sample']}_sorted.{args.alignment_format}")})
+    return samples
+
+#------------------------------------------------------------------------
+#Function for measuring the input sizes of a run: FASTQ bytes, reference bases and the bytes of the sorted alignment files (None when they do not exist)
+def measure_inputs(args, samples=None):
+    samples=samples or run_samples(args)
+    alignments=[sample["alignment"] for sample in samples]
+    return {
+        "samples": len(samples),
+        "fastq_bytes": sum(os.path.getsize(fastq) for sample in samples for fastq in sample["fastqs"] if os.path.exists(fastq)),
+        "reference_bases": reference_bases(args.ref_genome),
+        "alignment_bytes": sum(os.path.getsize(alignment) for alignment in alignments) if all(os.path.exists(alignment) for alignment in alignments) else None}
+
+#------------------------------------------------------------------------
+#Function for summarizing the step metrics of a run by step: CPU time, wall time, invocations and GC time of the GATK steps (added up), threads per invocation and peak RSS (maximum).
+#Steps restored from the step cache and failed steps are left out
+def summarize_steps(step_metrics):
+    steps={}
+    for metrics in step_metrics:
+        if metrics["cached"] or metrics["returncode"] != 0:
+            continue
+        step=steps.setdefault(step_name(metrics["tool"]), {"cpu_s": 0.0, "wall_s": 0.0, "invocations": 0, "threads": 1, "peak_rss_mb": 0.0})
+        step["cpu_s"]=round(step["cpu_s"] + metrics["user_cpu_s"] + metrics["system_cpu_s"], 3)
+        step["wall_s"]=round(step["wall_s"] + metrics["wall_time_s"], 3)
+        step["invocations"]+=1
+        step["threads"]=max(step["threads"], command_threads(metrics["command"]))
+        step["peak_rss_mb"]=max(step["peak_rss_mb"], metrics["peak_rss_mb"])
+        if metrics.get("gc_time_s") is not None:
+            step["gc_s"]=round(step.get("gc_s", 0.0) + metrics["gc_time_s"], 3)
+    return steps
+
+#------------------------------------------------------------------------
+#Function for appending the record of a finished run to the metrics history
+def append_run_history(history_file, args):
+    with STEP_METRICS_LOCK:
+        step_metrics=list(STEP_METRICS)
+    steps=summarize_steps(step_metrics)
+    if not steps:
+        return None
+
+    record={
+        "end": datetime.datetime.now().isoformat(timespec="seconds"),
+        "mode": "cohort" if args.sample_sheet else "sample",
+        "inputs": measure_inputs(args),
+        "threads": args.threads,
+        "shards": args.shards,
+        "align_chunks": args.align_chunks,
+        "steps": steps}
+    with open(history_file, "a") as history:
+        history.write(json.dumps(record) + "\n")
+    logging.info(f"Run of {len(steps)} steps added to the metrics history '{history_file}'.")
+    return record
+
+#------------------------------------------------------------------------
+#Function for reading the metrics history (the most recent records, lines that cannot be read are skipped)
+def read_run_history(history_file, max_records=HISTORY_RECORDS):
+    if not history_file or not os.path.exists(history_file):
+        return []
+    records=[]
+    with open(history_file) as history:
+        for line in history:
+            try:
+                record=json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and "steps" in record and "inputs" in record:
+                records.append(record)
+    return records[-max_records:]
+
+#------------------------------------------------------------------------
+#Class for the runtime model of the steps, fitted on the metrics history.
+#For every step, the model keeps the median CPU time per unit of its input size, the median parallel efficiency (CPU time / (wall time x threads)) and the highest peak RSS of the history
+class StepModel:
+
+    def __init__(self, history):
+        self.runs=len(history)
+        samples={}
+        ratios=[]
+        for record in history:
+            inputs=record["inputs"]
+            if inputs.get("fastq_bytes") and inputs.get("alignment_bytes"):
+                ratios.append(inputs["alignment_bytes"] / inputs["fastq_bytes"])
+            for step, metrics in record["steps"].items():
+                size=inputs.get(STEP_SIZES.get(step, "fastq_bytes"))
+                if not size or not metrics["wall_s"]:
+                    continue
+                step_samples=samples.setdefault(step, {"cpu_per_unit": [], "efficiency": [], "peak_rss_mb": []})
+                step_samples["cpu_per_unit"].append(metrics["cpu_s"] / size)
+                step_samples["efficiency"].append(min(1.0, metrics["cpu_s"] / (metrics["wall_s"] * max(1, metrics["threads"]))))
+                step_samples["peak_rss_mb"].append(metrics["peak_rss_mb"])
+
+        self.steps={step: {"cpu_per_unit": statistics.median(values["cpu_per_unit"]), "efficiency": statistics.median(values["efficiency"]), "peak_rss_mb": max(values["peak_rss_mb"]), "runs": len(values["cpu_per_unit"])} for step, values in samples.items()}
+        #Size of the sorted alignment per FASTQ byte, for predicting the size of an alignment that does not exist yet
+        self.alignment_ratio=statistics.median(ratios) if ratios else None
+
+    #Function for predicting the size of the sorted alignment of FASTQ files
+    def alignment_bytes(self, fastq_bytes):
+        return round(fastq_bytes * self.alignment_ratio) if self.alignment_ratio is not None else None
+
+    #Function for predicting the CPU time, wall time and peak RSS of a step (None values without history of the step).
+    #The invocations of the step run with threads each, concurrency of them at the same time
+    def predict(self, step, size, threads=1, invocations=1, concurrency=1):
+        model=self.steps.get(step)
+        if model is None or size is None:
+            return {"cpu_s": None, "wall_s": None, "peak_rss_mb": None}
+        cpu_s=model["cpu_per_unit"] * size
+        cores=max(1.0, model["efficiency"] * threads) * max(1, min(invocations, concurrency))
+        return {"cpu_s": round(cpu_s, 1), "wall_s": round(cpu_s / cores, 1), "peak_rss_mb": model["peak_rss_mb"]}
+
+#------------------------------------------------------------------------
+#Class for building the plan of a run: the steps of every stage, whether they run or are skipped, their resources and predicted runtime
+class RunPlan:
+
+    def __init__(self, model, sizes):
+        self.model=model
+        self.sizes=sizes
+        self.steps=[]
+
+    #Function for adding a step to the plan.
+    #tool is the resource profile of the step (see allocate), cores and share are the cores of the step and the number of invocations that share them, and the step runs invocations times
+    def add(self, stage, step, tool, run, sizes=None, cores=None, share=1, invocations=1):
+        resources=allocate(tool, cores=cores, share=share)
+        size=(sizes or self.sizes).get(STEP_SIZES.get(step, "fastq_bytes"))
+        prediction=self.model.predict(step, size, resources["threads"], invocations, share) if run else {"cpu_s": 0.0, "wall_s": 0.0, "peak_rss_mb": None}
+        self.steps.append({"stage": stage, "step": step, "action": "run" if run else "skip", "invocations": invocations, "threads": resources["threads"], "memory_mb": resources["memory_mb"] * min(invocations, share), **{f"predicted_{key}": value for key, value in prediction.items()}})
+        return run
+
+    #Function for the predicted wall time of a stage (the steps of a stage run one after the other, or in a stream for the steps given as concurrent). Steps without history are left out
+    def stage_wall_s(self, stage, concurrent=()):
+        walls=[step["predicted_wall_s"] or 0.0 for step in self.steps if step["stage"] == stage and step["step"] not in concurrent]
+        stream=[step["predicted_wall_s"] or 0.0 for step in self.steps if step["stage"] == stage and step["step"] in concurrent]
+        return round(sum(walls) + max(stream, default=0.0), 1)
+
+    #Function for the steps that run without a prediction (no history of the step)
+    def unpredicted_steps(self):
+        return sorted(set(step["step"] for step in self.steps if step["action"] == "run" and step["predicted_wall_s"] is None))
+
+    #Function for the peak memory that a stage reserves (the steps of a stream are reserved together)
+    def stage_memory_mb(self, stage, concurrent=()):
+        running=[step for step in self.steps if step["stage"] == stage and step["action"] == "run"]
+        return max([sum(step["memory_mb"] for step in running if step["step"] in concurrent)] + [step["memory_mb"] for step in running if step["step"] not in concurrent])
+
+#Steps of the alignment that run at the same time (bwa mem piped into samtools)
+ALIGNMENT_STREAM=("BWA mem", "Samtools fixmate", "Samtools sort", "Samtools markdup")
+
+#------------------------------------------------------------------------
+#Function for planning the alignment of one pair of FASTQ files with the options of the run (the run_bwa flow)
+def plan_alignment(plan, stage, args, run, sizes=None, cores=None, chunks=1):
+    cram=args.alignment_format == "cram"
+    if chunks > 1:
+        plan.add(stage, "BWA mem", "bwa mem", run, sizes, cores, share=chunks, invocations=chunks)
+        if args.mark_duplicates:
+            plan.add(stage, "Samtools fixmate", "samtools fixmate", run, sizes, cores, share=chunks, invocations=chunks)
+        plan.add(stage, "Samtools sort", "samtools sort", run, sizes, cores, share=chunks, invocations=chunks)
+        plan.add(stage, "Samtools merge", "samtools merge", run, sizes, cores)
+        if args.mark_duplicates:
+            plan.add(stage, "Samtools markdup", "samtools markdup", run, sizes, cores)
+        return
+    plan.add(stage, "BWA mem", "bwa mem", run, sizes, cores)
+    if args.mark_duplicates:
+        plan.add(stage, "Samtools fixmate", "samtools fixmate", run, sizes, cores)
+    elif not (args.stream or cram):
+        plan.add(stage, "Samtools view", "samtools view", run, sizes, cores)
+    plan.add(stage, "Samtools sort", "samtools sort", run, sizes, cores)
+    if args.mark_duplicates:
+        plan.add(stage, "Samtools markdup", "samtools markdup", run, sizes, cores)
+
+#------------------------------------------------------------------------
+#Function for planning the reference preparation (reference store assets, or the reference index and dictionary next to the reference)
+def plan_reference(plan, stage, args):
+    if args.reference_store:
+        reference_dir=os.path.join(args.reference_store, reference_checksum(args.ref_genome, os.path.join(args.reference_store, CHECKSUM_CACHE)))
+        for asset, tool in (("fai", "samtools faidx"), ("dict", "samtools dict"), ("bwa", "bwa index")):
+            plan.add(stage, f"Reference {asset}", tool, not os.path.exists(os.path.join(reference_dir, f".{asset}.done")))
+        return
+    plan.add(stage, "Samtools faidx", "samtools faidx", not output_ready(reference_index_path(args.ref_genome), remove_invalid=False))
+    plan.add(stage, "Samtools dict", "samtools dict", not output_ready(reference_dict_path(args.ref_genome), remove_invalid=False))
+
+#------------------------------------------------------------------------
+#Function for planning a single sample run (the stages of run_gatk).
+#A step runs when its outputs are not ready, and every step after a step that runs also runs, because its input is created again
+def plan_sample(plan, args, sample):
+    work_dir=args.work_dir
+    bam_sorted=sample["alignment"]
+    out_vcf=vcf_output_path(plan_path(work_dir, args.out_vcf), args.vcf_format)
+
+    #Quality control
+    if args.qc_engine == "native":
+        qc_stage="Native QC"
+        qc_report=plan_path(work_dir, "qc_results", f"{remove_extension(args.fastq1) or os.path.basename(args.fastq1)}_qc.json")
+        plan.add(qc_stage, "Native QC", "native qc", not output_ready(qc_report, non_empty=True, inputs=[args.fastq1, args.fastq2], remove_invalid=False))
+    else:
+        qc_stage="FASTQC"
+        fastqc_outputs=[plan_path(work_dir, "fastqc_results", f"{remove_extension(fastq)}_fastqc.{extension}") for fastq in (args.fastq1, args.fastq2) for extension in ("zip", "html")]
+        plan.add(qc_stage, "FASTQC", "fastqc", not all(output_ready(output, remove_invalid=False) for output in fastqc_outputs))
+
+    plan_reference(plan, "Reference preparation", args)
+
+    #Alignment
+    dup_metrics=plan_path(work_dir, args.dup_metrics)
+    align=not (output_ready(bam_sorted, remove_invalid=False) and (not args.mark_duplicates or output_ready(dup_metrics, remove_invalid=False)))
+    plan_alignment(plan, "Alignment", args, align, chunks=args.align_chunks)
+
+    #Variant calling
+    plan.add("Variant calling", "Samtools index", "samtools index", align or not output_ready(alignment_index_path(bam_sorted), inputs=[bam_sorted], remove_invalid=False))
+    call=align or not output_ready(out_vcf, non_empty=True, inputs=[bam_sorted], remove_invalid=False)
+    if args.shards > 1:
+        shard_concurrency=min(args.shard_concurrency or args.shards, args.shards)
+        plan.add("Variant calling", "GATK HaplotypeCaller", "gatk HaplotypeCaller", call, share=shard_concurrency, invocations=args.shards)
+        plan.add("Variant calling", "GATK GatherVcfs", "gatk GatherVcfs", call)
+        plan.add("Variant calling", "GATK IndexFeatureFile", "gatk IndexFeatureFile", call)
+    else:
+        plan.add("Variant calling", "GATK HaplotypeCaller", "gatk HaplotypeCaller", call)
+
+    summary_report=f"{out_vcf.removesuffix('.gz').removesuffix('.vcf')}_summary.json"
+    plan.add("VCF summary", "VCF summary", "vcf summary", call or not output_ready(summary_report, non_empty=True, inputs=[out_vcf], remove_invalid=False))
+
+    stages={"Reference preparation": [], "Alignment": [], "Variant calling": ["Alignment", "Reference preparation"], "VCF summary": ["Variant calling"], qc_stage: []}
+    concurrent={"Alignment": ALIGNMENT_STREAM if args.align_chunks == 1 and (args.stream or args.mark_duplicates or args.alignment_format == "cram") else ()}
+    return stages, concurrent
+
+#------------------------------------------------------------------------
+#Function for planning a cohort run (the samples of run_cohort, then the joint genotyping).
+#Every sample is aligned (per lane for a sample with lanes), indexed and called in GVCF mode when its outputs are not ready. The joint genotyping always runs
+def plan_cohort(plan, args, samples):
+    plan_reference(plan, "Reference preparation", args)
+
+    max_workers=min(args.sample_concurrency or len(samples), len(samples))
+    sample_threads=max(1, args.threads // max_workers)
+    stages={"Reference preparation": []}
+    concurrent={}
+    for sample in samples:
+        name=sample["sample"]
+        stage=f"Sample {name}"
+        sizes={"fastq_bytes": sum(os.path.getsize(fastq) for fastq in sample["fastqs"] if os.path.exists(fastq)), "reference_bases": plan.sizes["reference_bases"]}
+        sizes["alignment_bytes"]=os.path.getsize(sample["alignment"]) if os.path.exists(sample["alignment"]) else plan.model.alignment_bytes(sizes["fastq_bytes"])
+        sample_dir=os.path.dirname(sample["alignment"])
+        dup_metrics=os.path.join(sample_dir, f"{name}_markdup_metrics.txt")
+
+        if sample.get("lanes"):
+            #Lanes without sorted BAM file are aligned, then the lanes are merged when one of them is not in the lane manifest of the sample
+            lane_suffix="_fixmate_sorted.bam" if args.mark_duplicates else "_sorted.bam"
+            new_lanes=[lane for lane in sample["lanes"] if not output_ready(os.path.join(sample_dir, "lanes", f"{name}_{lane['lane']}{lane_suffix}"), inputs=[lane["fastq1"], lane["fastq2"]], remove_invalid=False)]
+            merged_lanes=read_lane_manifest(sample["alignment"]) if output_ready(sample["alignment"], remove_invalid=False) else []
+            lane_sizes={**sizes, "fastq_bytes": sum(os.path.getsize(fastq) for lane in new_lanes for fastq in (lane["fastq1"], lane["fastq2"]) if os.path.exists(fastq))}
+            plan.add(stage, "BWA mem", "bwa mem", bool(new_lanes), lane_sizes, sample_threads, share=max(1, len(new_lanes)), invocations=max(1, len(new_lanes)))
+            plan.add(stage, "Samtools sort", "samtools sort", bool(new_lanes), lane_sizes, sample_threads, share=max(1, len(new_lanes)), invocations=max(1, len(new_lanes)))
+            align=bool(new_lanes) or sorted(merged_lanes) != sorted(lane["lane"] for lane in sample["lanes"])
+            plan.add(stage, "Samtools markdup" if args.mark_duplicates else "Samtools merge", "samtools markdup" if args.mark_duplicates else "samtools merge", align, sizes, sample_threads)
+        else:
+            align=not (output_ready(sample["alignment"], remove_invalid=False) and (not args.mark_duplicates or output_ready(dup_metrics, remove_invalid=False)))
+            plan_alignment(plan, stage, args, align, sizes, sample_threads)
+            concurrent[stage]=ALIGNMENT_STREAM if args.stream or args.mark_duplicates or args.alignment_format == "cram" else ()
+
+        plan.add(stage, "Samtools index", "samtools index", align or not output_ready(alignment_index_path(sample["alignment"]), inputs=[sample["alignment"]], remove_invalid=False), sizes, sample_threads)
+        gvcf=os.path.join(sample_dir, f"{name}.g.vcf.gz")
+        plan.add(stage, "GATK HaplotypeCaller GVCF", "gatk HaplotypeCaller", align or not output_ready(gvcf, non_empty=True, inputs=[sample["alignment"]], remove_invalid=False), sizes, sample_threads)
+        stages[stage]=["Reference preparation"]
+
+    plan.add("Joint genotyping", "GATK CombineGVCFs", "gatk CombineGVCFs", True)
+    plan.add("Joint genotyping", "GATK GenotypeGVCFs", "gatk GenotypeGVCFs", True)
+    plan.add("VCF summary", "VCF summary", "vcf summary", True)
+    stages["Joint genotyping"]=[stage for stage in stages if stage.startswith("Sample ")]
+    stages["VCF summary"]=["Joint genotyping"]
+    return stages, concurrent
+
+#------------------------------------------------------------------------
+#Function for the predicted wall time of a run: the end of the last stage, where every stage starts when the stages it depends on end (steps without history count as 0).
+#The samples of a cohort share the cores, so sample_concurrency samples run at the same time
+def predict_run_wall_s(plan, stages, concurrent, sample_concurrency=None):
+    stage_walls={stage: plan.stage_wall_s(stage, concurrent.get(stage, ())) for stage in stages}
+    sample_walls=sorted((wall for stage, wall in stage_walls.items() if stage.startswith("Sample ")), reverse=True)
+    if sample_walls and sample_concurrency:
+        #Samples are started in order as the slots become free, so the longest ones bound the time of all of them
+        slots=[0.0] * min(sample_concurrency, len(sample_walls))
+        for wall in sample_walls:
+            slots[slots.index(min(slots))]+=wall
+        for stage in stage_walls:
+            if stage.startswith("Sample "):
+                stage_walls[stage]=max(slots)
+
+    ends={}
+    def stage_end(stage):
+        if stage not in ends:
+            ends[stage]=max([stage_end(dependency) for dependency in stages[stage] if dependency in stages], default=0.0) + stage_walls[stage]
+        return ends[stage]
+    return round(max(stage_end(stage) for stage in stages), 1)
+
+#------------------------------------------------------------------------
+#Function for recommending the resources of a run on this node: all its cores, the memory that the busiest stage reserves and the HaplotypeCaller shards.
+#A shard gets the PairHMM threads HaplotypeCaller can use well, as many shards run at the same time as the cores and the memory allow, and a shard should have at least MIN_SHARD_CPU_SECONDS of predicted CPU time
+def recommend_resources(args, model, sizes, node_cores, node_memory):
+    budget=ResourceBudget(node_cores, node_memory)
+    hc_profile=TOOL_PROFILES["gatk HaplotypeCaller"]
+    hc_memory_mb=hc_profile["base_mb"] + hc_profile["per_thread_mb"] * hc_profile["max_threads"]
+    shards=max(1, min(budget.cores // hc_profile["max_threads"], budget.memory_mb // hc_memory_mb))
+    hc_step="GATK HaplotypeCaller GVCF" if args.sample_sheet else "GATK HaplotypeCaller"
+    hc_cpu_s=model.predict(hc_step, sizes.get("alignment_bytes"))["cpu_s"]
+    if hc_cpu_s is not None:
+        shards=max(1, min(shards, int(hc_cpu_s // MIN_SHARD_CPU_SECONDS)))
+
+    #Memory reserved by the alignment stream and by the shards that run at the same time
+    stream_memory_mb=allocate("bwa mem", budget=budget)["memory_mb"] + allocate("samtools sort", budget=budget)["memory_mb"]
+    if args.mark_duplicates:
+        stream_memory_mb+=allocate("samtools fixmate", budget=budget)["memory_mb"] + allocate("samtools markdup", budget=budget)["memory_mb"]
+    calling_memory_mb=allocate("gatk HaplotypeCaller", share=shards, budget=budget)["memory_mb"] * shards
+    memory_mb=min(budget.memory_mb, max(stream_memory_mb, calling_memory_mb))
+
+    return {
+        "node_cores": node_cores,
+        "node_memory_mb": node_memory,
+        "threads": budget.cores,
+        "memory_gb": math.ceil(memory_mb / 1024),
+        "shards": 1 if args.sample_sheet else shards,
+        "shard_concurrency": 1 if args.sample_sheet else shards,
+        "tools": {tool: allocate(tool, share=shards if tool == "gatk HaplotypeCaller" and not args.sample_sheet else 1, budget=budget) for tool in ("bwa mem", "samtools sort", "samtools markdup" if args.mark_duplicates else "samtools merge", "gatk HaplotypeCaller")}}
+
+#------------------------------------------------------------------------
+#Function for planning a run without running it.
+#It returns the plan: the input sizes, the steps with their action (run or skip), resources and predicted CPU time, wall time and peak RSS, the predicted wall time of the run and the recommended resources for this node
+def plan_run(args, history_file=None, node_cores=None, node_memory=None):
+    history=read_run_history(history_file)
+    model=StepModel(history)
+    samples=run_samples(args)
+    sizes=measure_inputs(args, samples)
+    if sizes["alignment_bytes"] is None:
+        sizes["alignment_bytes"]=model.alignment_bytes(sizes["fastq_bytes"])
+
+    configure_resources(args.threads, int(args.memory_gb * 1024) if args.memory_gb else None)
+    plan=RunPlan(model, sizes)
+    if args.sample_sheet:
+        stages, concurrent=plan_cohort(plan, args, samples)
+    else:
+        stages, concurrent=plan_sample(plan, args, samples[0])
+
+    return {
+        "history_runs": model.runs,
+        "inputs": sizes,
+        "steps": plan.steps,
+        "stages": {stage: {"predicted_wall_s": plan.stage_wall_s(stage, concurrent.get(stage, ())), "memory_mb": plan.stage_memory_mb(stage, concurrent.get(stage, ()))} for stage in stages},
+        "unpredicted_steps": plan.unpredicted_steps(),
+        "predicted_wall_s": predict_run_wall_s(plan, stages, concurrent, min(args.sample_concurrency or len(samples), len(samples)) if args.sample_sheet else None),
+        "recommendation": recommend_resources(args, model, sizes, node_cores or os.cpu_count() or 1, node_memory or int(node_memory_mb() * DEFAULT_MEMORY_FRACTION))}
+
+#------------------------------------------------------------------------
+#Function for formatting the plan as a table
+def format_plan(plan):
+    def value(number, unit=""):
+        return "-" if number is None else f"{number}{unit}"
+
+    inputs=plan["inputs"]
+    alignment_mb=None if inputs["alignment_bytes"] is None else round(inputs["alignment_bytes"] / 1024**2, 1)
+    lines=[f"Inputs: {inputs['samples']} sample(s), {inputs['fastq_bytes'] / 1024**2:.1f} MB FASTQ, {inputs['reference_bases']} reference bases, {value(alignment_mb, ' MB')} sorted alignment (history: {plan['history_runs']} runs)",
+           f"{'Stage':<24} {'Step':<28} {'Action':<6} {'Runs':>4} {'Threads':>7} {'Mem(MB)':>8} {'CPU(s)':>9} {'Wall(s)':>9} {'RSS(MB)':>8}"]
+    for step in plan["steps"]:
+        lines.append(f"{step['stage'][:24]:<24} {step['step'][:28]:<28} {step['action']:<6} {step['invocations']:>4} {step['threads']:>7} {step['memory_mb']:>8} {value(step['predicted_cpu_s']):>9} {value(step['predicted_wall_s']):>9} {value(step['predicted_peak_rss_mb']):>8}")
+    lines.append(f"Predicted wall time of the run: {plan['predicted_wall_s']} s" + (f" (without the steps that have no history: {', '.join(plan['unpredicted_steps'])})" if plan["unpredicted_steps"] else ""))
+
+    recommendation=plan["recommendation"]
+    lines.append(f"Recommended on this node ({recommendation['node_cores']} cores, {recommendation['node_memory_mb']} MB): --threads {recommendation['threads']} --memory_gb {recommendation['memory_gb']} --shards {recommendation['shards']} --shard_concurrency {recommendation['shard_concurrency']}")
+    lines.append("Thread split: " + ", ".join(f"{tool} {resources['threads']} threads / {resources['memory_mb']} MB" for tool, resources in recommendation["tools"].items()))
+    return "\n".join(lines)
@@ -0,0 +1,325 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from run_gatk_integrity import BGZF_EOF, GZIP_MAGIC
+from run_gatk_reference import reference_index_path, reference_dict_path, asset_paths
+import multiprocessing
+import hashlib
+import logging
+import json
+import gzip
+import time
+import zlib
+import os
+
+#Pre-flight validation of the input files of a run.
+#Every input file (FASTQ files and reference genome) is read once as a stream, in large blocks, by a bounded number of worker processes, so a corrupt or truncated input stops the run before its long steps start. The scan of a file checks its gzip/BGZF integrity and its format and summarizes it (read count and read names of a FASTQ file, sequence layout and checksums of a FASTA file). The pairs of FASTQ files and the reference index, dictionary and bwa index are then checked against the summaries.
+#The summaries of the valid files are cached by file identity (path, device, inode, size and modification time), so repeated runs do not scan the same inputs again
+
+#Size of the blocks (of decompressed data) read from the input files
+BLOCK_BYTES=16 * 1024**2
+
+#Version of the scans, part of the cache key, so the cached summaries of an older scan are not used
+PREFLIGHT_VERSION=1
+
+#------------------------------------------------------------------------
+#Class for the errors found by the scan of a file
+class PreflightError(Exception):
+    pass
+
+#------------------------------------------------------------------------
+#Function for opening an input file as a stream of bytes (gzip or BGZF compressed files are decompressed)
+def open_input(path):
+    with open(path, "rb") as handle:
+        compressed=handle.read(2) == GZIP_MAGIC
+    return gzip.open(path, "rb") if compressed else open(path, "rb")
+
+#------------------------------------------------------------------------
+#Function for reading the lines of an input file in blocks.
+#It yields the complete lines of every block (without the newline) and the incomplete line at the end of the file as the last line. Decompression errors (corrupt or truncated gzip data) raise PreflightError
+def read_line_blocks(path, block_bytes=BLOCK_BYTES):
+    tail=b""
+    try:
+        with open_input(path) as stream:
+            while True:
+                block=stream.read(block_bytes)
+                if not block:
+                    break
+                lines=(tail + block).split(b"\n")
+                tail=lines.pop()
+                yield lines
+    except (EOFError, zlib.error, gzip.BadGzipFile) as e:
+        raise PreflightError(f"corrupt or truncated compressed data ({e})")
+    if tail:
+        yield [tail]
+
+#------------------------------------------------------------------------
+#Function for checking that a BGZF file ends with the BGZF EOF block. A BGZF file cut at a block boundary decompresses without error, so only the EOF block shows that it is complete
+def check_bgzf_eof(path):
+    with open(path, "rb") as handle:
+        head=handle.read(18)
+        if len(head) < 18 or head[:2] != GZIP_MAGIC or not head[3] & 4 or head[12:14] != b"BC":
+            return
+        handle.seek(max(0, os.path.getsize(path) - len(BGZF_EOF)))
+        if handle.read() != BGZF_EOF:
+            raise PreflightError("no BGZF EOF marker (truncated)")
+
+#------------------------------------------------------------------------
+#Function for finding the name of a read that both files of a pair share (the name without the /1 or /2 suffix)
+def read_name(header):
+    name=header[1:].split(maxsplit=1)[0] if len(header) > 1 else b""
+    return name[:-2] if name[-2:] in (b"/1", b"/2") else name
+
+#------------------------------------------------------------------------
+#Function for scanning a FASTQ file: every record has a header (@), a sequence, a separator (+) and qualities of the length of the sequence, and the last record is complete.
+#It returns the number of reads, the SHA-256 of their names (in order), and the names of the first and last reads
+def scan_fastq(fastq, block_bytes=BLOCK_BYTES):
+    names_digest=hashlib.sha256()
+    reads=0
+    first_read=last_read=None
+    leftover=[]
+    for lines in read_line_blocks(fastq, block_bytes):
+        lines=leftover + lines
+        complete=len(lines) - len(lines) % 4
+        leftover=lines[complete:]
+        headers, sequences, separators, qualities=lines[0:complete:4], lines[1:complete:4], lines[2:complete:4], lines[3:complete:4]
+        if not all(header.startswith(b"@") for header in headers) or not all(separator.startswith(b"+") for separator in separators):
+            raise PreflightError(f"malformed FASTQ record after read {reads}")
+        if any(len(sequence) != len(quality) for sequence, quality in zip(sequences, qualities)):
+            raise PreflightError(f"sequence and quality lengths differ after read {reads}")
+        if headers:
+            names=[read_name(header) for header in headers]
+            names_digest.update(b"\n".join(names) + b"\n")
+            first_read=first_read or names[0].decode()
+            last_read=names[-1].decode()
+            reads+=len(headers)
+    if any(leftover):
+        raise PreflightError(f"last record is incomplete (truncated) after read {reads}")
+    if not reads:
+        raise PreflightError("no reads")
+    check_bgzf_eof(fastq)
+    return {"reads": reads, "names_sha256": names_digest.hexdigest(), "first_read": first_read, "last_read": last_read}
+
+#------------------------------------------------------------------------
+#Class for following the layout of the sequences of a FASTA file line by line, like samtools faidx: name, length, offset of the first base, bases and bytes per line, and the MD5 of the upper case sequence (M5 of the sequence dictionary)
+class FastaLayout:
+    def __init__(self):
+        self.sequences=[]
+        self.current=None
+        self.position=0
+
+    def add_line(self, line, width):
+        self.position+=width
+        if line.startswith(b">"):
+            self.finish()
+            name=line[1:].split(maxsplit=1)
+            if not name:
+                raise PreflightError(f"sequence {len(self.sequences) + 1} has no name")
+            self.current={"name": name[0].decode(), "length": 0, "offset": self.position, "line_bases": 0, "line_width": 0, "md5": hashlib.md5(), "last_line": False}
+            return
+
+        bases=line.rstrip(b"\r")
+        sequence=self.current
+        if sequence is None:
+            if bases.strip():
+                raise PreflightError("sequence data before the first header")
+            return
+        if not bases:
+            sequence["last_line"]=True
+            return
+        if sequence["last_line"]:
+            raise PreflightError(f"sequence '{sequence['name']}' has lines of different lengths")
+        if not sequence["line_bases"]:
+            sequence["line_bases"], sequence["line_width"]=len(bases), width
+        elif len(bases) > sequence["line_bases"]:
+            raise PreflightError(f"sequence '{sequence['name']}' has lines of different lengths")
+        elif len(bases) < sequence["line_bases"]:
+            sequence["last_line"]=True
+        sequence["length"]+=len(bases)
+        sequence["md5"].update(bases.upper())
+
+    def finish(self):
+        if self.current:
+            sequence=self.current
+            sequence["md5"]=sequence["md5"].hexdigest()
+            del sequence["last_line"]
+            self.sequences.append(sequence)
+        self.current=None
+        return self.sequences
+
+#------------------------------------------------------------------------
+#Function for scanning a FASTA file: the layout of its sequences (see FastaLayout)
+def scan_fasta(fasta, block_bytes=BLOCK_BYTES):
+    layout=FastaLayout()
+    for lines in read_line_blocks(fasta, block_bytes):
+        for line in lines:
+            layout.add_line(line, len(line) + 1)
+    sequences=layout.finish()
+    if not sequences:
+        raise PreflightError("no sequences")
+    check_bgzf_eof(fasta)
+    return {"sequences": sequences}
+
+#Scans of the input file types
+SCANS={"fastq": scan_fastq, "fasta": scan_fasta}
+
+#------------------------------------------------------------------------
+#Function for scanning one input file in a worker process.
+#It returns the summary of the file, or a dictionary with the error that makes it invalid
+def scan_file(kind, path, block_bytes=BLOCK_BYTES):
+    start_time=time.time()
+    try:
+        summary=SCANS[kind](path, block_bytes)
+    except PreflightError as e:
+        summary={"error": str(e)}
+    except OSError as e:
+        summary={"error": f"cannot be read ({e})"}
+    summary["scan_time_s"]=round(time.time() - start_time, 3)
+    return summary
+
+#------------------------------------------------------------------------
+#Function for checking a pair of FASTQ files: the same number of reads with the same names, in the same order
+def check_fastq_pair(fastq_1, fastq_2, summary_1, summary_2):
+    if summary_1["reads"] != summary_2["reads"]:
+        return f"The paired FASTQ files '{fastq_1}' ({summary_1['reads']} reads) and '{fastq_2}' ({summary_2['reads']} reads) have different read counts."
+    if summary_1["names_sha256"] != summary_2["names_sha256"]:
+        return f"The read names of the paired FASTQ files '{fastq_1}' and '{fastq_2}' do not match (first reads '{summary_1['first_read']}' and '{summary_2['first_read']}', last reads '{summary_1['last_read']}' and '{summary_2['last_read']}')."
+    return None
+
+#------------------------------------------------------------------------
+#Function for checking the .fai index of a reference genome against the layout of its sequences
+def check_fai(fai, sequences):
+    with open(fai) as index:
+        entries=[line.rstrip("\n").split("\t") for line in index if line.strip()]
+    if len(entries) != len(sequences):
+        return f"The reference index '{fai}' lists {len(entries)} sequences, the reference genome has {len(sequences)}."
+    for entry, sequence in zip(entries, sequences):
+        expected=[sequence["name"], str(sequence["length"]), str(sequence["offset"]), str(sequence["line_bases"]), str(sequence["line_width"])]
+        if entry[:5] != expected:
+            return f"The reference index '{fai}' does not match sequence '{sequence['name']}' of the reference genome (index: {' '.join(entry[:5])}, reference: {' '.join(expected)})."
+    return None
+
+#------------------------------------------------------------------------
+#Function for checking the sequence dictionary of a reference genome: names and lengths of the @SQ lines and their M5 checksums (when the dictionary has them)
+def check_dict(reference_dict, sequences):
+    entries=[]
+    with open(reference_dict) as dictionary:
+        for line in dictionary:
+            if line.startswith("@SQ"):
+                entries.append(dict(field.split(":", 1) for field in line.rstrip("\n").split("\t")[1:] if ":" in field))
+    if len(entries) != len(sequences):
+        return f"The sequence dictionary '{reference_dict}' lists {len(entries)} sequences, the reference genome has {len(sequences)}."
+    for entry, sequence in zip(entries, sequences):
+        if entry.get("SN") != sequence["name"] or entry.get("LN") != str(sequence["length"]):
+            return f"The sequence dictionary '{reference_dict}' does not match sequence '{sequence['name']}' of the reference genome (dictionary: {entry.get('SN')} of length {entry.get('LN')}, reference: length {sequence['length']})."
+        if "M5" in entry and entry["M5"].lower() != sequence["md5"]:
+            return f"The sequence dictionary '{reference_dict}' has another MD5 checksum for sequence '{sequence['name']}' than the reference genome."
+    return None
+
+#------------------------------------------------------------------------
+#Function for checking the bwa index of a reference genome: all its files are present and its .ann file lists the names and lengths of the sequences (line "l_pac n_seqs seed", then per sequence "gi name annotation" and "offset length n_ambs")
+def check_bwa_index(ref_genome, sequences):
+    index_files=asset_paths(ref_genome, "bwa")
+    missing=[path for path in index_files if not os.path.isfile(path) or os.path.getsize(path) == 0]
+    if missing:
+        return f"The bwa index of '{ref_genome}' is incomplete (missing or empty: {', '.join(missing)})."
+    ann=index_files[1]
+    with open(ann) as annotations:
+        lines=[line.split() for line in annotations]
+    try:
+        names=[lines[1 + 2 * i][1] for i in range(int(lines[0][1]))]
+        lengths=[int(lines[2 + 2 * i][1]) for i in range(int(lines[0][1]))]
+    except (IndexError, ValueError):
+        return f"The bwa index file '{ann}' cannot be read."
+    if names != [sequence["name"] for sequence in sequences] or lengths != [sequence["length"] for sequence in sequences]:
+        return f"The bwa index '{ann}' does not match the sequences of the reference genome '{ref_genome}'."
+    return None
+
+#------------------------------------------------------------------------
+#Function for checking the reference index, dictionary and bwa index of a reference genome that exist (the missing ones are built by the pipeline)
+def check_reference_indexes(ref_genome, sequences):
+    errors=[]
+    fai=reference_index_path(ref_genome)
+    if os.path.exists(fai):
+        errors.append(check_fai(fai, sequences))
+    reference_dict=reference_dict_path(ref_genome)
+    if os.path.exists(reference_dict):
+        errors.append(check_dict(reference_dict, sequences))
+    if any(os.path.exists(path) for path in asset_paths(ref_genome, "bwa")):
+        errors.append(check_bwa_index(ref_genome, sequences))
+    return [error for error in errors if error]
+
+#------------------------------------------------------------------------
+#Function for finding the cache key of the scan of a file (kind, path and file system identity)
+def file_key(kind, path):
+    stat=os.stat(path)
+    return f"{PREFLIGHT_VERSION}:{kind}:{os.path.realpath(path)}:{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+
+#------------------------------------------------------------------------
+#Functions for reading and writing the cache of the scans (a JSON file). Only the entries of files that did not change are written back, so the cache does not grow with replaced inputs
+def read_preflight_cache(cache_file):
+    try:
+        with open(cache_file) as cache:
+            return json.load(cache)
+    except (OSError, ValueError):
+        return {}
+
+def write_preflight_cache(cache_file, cache):
+    current={}
+    for key, summary in cache.items():
+        version, kind, path=key.rsplit(":", 4)[0].split(":", 2)
+        try:
+            if key == file_key(kind, path):
+                current[key]=summary
+        except OSError:
+            continue
+    tmp_cache=f"{cache_file}.tmp"
+    with open(tmp_cache, "w") as cache:
+        json.dump(current, cache)
+    os.replace(tmp_cache, cache_file)
+
+#------------------------------------------------------------------------
+#Function for validating the input files of a run before its steps start.
+#The FASTQ files (fastq_pairs: pairs of FASTQ files) and the reference genome are scanned at the same time by at most workers processes, except the files whose scan is in the cache. It returns a report with the number of scanned and cached files and the errors found (an empty list when all the inputs are valid)
+def preflight_inputs(fastq_pairs, ref_genome, workers=2, cache_file=None, block_bytes=BLOCK_BYTES):
+    start_time=time.time()
+    files=list(dict.fromkeys([("fastq", fastq) for pair in fastq_pairs for fastq in pair] + [("fasta", ref_genome)]))
+    cache=read_preflight_cache(cache_file) if cache_file else {}
+
+    summaries={}
+    to_scan=[]
+    for kind, path in files:
+        try:
+            key=file_key(kind, path)
+        except OSError as e:
+            summaries[path]={"error": f"cannot be read ({e})"}
+            continue
+        if key in cache:
+            summaries[path]=cache[key]
+        else:
+            to_scan.append((kind, path, key))
+
+    #The workers are spawned, because forking the pipeline process (with the threads of Prefect) can deadlock the workers
+    if to_scan:
+        with ProcessPoolExecutor(max_workers=max(1, min(workers, len(to_scan))), mp_context=multiprocessing.get_context("spawn")) as executor:
+            scans={executor.submit(scan_file, kind, path, block_bytes): (path, key) for kind, path, key in to_scan}
+            for scan in as_completed(scans):
+                path, key=scans[scan]
+                summaries[path]=scan.result()
+                if "error" not in summaries[path]:
+                    cache[key]=summaries[path]
+                logging.info(f"Pre-flight scan of '{path}' done in {summaries[path]['scan_time_s']}s{': ' + summaries[path]['error'] if 'error' in summaries[path] else ''}.")
+
+    errors=[f"Input file '{path}' is invalid: {summary['error']}." for path, summary in summaries.items() if "error" in summary]
+    for fastq_1, fastq_2 in fastq_pairs:
+        if "error" not in summaries[fastq_1] and "error" not in summaries[fastq_2]:
+            errors.append(check_fastq_pair(fastq_1, fastq_2, summaries[fastq_1], summaries[fastq_2]))
+    if "error" not in summaries[ref_genome]:
+        errors+=check_reference_indexes(ref_genome, summaries[ref_genome]["sequences"])
+
+    if cache_file:
+        write_preflight_cache(cache_file, cache)
+    return {
+        "files": len(files),
+        "scanned": len(to_scan),
+        "cached": len(files) - len(to_scan),
+        "errors": [error for error in errors if error],
+        "wall_time_s": round(time.time() - start_time, 3)}
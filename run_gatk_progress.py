@@ -0,0 +1,360 @@
+import http.server
+import collections
+import threading
+import logging
+import socket
+import glob
+import json
+import time
+import re
+import os
+
+#Progress telemetry of the long running steps.
+#The process engine hands every stderr line of a tool to the progress tracker of its process, which parses the progress output of the tool:
+#- bwa mem: "[M::mem_process_seqs] Processed N reads" lines (reads). The total is estimated from the part of the input FASTQ files that bwa has read (Linux /proc/<pid>/fdinfo)
+#- GATK HaplotypeCaller: ProgressMeter lines (loci). The current locus is compared to the intervals of the step (-L, otherwise the contigs of the reference .fai)
+#- samtools sort: temporary files spilled to the scratch directory (the files of its -T prefix, and the "merging from N files" line at the end)
+#The throughput, progress and estimated remaining time of the running steps are served as Prometheus text metrics (http://HOST:PORT/metrics) and logged as JSON lines every interval seconds. A step without progress for STALL_SECONDS is logged as a warning, so stalled or throttled nodes stand out
+
+#Seconds between two progress log lines (default)
+PROGRESS_LOG_SECONDS=60
+
+#Seconds of the sliding window of the throughput
+RATE_WINDOW_SECONDS=120
+
+#Seconds without progress after which a step is reported as stalled
+STALL_SECONDS=900
+
+#------------------------------------------------------------------------
+#Class for the progress of one tool process. The subclasses parse the progress output of their tool
+class StepProgress:
+
+    unit="lines"
+
+    def __init__(self, tool, command, pid):
+        self.tool=tool
+        self.command=[str(arg) for arg in command]
+        self.pid=pid
+        self.start_time=time.time()
+        self.updated_time=self.start_time
+        self.processed=0
+        self.total=None
+        self.samples=collections.deque([(self.start_time, 0)])
+        self.lock=threading.Lock()
+
+    #Function for setting the number of units processed so far
+    def update(self, processed, now=None):
+        now=now or time.time()
+        with self.lock:
+            self.processed=processed
+            self.updated_time=now
+            self.samples.append((now, processed))
+            while len(self.samples) > 2 and now - self.samples[1][0] > RATE_WINDOW_SECONDS:
+                self.samples.popleft()
+
+    #Function for parsing one stderr line of the tool
+    def parse_line(self, line):
+        pass
+
+    #Function for updating the total before a snapshot (for the totals that are measured, not parsed)
+    def refresh(self):
+        pass
+
+    #Function for finding the throughput (units per second over the last RATE_WINDOW_SECONDS)
+    def rate(self):
+        with self.lock:
+            (first_time, first_processed), (last_time, last_processed)=self.samples[0], self.samples[-1]
+        if last_time <= first_time:
+            return 0.0
+        return (last_processed - first_processed) / (last_time - first_time)
+
+    #Function for the state of the step: processed units, throughput, progress, estimated remaining time and seconds since the last progress
+    def snapshot(self, now=None):
+        now=now or time.time()
+        self.refresh()
+        rate=self.rate()
+        progress=min(1.0, self.processed / self.total) if self.total else None
+        eta=(self.total - self.processed) / rate if self.total and rate > 0 and self.total >= self.processed else None
+        return {
+            "step": self.tool,
+            "pid": self.pid,
+            "unit": self.unit,
+            "processed": self.processed,
+            "total": self.total,
+            "rate_per_s": round(rate, 3),
+            "progress": None if progress is None else round(progress, 4),
+            "eta_s": None if eta is None else round(eta, 1),
+            "elapsed_s": round(now - self.start_time, 1),
+            "idle_s": round(now - self.updated_time, 1)}
+
+#------------------------------------------------------------------------
+#Function for reading the fraction of the input files that a process has read (None when it is not known).
+#The read position of every open input file is taken from /proc/<pid>/fdinfo (Linux)
+def input_fraction(pid, paths):
+    sizes={os.path.realpath(path): os.path.getsize(path) for path in paths if os.path.isfile(path)}
+    if not sizes:
+        return None
+    positions={}
+    try:
+        for fd in os.listdir(f"/proc/{pid}/fd"):
+            target=os.readlink(f"/proc/{pid}/fd/{fd}")
+            if target in sizes:
+                with open(f"/proc/{pid}/fdinfo/{fd}") as fdinfo:
+                    positions[target]=int(fdinfo.readline().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    if not positions:
+        return None
+    return sum(min(positions.get(path, 0), size) for path, size in sizes.items()) / sum(sizes.values())
+
+#Progress of bwa mem (reads)
+class BwaProgress(StepProgress):
+
+    unit="reads"
+    PROCESSED=re.compile(r"\[M::mem_process_seqs\] Processed (\d+) reads")
+
+    def parse_line(self, line):
+        match=self.PROCESSED.search(line)
+        if match:
+            self.update(self.processed + int(match.group(1)))
+
+    #The total reads are estimated from the processed reads and the part of the FASTQ files read so far
+    def refresh(self):
+        fastqs=[arg for arg in self.command if re.search(r"\.(fastq|fq)(\.gz)?$", arg)]
+        fraction=input_fraction(self.pid, fastqs)
+        if fraction and self.processed:
+            self.total=max(self.processed, int(self.processed / fraction))
+
+#------------------------------------------------------------------------
+#Function for reading the intervals of a HaplotypeCaller step as (contig, start, end): the contig:start-end lines of its -L file, otherwise the contigs of the reference .fai
+def step_intervals(intervals_file=None, ref_genome=None):
+    intervals=[]
+    try:
+        if intervals_file:
+            with open(intervals_file) as intervals_lines:
+                for line in intervals_lines:
+                    contig, separator, span=line.strip().rpartition(":")
+                    if separator and "-" in span:
+                        start, end=span.split("-")
+                        intervals.append((contig, int(start), int(end)))
+        elif ref_genome:
+            with open(f"{ref_genome}.fai") as fai:
+                for line in fai:
+                    fields=line.split("\t")
+                    intervals.append((fields[0], 1, int(fields[1])))
+    except (OSError, ValueError, IndexError):
+        return []
+    return intervals
+
+#Progress of GATK HaplotypeCaller (loci of its intervals)
+class HaplotypeCallerProgress(StepProgress):
+
+    unit="loci"
+    PROGRESS_METER=re.compile(r"ProgressMeter -\s+(\S+):(\d+)\s+[\d.]+\s+\d+\s+[\d.]+")
+
+    def __init__(self, tool, command, pid):
+        super().__init__(tool, command, pid)
+        self.intervals=step_intervals(argument(self.command, "-L", "--intervals"), argument(self.command, "-R", "--reference"))
+        self.total=sum(end - start + 1 for contig, start, end in self.intervals) or None
+
+    #Function for finding the loci before a locus (the intervals before it and the part of its interval up to it)
+    def loci_done(self, contig, position):
+        done=0
+        for interval_contig, start, end in self.intervals:
+            if interval_contig == contig and start <= position <= end:
+                return done + position - start + 1
+            done+=end - start + 1
+        return None
+
+    def parse_line(self, line):
+        match=self.PROGRESS_METER.search(line)
+        if match:
+            done=self.loci_done(match.group(1), int(match.group(2)))
+            if done is not None:
+                self.update(max(self.processed, done))
+        elif "ProgressMeter - Traversal complete" in line and self.total:
+            self.update(self.total)
+
+#Progress of samtools sort (temporary files spilled to disk)
+class SortProgress(StepProgress):
+
+    unit="spills"
+    MERGING=re.compile(r"merging from (\d+) files")
+
+    def parse_line(self, line):
+        match=self.MERGING.search(line)
+        if match:
+            self.update(max(self.processed, int(match.group(1))))
+
+    #The spills are the temporary files of the -T prefix (<prefix>.NNNN.bam)
+    def refresh(self):
+        prefix=argument(self.command, "-T")
+        if prefix:
+            spills=len(glob.glob(f"{glob.escape(prefix)}.[0-9]*.bam"))
+            if spills > self.processed:
+                self.update(spills)
+
+#------------------------------------------------------------------------
+#Function for reading the value of an option of a command
+def argument(command, *names):
+    for i, arg in enumerate(command[:-1]):
+        if arg in names:
+            return command[i + 1]
+    return None
+
+#------------------------------------------------------------------------
+#Function for choosing the progress tracker of a tool process (None for the tools without progress output)
+def progress_tracker(command, tool, pid):
+    command=[str(arg) for arg in command]
+    program=os.path.basename(command[0]) if command else ""
+    if program == "bwa" and "mem" in command[1:2]:
+        return BwaProgress(tool, command, pid)
+    if program == "gatk" and "HaplotypeCaller" in command:
+        return HaplotypeCallerProgress(tool, command, pid)
+    if program == "samtools" and "sort" in command[1:2]:
+        return SortProgress(tool, command, pid)
+    return None
+
+#------------------------------------------------------------------------
+#Class for the progress of the running steps of a run
+class ProgressRegistry:
+
+    def __init__(self):
+        self.steps={}
+        self.finished_steps=0
+        self.lock=threading.Lock()
+
+    def start(self, progress):
+        with self.lock:
+            self.steps[id(progress)]=progress
+
+    def finish(self, progress):
+        with self.lock:
+            if self.steps.pop(id(progress), None) is not None:
+                self.finished_steps+=1
+
+    def snapshots(self):
+        with self.lock:
+            steps=list(self.steps.values())
+        now=time.time()
+        return [step.snapshot(now) for step in steps]
+
+#Progress of the running steps of the run
+PROGRESS=ProgressRegistry()
+
+#------------------------------------------------------------------------
+#Functions used by the process engine for tracking the progress of a tool process
+def start_progress(command, tool, pid):
+    progress=progress_tracker(command, tool, pid)
+    if progress:
+        PROGRESS.start(progress)
+    return progress
+
+def finish_progress(progress):
+    if progress:
+        PROGRESS.finish(progress)
+
+#------------------------------------------------------------------------
+#Function for writing the progress of the running steps in the Prometheus text format
+def prometheus_metrics(snapshots=None, finished_steps=None):
+    snapshots=PROGRESS.snapshots() if snapshots is None else snapshots
+    finished_steps=PROGRESS.finished_steps if finished_steps is None else finished_steps
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    gauges=[
+        ("gatk_step_processed", "processed", "Units (reads, loci, spills) processed by the running step"),
+        ("gatk_step_total", "total", "Estimated total units of the running step"),
+        ("gatk_step_rate_per_second", "rate_per_s", "Throughput of the running step in units per second"),
+        ("gatk_step_progress_ratio", "progress", "Progress of the running step (0 to 1)"),
+        ("gatk_step_eta_seconds", "eta_s", "Estimated remaining time of the running step in seconds"),
+        ("gatk_step_elapsed_seconds", "elapsed_s", "Run time of the running step in seconds"),
+        ("gatk_step_idle_seconds", "idle_s", "Seconds since the last progress of the running step")]
+    lines=[
+        "# HELP gatk_running_steps Number of running steps with progress tracking",
+        "# TYPE gatk_running_steps gauge",
+        f"gatk_running_steps {len(snapshots)}",
+        "# HELP gatk_finished_steps_total Number of finished steps with progress tracking",
+        "# TYPE gatk_finished_steps_total counter",
+        f"gatk_finished_steps_total {finished_steps}"]
+    for name, key, description in gauges:
+        lines+=[f"# HELP {name} {description}", f"# TYPE {name} gauge"]
+        for snapshot in snapshots:
+            if snapshot[key] is not None:
+                lines.append(f"{name}{{step=\"{escape(snapshot['step'])}\",pid=\"{snapshot['pid']}\",unit=\"{snapshot['unit']}\"}} {snapshot[key]}")
+    return "\n".join(lines) + "\n"
+
+#------------------------------------------------------------------------
+#Class for the HTTP endpoint of the progress metrics (GET /metrics)
+class ProgressHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body=prometheus_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+#------------------------------------------------------------------------
+#Class for the progress reporting of a run: the metrics endpoint and the periodic progress log lines
+class ProgressReporter:
+
+    def __init__(self, port=None, interval=PROGRESS_LOG_SECONDS, host="127.0.0.1"):
+        self.interval=interval
+        self.server=http.server.ThreadingHTTPServer((host, port), ProgressHandler) if port is not None else None
+        self.stop_event=threading.Event()
+        self.threads=[]
+
+    @property
+    def address(self):
+        return self.server.server_address if self.server else None
+
+    def start(self):
+        if self.server:
+            self.threads.append(threading.Thread(target=self.server.serve_forever, name="progress-server", daemon=True))
+            logging.info(f"Progress metrics served at http://{self.address[0]}:{self.address[1]}/metrics.")
+        if self.interval:
+            self.threads.append(threading.Thread(target=self.log_progress, name="progress-log", daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    #Function for logging the progress of every running step every interval seconds
+    def log_progress(self):
+        while not self.stop_event.wait(self.interval):
+            for snapshot in PROGRESS.snapshots():
+                logging.info(f"Progress: {json.dumps({'host': socket.gethostname(), **snapshot})}")
+                if snapshot["idle_s"] >= STALL_SECONDS:
+                    logging.warning(f"{snapshot['step']} made no progress for {snapshot['idle_s']:.0f}s.")
+
+    def stop(self):
+        self.stop_event.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self.threads:
+            thread.join()
+        self.threads=[]
+
+#Progress reporter of the run (None when it is not started)
+PROGRESS_REPORTER=None
+
+#------------------------------------------------------------------------
+#Functions for starting and stopping the progress reporting of the run (no endpoint without port, no log lines with interval 0)
+def start_progress_reporting(port=None, interval=PROGRESS_LOG_SECONDS, host="127.0.0.1"):
+    global PROGRESS_REPORTER
+    stop_progress_reporting()
+    PROGRESS_REPORTER=ProgressReporter(port, interval, host)
+    PROGRESS_REPORTER.start()
+    return PROGRESS_REPORTER
+
+def stop_progress_reporting():
+    global PROGRESS_REPORTER
+    if PROGRESS_REPORTER:
+        PROGRESS_REPORTER.stop()
+        PROGRESS_REPORTER=None
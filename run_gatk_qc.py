@@ -0,0 +1,209 @@
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import multiprocessing
+import numpy as np
+import threading
+import logging
+import json
+import gzip
+import time
+import os
+
+#Native FASTQ quality control.
+#Every FASTQ file is read once as a stream, in blocks of decompressed data, and the blocks are cut at record boundaries into batches of reads. The batches are summarized with NumPy by worker processes and the partial summaries are added up. Only a bounded number of batches is in flight per file, so the memory does not depend on the size of the files
+
+#Size of the decompressed data of one batch of reads
+BATCH_BYTES=8 * 1024**2
+
+#Number of batches in flight per worker
+BATCHES_PER_WORKER=2
+
+#Offset of the Phred quality characters (Sanger / Illumina 1.8+)
+QUALITY_OFFSET=33
+MAX_QUALITY=93
+
+#------------------------------------------------------------------------
+#Function for reading a FASTQ file as batches of complete records.
+#It yields the lines of every batch (4 lines per read) and keeps the incomplete record at the end of a block for the next batch
+def read_fastq_batches(fastq, batch_bytes=BATCH_BYTES):
+    opener=gzip.open if fastq.endswith(".gz") else open
+    leftover=[]
+    with opener(fastq, "rb") as reads:
+        tail=b""
+        while True:
+            block=reads.read(batch_bytes)
+            if not block:
+                break
+            lines=(tail + block).split(b"\n")
+            tail=lines.pop()
+            lines=leftover + lines
+            complete=len(lines) - len(lines) % 4
+            leftover=lines[complete:]
+            if complete:
+                yield lines[:complete]
+        lines=leftover + ([tail] if tail else [])
+        if len(lines) >= 4:
+            yield lines[:len(lines) - len(lines) % 4]
+
+#------------------------------------------------------------------------
+#Function for summarizing one batch of reads with NumPy.
+#Reads of the same length are put in one matrix (reads x positions), so all the counts are vectorized
+def summarize_batch(lines):
+    sequences=lines[1::4]
+    qualities=lines[3::4]
+    lengths=np.fromiter((len(sequence) for sequence in sequences), dtype=np.int64, count=len(sequences))
+    max_length=int(lengths.max()) if len(lengths) else 0
+
+    summary={
+        "reads": len(sequences),
+        "bases": int(lengths.sum()),
+        "length_counts": np.bincount(lengths, minlength=max_length + 1),
+        "quality_counts": np.zeros((max_length, MAX_QUALITY + 1), dtype=np.int64),
+        "n_counts": np.zeros(max_length, dtype=np.int64),
+        "gc_bases": 0,
+        "gc_distribution": np.zeros(101, dtype=np.int64),
+        "read_quality_distribution": np.zeros(MAX_QUALITY + 1, dtype=np.int64)}
+
+    for length in np.unique(lengths):
+        if length == 0:
+            continue
+        selected=np.flatnonzero(lengths == length)
+        bases=np.frombuffer(b"".join(sequences[i] for i in selected), dtype=np.uint8).reshape(len(selected), length)
+        quality=np.frombuffer(b"".join(qualities[i][:length].ljust(length, b"!") for i in selected), dtype=np.uint8).reshape(len(selected), length).astype(np.int64) - QUALITY_OFFSET
+        np.clip(quality, 0, MAX_QUALITY, out=quality)
+
+        #Quality distribution of every position
+        positions=np.broadcast_to(np.arange(length), quality.shape)
+        summary["quality_counts"][:length]+=np.bincount((positions * (MAX_QUALITY + 1) + quality).ravel(), minlength=length * (MAX_QUALITY + 1)).reshape(length, MAX_QUALITY + 1)
+
+        #N content of every position, GC content of every read
+        upper_bases=bases & 0xDF
+        summary["n_counts"][:length]+=(upper_bases == ord("N")).sum(axis=0)
+        gc=((upper_bases == ord("G")) | (upper_bases == ord("C"))).sum(axis=1)
+        summary["gc_bases"]+=int(gc.sum())
+        summary["gc_distribution"]+=np.bincount(np.rint(gc * 100 / length).astype(np.int64), minlength=101)
+
+        #Mean quality of every read
+        summary["read_quality_distribution"]+=np.bincount(np.rint(quality.mean(axis=1)).astype(np.int64), minlength=MAX_QUALITY + 1)
+
+    return summary
+
+#------------------------------------------------------------------------
+#Function for adding the summary of a batch to the summary of a file (the per position arrays grow to the longest read)
+def merge_summaries(total, summary):
+    if total is None:
+        return summary
+    for key, value in summary.items():
+        if isinstance(value, np.ndarray):
+            if len(value) > len(total[key]):
+                total[key], value=value, total[key]
+            total[key][:len(value)]+=value
+        else:
+            total[key]+=value
+    return total
+
+#------------------------------------------------------------------------
+#Function for finding a quantile of every row of a histogram
+def histogram_quantile(counts, quantile):
+    cumulative=np.cumsum(counts, axis=-1)
+    totals=cumulative[..., -1:]
+    return np.where(totals[..., 0] > 0, np.argmax(cumulative >= np.maximum(totals * quantile, 1), axis=-1), 0)
+
+#------------------------------------------------------------------------
+#Function for building the JSON report of one FASTQ file from its summary
+def file_report(fastq, summary, first_read, last_read):
+    quality_counts=summary["quality_counts"]
+    position_reads=quality_counts.sum(axis=1)
+    mean_quality=(quality_counts * np.arange(MAX_QUALITY + 1)).sum(axis=1) / np.maximum(position_reads, 1)
+
+    return {
+        "file": fastq,
+        "reads": summary["reads"],
+        "bases": summary["bases"],
+        "first_read": first_read,
+        "last_read": last_read,
+        "length_distribution": {str(length): int(count) for length, count in enumerate(summary["length_counts"]) if count},
+        "gc_percent": round(100 * summary["gc_bases"] / max(summary["bases"], 1), 2),
+        "gc_distribution": summary["gc_distribution"].tolist(),
+        "mean_quality_per_position": np.round(mean_quality, 2).tolist(),
+        "median_quality_per_position": histogram_quantile(quality_counts, 0.5).tolist(),
+        "lower_quartile_quality_per_position": histogram_quantile(quality_counts, 0.25).tolist(),
+        "n_percent_per_position": np.round(100 * summary["n_counts"] / np.maximum(position_reads, 1), 3).tolist(),
+        "read_mean_quality_distribution": {str(quality): int(count) for quality, count in enumerate(summary["read_quality_distribution"]) if count}}
+
+#------------------------------------------------------------------------
+#Function for the name of a read without its pair suffix (/1, /2) and comment
+def pair_name(header):
+    name=header[1:].split()[0] if header else b""
+    return name[:-2].decode() if name[-2:] in (b"/1", b"/2") else name.decode()
+
+#------------------------------------------------------------------------
+#Function for running the quality control of one FASTQ file with the worker processes of executor.
+#At most max_pending batches are read ahead of the workers
+def qc_fastq(fastq, executor, max_pending, batch_bytes=BATCH_BYTES):
+    total=None
+    pending=set()
+    first_read=last_read=None
+
+    for lines in read_fastq_batches(fastq, batch_bytes):
+        if first_read is None:
+            first_read=pair_name(lines[0])
+        last_read=pair_name(lines[-4])
+        if len(pending) >= max_pending:
+            done, pending=wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                total=merge_summaries(total, future.result())
+        pending.add(executor.submit(summarize_batch, lines))
+
+    for future in pending:
+        total=merge_summaries(total, future.result())
+    if total is None:
+        total=summarize_batch([])
+    return file_report(fastq, total, first_read, last_read)
+
+#------------------------------------------------------------------------
+#Function for running the quality control of a pair of FASTQ files and writing the JSON report.
+#Both files are read at the same time and share the worker processes. The pair is consistent when both files have the same number of reads and their first and last reads have the same names
+def run_fastq_qc(fastq_1, fastq_2, out_report, workers=2, batch_bytes=BATCH_BYTES):
+    start_time=time.time()
+    reports={}
+    errors=[]
+
+    #The workers are spawned, because forking the pipeline process (with the threads of Prefect) can deadlock the workers
+    with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=multiprocessing.get_context("spawn")) as executor:
+        max_pending=max(1, workers) * BATCHES_PER_WORKER
+
+        def qc_file(read, fastq):
+            try:
+                reports[read]=qc_fastq(fastq, executor, max_pending, batch_bytes)
+            except Exception as e:
+                errors.append(e)
+
+        readers=[threading.Thread(target=qc_file, args=(read, fastq)) for read, fastq in [("read_1", fastq_1), ("read_2", fastq_2)]]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+
+    if errors:
+        raise errors[0]
+
+    report_1, report_2=reports["read_1"], reports["read_2"]
+    report={
+        "read_1": report_1,
+        "read_2": report_2,
+        "pairs": {
+            "read_1_count": report_1["reads"],
+            "read_2_count": report_2["reads"],
+            "consistent": report_1["reads"] == report_2["reads"] and report_1["first_read"] == report_2["first_read"] and report_1["last_read"] == report_2["last_read"]},
+        "workers": workers,
+        "wall_time_s": round(time.time() - start_time, 3)}
+
+    tmp_report=f"{out_report}.tmp"
+    with open(tmp_report, "w") as report_file:
+        json.dump(report, report_file, indent=1)
+    os.replace(tmp_report, out_report)
+
+    if not report["pairs"]["consistent"]:
+        logging.warning(f"The paired FASTQ files '{fastq_1}' ({report_1['reads']} reads) and '{fastq_2}' ({report_2['reads']} reads) do not match.")
+    logging.info(f"Native QC of {report_1['reads']} read pairs done in {report['wall_time_s']}s, report written to '{out_report}'.")
+    return report
@@ -0,0 +1,186 @@
+from run_gatk_metrics import run_measured
+import contextlib
+import subprocess
+import functools
+import hashlib
+import logging
+import fcntl
+import json
+import os
+
+#Extensions of the bwa index files
+BWA_INDEX_EXTENSIONS=[".amb", ".ann", ".bwt", ".pac", ".sa"]
+
+#Reference assets of the store: the fasta index, the sequence dictionary and the bwa index
+REFERENCE_ASSETS=["fai", "dict", "bwa"]
+
+#File of the store with the checksums of the reference genomes, so a reference is not read again by the next runs
+CHECKSUM_CACHE="checksums.json"
+
+#------------------------------------------------------------------------
+#Function for finding the path of the fasta index of a reference genome
+def reference_index_path(ref_genome):
+    return f"{ref_genome}.fai"
+
+#------------------------------------------------------------------------
+#Function for finding the path of the sequence dictionary of a reference genome (GATK expects reference.dict next to reference.fasta, also for reference.fasta.gz)
+def reference_dict_path(ref_genome):
+    return f"{os.path.splitext(ref_genome.removesuffix('.gz'))[0]}.dict"
+
+#------------------------------------------------------------------------
+#Function for finding the paths of the files of one asset of a reference genome
+def asset_paths(ref_genome, asset):
+    if asset == "fai":
+        return [reference_index_path(ref_genome)]
+    if asset == "dict":
+        return [reference_dict_path(ref_genome)]
+    return [f"{ref_genome}{extension}" for extension in BWA_INDEX_EXTENSIONS]
+
+#------------------------------------------------------------------------
+#Function for finding the SHA-256 checksum of a reference genome.
+#The checksum is kept in memory for the file system identity of the file (device, inode, size and modification time), so the reference is read only once per run. When cache_file is given, the checksum of the same file identity is read from it (see ReferenceStore.checksum)
+def reference_checksum(ref_genome, cache_file=None):
+    path, identity=file_identity(ref_genome)
+    cached=read_checksum_cache(cache_file).get(path) if cache_file else None
+    if cached and cached["identity"] == identity:
+        return cached["sha256"]
+    return _file_checksum(path, *identity)
+
+#Function for finding the real path and the file system identity (device, inode, size and modification time) of a file
+def file_identity(path):
+    stat=os.stat(path)
+    return os.path.realpath(path), [stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+#Function for reading the checksum cache of a store (real path of every reference: its identity and checksum)
+def read_checksum_cache(cache_file):
+    try:
+        with open(cache_file) as cache:
+            return json.load(cache)
+    except (OSError, ValueError):
+        return {}
+
+@functools.lru_cache(maxsize=None)
+def _file_checksum(path, device, inode, size, mtime_ns):
+    checksum=hashlib.sha256()
+    with open(path, "rb") as reference:
+        for block in iter(lambda: reference.read(8 * 1024**2), b""):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+#------------------------------------------------------------------------
+#Class for the reference asset store.
+#Every reference genome gets its own directory, named by its checksum, with a link to the fasta file and its assets (fai, dict and bwa index) next to it. The link is named by the checksum as well, so a reference given under another file name uses the same assets, and the bwa index in shared memory (found by bwa by the name of the reference) is always the index of this reference. Every asset is built once per reference: a run takes the file lock of the asset before building it, so concurrent runs on the node (or concurrent samples of one run) wait for the run that builds it instead of building it again. The files of an asset are built under temporary names and renamed, and a .done marker is written last, so an interrupted build is started again by the next run.
+class ReferenceStore:
+    def __init__(self, store_dir):
+        self.store_dir=store_dir
+        os.makedirs(store_dir, exist_ok=True)
+
+    #Lock shared by all the runs that use the store (fcntl locks work between processes and, with their own open file, between threads)
+    @contextlib.contextmanager
+    def lock(self, lock_dir, name):
+        with open(os.path.join(lock_dir, f".{name}.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    #Checksum of a reference genome. It is kept in the checksum cache of the store for the real path and identity of the file, so the runs that use the store read a multi-GB reference only once. The entries of references that were replaced or removed are dropped
+    def checksum(self, ref_genome):
+        cache_file=os.path.join(self.store_dir, CHECKSUM_CACHE)
+        checksum=reference_checksum(ref_genome, cache_file)
+        path, identity=file_identity(ref_genome)
+        with self.lock(self.store_dir, "checksums"):
+            cache=read_checksum_cache(cache_file)
+            if cache.get(path) != {"identity": identity, "sha256": checksum}:
+                cache={cached_path: cached for cached_path, cached in cache.items() if os.path.exists(cached_path) and file_identity(cached_path)[1] == cached["identity"]}
+                cache[path]={"identity": identity, "sha256": checksum}
+                with open(f"{cache_file}.tmp", "w") as tmp_cache:
+                    json.dump(cache, tmp_cache)
+                os.replace(f"{cache_file}.tmp", cache_file)
+        return checksum
+
+    def reference_dir(self, ref_genome):
+        return os.path.join(self.store_dir, self.checksum(ref_genome))
+
+    #Path of the reference genome in the store, <checksum>.fasta (or <checksum>.fasta.gz for a compressed reference). The fasta file is hard linked, or symbolic linked across file systems
+    def reference_path(self, ref_genome):
+        reference_dir=self.reference_dir(ref_genome)
+        extension=".fasta.gz" if ref_genome.endswith(".gz") else ".fasta"
+        reference_path=os.path.join(reference_dir, f"{os.path.basename(reference_dir)}{extension}")
+        os.makedirs(reference_dir, exist_ok=True)
+
+        with self.lock(reference_dir, "fasta"):
+            if not os.path.exists(reference_path):
+                try:
+                    os.link(ref_genome, reference_path)
+                except OSError:
+                    os.symlink(os.path.abspath(ref_genome), reference_path)
+        return reference_path
+
+    def is_built(self, reference_path, asset):
+        return os.path.exists(os.path.join(os.path.dirname(reference_path), f".{asset}.done"))
+
+    #Function for building one asset of a reference of the store, if no run built it before.
+    #It returns True when the asset is ready
+    def build(self, reference_path, asset):
+        reference_dir=os.path.dirname(reference_path)
+        if self.is_built(reference_path, asset):
+            logging.info(f"Reference {asset} of '{reference_path}' found in the reference store.")
+            return True
+
+        with self.lock(reference_dir, asset):
+            if self.is_built(reference_path, asset):
+                logging.info(f"Reference {asset} of '{reference_path}' was built by another run.")
+                return True
+
+            out_files=asset_paths(reference_path, asset)
+            if asset == "fai":
+                tmp_files=[f"{out_files[0]}.tmp"]
+                command=["samtools", "faidx", "--fai-idx", tmp_files[0], reference_path]
+            elif asset == "dict":
+                tmp_files=[f"{out_files[0]}.tmp"]
+                command=["samtools", "dict", "-o", tmp_files[0], reference_path]
+            else:
+                tmp_prefix=f"{reference_path}.tmp"
+                tmp_files=[f"{tmp_prefix}{extension}" for extension in BWA_INDEX_EXTENSIONS]
+                command=["bwa", "index", "-p", tmp_prefix, reference_path]
+
+            logging.info(f"------------------Reference {asset} build starts-----------------")
+            try:
+                run_measured(command, f"Reference {asset}", outputs=tmp_files)
+            except subprocess.SubprocessError as e:
+                logging.error(f"Command failed: {command}. {e}")
+                return False
+            except FileNotFoundError:
+                logging.error(f"Tool not found for command: {command}")
+                return False
+
+            for tmp_file, out_file in zip(tmp_files, out_files):
+                os.replace(tmp_file, out_file)
+            open(os.path.join(reference_dir, f".{asset}.done"), "w").close()
+            logging.info(f"------------------Reference {asset} build ends-----------------")
+            return True
+
+    #Function for loading the bwa index of a reference into shared memory with bwa shm, so that concurrent bwa mem processes use it without loading it from disk.
+    #bwa mem finds a loaded index by the name of the reference, so the index is only loaded if no index with this name is loaded yet (the name is the checksum of the reference, so an index with this name is the index of this reference). The lock is shared by the whole store, because the shared memory is shared by the whole node
+    def load_bwa_shm(self, reference_path):
+        with self.lock(self.store_dir, "bwa_shm"):
+            try:
+                listing=subprocess.run(["bwa", "shm", "-l"], capture_output=True, text=True).stdout
+            except FileNotFoundError:
+                logging.error("Tool not found for command: bwa shm")
+                return False
+
+            loaded=[os.path.basename(line.split("\t")[0]) for line in listing.splitlines() if line.strip()]
+            if os.path.basename(reference_path) in loaded:
+                logging.info(f"Bwa index of '{reference_path}' is already loaded in shared memory.")
+                return True
+
+            try:
+                run_measured(["bwa", "shm", reference_path], "BWA shm")
+            except (subprocess.SubprocessError, FileNotFoundError) as e:
+                logging.error(f"Command failed: bwa shm {reference_path}. {e}")
+                return False
+            logging.info(f"Bwa index of '{reference_path}' loaded in shared memory.")
+            return True
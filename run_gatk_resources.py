@@ -0,0 +1,199 @@
+import contextlib
+import functools
+import threading
+import logging
+import os
+
+#Resource profile of the tools:
+#max_threads is the number of threads the tool can use well (None for no limit), base_mb the memory (in MB) the tool needs for itself and per_thread_mb the memory (in MB) needed by every thread. The GATK tools also have max_mb, the memory (in MB) up to which a bigger Java heap still helps them
+TOOL_PROFILES={
+    "bwa mem": {"max_threads": None, "base_mb": 6144, "per_thread_mb": 256},
+    "samtools view": {"max_threads": 8, "base_mb": 256, "per_thread_mb": 64},
+    "samtools sort": {"max_threads": None, "base_mb": 256, "per_thread_mb": 768},
+    "samtools index": {"max_threads": 8, "base_mb": 256, "per_thread_mb": 64},
+    "samtools merge": {"max_threads": 16, "base_mb": 256, "per_thread_mb": 64},
+    "samtools fixmate": {"max_threads": 4, "base_mb": 256, "per_thread_mb": 64},
+    "samtools markdup": {"max_threads": 8, "base_mb": 1024, "per_thread_mb": 64},
+    "samtools faidx": {"max_threads": 1, "base_mb": 512, "per_thread_mb": 0},
+    "samtools dict": {"max_threads": 1, "base_mb": 512, "per_thread_mb": 0},
+    "bwa index": {"max_threads": 1, "base_mb": 5632, "per_thread_mb": 0},
+    "fastqc": {"max_threads": 2, "base_mb": 0, "per_thread_mb": 512},
+    "native qc": {"max_threads": None, "base_mb": 256, "per_thread_mb": 128},
+    "preflight": {"max_threads": None, "base_mb": 256, "per_thread_mb": 128},
+    "vcf summary": {"max_threads": 1, "base_mb": 256, "per_thread_mb": 0},
+    "gatk HaplotypeCaller": {"max_threads": 4, "base_mb": 4096, "per_thread_mb": 512, "max_mb": 16384},
+    "gatk": {"max_threads": 1, "base_mb": 4096, "per_thread_mb": 0, "max_mb": 8192}}
+
+#Share of the memory of the node that is used when no memory budget is given
+DEFAULT_MEMORY_FRACTION=0.8
+
+#Share of the memory of a GATK step that is given to the Java heap (the rest is left for the JVM itself and the native PairHMM)
+JAVA_HEAP_FRACTION=0.85
+
+#Java heap (in MB) from which the GATK steps use the G1 garbage collector instead of the parallel collector (which has the best throughput, with short pauses on small heaps)
+G1_HEAP_MB=16384
+
+#Garbage collectors and PairHMM implementations of the GATK execution profile ("auto" derives them from the step and the node)
+JAVA_GC_CHOICES=["auto", "parallel", "g1"]
+PAIR_HMM_CHOICES=["auto", "FASTEST_AVAILABLE", "AVX_LOGLESS_CACHING_OMP", "AVX_LOGLESS_CACHING", "LOGLESS_CACHING"]
+
+#GATK execution profile of the run
+GATK_PROFILE={"java_gc": "auto", "pair_hmm": "auto"}
+
+#------------------------------------------------------------------------
+#Function for finding the memory of the node in MB
+def node_memory_mb():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 1024**2
+    except (ValueError, OSError, AttributeError):
+        return 8192
+
+#------------------------------------------------------------------------
+#Class for sharing a budget of cores and memory between the tools that run at the same time.
+#A tool is admitted only when its cores and memory are free, otherwise it waits until enough running tools finish. A request bigger than the whole budget is reduced to the whole budget, so that it can always run alone.
+class ResourceBudget:
+    def __init__(self, cores, memory_mb):
+        self.cores=max(1, cores)
+        self.memory_mb=max(1, memory_mb)
+        self.free_cores=self.cores
+        self.free_memory_mb=self.memory_mb
+        self._condition=threading.Condition()
+
+    def acquire(self, cores, memory_mb):
+        cores=min(max(1, cores or 1), self.cores)
+        memory_mb=min(memory_mb or 0, self.memory_mb)
+        with self._condition:
+            self._condition.wait_for(lambda: self.free_cores >= cores and self.free_memory_mb >= memory_mb)
+            self.free_cores-=cores
+            self.free_memory_mb-=memory_mb
+        return cores, memory_mb
+
+    def release(self, cores, memory_mb):
+        with self._condition:
+            self.free_cores+=cores
+            self.free_memory_mb+=memory_mb
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def reserve(self, cores, memory_mb):
+        cores, memory_mb=self.acquire(cores, memory_mb)
+        try:
+            yield
+        finally:
+            self.release(cores, memory_mb)
+
+#Resource budget of the run (by default all the cores and most of the memory of the node)
+RESOURCE_BUDGET=ResourceBudget(os.cpu_count() or 1, int(node_memory_mb() * DEFAULT_MEMORY_FRACTION))
+
+#------------------------------------------------------------------------
+#Function for setting the resource budget of the run.
+#When memory_mb is None, most of the memory of the node is used
+def configure_resources(cores, memory_mb=None):
+    global RESOURCE_BUDGET
+    if memory_mb is None:
+        memory_mb=int(node_memory_mb() * DEFAULT_MEMORY_FRACTION)
+    RESOURCE_BUDGET=ResourceBudget(cores, memory_mb)
+    logging.info(f"Resource budget: {RESOURCE_BUDGET.cores} cores, {RESOURCE_BUDGET.memory_mb} MB memory.")
+    return RESOURCE_BUDGET
+
+#------------------------------------------------------------------------
+#Function for allocating threads and memory to one invocation of a tool.
+#The invocation gets its share of the cores (all the cores of the budget, or cores when given, divided by the number of invocations that share them) up to the threads the tool can use, and the memory that the tool needs for these threads up to its share of the memory budget.
+#A GATK tool gets more memory for its Java heap when the budget has it: its share of the memory budget in proportion to its share of the cores (so concurrent GATK processes split the memory like they split the cores), up to the max_mb of the tool.
+#The budget of the run is used unless another budget is given (e.g. for recommending the resources of a node).
+#It returns a dictionary with threads and memory_mb, which can be passed to the tasks
+def allocate(tool, cores=None, share=1, budget=None):
+    profile=TOOL_PROFILES.get(tool, TOOL_PROFILES["gatk"] if tool.startswith("gatk") else {"max_threads": 1, "base_mb": 256, "per_thread_mb": 0})
+    share=max(1, share)
+    budget=budget or RESOURCE_BUDGET
+
+    threads=max(1, (cores or budget.cores) // share)
+    if profile["max_threads"]:
+        threads=min(threads, profile["max_threads"])
+
+    memory_mb=profile["base_mb"] + profile["per_thread_mb"] * threads
+    if profile.get("max_mb"):
+        memory_share=budget.memory_mb * min(cores or budget.cores, budget.cores) // budget.cores // share
+        memory_mb=max(memory_mb, min(memory_share, profile["max_mb"]))
+    memory_mb=max(1, min(memory_mb, budget.memory_mb // share))
+
+    return {"threads": threads, "memory_mb": memory_mb}
+
+#------------------------------------------------------------------------
+#Function for reserving threads and memory of the run budget while a tool runs (used as "with reserve_resources(threads, memory_mb):")
+def reserve_resources(threads, memory_mb):
+    return RESOURCE_BUDGET.reserve(threads, memory_mb)
+
+#------------------------------------------------------------------------
+#Function for building the thread arguments of samtools (-@ is the number of additional threads)
+def samtools_thread_args(threads):
+    return ["-@", str(threads - 1)] if threads > 1 else []
+
+#------------------------------------------------------------------------
+#Function for building the memory argument of samtools sort (-m is the memory per thread)
+def samtools_sort_memory_args(threads, memory_mb):
+    return ["-m", f"{max(1, memory_mb // threads)}M"] if memory_mb else []
+
+#------------------------------------------------------------------------
+#Function for setting the GATK execution profile of the run: the garbage collector of the JVM and the PairHMM implementation of HaplotypeCaller (one of JAVA_GC_CHOICES and PAIR_HMM_CHOICES)
+def configure_gatk_profile(java_gc="auto", pair_hmm="auto"):
+    if java_gc not in JAVA_GC_CHOICES or pair_hmm not in PAIR_HMM_CHOICES:
+        raise ValueError(f"Unknown GATK execution profile: garbage collector '{java_gc}', PairHMM '{pair_hmm}'.")
+    GATK_PROFILE.update(java_gc=java_gc, pair_hmm=pair_hmm)
+    return GATK_PROFILE
+
+#------------------------------------------------------------------------
+#Function for finding the instruction set extensions of the CPU of the node (None when /proc/cpuinfo does not list them, e.g. on other systems than x86 Linux)
+@functools.lru_cache(maxsize=None)
+def cpu_flags():
+    try:
+        with open("/proc/cpuinfo") as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith("flags"):
+                    return frozenset(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return None
+
+#------------------------------------------------------------------------
+#Function for choosing the PairHMM implementation of HaplotypeCaller.
+#With "auto" it is the AVX implementation of the Intel GKL when the CPU has AVX (its OpenMP version when the step has more than one thread) and the Java implementation otherwise, so GATK does not have to probe for the native library. When the CPU flags are not known, GATK chooses (FASTEST_AVAILABLE)
+def pair_hmm_implementation(threads):
+    if GATK_PROFILE["pair_hmm"] != "auto":
+        return GATK_PROFILE["pair_hmm"]
+    flags=cpu_flags()
+    if flags is None:
+        return "FASTEST_AVAILABLE"
+    if "avx" not in flags:
+        return "LOGLESS_CACHING"
+    return "AVX_LOGLESS_CACHING_OMP" if threads > 1 else "AVX_LOGLESS_CACHING"
+
+#------------------------------------------------------------------------
+#Function for building the PairHMM arguments of GATK HaplotypeCaller: implementation and threads (the GATK defaults are kept when threads is None)
+def pair_hmm_args(threads):
+    if not threads:
+        return []
+    return ["--pair-hmm-implementation", pair_hmm_implementation(threads), "--native-pair-hmm-threads", str(threads)]
+
+#------------------------------------------------------------------------
+#Function for building the garbage collector options of the JVM of a GATK step.
+#With "auto" heaps of G1_HEAP_MB and more use G1, smaller heaps the parallel collector. The GC threads are limited to the threads of the step, otherwise every JVM starts GC threads for all the cores of the node and concurrent GATK processes oversubscribe the CPU
+def java_gc_options(threads, heap_mb):
+    gc_threads=max(1, threads or 1)
+    java_gc=GATK_PROFILE["java_gc"]
+    if java_gc == "auto":
+        java_gc="g1" if heap_mb >= G1_HEAP_MB else "parallel"
+    if java_gc == "g1":
+        return ["-XX:+UseG1GC", f"-XX:ParallelGCThreads={gc_threads}", f"-XX:ConcGCThreads={max(1, gc_threads // 4)}"]
+    return ["-XX:+UseParallelGC", f"-XX:ParallelGCThreads={gc_threads}"]
+
+#------------------------------------------------------------------------
+#Function for building the start of a gatk command with the JVM options that fit the memory and threads of the step: Java heap, garbage collector and GC threads, and the GC log (gc_log) from which the metrics read the GC time of the step
+def gatk_base_command(memory_mb=None, threads=None, gc_log=None):
+    if not memory_mb:
+        return ["gatk"]
+    heap_mb=int(memory_mb * JAVA_HEAP_FRACTION)
+    java_options=[f"-Xmx{heap_mb}m", *java_gc_options(threads, heap_mb)]
+    if gc_log:
+        java_options.append(f"-Xlog:gc:file={gc_log}")
+    return ["gatk", "--java-options", " ".join(java_options)]
@@ -0,0 +1,469 @@
+import zipfile
+import json
+import struct
+import gzip
+import time
+import sys
+import os
+
+#Stand-in versions of bwa, samtools, fastqc and gatk for the benchmark suite.
+#They accept the command lines of the pipeline and write outputs of the right shape (SAM text, BGZF compressed "BAM" and CRAM framed "CRAM" files that hold SAM text, .fai, .dict, VCF and FASTQC files) in a fraction of the time of the real tools, so the orchestration of the pipeline can be measured without the real tools and the hg38 bundle.
+#The latency of every invocation is set with environment variables: GATK_STANDIN_LATENCY (seconds, for all tools) or GATK_STANDIN_LATENCY_<TOOL> (e.g. GATK_STANDIN_LATENCY_BWA), and GATK_STANDIN_SECONDS_PER_MB (seconds per MB of input). With GATK_STANDIN_BUSY=1 the latency is spent on the CPU instead of sleeping, so the tools compete for the cores like the real ones.
+#When GATK_STANDIN_TRACE is set, every invocation appends its start and end time to this file (one JSON line per invocation), which the benchmark uses for measuring the scheduling of the pipeline
+
+#Empty BGZF block at the end of every BGZF file
+BGZF_EOF=bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+#Start (magic bytes, version and file id) and EOF container of the stand-in "CRAM" files, which hold gzipped SAM text
+CRAM_HEADER=b"CRAM\x03\x01" + b"standin".ljust(20, b"\0")
+CRAM_EOF=bytes.fromhex("0f000000ffffffff0fe0454f4600000000010005bdd94f0001000606010001000100ee63014b")
+
+STANDIN_VERSION="standin"
+
+#Reads per progress line of the bwa mem stand-in
+BWA_BATCH_READS=10000
+
+#------------------------------------------------------------------------
+#Function for spending the latency of an invocation
+def simulate_latency(tool, inputs=()):
+    latency=float(os.environ.get(f"GATK_STANDIN_LATENCY_{tool.upper()}", os.environ.get("GATK_STANDIN_LATENCY", "0")))
+    input_mb=sum(os.path.getsize(path) for path in inputs if path != "-" and os.path.isfile(path)) / 1024**2
+    latency+=input_mb * float(os.environ.get("GATK_STANDIN_SECONDS_PER_MB", "0"))
+
+    if os.environ.get("GATK_STANDIN_BUSY") == "1":
+        end_time=time.time() + latency
+        while time.time() < end_time:
+            pass
+    elif latency > 0:
+        time.sleep(latency)
+
+#------------------------------------------------------------------------
+#Functions for reading and writing the files of the stand-in tools
+def open_text(path):
+    if path == "-":
+        data=sys.stdin.buffer.read()
+    else:
+        with open(path, "rb") as handle:
+            data=handle.read()
+    if data[:4] == CRAM_HEADER[:4]:
+        data=data[len(CRAM_HEADER):-len(CRAM_EOF)]
+    if data[:2] == b"\x1f\x8b":
+        data=gzip.decompress(data)
+    return data.decode().splitlines()
+
+def write_output(path, text, compressed=False, cram=False):
+    data=text.encode()
+    if cram:
+        data=CRAM_HEADER + gzip.compress(data, compresslevel=6) + CRAM_EOF
+    elif compressed:
+        data=gzip.compress(data, compresslevel=1) + BGZF_EOF
+    if path in (None, "-"):
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+    else:
+        with open(path, "wb") as handle:
+            handle.write(data)
+
+def option(args, *names, default=None):
+    for name in names:
+        if name in args and args.index(name) + 1 < len(args):
+            return args[args.index(name) + 1]
+    return default
+
+def options(args, name):
+    return [args[i + 1] for i, arg in enumerate(args[:-1]) if arg == name]
+
+#Positional arguments of a command line, without the options that take a value
+def positionals(args, value_options):
+    values=[]
+    skip=False
+    for arg in args:
+        if skip:
+            skip=False
+        elif arg in value_options:
+            skip=True
+        elif not arg.startswith("-") or arg == "-":
+            values.append(arg)
+    return values
+
+def read_fasta(path):
+    sequences={}
+    name=None
+    for line in open_text(path):
+        if line.startswith(">"):
+            name=line[1:].split()[0]
+            sequences[name]=[]
+        elif name:
+            sequences[name].append(line.strip())
+    return {name: "".join(lines) for name, lines in sequences.items()}
+
+def sam_header(sequences, extra_lines=()):
+    lines=["@HD\tVN:1.6\tSO:unsorted"]
+    lines+=[f"@SQ\tSN:{name}\tLN:{len(sequence)}" for name, sequence in sequences.items()]
+    return lines + list(extra_lines)
+
+def split_sam(lines):
+    header=[line for line in lines if line.startswith("@")]
+    records=[line for line in lines if line and not line.startswith("@")]
+    return header, records
+
+def contig_order(header):
+    names=[field[3:] for line in header if line.startswith("@SQ") for field in line.split("\t") if field.startswith("SN:")]
+    return {name: i for i, name in enumerate(names)}
+
+def sort_records(header, records):
+    order=contig_order(header)
+    def key(record):
+        fields=record.split("\t")
+        return (order.get(fields[2], len(order)), int(fields[3]), fields[0])
+    return sorted(records, key=key)
+
+def sorted_header(header):
+    return ["@HD\tVN:1.6\tSO:coordinate" if line.startswith("@HD") else line for line in header]
+
+#------------------------------------------------------------------------
+#Stand-in for bwa (mem, index and shm).
+#bwa mem places every read pair at the position encoded in its name by the read simulator of the benchmark (sim<i>:<contig>:<position 1>:<position 2>); other reads are unmapped
+def standin_bwa(args):
+    if not args:
+        sys.stderr.write(f"\nProgram: bwa (alignment via Burrows-Wheeler transformation)\nVersion: 0.7.18-{STANDIN_VERSION}\n")
+        return 1
+
+    command, args=args[0], args[1:]
+    if command == "index":
+        ref_genome=positionals(args, {"-p", "-a", "-b"})[0]
+        prefix=option(args, "-p", default=ref_genome)
+        simulate_latency("bwa", [ref_genome])
+        for extension in [".amb", ".bwt", ".pac", ".sa"]:
+            write_output(f"{prefix}{extension}", f"{STANDIN_VERSION} bwa index of {os.path.basename(ref_genome)}\n")
+        #The .ann file lists the sequences like the one of bwa index
+        sequences=read_fasta(ref_genome)
+        annotations=[f"{sum(len(sequence) for sequence in sequences.values())} {len(sequences)} 11"]
+        offset=0
+        for name, sequence in sequences.items():
+            annotations+=[f"0 {name} (null)", f"{offset} {len(sequence)} 0"]
+            offset+=len(sequence)
+        write_output(f"{prefix}.ann", "\n".join(annotations) + "\n")
+        return 0
+
+    if command == "shm":
+        return 0
+
+    if command == "mem":
+        ref_genome, fastq_1, fastq_2=positionals(args, {"-t", "-R", "-K", "-k", "-v"})[:3]
+        read_group=option(args, "-R")
+        simulate_latency("bwa", [fastq_1, fastq_2])
+
+        sequences=read_fasta(ref_genome)
+        extra_lines=[]
+        read_group_tag=""
+        if read_group:
+            read_group=read_group.replace("\\t", "\t")
+            extra_lines.append(read_group)
+            read_group_id=[field[3:] for field in read_group.split("\t") if field.startswith("ID:")][0]
+            read_group_tag=f"\tRG:Z:{read_group_id}"
+        extra_lines.append(f"@PG\tID:bwa\tPN:bwa\tVN:0.7.18-{STANDIN_VERSION}")
+
+        lines=sam_header(sequences, extra_lines)
+        reads_1=open_text(fastq_1)
+        reads_2=open_text(fastq_2)
+        for i in range(0, min(len(reads_1), len(reads_2)) - 3, 4):
+            name=reads_1[i][1:].split()[0].removesuffix("/1")
+            parts=name.split(":")
+            contig=":".join(parts[1:-2])
+            mapped=len(parts) >= 4 and contig in sequences
+            position_1, position_2=(int(parts[-2]), int(parts[-1])) if mapped else (0, 0)
+            for read, flag, position, mate_position in [(reads_1, 99, position_1, position_2), (reads_2, 147, position_2, position_1)]:
+                sequence, quality=read[i + 1], read[i + 3]
+                if mapped:
+                    template_length=(position_2 + len(sequence) - position_1) * (1 if flag == 99 else -1)
+                    lines.append(f"{name}\t{flag}\t{contig}\t{position}\t60\t{len(sequence)}M\t=\t{mate_position}\t{template_length}\t{sequence}\t{quality}{read_group_tag}")
+                else:
+                    lines.append(f"{name}\t{77 if flag == 99 else 141}\t*\t0\t0\t*\t*\t0\t0\t{sequence}\t{quality}{read_group_tag}")
+        #Progress lines like bwa mem (one per batch of reads)
+        reads=min(len(reads_1), len(reads_2)) // 4 * 2
+        for batch_start in range(0, reads, BWA_BATCH_READS):
+            sys.stderr.write(f"[M::mem_process_seqs] Processed {min(BWA_BATCH_READS, reads - batch_start)} reads in 0.010 CPU sec, 0.010 real sec\n")
+        write_output(None, "\n".join(lines) + "\n")
+        return 0
+
+    sys.stderr.write(f"[main] unrecognized command '{command}'\n")
+    return 1
+
+#------------------------------------------------------------------------
+#Stand-in for samtools markdup: a read is a duplicate of an earlier read with the same contig, position, strand and mate position.
+#It returns the marked records and the duplication statistics in the format of samtools markdup -f
+def mark_duplicates(records):
+    seen=set()
+    marked=[]
+    stats={"READ": len(records), "EXAMINED": 0, "DUPLICATE PRIMARY TOTAL": 0}
+    for record in records:
+        fields=record.split("\t")
+        flag=int(fields[1])
+        if not flag & 4:
+            stats["EXAMINED"]+=1
+            key=(fields[2], fields[3], flag & 16, fields[7])
+            if key in seen:
+                fields[1]=str(flag | 1024)
+                stats["DUPLICATE PRIMARY TOTAL"]+=1
+            seen.add(key)
+        marked.append("\t".join(fields))
+    stats["DUPLICATE TOTAL"]=stats["DUPLICATE PRIMARY TOTAL"]
+    return marked, stats
+
+#------------------------------------------------------------------------
+#Stand-in for samtools (view, sort, index, merge, fixmate, markdup, faidx and dict)
+def standin_samtools(args):
+    if not args or args[0] == "--version":
+        sys.stdout.write(f"samtools 1.21-{STANDIN_VERSION}\n")
+        return 0
+
+    command, args=args[0], args[1:]
+    value_options={"-@", "-m", "-o", "-T", "-O", "--fai-idx", "--output-fmt", "--reference"}
+    #-f is the metrics file of markdup, but a flag of merge
+    if command == "markdup":
+        value_options.add("-f")
+    inputs=positionals(args, value_options)
+    out_file=option(args, "-o")
+    cram=option(args, "-O", "--output-fmt") == "cram"
+    simulate_latency("samtools", inputs)
+
+    if command == "view":
+        header, records=split_sam(open_text(inputs[0]))
+        write_output(out_file, "\n".join(header + records) + "\n", compressed="-b" in args or "-bS" in args)
+    elif command == "sort":
+        header, records=split_sam(open_text(inputs[0] if inputs else "-"))
+        write_output(out_file, "\n".join(sorted_header(header) + sort_records(header, records)) + "\n", compressed="-u" not in args, cram=cram)
+    elif command == "merge":
+        out_file, bams=inputs[0], inputs[1:]
+        header, records=split_sam(open_text(bams[0]))
+        for bam in bams[1:]:
+            records+=split_sam(open_text(bam))[1]
+        write_output(out_file, "\n".join(sorted_header(header) + sort_records(header, records)) + "\n", compressed="-u" not in args, cram=cram)
+    elif command == "fixmate":
+        header, records=split_sam(open_text(inputs[0]))
+        write_output(inputs[1], "\n".join(header + records) + "\n", compressed="-u" not in args)
+    elif command == "markdup":
+        header, records=split_sam(open_text(inputs[0]))
+        records, stats=mark_duplicates(records)
+        write_output(inputs[1], "\n".join(header + records) + "\n", compressed="-u" not in args, cram=cram)
+        if option(args, "-f"):
+            write_output(option(args, "-f"), "COMMAND: samtools markdup\n" + "".join(f"{key}: {value}\n" for key, value in stats.items()))
+    elif command == "index":
+        bam=inputs[0]
+        out_index=out_file or (inputs[1] if len(inputs) > 1 else f"{bam}.crai" if bam.endswith(".cram") else f"{bam}.bai")
+        contigs=len(contig_order(split_sam(open_text(bam))[0]))
+        with open(out_index, "wb") as index:
+            index.write(gzip.compress(f"{contigs}\n".encode()) if out_index.endswith(".crai") else b"BAI\1" + struct.pack("<i", contigs))
+    elif command == "faidx":
+        ref_genome=inputs[0]
+        offset=0
+        fai_lines=[]
+        with open(ref_genome) as reference:
+            lines=reference.read().splitlines(keepends=True)
+        i=0
+        while i < len(lines):
+            offset+=len(lines[i])
+            name=lines[i][1:].split()[0]
+            i+=1
+            start, length, line_bases, line_width=offset, 0, 0, 0
+            while i < len(lines) and not lines[i].startswith(">"):
+                line_bases=line_bases or len(lines[i].rstrip("\n"))
+                line_width=line_width or len(lines[i])
+                length+=len(lines[i].rstrip("\n"))
+                offset+=len(lines[i])
+                i+=1
+            fai_lines.append(f"{name}\t{length}\t{start}\t{line_bases}\t{line_width}")
+        write_output(option(args, "--fai-idx", default=f"{ref_genome}.fai"), "\n".join(fai_lines) + "\n")
+    elif command == "dict":
+        sequences=read_fasta(inputs[0])
+        lines=["@HD\tVN:1.0\tSO:unsorted"] + [f"@SQ\tSN:{name}\tLN:{len(sequence)}\tUR:file:{os.path.abspath(inputs[0])}" for name, sequence in sequences.items()]
+        write_output(out_file, "\n".join(lines) + "\n")
+    else:
+        sys.stderr.write(f"[main] unrecognized command '{command}'\n")
+        return 1
+    return 0
+
+#------------------------------------------------------------------------
+#Stand-in for fastqc (one zip and one html report per FASTQ file)
+def standin_fastqc(args):
+    if args and args[0] == "--version":
+        sys.stdout.write(f"FastQC v0.12.1-{STANDIN_VERSION}\n")
+        return 0
+
+    fastqs=positionals(args, {"-t", "-o", "--threads", "--outdir"})
+    out_dir=option(args, "-o", "--outdir", default=".")
+    simulate_latency("fastqc", fastqs)
+
+    for fastq in fastqs:
+        base=os.path.basename(fastq)
+        for extension in [".fastq.gz", ".fq.gz", ".fastq", ".fq"]:
+            base=base.removesuffix(extension)
+        total_sequences=len(open_text(fastq)) // 4
+        with zipfile.ZipFile(os.path.join(out_dir, f"{base}_fastqc.zip"), "w") as report:
+            report.writestr(f"{base}_fastqc/fastqc_data.txt", f"##FastQC\t0.12.1\n>>Basic Statistics\tpass\nFilename\t{os.path.basename(fastq)}\nTotal Sequences\t{total_sequences}\n>>END_MODULE\n")
+        write_output(os.path.join(out_dir, f"{base}_fastqc.html"), f"<html><body>FastQC report of {os.path.basename(fastq)}: {total_sequences} sequences</body></html>\n")
+    return 0
+
+#------------------------------------------------------------------------
+#Functions of the gatk stand-in
+def read_intervals(intervals_file):
+    intervals=[]
+    if intervals_file:
+        for line in open_text(intervals_file):
+            contig, span=line.strip().rsplit(":", 1)
+            start, end=span.split("-")
+            intervals.append((contig, int(start), int(end)))
+    return intervals
+
+def vcf_header(sequences, samples, gvcf=False):
+    lines=["##fileformat=VCFv4.2", "##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">"]
+    if gvcf:
+        lines.append("##ALT=<ID=NON_REF,Description=\"Represents any possible alternative allele not already represented at this location\">")
+    lines+=[f"##contig=<ID={name},length={len(sequence)}>" for name, sequence in sequences.items()]
+    lines.append("\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT", *samples]))
+    return lines
+
+#A .vcf.gz file gets a tabix index (.tbi), a .vcf file a Tribble index (.idx), like the VCF files written by GATK
+def write_vcf(out_vcf, lines, index=True):
+    write_output(out_vcf, "\n".join(lines) + "\n", compressed=out_vcf.endswith(".gz"))
+    if index:
+        write_vcf_index(out_vcf)
+
+def write_vcf_index(vcf, out_index=None):
+    if vcf.endswith(".gz"):
+        write_output(out_index or f"{vcf}.tbi", "TBI\1", compressed=True)
+    else:
+        write_output(out_index or f"{vcf}.idx", "TIDX")
+
+def split_vcf(path):
+    lines=open_text(path)
+    header=[line for line in lines if line.startswith("#")]
+    records=[line for line in lines if line and not line.startswith("#")]
+    return header, records
+
+#HaplotypeCaller calls one heterozygous SNV in the middle of every covered 1 kb bin of the genome
+def haplotype_caller(args, sequences):
+    bam=option(args, "-I")
+    out_vcf=option(args, "-O")
+    gvcf=option(args, "-ERC") == "GVCF"
+    intervals=read_intervals(option(args, "-L"))
+
+    header, records=split_sam(open_text(bam))
+    samples=[field[3:] for line in header if line.startswith("@RG") for field in line.split("\t") if field.startswith("SM:")][:1] or ["sample"]
+    bins={}
+    for record in records:
+        fields=record.split("\t")
+        if fields[2] in sequences:
+            key=(fields[2], int(fields[3]) // 1000)
+            bins[key]=bins.get(key, 0) + 1
+
+    order=list(sequences)
+    lines=vcf_header(sequences, samples, gvcf)
+    for (contig, bin_index), reads in sorted(bins.items(), key=lambda item: (order.index(item[0][0]), item[0][1])):
+        position=bin_index * 1000 + 500
+        if position > len(sequences[contig]):
+            continue
+        if intervals and not any(contig == name and start <= position <= end for name, start, end in intervals):
+            continue
+        ref_base=sequences[contig][position - 1].upper()
+        alt_base="ACGT"[("ACGT".index(ref_base) + 1) % 4] if ref_base in "ACGT" else "A"
+        alt=f"{alt_base},<NON_REF>" if gvcf else alt_base
+        lines.append(f"{contig}\t{position}\t.\t{ref_base}\t{alt}\t{min(reads * 10, 1000)}.0\t.\t.\tGT\t0/1")
+    #Progress lines like the GATK ProgressMeter (one per interval, at its end)
+    sys.stderr.write("INFO  ProgressMeter -       Current Locus  Elapsed Minutes     Regions Processed   Regions/Minute\n")
+    for processed, (contig, start, end) in enumerate(intervals or [(name, 1, len(sequence)) for name, sequence in sequences.items()], start=1):
+        sys.stderr.write(f"INFO  ProgressMeter -        {contig}:{end}              0.0                  {processed}           {processed * 60.0}\n")
+    sys.stderr.write("INFO  ProgressMeter - Traversal complete. Processed 0 total regions in 0.0 minutes.\n")
+    write_vcf(out_vcf, lines)
+
+#CombineGVCFs and GenotypeGVCFs join the records of the samples by position
+def combine_vcfs(vcfs, out_vcf, sequences, gvcf):
+    samples=[]
+    calls={}
+    for vcf in vcfs:
+        header, records=split_vcf(vcf)
+        vcf_samples=header[-1].split("\t")[9:]
+        for record in records:
+            fields=record.split("\t")
+            key=(fields[0], int(fields[1]))
+            if key not in calls:
+                calls[key]=(fields[:9], {})
+            calls[key][1].update(zip(vcf_samples, fields[9:]))
+        samples+=[sample for sample in vcf_samples if sample not in samples]
+
+    order=list(sequences)
+    lines=vcf_header(sequences, samples, gvcf)
+    for key in sorted(calls, key=lambda key: (order.index(key[0]) if key[0] in order else len(order), key[1])):
+        fields, genotypes=calls[key]
+        if not gvcf:
+            fields=fields[:4] + [fields[4].replace(",<NON_REF>", "")] + fields[5:]
+        lines.append("\t".join(fields + [genotypes.get(sample, "./.") for sample in samples]))
+    write_vcf(out_vcf, lines)
+
+#------------------------------------------------------------------------
+#Stand-in for gatk (HaplotypeCaller, GatherVcfs, IndexFeatureFile, CombineGVCFs and GenotypeGVCFs). The JVM options are ignored, except the GC log
+def standin_gatk(args):
+    gc_log=None
+    if "--java-options" in args:
+        java_options=args.index("--java-options")
+        gc_log=next((option.split(":file=", 1)[1] for option in args[java_options + 1].split() if option.startswith("-Xlog:gc") and ":file=" in option), None)
+        args=args[:java_options] + args[java_options + 2:]
+    if not args or args[0] == "--version":
+        sys.stdout.write(f"The Genome Analysis Toolkit (GATK) v4.5.0.0-{STANDIN_VERSION}\n")
+        return 0
+
+    command, args=args[0], args[1:]
+    inputs=options(args, "-I") + options(args, "-V")
+    simulate_latency("gatk", inputs)
+    reference=option(args, "-R")
+    sequences=read_fasta(reference) if reference else {}
+
+    if command == "HaplotypeCaller":
+        haplotype_caller(args, sequences)
+    elif command == "GatherVcfs":
+        header, records=split_vcf(inputs[0])
+        for vcf in inputs[1:]:
+            records+=split_vcf(vcf)[1]
+        write_vcf(option(args, "-O"), header + records, index=False)
+    elif command == "IndexFeatureFile":
+        write_vcf_index(inputs[0], option(args, "-O"))
+    elif command in ("CombineGVCFs", "GenotypeGVCFs"):
+        combine_vcfs(inputs, option(args, "-O"), sequences, gvcf=command == "CombineGVCFs")
+    else:
+        sys.stderr.write(f"A USER ERROR has occurred: '{command}' is not a valid command.\n")
+        return 2
+    #GC log of the JVM (unified logging), with one young collection pause
+    if gc_log:
+        write_output(gc_log, "[0.512s][info][gc] Using Parallel\n[1.024s][info][gc] GC(0) Pause Young (Allocation Failure) 64M->8M(245M) 12.500ms\n")
+    return 0
+
+STANDIN_TOOLS={"bwa": standin_bwa, "samtools": standin_samtools, "fastqc": standin_fastqc, "gatk": standin_gatk}
+
+#------------------------------------------------------------------------
+#Function for running a stand-in tool
+def main(tool, args):
+    start_time=time.time()
+    returncode=STANDIN_TOOLS[tool](args)
+
+    trace_file=os.environ.get("GATK_STANDIN_TRACE")
+    if trace_file:
+        with open(trace_file, "a") as trace:
+            trace.write(json.dumps({"tool": tool, "command": " ".join([tool, *[arg for arg in args if not arg.startswith("-")][:1]]), "start": start_time, "end": time.time(), "returncode": returncode}) + "\n")
+    return returncode
+
+#------------------------------------------------------------------------
+#Function for installing the stand-in tools as executables in bin_dir.
+#bin_dir has to be put in front of PATH so that the pipeline runs the stand-in tools instead of the real ones
+def install_standin_tools(bin_dir):
+    os.makedirs(bin_dir, exist_ok=True)
+    module_dir=os.path.dirname(os.path.abspath(__file__))
+    for tool in STANDIN_TOOLS:
+        tool_path=os.path.join(bin_dir, tool)
+        with open(tool_path, "w") as executable:
+            executable.write(f"#!{sys.executable}\nimport sys\nsys.path.insert(0, {module_dir!r})\nfrom run_gatk_standins import main\nsys.exit(main({tool!r}, sys.argv[1:]))\n")
+        os.chmod(tool_path, 0o755)
+    return bin_dir
+
+if __name__=="__main__":
+    sys.exit(main(sys.argv[1], sys.argv[2:]))
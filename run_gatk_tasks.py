@@ -1,59 +1,266 @@
 from run_gatk_extras import *
-from prefect import task
+from run_gatk_resources import *
+from run_gatk_reference import *
+from run_gatk_orchestration import task
+import contextlib
 import os
 
 #------------------------------------------------------------------------
 #Function for converting SAM file to BAM file.
 #Input=SAM -- Output=BAM
 #This task is used by run_bwa flow
+#The threads and memory_mb of every task are reserved from the resource budget of the run while the tool runs
+#Tasks that write the input of a later step raise a RuntimeError when their tool fails, so that the pipeline stops instead of going on without it
 @task
-def convert_sam_to_bam(sam_file, out_bam):
-    samtools_command=["samtools", "view", "-bS", sam_file]
+def convert_sam_to_bam(sam_file, out_bam, threads=1, memory_mb=None):
+    samtools_command=["samtools", "view", "-bS", *samtools_thread_args(threads), sam_file]
     
-    run_subprocess_out_file(samtools_command, out_bam, tool="Samtools view", out_name="bam_output")
+    with reserve_resources(threads, memory_mb):
+        if not run_subprocess_out_file(samtools_command, out_bam, tool="Samtools view", out_name="bam_output"):
+            raise RuntimeError(f"Conversion of '{sam_file}' to BAM failed.")
 
 #------------------------------------------------------------------------
 #Function for sorting BAM file
 #Input: BAM -- Output: Sorted BAM
 #This task is used by run_bwa flow
 @task
-def sort_bam(bam_file, out_sorted_bam_file):
-    samtools_sort_bam=["samtools", "sort", bam_file]
+def sort_bam(bam_file, out_sorted_bam_file, threads=1, memory_mb=None):
+    samtools_sort_bam=["samtools", "sort", *samtools_thread_args(threads), *samtools_sort_memory_args(threads, memory_mb), *sort_temp_args(out_sorted_bam_file), bam_file]
 
-    run_subprocess_out_file(samtools_sort_bam, out_sorted_bam_file, tool="Samtools sort", out_name="sorted_bam_output")
+    with reserve_resources(threads, memory_mb):
+        if not run_subprocess_out_file(samtools_sort_bam, out_sorted_bam_file, tool="Samtools sort", out_name="sorted_bam_output"):
+            raise RuntimeError(f"Sorting of '{bam_file}' failed.")
 
 #------------------------------------------------------------------------
 #Function for indexing the reference genome fasta file
 #Input: Reference genome fasta file -- Output: Indexed reference genome fasta file
 #This task is used by run_HaplotypeCaller flow
 @task
-def index_reference(reference_genome, out_reference_genome_index):
-    samtools_faidx=["samtools", "faidx", reference_genome]
+def index_reference(reference_genome, out_reference_genome_index, threads=1, memory_mb=None):
+    samtools_faidx=["samtools", "faidx", reference_genome, "--fai-idx", out_reference_genome_index]
 
-    run_subprocess_out_file(samtools_faidx, out_reference_genome_index, tool="Samtools faidx", out_name="ref_index")
+    with reserve_resources(threads, memory_mb):
+        if not run_subprocess(samtools_faidx, tool="Samtools faidx", outputs=[out_reference_genome_index]):
+            raise RuntimeError(f"Indexing of the reference genome '{reference_genome}' failed.")
 
 #------------------------------------------------------------------------
 #Function for creating a dictionary file for the reference genome file
 #Input: Reference genome fasta file -- Output: Reference genome fasta dictionary file
 #This task is used by run_HaplotypeCaller flow
 @task
-def dict_reference(reference_genome, reference_genome_dict):
-    ref_dict="data/Homo_sapiens_assembly38.dict"
-
-    if os.path.exists(ref_dict) and os.path.getsize(ref_dict) > 0:
+def dict_reference(reference_genome, reference_genome_dict, threads=1, memory_mb=None):
+    if output_ready(reference_genome_dict, non_empty=True):
         logging.info(f"The Dict file already exists and is not empty.")
         logging.info (f"------------------Creating FASTA dict analysis ends-----------------")
         return
     samtools_dict=["samtools", "dict", reference_genome]
 
-    run_subprocess_out_file(samtools_dict, reference_genome_dict, tool="Samtools dict", out_name="ref_dict")
+    with reserve_resources(threads, memory_mb):
+        if not run_subprocess_out_file(samtools_dict, reference_genome_dict, tool="Samtools dict", out_name="ref_dict"):
+            raise RuntimeError(f"Creating the dictionary of the reference genome '{reference_genome}' failed.")
+
+#------------------------------------------------------------------------
+#Function for building one asset (fai, dict or bwa index) of a reference genome of the reference store
+#Input: Reference genome fasta file of the store -- Output: *.fai, *.dict or *.amb, *.ann, *.bwt, *.pac, *.sa
+#This task is used by prepare_reference_store flow
+@task
+def build_reference_asset(store_dir, reference_path, asset, threads=1, memory_mb=None):
+    with reserve_resources(threads, memory_mb):
+        return ReferenceStore(store_dir).build(reference_path, asset)
 
 #------------------------------------------------------------------------
 #Function for indexing the sorted BAM file
-#Input: Sorted BAM file -- Output: Indexed sorted BAM file
+#Input: Sorted BAM (or CRAM) file -- Output: Index of the sorted BAM file (.bai, or .crai for a CRAM file)
 #This task is used by run_HaplotypeCaller flow
 @task
-def index_bam(bam_sorted, out_index_bam_file):     
-    samtools_index=["samtools", "index", bam_sorted]
+def index_bam(bam_sorted, out_index_bam_file, threads=1, memory_mb=None):     
+    samtools_index=["samtools", "index", *samtools_thread_args(threads), bam_sorted, "-o", out_index_bam_file]
+
+    with reserve_resources(threads, memory_mb):
+        if not run_subprocess(samtools_index, tool="Samtools index", outputs=[out_index_bam_file]):
+            raise RuntimeError(f"Indexing of '{bam_sorted}' failed.")
+
+#------------------------------------------------------------------------
+#Function for calling the variants of a sample
+#Input: Reference genome fasta file, sorted BAM file -- Output: VCF file and its index
+#This task is used by run_HaplotypeCaller flow. HaplotypeCaller writes the VCF file itself (-O): a .vcf.gz file is block gzipped (BGZF) with a tabix index, a .vcf file is plain text with a Tribble index
+@task
+def haplotype_caller(ref_genome, bam_sorted, out_vcf, threads=None, memory_mb=None):
+    haplotypecaller_command=gatk_command("HaplotypeCaller", ["-R", ref_genome, "-I", bam_sorted, "-O", out_vcf, *pair_hmm_args(threads)], out_vcf, threads, memory_mb)
+
+    with reserve_resources(threads, memory_mb), gatk_scratch(out_vcf, memory_mb):
+        return run_subprocess(haplotypecaller_command, tool="GATK HaplotypeCaller", outputs=[out_vcf, vcf_index_path(out_vcf)])
+
+#------------------------------------------------------------------------
+#Function for indexing a VCF file (tabix index for a .vcf.gz file, Tribble index for a .vcf file)
+#Input: VCF file -- Output: *.tbi or *.idx
+#This task is used by run_HaplotypeCaller and run_HaplotypeCaller_scatter flows, for the VCF files written without index (GatherVcfs)
+@task
+def index_vcf(vcf, out_vcf_index, threads=1, memory_mb=None):
+    index_command=gatk_command("IndexFeatureFile", ["-I", vcf, "-O", out_vcf_index], out_vcf_index, threads, memory_mb)
+
+    with reserve_resources(threads, memory_mb), gatk_scratch(out_vcf_index, memory_mb):
+        return run_subprocess(index_command, tool="GATK IndexFeatureFile", outputs=[out_vcf_index])
+
+#------------------------------------------------------------------------
+#Function for calling variants in one interval shard of the genome
+#Input: Reference genome fasta file, sorted BAM file, .intervals file -- Output: Shard VCF file
+#This task is used by run_HaplotypeCaller_scatter flow. The shards of one scatter share a process group, so a failed shard stops the other shards.
+#It is a distributed task: with a worker pool, the shards run on the workers (preferring the workers that hold the BAM file)
+@task(distributed=True, locality=["bam_sorted", "intervals_file"])
+def haplotype_caller_shard(ref_genome, bam_sorted, intervals_file, out_shard_vcf, threads=None, memory_mb=None, process_group=None):
+    haplotypecaller_command=gatk_command("HaplotypeCaller", ["-R", ref_genome, "-I", bam_sorted, "-L", intervals_file, "-O", out_shard_vcf, *pair_hmm_args(threads)], out_shard_vcf, threads, memory_mb)
+
+    with reserve_resources(threads, memory_mb), gatk_scratch(out_shard_vcf, memory_mb):
+        return run_subprocess(haplotypecaller_command, tool=f"GATK HaplotypeCaller {os.path.basename(intervals_file)}", outputs=[out_shard_vcf], process_group=process_group)
+
+#------------------------------------------------------------------------
+#Function for gathering the shard VCF files into one VCF file
+#Input: Shard VCF files (in reference order) -- Output: VCF file
+#This task is used by run_HaplotypeCaller_scatter flow
+@task
+def gather_vcfs(shard_vcfs, out_vcf, threads=1, memory_mb=None):
+    gather_args=["-O", out_vcf]
+    for shard_vcf in shard_vcfs:
+        gather_args+=["-I", shard_vcf]
+    gatk_gather=gatk_command("GatherVcfs", gather_args, out_vcf, threads, memory_mb)
+
+    with reserve_resources(threads, memory_mb), gatk_scratch(out_vcf, memory_mb):
+        return run_subprocess(gatk_gather, tool="GATK GatherVcfs", outputs=[out_vcf])
+
+#------------------------------------------------------------------------
+#Function for calling the variants of one sample in GVCF mode
+#Input: Reference genome fasta file, sorted BAM file -- Output: GVCF file (*.g.vcf.gz)
+#This task is used by run_cohort flow
+@task
+def haplotype_caller_gvcf(ref_genome, bam_sorted, out_gvcf, threads=None, memory_mb=None):
+    haplotypecaller_command=gatk_command("HaplotypeCaller", ["-R", ref_genome, "-I", bam_sorted, "-O", out_gvcf, "-ERC", "GVCF", *pair_hmm_args(threads)], out_gvcf, threads, memory_mb)
+
+    with reserve_resources(threads, memory_mb), gatk_scratch(out_gvcf, memory_mb):
+        return run_subprocess(haplotypecaller_command, tool=f"GATK HaplotypeCaller GVCF {os.path.basename(bam_sorted)}", outputs=[out_gvcf, f"{out_gvcf}.tbi"])
+
+#------------------------------------------------------------------------
+#Function for combining the GVCF files of the samples of a cohort
+#Input: Reference genome fasta file, GVCF files -- Output: Cohort GVCF file
+#This task is used by run_cohort flow
+@task
+def combine_gvcfs(ref_genome, gvcfs, out_cohort_gvcf, threads=1, memory_mb=None):
+    combine_args=["-R", ref_genome, "-O", out_cohort_gvcf]
+    for gvcf in gvcfs:
+        combine_args+=["-V", gvcf]
+    gatk_combine=gatk_command("CombineGVCFs", combine_args, out_cohort_gvcf, threads, memory_mb)
+
+    with reserve_resources(threads, memory_mb), gatk_scratch(out_cohort_gvcf, memory_mb):
+        return run_subprocess(gatk_combine, tool="GATK CombineGVCFs", outputs=[out_cohort_gvcf, f"{out_cohort_gvcf}.tbi"])
+
+#------------------------------------------------------------------------
+#Function for joint genotyping the cohort GVCF file
+#Input: Reference genome fasta file, cohort GVCF file -- Output: VCF file
+#This task is used by run_cohort flow
+@task
+def genotype_gvcfs(ref_genome, cohort_gvcf, out_vcf, threads=1, memory_mb=None):
+    gatk_genotype=gatk_command("GenotypeGVCFs", ["-R", ref_genome, "-V", cohort_gvcf, "-O", out_vcf], out_vcf, threads, memory_mb)
+
+    with reserve_resources(threads, memory_mb), gatk_scratch(out_vcf, memory_mb):
+        return run_subprocess(gatk_genotype, tool="GATK GenotypeGVCFs", outputs=[out_vcf, vcf_index_path(out_vcf)])
+
+#------------------------------------------------------------------------
+#Function for building a GATK command with the execution profile of the step.
+#When the step has its resources (memory_mb), the JVM gets its Java heap, garbage collector and GC threads from the memory and threads of the step and writes its GC log, and GATK writes its temporary files (--tmp-dir), in the scratch directory of the step. Without resources the GATK defaults are kept
+def gatk_command(gatk_tool, arguments, out_file, threads=None, memory_mb=None):
+    if not memory_mb:
+        return ["gatk", gatk_tool, *arguments]
+    step_dir=gatk_scratch_dir(out_file)
+    return [*gatk_base_command(memory_mb, threads, gc_log=os.path.join(step_dir, "gc.log")), gatk_tool, *arguments, "--tmp-dir", step_dir]
+
+#------------------------------------------------------------------------
+#Function for removing the scratch directory of a GATK step when the step is done (used as "with gatk_scratch(out_file, memory_mb):")
+@contextlib.contextmanager
+def gatk_scratch(out_file, memory_mb=None):
+    try:
+        yield
+    finally:
+        if memory_mb:
+            remove_intermediates(gatk_scratch_dir(out_file))
+
+#------------------------------------------------------------------------
+#Function for building the output format arguments of the samtools command that writes the final alignment file.
+#A .cram file is written as CRAM, compressed against the reference genome (reference-based compression), other files are written as BAM
+def alignment_format_args(out_file, ref_genome):
+    if out_file.endswith(".cram"):
+        return ["-O", "cram", "--reference", ref_genome]
+    return []
+
+#------------------------------------------------------------------------
+#Function for finding the index file of an alignment file (.crai for CRAM, .bai for BAM)
+def alignment_index_path(alignment_file):
+    return f"{alignment_file}.crai" if alignment_file.endswith(".cram") else f"{alignment_file}.bai"
+
+#------------------------------------------------------------------------
+#Function for finding the index file of a VCF file (.tbi for a block gzipped .vcf.gz file, .idx for a plain .vcf file)
+def vcf_index_path(vcf):
+    return f"{vcf}.tbi" if vcf.endswith(".gz") else f"{vcf}.idx"
+
+#------------------------------------------------------------------------
+#Function for finding the path of the output VCF file (vcf.gz: block gzipped with tabix index, vcf: plain text).
+#The format comes from the .vcf.gz or .vcf extension of out_vcf, which is kept. vcf_format only applies to an out_vcf without one of these extensions, which gets the extension of the format (default vcf.gz). A vcf_format that does not match the extension of out_vcf raises a ValueError
+def vcf_output_path(out_vcf, vcf_format=None):
+    extension="vcf.gz" if out_vcf.endswith(".vcf.gz") else "vcf" if out_vcf.endswith(".vcf") else None
+    if extension is None:
+        return f"{out_vcf}.{vcf_format or 'vcf.gz'}"
+    if vcf_format and vcf_format != extension:
+        raise ValueError(f"the output VCF file '{out_vcf}' is not a {vcf_format} file")
+    return out_vcf
+
+#------------------------------------------------------------------------
+#Function for building the samtools commands that mark the duplicates of the bwa mem output in the alignment stream (bwa mem | fixmate | sort | markdup).
+#Samtools fixmate -m adds the mate tags that markdup needs (bwa mem writes the mates of a pair next to each other, so no name sorting is needed), samtools sort sorts the reads by coordinate and samtools markdup marks the duplicates, writes out_bam (CRAM compressed against ref_genome for a .cram file) and writes the duplication metrics to metrics_file. The BAM streams between the tools are uncompressed (-u), so only out_bam is compressed
+def duplicate_marking_commands(out_bam, metrics_file, fixmate_threads=1, sort_threads=1, sort_memory_mb=None, markdup_threads=1, ref_genome=None):
+    return [
+        ["samtools", "fixmate", "-m", "-u", *samtools_thread_args(fixmate_threads), "-", "-"],
+        ["samtools", "sort", "-u", *samtools_thread_args(sort_threads), *samtools_sort_memory_args(sort_threads, sort_memory_mb), *sort_temp_args(out_bam), "-"],
+        ["samtools", "markdup", *samtools_thread_args(markdup_threads), *alignment_format_args(out_bam, ref_genome), "-f", metrics_file, "-", out_bam]]
+
+#------------------------------------------------------------------------
+#Function for aligning one chunk of the paired reads and sorting the alignments
+#Input: Chunk of the paired reads, reference genome fasta file -- Output: Sorted BAM file of the chunk
+#This task is used by run_bwa_sharded flow. It raises a RuntimeError when the alignment fails, so that prefect retries only this chunk.
+#With fixmate, samtools fixmate -m runs between bwa mem and samtools sort, so the duplicates of the merged chunks can be marked.
+#It is a distributed task: with a worker pool, the chunks run on the workers (preferring the workers that hold the chunk files) and a chunk whose worker was lost is retried on another worker
+@task(retries=2, retry_delay_seconds=10, distributed=True, locality=["chunk_1", "chunk_2"])
+def align_chunk(chunk_1, chunk_2, ref_genome, read_group_info, out_chunk_bam, threads=1, memory_mb=None, sort_memory_mb=None, fixmate=False):
+    bwa_command=["bwa", "mem", "-t", str(threads), "-R", read_group_info, ref_genome, chunk_1, chunk_2]
+    samtools_sort_command=["samtools", "sort", *samtools_thread_args(threads), *samtools_sort_memory_args(threads, sort_memory_mb), *sort_temp_args(out_chunk_bam), "-o", out_chunk_bam, "-"]
+    commands=[bwa_command, samtools_sort_command]
+    tools=[f"BWA mem {os.path.basename(chunk_1)}", "Samtools sort"]
+    if fixmate:
+        commands.insert(1, ["samtools", "fixmate", "-m", "-u", "-", "-"])
+        tools.insert(1, "Samtools fixmate")
+
+    with reserve_resources(threads, (memory_mb or 0) + (sort_memory_mb or 0)):
+        if not run_subprocess_pipe(commands, tools=tools, outputs=[out_chunk_bam]):
+            raise RuntimeError(f"Alignment of chunk '{chunk_1}' failed.")
+    return True
+
+#------------------------------------------------------------------------
+#Function for merging sorted BAM files into one sorted BAM file
+#Input: Sorted BAM files -- Output: Sorted BAM file (or CRAM file, compressed against ref_genome)
+#This task is used by run_bwa_sharded flow
+@task
+def merge_bams(bams, out_bam, threads=1, memory_mb=None, ref_genome=None):
+    samtools_merge=["samtools", "merge", "-f", *samtools_thread_args(threads), *alignment_format_args(out_bam, ref_genome), out_bam, *bams]
+
+    with reserve_resources(threads, memory_mb):
+        return run_subprocess(samtools_merge, tool="Samtools merge", outputs=[out_bam])
+
+#------------------------------------------------------------------------
+#Function for merging sorted BAM files and marking their duplicates in one stream (samtools merge | samtools markdup)
+#Input: Sorted BAM files with the mate tags of samtools fixmate -m -- Output: Sorted BAM file (or CRAM file, compressed against ref_genome) with the duplicates marked, duplication metrics
+#This task is used by run_bwa_sharded flow. The merged BAM stream is uncompressed, so only out_bam is written to disk
+@task
+def merge_mark_duplicates(bams, out_bam, metrics_file, threads=1, memory_mb=None, markdup_threads=1, ref_genome=None):
+    samtools_merge=["samtools", "merge", "-u", "-f", *samtools_thread_args(threads), "-", *bams]
+    samtools_markdup=["samtools", "markdup", *samtools_thread_args(markdup_threads), *alignment_format_args(out_bam, ref_genome), "-f", metrics_file, "-", out_bam]
 
-    run_subprocess_out_file(samtools_index, out_index_bam_file, tool="Samtools index", out_name="bam_index")
\ No newline at end of file
+    with reserve_resources(max(threads, markdup_threads), memory_mb):
+        return run_subprocess_pipe([samtools_merge, samtools_markdup], tools=["Samtools merge", "Samtools markdup"], outputs=[out_bam, metrics_file])
@@ -0,0 +1,179 @@
+import collections
+import logging
+import json
+import gzip
+import os
+
+#Streaming summary of a VCF file.
+#The VCF file (plain or block gzipped) is read once as a stream, in batches of records. Every batch is summarized on its own and the batch summaries are added up, so the memory does not depend on the size of the file: variant counts by type and by chromosome, transitions and transversions (Ti/Tv ratio), filters and the QUAL distribution
+
+#Number of records of one batch
+BATCH_RECORDS=50000
+
+#Width of the bins of the QUAL histogram and QUAL of the last bin (QUAL >= MAX_QUAL)
+QUAL_BIN_WIDTH=10
+MAX_QUAL=1000
+
+#Transitions (purine <-> purine, pyrimidine <-> pyrimidine), every other SNV is a transversion
+TRANSITIONS={("A", "G"), ("G", "A"), ("C", "T"), ("T", "C")}
+
+#------------------------------------------------------------------------
+#Function for reading the records of a VCF file as batches of lines (the header lines are skipped)
+def read_vcf_batches(vcf, batch_records=BATCH_RECORDS):
+    opener=gzip.open if vcf.endswith((".gz", ".bgz")) else open
+    batch=[]
+    with opener(vcf, "rt") as records:
+        for line in records:
+            if line.startswith("#") or not line.strip():
+                continue
+            batch.append(line)
+            if len(batch) >= batch_records:
+                yield batch
+                batch=[]
+    if batch:
+        yield batch
+
+#------------------------------------------------------------------------
+#Function for finding the type of an alternative allele: SNV, MNV, insertion, deletion, complex, symbolic (<DEL>, breakends) or spanning deletion (*)
+def allele_type(ref, alt):
+    if alt == "*":
+        return "spanning_deletion"
+    if alt.startswith("<") or "[" in alt or "]" in alt or alt == ".":
+        return "symbolic"
+    if len(ref) == len(alt):
+        return "snv" if len(ref) == 1 else "mnv"
+    if len(ref) < len(alt) and alt.startswith(ref[0]) and len(ref) == 1:
+        return "insertion"
+    if len(ref) > len(alt) and ref.startswith(alt[0]) and len(alt) == 1:
+        return "deletion"
+    return "complex"
+
+#------------------------------------------------------------------------
+#Function for an empty summary
+def empty_summary():
+    return {
+        "records": 0,
+        "alleles": 0,
+        "multiallelic": 0,
+        "passed": 0,
+        "types": collections.Counter(),
+        "chromosomes": collections.Counter(),
+        "filters": collections.Counter(),
+        "transitions": 0,
+        "transversions": 0,
+        "qual_missing": 0,
+        "qual_sum": 0.0,
+        "qual_min": None,
+        "qual_max": None,
+        "qual_histogram": [0] * (MAX_QUAL // QUAL_BIN_WIDTH + 1)}
+
+#------------------------------------------------------------------------
+#Function for summarizing one batch of records
+def summarize_batch(lines):
+    summary=empty_summary()
+    for line in lines:
+        fields=line.rstrip("\n").split("\t", 7)
+        if len(fields) < 7:
+            continue
+        chrom, ref, alts, qual, filters=fields[0], fields[3].upper(), fields[4].upper(), fields[5], fields[6]
+        summary["records"]+=1
+        summary["chromosomes"][chrom]+=1
+
+        #Filters
+        if filters in ("PASS", "."):
+            summary["passed"]+=1
+        for name in filters.split(";"):
+            summary["filters"][name]+=1
+
+        #Alternative alleles (the <NON_REF> allele of GVCF files is not a variant)
+        alleles=[alt for alt in alts.split(",") if alt != "<NON_REF>"]
+        if len(alleles) > 1:
+            summary["multiallelic"]+=1
+        for alt in alleles:
+            kind=allele_type(ref, alt)
+            summary["alleles"]+=1
+            summary["types"][kind]+=1
+            if kind == "snv":
+                if (ref, alt) in TRANSITIONS:
+                    summary["transitions"]+=1
+                else:
+                    summary["transversions"]+=1
+
+        #QUAL distribution
+        try:
+            value=float(qual)
+        except ValueError:
+            summary["qual_missing"]+=1
+            continue
+        summary["qual_sum"]+=value
+        summary["qual_min"]=value if summary["qual_min"] is None else min(summary["qual_min"], value)
+        summary["qual_max"]=value if summary["qual_max"] is None else max(summary["qual_max"], value)
+        summary["qual_histogram"][min(int(max(value, 0) // QUAL_BIN_WIDTH), MAX_QUAL // QUAL_BIN_WIDTH)]+=1
+    return summary
+
+#------------------------------------------------------------------------
+#Function for adding the summary of a batch to the total summary
+def merge_summaries(total, summary):
+    for key in ("records", "alleles", "multiallelic", "passed", "transitions", "transversions", "qual_missing", "qual_sum"):
+        total[key]+=summary[key]
+    for key in ("types", "chromosomes", "filters"):
+        total[key].update(summary[key])
+    for key, choose in (("qual_min", min), ("qual_max", max)):
+        values=[value for value in (total[key], summary[key]) if value is not None]
+        total[key]=choose(values) if values else None
+    total["qual_histogram"]=[a + b for a, b in zip(total["qual_histogram"], summary["qual_histogram"])]
+    return total
+
+#------------------------------------------------------------------------
+#Function for finding a quantile of the QUAL histogram (lower edge of the bin that holds it)
+def qual_quantile(histogram, quantile):
+    total=sum(histogram)
+    if not total:
+        return None
+    count=0
+    for i, bin_count in enumerate(histogram):
+        count+=bin_count
+        if count >= quantile * total:
+            return i * QUAL_BIN_WIDTH
+    return (len(histogram) - 1) * QUAL_BIN_WIDTH
+
+#------------------------------------------------------------------------
+#Function for the report of a summary (JSON compatible)
+def summary_report(vcf, summary):
+    qual_records=summary["records"] - summary["qual_missing"]
+    histogram=summary["qual_histogram"]
+    return {
+        "vcf": vcf,
+        "records": summary["records"],
+        "alleles": summary["alleles"],
+        "multiallelic_records": summary["multiallelic"],
+        "passed_records": summary["passed"],
+        "variant_types": dict(sorted(summary["types"].items())),
+        "chromosomes": dict(summary["chromosomes"]),
+        "filters": dict(sorted(summary["filters"].items())),
+        "transitions": summary["transitions"],
+        "transversions": summary["transversions"],
+        "ti_tv_ratio": round(summary["transitions"] / summary["transversions"], 4) if summary["transversions"] else None,
+        "qual": {
+            "missing": summary["qual_missing"],
+            "mean": round(summary["qual_sum"] / qual_records, 2) if qual_records else None,
+            "min": summary["qual_min"],
+            "max": summary["qual_max"],
+            "median_bin": qual_quantile(histogram, 0.5),
+            "histogram": {(f"{i * QUAL_BIN_WIDTH}-{(i + 1) * QUAL_BIN_WIDTH}" if i < len(histogram) - 1 else f">={MAX_QUAL}"): count for i, count in enumerate(histogram) if count}}}
+
+#------------------------------------------------------------------------
+#Function for summarizing a VCF file and writing the JSON report.
+#Input: VCF file (*.vcf or *.vcf.gz) -- Output: JSON report
+def write_vcf_summary(vcf, out_report, batch_records=BATCH_RECORDS):
+    total=empty_summary()
+    for batch in read_vcf_batches(vcf, batch_records):
+        merge_summaries(total, summarize_batch(batch))
+    report=summary_report(vcf, total)
+
+    tmp_report=f"{out_report}.tmp"
+    with open(tmp_report, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+    os.replace(tmp_report, out_report)
+    logging.info(f"VCF summary of '{vcf}': {report['records']} records, {report['variant_types'].get('snv', 0)} SNVs, Ti/Tv {report['ti_tv_ratio']}. Report written to '{out_report}'.")
+    return report
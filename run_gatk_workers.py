@@ -0,0 +1,321 @@
+from run_gatk_resources import ResourceBudget, node_memory_mb, DEFAULT_MEMORY_FRACTION
+import multiprocessing.connection
+import concurrent.futures
+import multiprocessing
+import threading
+import importlib
+import traceback
+import inspect
+import argparse
+import logging
+import pickle
+import socket
+import time
+import sys
+import os
+
+#Distributed execution of the shard tasks of the pipeline on worker processes of other nodes.
+#A worker (python run_gatk_workers.py --listen HOST:PORT) runs on every node and accepts tasks from the runs whose --workers option lists it. The tasks declared with task(distributed=True) (alignment chunks, HaplotypeCaller interval shards, cohort samples) are sent to the worker pool of the run, the other tasks run in the process of the run.
+#- The nodes share the file system (same paths on all nodes), the tasks run in the current directory of the run
+#- Every task runs in a new child process of the worker, configured like the run (work and scratch directories, step cache, step timeouts). The worker has a budget of cores and memory (--cores and --memory_gb, default: the cores and most of the memory of its node) shared by its slots: a task starts when its threads and memory are free, and its child process gets them as its resource budget. The step metrics of the task are sent back with its result
+#- A failed task does not stop the other tasks of the run on the workers (e.g. the other HaplotypeCaller shards), since the process groups of the process engine are local to a process. They run to the end, and tool processes that already run on a worker are not stopped when the run fails
+#- Locality hints: a worker announces the directories whose data is local to its node (--data_dir). A task goes to a free worker that holds most of its input files (the arguments named by the locality option of the task), otherwise to the least busy free worker
+#- The connections are authenticated with the key in the GATK_WORKER_AUTHKEY environment variable, which must be the same for the run and its workers. The connections are not encrypted (no TLS): the key is their only protection, so a worker listens on the loopback interface unless another address is given, and on all interfaces only with --all_interfaces
+
+WORKER_AUTHKEY_ENV="GATK_WORKER_AUTHKEY"
+DEFAULT_WORKER_PORT=7077
+DEFAULT_WORKER_HOST="127.0.0.1"
+#Host that makes a worker listen on all the interfaces of its node
+ALL_INTERFACES_HOST="0.0.0.0"
+
+#Error of a task whose worker could not be reached or stopped while running it (the task can be retried on another worker)
+class WorkerLost(RuntimeError):
+    pass
+
+#Error of a task that failed on a worker with an exception that could not be sent back
+class RemoteTaskError(RuntimeError):
+    pass
+
+#------------------------------------------------------------------------
+#Function for reading a HOST:PORT worker address (default port DEFAULT_WORKER_PORT)
+def parse_address(address):
+    host, separator, port=address.rpartition(":")
+    if not separator:
+        return (address, DEFAULT_WORKER_PORT)
+    return (host or DEFAULT_WORKER_HOST, int(port))
+
+#------------------------------------------------------------------------
+#Function for reading the authentication key of the workers
+def worker_authkey():
+    authkey=os.environ.get(WORKER_AUTHKEY_ENV)
+    if not authkey:
+        raise ValueError(f"The {WORKER_AUTHKEY_ENV} environment variable must hold the authentication key of the workers.")
+    return authkey.encode()
+
+#------------------------------------------------------------------------
+#Function for collecting the configuration of the run that the tasks need on the workers
+def task_context():
+    import run_gatk_extras
+    import run_gatk_workspace
+    import run_gatk_engine
+    import run_gatk_progress
+    import run_gatk_resources
+    step_cache=run_gatk_extras.STEP_CACHE
+    workspace=run_gatk_workspace.WORKSPACE
+    return {
+        "cwd": os.getcwd(),
+        "work_dir": workspace.work_dir,
+        "scratch_dir": workspace.scratch_dir,
+        "keep_intermediates": workspace.keep_intermediates,
+        "step_cache": (step_cache.cache_dir, step_cache.max_bytes, step_cache.checksum) if step_cache else None,
+        "timeouts": run_gatk_engine.PROCESS_ENGINE.timeouts,
+        "gatk_profile": dict(run_gatk_resources.GATK_PROFILE),
+        "progress_interval": run_gatk_progress.PROGRESS_REPORTER.interval if run_gatk_progress.PROGRESS_REPORTER else 0}
+
+#------------------------------------------------------------------------
+#Function for finding the resources a task needs on a worker: its threads and memory_mb arguments (None when the task does not have them)
+def task_resources(function, args, kwargs):
+    try:
+        arguments=inspect.signature(function).bind(*args, **kwargs).arguments
+    except (TypeError, ValueError):
+        arguments=kwargs
+    return {"threads": arguments.get("threads"), "memory_mb": arguments.get("memory_mb")}
+
+#------------------------------------------------------------------------
+#Function for running one task in a child process of a worker.
+#The child process uses the configuration of the run, calls the function of the task and returns its result (or its exception) with the step metrics of its tools. The progress lines of its steps go to the log file of the worker
+def execute_task(request):
+    logging.basicConfig(filename=request["log_file"], encoding="utf-8", filemode="a", format="{asctime} - {levelname} - {message}", style="{", datefmt="%Y-%m-%d %H:%M", level=logging.INFO, force=True)
+    os.environ["GATK_WORKER"]=request["worker"]
+    context=request["context"]
+    os.chdir(context["cwd"])
+
+    from run_gatk_orchestration import configure_orchestration
+    from run_gatk_extras import configure_step_cache
+    from run_gatk_workspace import configure_workspace
+    from run_gatk_engine import configure_process_engine
+    from run_gatk_resources import configure_resources, configure_gatk_profile
+    from run_gatk_metrics import STEP_METRICS
+    from run_gatk_progress import start_progress_reporting
+    configure_orchestration("local")
+    configure_workspace(context["work_dir"], context["scratch_dir"], keep_intermediates=context["keep_intermediates"])
+    configure_process_engine(timeouts=context["timeouts"])
+    configure_resources(*request["budget"])
+    configure_gatk_profile(**context["gatk_profile"])
+    if context["step_cache"]:
+        configure_step_cache(*context["step_cache"])
+    start_progress_reporting(interval=context["progress_interval"])
+
+    start=time.monotonic()
+    try:
+        target=getattr(importlib.import_module(request["module"]), request["name"])
+        result=getattr(target, "function", target)(*request["args"], **request["kwargs"])
+        response={"status": "ok", "result": result}
+    except Exception as e:
+        logging.exception(f"Task {request['name']} failed on worker {request['worker']}.")
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e=RemoteTaskError(traceback.format_exc())
+        response={"status": "error", "result": e}
+    response["wall_time_s"]=round(time.monotonic() - start, 3)
+    response["metrics"]=list(STEP_METRICS)
+    return response
+
+#------------------------------------------------------------------------
+#Class for the worker of a node.
+#It accepts tasks from the runs and runs at most slots tasks at the same time (default: one per core of its budget), each one in a new child process. A task waits until its threads and memory are free in the budget of the worker. A task without memory_mb gets the share of the memory of its threads
+class Worker:
+
+    def __init__(self, address, slots=None, data_dirs=None, log_file="gatk_worker.log", cores=None, memory_mb=None):
+        self.listener=multiprocessing.connection.Listener(address, authkey=worker_authkey())
+        host, port=self.listener.address
+        self.name=f"{socket.gethostname()}:{port}"
+        self.budget=ResourceBudget(cores or os.cpu_count() or 1, memory_mb or int(node_memory_mb() * DEFAULT_MEMORY_FRACTION))
+        self.slots=slots or self.budget.cores
+        self.data_dirs=[os.path.abspath(data_dir) for data_dir in data_dirs or []]
+        self.log_file=os.path.abspath(log_file)
+        self.executor=concurrent.futures.ProcessPoolExecutor(max_workers=self.slots, mp_context=multiprocessing.get_context("spawn"), max_tasks_per_child=1)
+
+    @property
+    def address(self):
+        return self.listener.address
+
+    def info(self):
+        return {"name": self.name, "host": socket.gethostname(), "slots": self.slots, "cores": self.budget.cores, "memory_mb": self.budget.memory_mb, "data_dirs": self.data_dirs}
+
+    #Function for finding the cores and memory of the budget of the worker that a task reserves
+    def task_budget(self, resources):
+        cores=min(max(1, resources.get("threads") or 1), self.budget.cores)
+        memory_mb=resources.get("memory_mb") or self.budget.memory_mb * cores // self.budget.cores
+        return cores, min(memory_mb, self.budget.memory_mb)
+
+    #Function for accepting the connections of the runs (one thread per connection)
+    def serve(self):
+        logging.info(f"Worker {self.name} listening on {self.address[0]}:{self.address[1]} with {self.slots} slots, {self.budget.cores} cores and {self.budget.memory_mb} MB memory (data directories: {', '.join(self.data_dirs) or 'none'}).")
+        while True:
+            try:
+                connection=self.listener.accept()
+            except (multiprocessing.AuthenticationError, OSError) as e:
+                logging.warning(f"Connection refused by worker {self.name}: {e}")
+                continue
+            threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    #Function for answering one request of a run: the worker information (hello) or the result of a task (run)
+    def handle(self, connection):
+        with connection:
+            try:
+                request=connection.recv()
+            except (EOFError, OSError):
+                return
+            if request["type"] == "hello":
+                connection.send(self.info())
+                return
+
+            cores, memory_mb=self.budget.acquire(*self.task_budget(request.get("resources") or {}))
+            request.update(worker=self.name, log_file=self.log_file, budget=(cores, memory_mb))
+            logging.info(f"Task {request['name']} started on worker {self.name} ({cores} cores, {memory_mb} MB memory).")
+            try:
+                response=self.executor.submit(execute_task, request).result()
+            except Exception as e:
+                response={"status": "error", "result": WorkerLost(f"Child process of worker {self.name} failed: {e!r}"), "metrics": []}
+            finally:
+                self.budget.release(cores, memory_mb)
+            logging.info(f"Task {request['name']} finished on worker {self.name} ({response['status']}).")
+            try:
+                connection.send(response)
+            except (EOFError, OSError):
+                logging.warning(f"Run of task {request['name']} disconnected from worker {self.name} before the result was sent.")
+
+    def close(self):
+        self.listener.close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+#------------------------------------------------------------------------
+#Class for the worker pool of a run.
+#It keeps the free slots and cores of every worker and sends every task to the best free worker for its input files (a worker with a free slot and the cores of the task's threads free, or no running task), waiting when no worker is free. A worker that cannot be reached is left out of the pool
+class WorkerPool:
+
+    def __init__(self, addresses):
+        self.authkey=worker_authkey()
+        self.condition=threading.Condition()
+        self.workers=[]
+        for address in addresses:
+            address=parse_address(address) if isinstance(address, str) else address
+            info=self.request(address, {"type": "hello"})
+            self.workers.append({**info, "address": address, "running": 0, "reserved_cores": 0, "alive": True})
+            logging.info(f"Worker {info['name']} added to the worker pool ({info['slots']} slots, {info['cores']} cores, {info['memory_mb']} MB memory, data directories: {', '.join(info['data_dirs']) or 'none'}).")
+
+    def request(self, address, message):
+        try:
+            with multiprocessing.connection.Client(address, authkey=self.authkey) as connection:
+                connection.send(message)
+                return connection.recv()
+        except (EOFError, OSError) as e:
+            raise WorkerLost(f"Worker {address[0]}:{address[1]} could not be reached: {e!r}") from e
+
+    #Function for counting the input files of a task that are in the data directories of a worker
+    @staticmethod
+    def locality_score(worker, paths):
+        paths=[os.path.abspath(path) for path in paths]
+        return sum(any(path.startswith(data_dir + os.sep) for data_dir in worker["data_dirs"]) for path in paths)
+
+    #Function for finding the cores a task reserves on a worker (its threads, at most the cores of the worker)
+    @staticmethod
+    def task_cores(worker, threads):
+        return min(max(1, threads or 1), worker["cores"])
+
+    def acquire(self, paths, threads=None):
+        with self.condition:
+            while True:
+                alive=[worker for worker in self.workers if worker["alive"]]
+                if not alive:
+                    raise WorkerLost("No worker of the worker pool is left.")
+                free=[worker for worker in alive if worker["running"] < worker["slots"] and (worker["running"] == 0 or worker["reserved_cores"] + self.task_cores(worker, threads) <= worker["cores"])]
+                if free:
+                    worker=max(free, key=lambda worker: (self.locality_score(worker, paths), worker["cores"] - worker["reserved_cores"]))
+                    worker["running"]+=1
+                    worker["reserved_cores"]+=self.task_cores(worker, threads)
+                    return worker
+                self.condition.wait()
+
+    def release(self, worker, threads=None, alive=True):
+        with self.condition:
+            worker["running"]-=1
+            worker["reserved_cores"]-=self.task_cores(worker, threads)
+            worker["alive"]=worker["alive"] and alive
+            self.condition.notify_all()
+
+    #Function for running a task function on a worker. It returns the result of the function or raises its exception, and adds the step metrics of the task to the metrics of the run
+    def run(self, function, args, kwargs, locality=()):
+        from run_gatk_metrics import record_step_metrics
+        if function.__module__ == "__main__":
+            raise ValueError(f"Task {function.__name__} cannot run on a worker because it is declared in the main script.")
+        resources=task_resources(function, args, kwargs)
+        request={"type": "run", "module": function.__module__, "name": function.__name__, "args": args, "kwargs": kwargs, "resources": resources, "context": task_context()}
+
+        worker=self.acquire(locality, resources["threads"])
+        try:
+            response=self.request(worker["address"], request)
+        except WorkerLost:
+            self.release(worker, resources["threads"], alive=False)
+            logging.error(f"Worker {worker['name']} left the worker pool while running task {function.__name__}.")
+            raise
+        self.release(worker, resources["threads"])
+
+        for metrics in response["metrics"]:
+            record_step_metrics({**metrics, "worker": worker["name"]})
+        logging.info(f"Task {function.__name__} ran on worker {worker['name']} in {response.get('wall_time_s', 0)}s ({response['status']}).")
+        if response["status"] == "error":
+            raise response["result"]
+        return response["result"]
+
+#Worker pool of the run (None when the distributed tasks run in the process of the run)
+WORKER_POOL=None
+
+#------------------------------------------------------------------------
+#Function for setting the worker pool of the run (no addresses: no worker pool)
+def configure_worker_pool(addresses=None):
+    global WORKER_POOL
+    WORKER_POOL=WorkerPool(addresses) if addresses else None
+    if WORKER_POOL:
+        logging.info(f"Worker pool of {len(WORKER_POOL.workers)} workers ({sum(worker['slots'] for worker in WORKER_POOL.workers)} slots).")
+    return WORKER_POOL
+
+#------------------------------------------------------------------------
+#Function for running a distributed task: on the worker pool of the run, or in the process of the run when there is none
+def dispatch(function, args, kwargs, locality=()):
+    if WORKER_POOL is None:
+        return function(*args, **kwargs)
+    return WORKER_POOL.run(function, args, kwargs, locality)
+
+#------------------------------------------------------------------------
+#Function for running a worker from the command line
+def main():
+    parser=argparse.ArgumentParser(description=f"Worker of the GATK pipeline. It runs the distributed tasks (alignment chunks, HaplotypeCaller shards, cohort samples) of the runs whose --workers option lists it. The run and its workers share the file system and the authentication key in the {WORKER_AUTHKEY_ENV} environment variable.")
+    parser.add_argument("--listen", default=f"{DEFAULT_WORKER_HOST}:{DEFAULT_WORKER_PORT}", help=f"Address the worker listens on (HOST:PORT, port 0 chooses a free port, default: {DEFAULT_WORKER_HOST}:{DEFAULT_WORKER_PORT}), e.g. the address of the node on the cluster network. The connections are not encrypted (no TLS): the key in {WORKER_AUTHKEY_ENV} is their only protection, so only listen on networks whose hosts are trusted.")
+    parser.add_argument("--all_interfaces", action="store_true", help=f"Allow listening on all the interfaces of the node (--listen {ALL_INTERFACES_HOST}:PORT).")
+    parser.add_argument("--slots", type=int, default=None, help="Maximum number of tasks running at the same time (default: the cores of the worker).")
+    parser.add_argument("--cores", type=int, default=None, help="Cores shared by the tasks of the worker. A task starts when the cores of its threads are free (default: the cores of the node).")
+    parser.add_argument("--memory_gb", type=float, default=None, help="Memory in GB shared by the tasks of the worker. A task starts when its memory is free (default: 80%% of the memory of the node).")
+    parser.add_argument("--data_dir", action="append", default=[], help="Directory whose files are local to this node, e.g. its node-local scratch directory. Tasks whose input files are in it prefer this worker. Can be given more than once.")
+    parser.add_argument("--log_file", default="gatk_worker.log", help="Log file of the worker and its tasks.")
+    args=parser.parse_args()
+
+    address=parse_address(args.listen)
+    if address[0] == ALL_INTERFACES_HOST and not args.all_interfaces:
+        parser.error(f"--listen {args.listen} listens on all the interfaces of the node, which needs --all_interfaces")
+
+    logging.basicConfig(filename=args.log_file, encoding="utf-8", filemode="a", format="{asctime} - {levelname} - {message}", style="{", datefmt="%Y-%m-%d %H:%M", level=logging.INFO)
+    if args.all_interfaces:
+        logging.warning(f"Worker listening on all the interfaces of the node: the {WORKER_AUTHKEY_ENV} key is the only protection of its unencrypted connections.")
+    worker=Worker(address, args.slots, args.data_dir, args.log_file, cores=args.cores, memory_mb=int(args.memory_gb * 1024) if args.memory_gb else None)
+    #The address is printed, so a worker started with port 0 can be found
+    print(f"{worker.address[0]}:{worker.address[1]}", flush=True)
+    try:
+        worker.serve()
+    except KeyboardInterrupt:
+        worker.close()
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,138 @@
+import contextlib
+import threading
+import hashlib
+import logging
+import shutil
+import os
+
+#Directories of a run.
+#The work directory keeps the final outputs of the run (sorted alignment and its index, duplication metrics, QC reports, VCF and metrics report), which are usually on durable (shared) storage. The scratch directory, e.g. on node-local NVMe, holds the transient files: SAM and unsorted BAM files, alignment chunks, HaplotypeCaller shards and the temporary files of samtools sort. The intermediate files are removed as soon as the steps that read them are done, unless they are kept
+
+#Interval in seconds between two measurements of the scratch usage
+SCRATCH_SAMPLE_SECONDS=2.0
+
+#------------------------------------------------------------------------
+#Class for the work and scratch directories of a run and for measuring the peak disk usage of the scratch directory
+class Workspace:
+
+    def __init__(self, work_dir=".", scratch_dir=None, keep_intermediates=False):
+        self.work_dir=work_dir
+        self.scratch_dir=scratch_dir or os.path.join(work_dir, "scratch")
+        self.own_scratch_dir=scratch_dir is None
+        self.keep_intermediates=keep_intermediates
+        self.peak_scratch_bytes=0
+        self.lock=threading.Lock()
+        self.stop_event=threading.Event()
+        self.monitor=None
+
+    #Functions for finding the path of a file in the work or scratch directory (absolute paths are kept). The parent directory of the file is created
+    def work_path(self, *names):
+        return self._path(self.work_dir, names)
+
+    def scratch_path(self, *names):
+        return self._path(self.scratch_dir, names)
+
+    @staticmethod
+    def _path(directory, names):
+        path=os.path.normpath(os.path.join(directory, *names))
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        return path
+
+    #Function for measuring the disk usage of the scratch directory (allocated blocks of its files) and updating its peak
+    def measure_scratch(self):
+        used_bytes=0
+        for directory, subdirectories, files in os.walk(self.scratch_dir):
+            for name in files:
+                with contextlib.suppress(OSError):
+                    used_bytes+=os.lstat(os.path.join(directory, name)).st_blocks * 512
+        with self.lock:
+            self.peak_scratch_bytes=max(self.peak_scratch_bytes, used_bytes)
+        return used_bytes
+
+    #Functions for measuring the scratch usage every interval seconds while the run goes on
+    def start_monitor(self, interval=SCRATCH_SAMPLE_SECONDS):
+        self.stop_event.clear()
+        def sample():
+            while not self.stop_event.wait(interval):
+                self.measure_scratch()
+        self.monitor=threading.Thread(target=sample, name="scratch-monitor", daemon=True)
+        self.monitor.start()
+
+    def stop_monitor(self):
+        if self.monitor:
+            self.stop_event.set()
+            self.monitor.join()
+            self.monitor=None
+        self.measure_scratch()
+        return self.peak_scratch_bytes
+
+    #Function for removing intermediate files and directories whose consumers are done. The scratch usage is measured first, so the peak includes them
+    def remove_intermediates(self, *paths):
+        if self.keep_intermediates:
+            return
+        self.measure_scratch()
+        for path in paths:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.lexists(path):
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+            else:
+                continue
+            logging.info(f"Intermediate '{path}' removed.")
+
+#Workspace of the run (until it is configured, all the files are written to the current directory)
+WORKSPACE=Workspace(".", ".")
+
+#------------------------------------------------------------------------
+#Function for setting the work and scratch directories of the run (default scratch directory: <work_dir>/scratch)
+def configure_workspace(work_dir=".", scratch_dir=None, keep_intermediates=False):
+    global WORKSPACE
+    WORKSPACE=Workspace(work_dir, scratch_dir, keep_intermediates)
+    os.makedirs(WORKSPACE.work_dir, exist_ok=True)
+    os.makedirs(WORKSPACE.scratch_dir, exist_ok=True)
+    logging.info(f"Work directory '{WORKSPACE.work_dir}', scratch directory '{WORKSPACE.scratch_dir}'{' (intermediates are kept)' if keep_intermediates else ''}.")
+    return WORKSPACE
+
+#------------------------------------------------------------------------
+#Functions for using the workspace of the run
+def work_path(*names):
+    return WORKSPACE.work_path(*names)
+
+def scratch_path(*names):
+    return WORKSPACE.scratch_path(*names)
+
+def remove_intermediates(*paths):
+    WORKSPACE.remove_intermediates(*paths)
+
+#------------------------------------------------------------------------
+#Function for finding the name of the temporary files of a step in the scratch directory (<kind>.<name of the output>.<hash of the output path>).
+#The hash of the absolute output path keeps the steps of outputs with the same name in other directories (e.g. the lanes or samples of a cohort) apart, while the same output always gets the same name
+def step_scratch_name(kind, out_file):
+    return f"{kind}.{os.path.basename(out_file)}.{hashlib.sha1(os.path.abspath(out_file).encode()).hexdigest()[:8]}"
+
+#------------------------------------------------------------------------
+#Function for building the temporary file argument of samtools sort, so its temporary files are written to the scratch directory (prefix <scratch>/samtools_sort.<name of the output>.<hash>)
+def sort_temp_args(out_file):
+    return ["-T", scratch_path(step_scratch_name("samtools_sort", out_file))]
+
+#------------------------------------------------------------------------
+#Function for finding the scratch directory of a GATK step (<scratch>/gatk.<name of the output>.<hash>), which holds its temporary files (--tmp-dir) and the GC log of its JVM. The directory is created
+def gatk_scratch_dir(out_file):
+    directory=scratch_path(step_scratch_name("gatk", out_file))
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+#------------------------------------------------------------------------
+#Functions for measuring the peak scratch usage of the run.
+#The scratch usage is measured every SCRATCH_SAMPLE_SECONDS seconds and before intermediates are removed. At the end of the run the peak is logged and returned, and the default scratch directory is removed when it is empty
+def start_scratch_monitor():
+    WORKSPACE.start_monitor()
+
+def stop_scratch_monitor():
+    peak_bytes=WORKSPACE.stop_monitor()
+    logging.info(f"Peak scratch usage of the run in '{WORKSPACE.scratch_dir}': {peak_bytes / 1024**2:.1f} MB.")
+    if WORKSPACE.own_scratch_dir and not WORKSPACE.keep_intermediates:
+        with contextlib.suppress(OSError):
+            os.rmdir(WORKSPACE.scratch_dir)
+    return peak_bytes
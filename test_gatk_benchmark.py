@@ -0,0 +1,100 @@
+import unittest
+import subprocess
+import tempfile
+import gzip
+import os
+from run_gatk_benchmark import *
+from run_gatk_standins import *
+
+#------------------------------------------------------------------------
+#Tests for run_gatk_benchmark.py and run_gatk_standins.py
+#------------------------------------------------------------------------
+class test_benchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir=tempfile.TemporaryDirectory()
+        self.ref_genome=generate_reference(os.path.join(self.tmp_dir.name, "synthetic.fasta"), contigs=2, contig_length=5000)
+        self.fastq_1=os.path.join(self.tmp_dir.name, "synthetic_1.fastq.gz")
+        self.fastq_2=os.path.join(self.tmp_dir.name, "synthetic_2.fastq.gz")
+        self.read_pairs=simulate_reads(self.ref_genome, self.fastq_1, self.fastq_2, depth=4, read_length=50, insert_size=200)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    #Test for generate_reference and simulate_reads
+    #Checking if the reads give the requested depth and come from the position written in their name
+    def test_simulate_reads(self):
+        sequences=read_reference(self.ref_genome)
+        self.assertEqual({name: len(sequence) for name, sequence in sequences.items()}, {"chr1": 5000, "chr2": 5000})
+        self.assertEqual(self.read_pairs, 400)
+
+        with gzip.open(self.fastq_1, "rt") as fastq:
+            lines=fastq.read().splitlines()
+        self.assertEqual(len(lines), 4 * self.read_pairs)
+
+        name, contig, position_1, position_2=lines[0][1:].removesuffix("/1").split(":")
+        read=lines[1]
+        reference=sequences[contig][int(position_1) - 1:int(position_1) - 1 + len(read)]
+        self.assertGreater(sum(base == reference_base for base, reference_base in zip(read, reference)), 45)
+
+    #Test for the stand-in tools
+    #Running the installed stand-in tools on the synthetic data to check that the alignment is sorted and the VCF file has one call per covered kb
+    def test_standin_tools(self):
+        bin_dir=install_standin_tools(os.path.join(self.tmp_dir.name, "bin"))
+        sorted_bam=os.path.join(self.tmp_dir.name, "sorted.bam")
+        out_vcf=os.path.join(self.tmp_dir.name, "output.vcf")
+
+        bwa=subprocess.Popen([os.path.join(bin_dir, "bwa"), "mem", "-t", "2", "-R", "@RG\\tID:run1\\tSM:sample1", self.ref_genome, self.fastq_1, self.fastq_2], stdout=subprocess.PIPE)
+        subprocess.run([os.path.join(bin_dir, "samtools"), "sort", "-@", "1", "-o", sorted_bam, "-"], stdin=bwa.stdout, check=True)
+        bwa.stdout.close()
+        self.assertEqual(bwa.wait(), 0)
+        subprocess.run([os.path.join(bin_dir, "gatk"), "--java-options", "-Xmx1g", "HaplotypeCaller", "-R", self.ref_genome, "-I", sorted_bam, "-O", out_vcf], check=True)
+
+        with open(sorted_bam, "rb") as bam:
+            self.assertTrue(bam.read().endswith(BGZF_EOF))
+        with gzip.open(sorted_bam, "rt") as bam:
+            records=[line.split("\t") for line in bam.read().splitlines() if not line.startswith("@")]
+        self.assertEqual(len(records), 2 * self.read_pairs)
+        self.assertEqual(records, sorted(records, key=lambda fields: (fields[2], int(fields[3]), fields[0])))
+        self.assertTrue(all(fields[-1] == "RG:Z:run1" for fields in records))
+
+        with open(out_vcf) as vcf:
+            lines=vcf.read().splitlines()
+        self.assertEqual(lines[-1].split("\t")[:2], ["chr2", "4500"])
+        self.assertEqual(lines[[line.startswith("#CHROM") for line in lines].index(True)].split("\t")[-1], "sample1")
+
+    #Test for summarize_trace
+    #Checking if the overheads and the concurrency are found from the start and end times of the tools
+    def test_summarize_trace(self):
+        trace=[{"start": 12, "end": 20}, {"start": 14, "end": 18}, {"start": 22, "end": 26}]
+
+        summary=summarize_trace(trace, 10, 30)
+
+        self.assertEqual(summary["busy_time_s"], 12)
+        self.assertEqual(summary["tool_time_s"], 16)
+        self.assertEqual(summary["startup_overhead_s"], 2)
+        self.assertEqual(summary["scheduling_overhead_s"], 2)
+        self.assertEqual(summary["shutdown_overhead_s"], 4)
+        self.assertEqual(summary["peak_concurrency"], 2)
+
+    #Test for check_regression
+    #Checking if a wall time above the tolerance of the baseline is a regression
+    def test_check_regression(self):
+        baseline={"median": {"wall_time_s": 10.0}}
+
+        self.assertTrue(check_regression({"median": {"wall_time_s": 11.5}}, baseline, tolerance=0.2))
+        self.assertFalse(check_regression({"median": {"wall_time_s": 12.5}}, baseline, tolerance=0.2))
+
+    #Test for parse_import_times
+    #Checking if the self and cumulative import times of the modules are read from the python -X importtime output
+    def test_parse_import_times(self):
+        output="import time: self [us] | cumulative | imported package\nimport time:       150 |        250 |   run_gatk_engine\nimport time:      1000 |       2000 | run_gatk_pipe\n"
+
+        import_times=parse_import_times(output)
+
+        self.assertEqual(import_times["run_gatk_pipe"], {"self_s": 0.001, "cumulative_s": 0.002})
+        self.assertEqual(import_times["run_gatk_engine"], {"self_s": 0.00015, "cumulative_s": 0.00025})
+        self.assertEqual(len(import_times), 2)
+
+if __name__ == "__main__":
+    unittest.main()
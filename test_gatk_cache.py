@@ -0,0 +1,151 @@
+import unittest
+from unittest.mock import patch
+import tempfile
+import os
+from run_gatk_cache import *
+
+#------------------------------------------------------------------------
+#Tests for run_gatk_cache.py
+#------------------------------------------------------------------------
+class test_cache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir=tempfile.TemporaryDirectory()
+        self.cache=StepCache(os.path.join(self.tmp_dir.name, "cache"), max_bytes=1 << 30)
+        self.input_file=self.write_file("input.fastq", "@read1\nACGT\n+\nIIII\n")
+        self.output_file=os.path.join(self.tmp_dir.name, "output.sam")
+        self.command=["bwa", "mem", self.input_file]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_file(self, name, content):
+        path=os.path.join(self.tmp_dir.name, name)
+        with open(path, "w") as handle:
+            handle.write(content)
+        return path
+
+    #Test for StepCache.restore
+    #Checking if the outputs of a stored step are restored after they were removed
+    @patch("run_gatk_cache.tool_version", return_value="Version: 0.7.18")
+    def test_restore_after_store(self, mock_tool_version):
+        self.write_file("output.sam", "aligned reads\n")
+        self.assertTrue(self.cache.store([self.command], [self.output_file]))
+        os.remove(self.output_file)
+
+        self.assertTrue(self.cache.restore([self.command], [self.output_file]))
+
+        with open(self.output_file) as output:
+            self.assertEqual(output.read(), "aligned reads\n")
+
+    #Test for StepCache.restore
+    #Checking if a step is not restored when the content of its input file changed
+    @patch("run_gatk_cache.tool_version", return_value="Version: 0.7.18")
+    def test_changed_input_is_not_restored(self, mock_tool_version):
+        self.write_file("output.sam", "aligned reads\n")
+        self.cache.store([self.command], [self.output_file])
+        self.write_file("input.fastq", "@read2\nTTTT\n+\nIIII\n")
+
+        self.assertFalse(self.cache.restore([self.command], [self.output_file]))
+
+    #Test for StepCache.restore
+    #Checking if a step is restored when its large input file was renamed (the file system identity does not change)
+    @patch("run_gatk_cache.tool_version", return_value="Version: 0.7.18")
+    def test_renamed_input_is_restored(self, mock_tool_version):
+        large_input=self.write_file("large.fastq", "A" * SMALL_FILE_BYTES)
+        self.write_file("output.sam", "aligned reads\n")
+        self.cache.store([["bwa", "mem", large_input]], [self.output_file])
+
+        renamed_input=os.path.join(self.tmp_dir.name, "renamed.fastq")
+        os.rename(large_input, renamed_input)
+
+        self.assertTrue(self.cache.restore([["bwa", "mem", renamed_input]], [self.output_file]))
+
+    #Test for StepCache.restore
+    #Checking if a step is not restored when the version of its tool changed
+    @patch("run_gatk_cache.tool_version")
+    def test_new_tool_version_is_not_restored(self, mock_tool_version):
+        mock_tool_version.return_value="Version: 0.7.18"
+        self.write_file("output.sam", "aligned reads\n")
+        self.cache.store([self.command], [self.output_file])
+
+        mock_tool_version.return_value="Version: 0.7.19"
+
+        self.assertFalse(self.cache.restore([self.command], [self.output_file]))
+
+    #Test for StepCache.evict
+    #Checking if the least recently used outputs are removed when the cache is full
+    @patch("run_gatk_cache.tool_version", return_value="Version: 0.7.18")
+    def test_evict_least_recently_used(self, mock_tool_version):
+        self.cache.max_bytes=15
+        self.write_file("output.sam", "first output\n")
+        self.cache.store([self.command], [self.output_file])
+        os.utime(self.cache._object_path(self.cache.file_checksum(self.output_file)), (0, 0))
+
+        second_output=self.write_file("second.sam", "second output\n")
+        self.cache.store([["bwa", "mem", "-M", self.input_file]], [second_output])
+
+        self.assertFalse(self.cache.restore([self.command], [self.output_file]))
+        self.assertTrue(self.cache.restore([["bwa", "mem", "-M", self.input_file]], [second_output]))
+
+    #Test for StepCache.step_key
+    #Checking that the JVM options, temporary directory and PairHMM threads of a GATK step (from the scratch directory and the resources of the run) do not change its key, while its other arguments do
+    @patch("run_gatk_cache.tool_version", return_value="The Genome Analysis Toolkit (GATK) v4.5.0.0")
+    def test_gatk_execution_options(self, mock_tool_version):
+        def haplotype_caller(scratch_dir, threads, memory_mb, intervals="chr1"):
+            return ["gatk", "--java-options", f"-Xmx{memory_mb}m -XX:+UseG1GC -XX:ParallelGCThreads={threads} -Xlog:gc:file={scratch_dir}/gc.log", "HaplotypeCaller", "-R", self.input_file, "-L", intervals, "-O", "output.vcf.gz", "--native-pair-hmm-threads", str(threads), "--tmp-dir", scratch_dir]
+
+        key=self.cache.step_key([haplotype_caller("/scratch/run1", 4, 8192)], ["output.vcf.gz"])
+
+        self.assertEqual(self.cache.step_key([haplotype_caller("/tmp/run2", 16, 16384)], ["output.vcf.gz"]), key)
+        self.assertNotEqual(self.cache.step_key([haplotype_caller("/scratch/run1", 4, 8192, intervals="chr2")], ["output.vcf.gz"]), key)
+
+    #Test for StepCache.step_key
+    #Checking that the index of an input BAM file and the index and dictionary of the reference genome are part of the key although they are not on the command line, while an index written by the step is not
+    @patch("run_gatk_cache.tool_version", return_value="1.0")
+    def test_sidecar_files(self, mock_tool_version):
+        bam=self.write_file("sorted.bam", "alignments")
+        reference=self.write_file("reference.fasta", ">chr1\nACGT\n")
+        command=["gatk", "HaplotypeCaller", "-R", reference, "-I", bam, "-O", "output.vcf.gz"]
+        key=self.cache.step_key([command], ["output.vcf.gz"])
+
+        self.write_file("sorted.bam.bai", "index 1")
+        bai_key=self.cache.step_key([command], ["output.vcf.gz"])
+        self.assertNotEqual(bai_key, key)
+        self.write_file("sorted.bam.bai", "index 2")
+        self.assertNotEqual(self.cache.step_key([command], ["output.vcf.gz"]), bai_key)
+
+        self.write_file("reference.dict", "@HD\tVN:1.0\n")
+        dict_key=self.cache.step_key([command], ["output.vcf.gz"])
+        self.write_file("reference.fasta.fai", "chr1\t4\t6\t4\t5\n")
+        self.assertEqual(len({key, bai_key, dict_key, self.cache.step_key([command], ["output.vcf.gz"])}), 4)
+
+        index_command=["samtools", "index", bam, os.path.join(self.tmp_dir.name, "sorted.bam.bai")]
+        index_key=self.cache.step_key([index_command], [os.path.join(self.tmp_dir.name, "sorted.bam.bai")])
+        self.write_file("sorted.bam.bai", "index 3")
+        self.assertEqual(self.cache.step_key([index_command], [os.path.join(self.tmp_dir.name, "sorted.bam.bai")]), index_key)
+
+    #Test for StepCache.restore and StepCache.evict
+    #Checking that restoring a large output does not change its identity as input of the next step, and that the restore counts as a use of the output for the eviction
+    @patch("run_gatk_cache.tool_version", return_value="Version: 0.7.18")
+    def test_restore_keeps_next_step_key(self, mock_tool_version):
+        bam=self.write_file("output.bam", "B" * SMALL_FILE_BYTES)
+        self.cache.store([self.command], [bam])
+        os.utime(bam, (0, 0))
+        next_command=["gatk", "HaplotypeCaller", "-I", bam, "-O", "output.vcf"]
+        next_key=self.cache.step_key([next_command], ["output.vcf"])
+
+        self.assertTrue(self.cache.restore([self.command], [bam]))
+        self.assertEqual(self.cache.step_key([next_command], ["output.vcf"]), next_key)
+        self.assertEqual(os.stat(bam).st_mtime, 0)
+
+        #The BAM was used more recently than the new output, so the new output is evicted first
+        self.cache.max_bytes=SMALL_FILE_BYTES + 1
+        other_output=self.write_file("other.sam", "other output\n")
+        os.utime(other_output, (1, 1))
+        self.cache.store([["bwa", "mem", "-M", self.input_file]], [other_output])
+        self.assertTrue(self.cache.restore([self.command], [bam]))
+        self.assertFalse(self.cache.restore([["bwa", "mem", "-M", self.input_file]], [other_output]))
+
+if __name__ == "__main__":
+    unittest.main()
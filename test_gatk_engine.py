@@ -0,0 +1,94 @@
+import unittest
+from unittest.mock import patch
+import subprocess
+import threading
+import tempfile
+import time
+import os
+from run_gatk_engine import *
+
+#------------------------------------------------------------------------
+#Tests for run_gatk_engine.py
+#------------------------------------------------------------------------
+class test_engine(unittest.TestCase):
+
+    def setUp(self):
+        self.engine=ProcessEngine(max_processes=4, timeouts={"": 20, "Slow": 1})
+
+    def tearDown(self):
+        self.engine.stop()
+
+    #Test for ProcessEngine.run
+    #Using patch to mock if the stderr of a tool is logged line by line with the name of the tool and kept in the result
+    @patch("run_gatk_engine.logging.info")
+    def test_run_stderr_logged(self, mock_info):
+        result,=self.engine.run([["sh", "-c", "echo line1 >&2; echo line2 >&2"]], ["Shell"])
+
+        self.assertEqual(result["returncode"], 0)
+        self.assertEqual(list(result["stderr_tail"]), ["line1", "line2"])
+        mock_info.assert_any_call("Shell: line1")
+        mock_info.assert_any_call("Shell: line2")
+        self.assertGreaterEqual(result["end_time"], result["start_time"])
+        self.assertIsNotNone(result["usage"])
+
+    #Test for ProcessEngine.run
+    #Using real commands to check that a tool is stopped when its timeout expires (the longest matching tool prefix wins)
+    def test_run_timeout(self):
+        start_time=time.time()
+        result,=self.engine.run([["sleep", "30"]], ["Slow tool"])
+
+        self.assertTrue(result["timed_out"])
+        self.assertLess(time.time() - start_time, 10)
+        with self.assertRaises(subprocess.TimeoutExpired):
+            check_result(result)
+
+    #Test for ProcessEngine.run
+    #Using real commands to check that a failing job stops the running jobs of its process group and that the later jobs of the group are not started
+    def test_run_group_cancel(self):
+        results={}
+        sleeper=threading.Thread(target=lambda: results.update(sleep=self.engine.run([["sleep", "30"]], ["Sleep"], group="shards")[0]))
+        start_time=time.time()
+        sleeper.start()
+        time.sleep(0.5)
+
+        failed,=self.engine.run([["false"]], ["False"], group="shards")
+        sleeper.join()
+
+        self.assertEqual(failed["returncode"], 1)
+        self.assertIn("False failed", results["sleep"]["cancelled"])
+        self.assertLess(time.time() - start_time, 10)
+        with self.assertRaises(ProcessCancelled):
+            self.engine.run([["true"]], ["True"], group="shards")
+        #Other groups are not affected
+        self.assertEqual(self.engine.run([["true"]], ["True"], group="other")[0]["returncode"], 0)
+
+    #Test for ProcessEngine.run
+    #Using real commands to check that no more than max_processes tool processes run at the same time
+    def test_run_bounded_concurrency(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            counter=os.path.join(tmp_dir, "running")
+            command=["sh", "-c", f"echo start >> {counter}; sleep 0.3; echo end >> {counter}"]
+            threads=[threading.Thread(target=self.engine.run, args=([command], ["Count"])) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            running=maximum=0
+            with open(counter) as events:
+                for event in events:
+                    running+=1 if event.strip() == "start" else -1
+                    maximum=max(maximum, running)
+
+        self.assertEqual(maximum, 4)
+
+    #Test for parse_step_timeouts
+    #Checking that a plain number is the default timeout and TOOL=SECONDS the timeout of a tool
+    def test_parse_step_timeouts(self):
+        self.assertEqual(parse_step_timeouts(["3600", "GATK HaplotypeCaller=7200"]), {"": 3600.0, "GATK HaplotypeCaller": 7200.0})
+        self.assertEqual(ProcessEngine(timeouts={"": 1, "GATK": 2, "GATK HaplotypeCaller": 3}).step_timeout("GATK HaplotypeCaller shard_0001.intervals"), 3)
+        with self.assertRaises(ValueError):
+            parse_step_timeouts(["BWA mem=-1"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,10 @@
 import unittest
 from unittest.mock import patch, mock_open, MagicMock
 import subprocess
+import tempfile
+import gzip
+import time
+import os
 from run_gatk_pipe import *
 
 #------------------------------------------------------------------------
@@ -10,7 +14,7 @@ class test_extras(unittest.TestCase):
 
     #Test for run_subprocess
     #Using patch to mock if the run_subprocess function handles correctly cmd commands
-    @patch("run_gatk_extras.subprocess.run")
+    @patch("run_gatk_extras.run_measured")
     def test_run_subprocess_success(self, mock_run):
         mock_run.return_value=MagicMock() 
         result=run_subprocess(["pwd"], "TestTool")
@@ -19,7 +23,7 @@ class test_extras(unittest.TestCase):
 
     #Test for run_subprocess
     #Using patch to mock if the run_subprocess fails when a subprocess call fails.
-    @patch("run_gatk_extras.subprocess.run")
+    @patch("run_gatk_extras.run_measured")
     def test_run_subprocess_error(self, mock_run):
         mock_run.side_effect=subprocess.CalledProcessError(returncode=1, cmd="ls")
         result=run_subprocess(["ls"], "TestTool")
@@ -28,7 +32,7 @@ class test_extras(unittest.TestCase):
 
     #Test for run_subprocess
     #Using patch to mock if the run_subprocess fails because the user used a run command that does not exist
-    @patch("run_gatk_extras.subprocess.run")
+    @patch("run_gatk_extras.run_measured")
     def test_run_subprocess_no_tool_error(self, mock_run):
         mock_run.side_effect=FileNotFoundError
         result=run_subprocess(["ToolDoesNotExist"], "TestTool")
@@ -37,7 +41,7 @@ class test_extras(unittest.TestCase):
 
     #Test for run_subprocess
     #Using patch to mock if the run_subprocess handles correctly subprocess when dealing with output files
-    @patch("run_gatk_extras.subprocess.run")
+    @patch("run_gatk_extras.run_measured")
     @patch("builtins.open", new_callable=mock_open)
     def test_run_subprocess_out_file_error(self, mock_open, mock_run):
 
@@ -47,12 +51,12 @@ class test_extras(unittest.TestCase):
 
         self.assertFalse(result)
 
-        mock_open.assert_called_once_with("output.txt", "w")
-        mock_run.assert_called_once_with(["ls", "-l"], stdout=mock_open(), check=True)
+        mock_open.assert_called_once_with(".partial.output.txt", "w")
+        mock_run.assert_called_once_with(["ls", "-l"], "TestTool", outputs=[".partial.output.txt"], stdout=mock_open())
 
     #Test for run_subprocess
     #Using patch to mock if the run_subprocess works correctly when it encounters a FileNotFoundError error
-    @patch("run_gatk_extras.subprocess.run")
+    @patch("run_gatk_extras.run_measured")
     @patch("builtins.open", new_callable=mock_open)
     def test_run_subprocess_file_not_found_error(self, mock_open, mock_run):
 
@@ -62,8 +66,317 @@ class test_extras(unittest.TestCase):
         
         self.assertFalse(result)
 
-        mock_open.assert_called_once_with("output.txt", "w")
-        mock_run.assert_called_once_with(["ToolDoesNotExist"], stdout=mock_open(), check=True)
+        mock_open.assert_called_once_with(".partial.output.txt", "w")
+        mock_run.assert_called_once_with(["ToolDoesNotExist"], "TestTool", outputs=[".partial.output.txt"], stdout=mock_open())
+
+    #Test for run_subprocess_pipe
+    #Using real commands to check that the stdout of the first command reaches the output file through the second one
+    def test_run_subprocess_pipe_success(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_file=os.path.join(tmp_dir, "output.txt")
+
+            result=run_subprocess_pipe([["echo", "read1"], ["cat"]], ["Echo", "Cat"], out_file=out_file)
+
+            self.assertTrue(result)
+            with open(out_file) as handle:
+                self.assertEqual(handle.read(), "read1\n")
+
+    #Test for run_subprocess_pipe
+    #Using real commands to check that the pipe fails when one of its stages fails
+    def test_run_subprocess_pipe_stage_error(self):
+        result=run_subprocess_pipe([["echo", "read1"], ["false"]], ["Echo", "False"])
+
+        self.assertFalse(result)
+
+    #Test for run_subprocess_pipe
+    #Using real commands to check that the pipe fails and the started stages are stopped (instead of waited for) when a tool does not exist
+    def test_run_subprocess_pipe_no_tool_error(self):
+        start_time=time.time()
+        result=run_subprocess_pipe([["sleep", "30"], ["ToolDoesNotExist"]], ["Sleep", "TestTool"])
+
+        self.assertFalse(result)
+        self.assertLess(time.time() - start_time, 10)
+
+    #Test for run_subprocess_pipe
+    #Using real commands to check that a failing stage stops the other stages of the pipe right away
+    def test_run_subprocess_pipe_stops_stages(self):
+        start_time=time.time()
+        result=run_subprocess_pipe([["sleep", "30"], ["sh", "-c", "exit 3"]], ["Sleep", "Exit"])
+
+        self.assertFalse(result)
+        self.assertLess(time.time() - start_time, 10)
+
+    #Test for split_reference_intervals
+    #Using a small .fai file to check that whole contigs are grouped into balanced shards that keep the reference order, and that no contig is split without a reference gap
+    def test_split_reference_intervals(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fai_file=os.path.join(tmp_dir, "reference.fasta.fai")
+            with open(fai_file, "w") as fai:
+                fai.write("chr1\t100\t6\t60\t61\n")
+                fai.write("chr2\t50\t115\t60\t61\n")
+                fai.write("chr3\t40\t172\t60\t61\n")
+                fai.write("chrM\t30\t220\t60\t61\n")
+
+            shard_intervals=split_reference_intervals(fai_file, 3)
+
+        self.assertEqual(shard_intervals, [["chr1:1-100"], ["chr2:1-50"], ["chr3:1-40", "chrM:1-30"]])
+
+    #Test for split_reference_intervals
+    #Using a small reference genome to check that a contig longer than a shard is only cut in the middle of a gap of N bases, and that no contig shorter than a shard is split
+    def test_split_reference_intervals_at_gap(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ref_genome=os.path.join(tmp_dir, "reference.fasta")
+            sequences={"chr1": "ACGT" * 15 + "N" * 20 + "ACGT" * 30, "chr2": "ACGTN" * 12, "chrM": "ACGT" * 10}
+            with open(ref_genome, "w") as fasta, open(f"{ref_genome}.fai", "w") as fai:
+                for contig, sequence in sequences.items():
+                    fasta.write(f">{contig}\n")
+                    fai.write(f"{contig}\t{len(sequence)}\t{fasta.tell()}\t25\t26\n")
+                    for i in range(0, len(sequence), 25):
+                        fasta.write(f"{sequence[i:i + 25]}\n")
+
+            shard_intervals=split_reference_intervals(f"{ref_genome}.fai", 3, min_gap=10)
+
+        self.assertEqual(shard_intervals, [["chr1:1-69"], ["chr1:70-200"], ["chr2:1-60", "chrM:1-40"]])
+
+    #Test for split_reference_intervals
+    #Using a small .fai file to check that no empty shards are returned when there are more shards than contigs
+    def test_split_reference_intervals_more_shards_than_contigs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fai_file=os.path.join(tmp_dir, "reference.fasta.fai")
+            with open(fai_file, "w") as fai:
+                fai.write("chr1\t2\t6\t60\t61\n")
+                fai.write("chr2\t3\t15\t60\t61\n")
+
+            shard_intervals=split_reference_intervals(fai_file, 5)
+
+        self.assertEqual(shard_intervals, [["chr1:1-2"], ["chr2:1-3"]])
+
+    #Test for build_read_group
+    #Checking if build_read_group returns the read group line that bwa mem expects
+    def test_build_read_group(self):
+        read_group=build_read_group("NA12878", "gatk_exercise")
+
+        self.assertEqual(read_group, "@RG\\tID:gatk_exercise\\tSM:NA12878\\tLB:lib1\\tPL:ILLUMINA\\tPU:unit1")
+
+    #Test for read_duplicate_metrics
+    #Using a small samtools markdup metrics file to check that the counts and the duplication rate are returned
+    def test_read_duplicate_metrics(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            metrics_file=os.path.join(tmp_dir, "markdup_metrics.txt")
+            with open(metrics_file, "w") as metrics:
+                metrics.write("COMMAND: samtools markdup -f markdup_metrics.txt - out.bam\nREAD: 1000\nEXAMINED: 800\nDUPLICATE PRIMARY TOTAL: 200\nDUPLICATE TOTAL: 210\n")
+
+            duplicate_metrics=read_duplicate_metrics(metrics_file)
+
+        self.assertEqual(duplicate_metrics["EXAMINED"], 800)
+        self.assertEqual(duplicate_metrics["DUPLICATE TOTAL"], 210)
+        self.assertEqual(duplicate_metrics["DUPLICATION RATE"], 0.25)
+        self.assertNotIn("COMMAND", duplicate_metrics)
+
+    #Test for read_sample_sheet
+    #Using a small sample sheet to check that every sample is returned with its FASTQ files
+    def test_read_sample_sheet(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sample_sheet=os.path.join(tmp_dir, "samples.tsv")
+            with open(sample_sheet, "w") as sheet:
+                sheet.write("sample\tfastq1\tfastq2\n")
+                sheet.write("S1\tS1_1.fastq.gz\tS1_2.fastq.gz\n")
+                sheet.write("S2\tS2_1.fastq.gz\tS2_2.fastq.gz\n")
+
+            samples=read_sample_sheet(sample_sheet)
+
+        self.assertEqual(samples, [{"sample": "S1", "fastq1": "S1_1.fastq.gz", "fastq2": "S1_2.fastq.gz"},
+                                   {"sample": "S2", "fastq1": "S2_1.fastq.gz", "fastq2": "S2_2.fastq.gz"}])
+
+    #Test for read_sample_sheet
+    #Using a sample sheet with a lane column to check that the lines of a sample are returned as its lanes and that a lane used twice raises a ValueError
+    def test_read_sample_sheet_lanes(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sample_sheet=os.path.join(tmp_dir, "samples.tsv")
+            with open(sample_sheet, "w") as sheet:
+                sheet.write("sample\tlane\tfastq1\tfastq2\n")
+                sheet.write("S1\tL001\tS1_L001_1.fastq.gz\tS1_L001_2.fastq.gz\n")
+                sheet.write("S2\tL001\tS2_L001_1.fastq.gz\tS2_L001_2.fastq.gz\n")
+                sheet.write("S1\tL002\tS1_L002_1.fastq.gz\tS1_L002_2.fastq.gz\n")
+
+            samples=read_sample_sheet(sample_sheet)
+
+            with open(sample_sheet, "a") as sheet:
+                sheet.write("S1\tL002\tS1_L002b_1.fastq.gz\tS1_L002b_2.fastq.gz\n")
+            with self.assertRaisesRegex(ValueError, "S1 L002"):
+                read_sample_sheet(sample_sheet)
+
+        self.assertEqual(samples, [{"sample": "S1", "lanes": [{"lane": "L001", "fastq1": "S1_L001_1.fastq.gz", "fastq2": "S1_L001_2.fastq.gz"}, {"lane": "L002", "fastq1": "S1_L002_1.fastq.gz", "fastq2": "S1_L002_2.fastq.gz"}]},
+                                   {"sample": "S2", "lanes": [{"lane": "L001", "fastq1": "S2_L001_1.fastq.gz", "fastq2": "S2_L001_2.fastq.gz"}]}])
+
+    #Test for read_sample_sheet
+    #Using small sample sheets to check that a missing column or a duplicate sample raises a ValueError
+    def test_read_sample_sheet_errors(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sample_sheet=os.path.join(tmp_dir, "samples.tsv")
+            with open(sample_sheet, "w") as sheet:
+                sheet.write("sample\tfastq1\n")
+                sheet.write("S1\tS1_1.fastq.gz\n")
+            with self.assertRaises(ValueError):
+                read_sample_sheet(sample_sheet)
+
+            with open(sample_sheet, "w") as sheet:
+                sheet.write("sample\tfastq1\tfastq2\n")
+                sheet.write("S1\tS1_1.fastq.gz\tS1_2.fastq.gz\n")
+                sheet.write("S1\tS1b_1.fastq.gz\tS1b_2.fastq.gz\n")
+            with self.assertRaises(ValueError):
+                read_sample_sheet(sample_sheet)
+
+    #Test for run_subprocess
+    #Using patch to mock if the run_subprocess restores the outputs of a step from the step cache instead of running the command again
+    @patch("run_gatk_cache.tool_version", return_value="1.0")
+    def test_run_subprocess_step_cache(self, mock_tool_version):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            in_file=os.path.join(tmp_dir, "input.txt")
+            out_file=os.path.join(tmp_dir, "output.txt")
+            with open(in_file, "w") as handle:
+                handle.write("reads\n")
+            configure_step_cache(os.path.join(tmp_dir, "cache"), 1 << 20)
+            try:
+                self.assertTrue(run_subprocess(["cp", in_file, out_file], "Copy", outputs=[out_file]))
+                os.remove(out_file)
+
+                with patch("run_gatk_extras.run_measured") as mock_run:
+                    self.assertTrue(run_subprocess(["cp", in_file, out_file], "Copy", outputs=[out_file]))
+                    mock_run.assert_not_called()
+            finally:
+                configure_step_cache(None, 0)
+
+            with open(out_file) as handle:
+                self.assertEqual(handle.read(), "reads\n")
+
+    #Test for output_ready
+    #Checking that an existing output is still used without running its step when a step cache is configured, and that an output older than its input is not
+    def test_output_ready_step_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            in_file=os.path.join(tmp_dir, "input.txt")
+            out_file=os.path.join(tmp_dir, "output.txt")
+            for path in [in_file, out_file]:
+                with open(path, "w") as handle:
+                    handle.write("reads\n")
+            os.utime(in_file, (0, 0))
+            configure_step_cache(os.path.join(tmp_dir, "cache"), 1 << 20)
+            try:
+                self.assertTrue(output_ready(out_file, non_empty=True, inputs=[in_file]))
+                os.utime(in_file, None)
+                os.utime(out_file, (0, 0))
+                self.assertFalse(output_ready(out_file, non_empty=True, inputs=[in_file]))
+            finally:
+                configure_step_cache(None, 0)
+
+    #Test for split_fastq_pair
+    #Using small gzipped FASTQ files to check that the batches of reads are written round-robin into read-aligned chunks, that the splitting is skipped the second time, and that the files of the earlier chunks are removed when the chunk count changes
+    def test_split_fastq_pair(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fastqs=[]
+            for mate in [1, 2]:
+                fastq=os.path.join(tmp_dir, f"sample_{mate}.fastq.gz")
+                with gzip.open(fastq, "wt") as handle:
+                    for read in range(5):
+                        handle.write(f"@read{read}/{mate}\nACGT\n+\nIIII\n")
+                fastqs.append(fastq)
+            chunk_dir=os.path.join(tmp_dir, "chunks")
+
+            chunk_pairs=split_fastq_pair(fastqs[0], fastqs[1], chunk_dir, 2, batch_reads=2)
+
+            with gzip.open(chunk_pairs[0][0], "rt") as handle:
+                chunk_1_names=[line.strip() for line in handle if line.startswith("@")]
+            with gzip.open(chunk_pairs[1][1], "rt") as handle:
+                chunk_2_names=[line.strip() for line in handle if line.startswith("@")]
+
+            with patch("run_gatk_extras.gzip.open") as mock_gzip_open:
+                self.assertEqual(split_fastq_pair(fastqs[0], fastqs[1], chunk_dir, 2, batch_reads=2), chunk_pairs)
+                mock_gzip_open.assert_not_called()
+
+            #Other chunk count: the chunks of the first split and their BAM files are removed
+            chunk_bam=os.path.join(chunk_dir, "chunk_0002_sorted.bam")
+            open(chunk_bam, "w").close()
+            self.assertEqual(len(split_fastq_pair(fastqs[0], fastqs[1], chunk_dir, 1, batch_reads=2)), 1)
+            self.assertFalse(os.path.exists(chunk_bam))
+            self.assertFalse(os.path.exists(chunk_pairs[1][0]))
+
+        self.assertEqual(chunk_1_names, ["@read0/1", "@read1/1", "@read4/1"])
+        self.assertEqual(chunk_2_names, ["@read2/2", "@read3/2"])
+
+    #Test for split_fastq_pair
+    #Using small FASTQ files to check that reads without their mate raise a ValueError
+    def test_split_fastq_pair_not_paired(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fastq_1=os.path.join(tmp_dir, "sample_1.fastq")
+            fastq_2=os.path.join(tmp_dir, "sample_2.fastq")
+            with open(fastq_1, "w") as handle:
+                handle.write("@read1/1\nACGT\n+\nIIII\n")
+            with open(fastq_2, "w") as handle:
+                handle.write("@read2/2\nACGT\n+\nIIII\n")
+
+            with self.assertRaises(ValueError):
+                split_fastq_pair(fastq_1, fastq_2, os.path.join(tmp_dir, "chunks"), 2)
+
+
+    #Test for critical_path
+    #Checking if the critical path goes back from the stage that ended last through the dependency that ended last
+    def test_critical_path(self):
+        stage_times={
+            "FASTQC": {"start": 0, "end": 30},
+            "Reference preparation": {"start": 0, "end": 50},
+            "Alignment": {"start": 0, "end": 40},
+            "Variant calling": {"start": 50, "end": 90}}
+        dependencies={"Variant calling": ["Alignment", "Reference preparation"]}
+
+        self.assertEqual(critical_path(stage_times, dependencies), ["Reference preparation", "Variant calling"])
+        self.assertEqual(critical_path({}, dependencies), [])
+
+    #Test for run_subprocess
+    #Using real commands to check that the output is renamed to its final name only when the command succeeds, together with the index written next to it
+    def test_run_subprocess_atomic_outputs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_file=os.path.join(tmp_dir, "output.vcf.gz")
+            write_outputs='echo data > "$0"; echo index > "$0.tbi"; exit "$1"'
+
+            self.assertFalse(run_subprocess(["sh", "-c", write_outputs, out_file, "1"], "Failing tool", outputs=[out_file, f"{out_file}.tbi"]))
+            self.assertEqual(os.listdir(tmp_dir), [])
+
+            self.assertTrue(run_subprocess(["sh", "-c", write_outputs, out_file, "0"], "Tool", outputs=[out_file, f"{out_file}.tbi"]))
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ["output.vcf.gz", "output.vcf.gz.tbi"])
+
+    #Test for output_ready
+    #Checking if a truncated BAM file left behind by a crashed run is removed instead of reused, and if an output older than its input is not reused
+    def test_output_ready_integrity(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            bam=os.path.join(tmp_dir, "sorted.bam")
+            with open(bam, "wb") as bam_file:
+                bam_file.write(gzip.compress(b"BAM\1"))
+            self.assertFalse(output_ready(bam))
+            self.assertFalse(os.path.exists(bam))
+
+            with open(bam, "wb") as bam_file:
+                bam_file.write(gzip.compress(b"BAM\1") + BGZF_EOF)
+            self.assertTrue(output_ready(bam))
+
+            vcf=os.path.join(tmp_dir, "output.vcf")
+            with open(vcf, "w") as vcf_file:
+                vcf_file.write("##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\nchr1\t100\t.\tA\tC\t50\t.\t.\n")
+            os.utime(vcf, (0, 0))
+            self.assertTrue(output_ready(vcf))
+            self.assertFalse(output_ready(vcf, inputs=[bam]))
+
+            with open(vcf, "a") as vcf_file:
+                vcf_file.write("chr1\t200\t.\tA")
+            self.assertFalse(output_ready(vcf))
+
+            cram=os.path.join(tmp_dir, "sorted.cram")
+            with open(cram, "wb") as cram_file:
+                cram_file.write(b"CRAM\3\1" + bytes(20) + CRAM_EOF[:-4])
+            self.assertFalse(output_ready(cram))
+
+            with open(cram, "wb") as cram_file:
+                cram_file.write(b"CRAM\3\1" + bytes(20) + CRAM_EOF)
+            self.assertTrue(output_ready(cram))
 
 if __name__ == "__main__":
     unittest.main()
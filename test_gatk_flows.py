@@ -1,6 +1,7 @@
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, ANY, MagicMock
 import os
+import tempfile
 from run_gatk_pipe import *
 
 #------------------------------------------------------------------------
@@ -39,9 +40,11 @@ class test_flows(unittest.TestCase):
     
     #Test for run_bwa
     #Using patch to mock if run_bwa (run_subprocess_out_file) will run if sam output is already present in run_gatk_flow.py
+    @patch("run_gatk_tasks.run_subprocess", return_value=True)
+    @patch("run_gatk_tasks.run_subprocess_out_file", return_value=True)
     @patch("os.path.exists")
     @patch("run_gatk_flows.run_subprocess_out_file")
-    def test_run_sam_exists(self, mock_run_subprocess_out_file, mock_exists):
+    def test_run_sam_exists(self, mock_run_subprocess_out_file, mock_exists, mock_task_run_subprocess_out_file, mock_task_run_subprocess):
 
         mock_exists.side_effect=lambda x: x == "gatk_pipeline.sam"
         
@@ -51,10 +54,12 @@ class test_flows(unittest.TestCase):
 
     #Test for run_bwa
     #Using patch to mock if run_bwa (convert_sam_to_bam) will run if bam output is already present in run_gatk_flow.py
+    @patch("run_gatk_tasks.run_subprocess", return_value=True)
+    @patch("run_gatk_tasks.run_subprocess_out_file", return_value=True)
     @patch("os.path.exists")
     @patch("run_gatk_flows.convert_sam_to_bam")
     @patch("run_gatk_flows.run_subprocess_out_file")
-    def test_run_bam_exists(self, mock_run_subprocess_out_file, mock_convert_sam_to_bam, mock_exists):
+    def test_run_bam_exists(self, mock_run_subprocess_out_file, mock_convert_sam_to_bam, mock_exists, mock_task_run_subprocess_out_file, mock_task_run_subprocess):
         
         mock_exists.side_effect=lambda x: x == "gatk_pipeline.bam" 
         
@@ -65,76 +70,410 @@ class test_flows(unittest.TestCase):
 
     #Test for run_bwa
     #Using patch to mock if run_bwa (sort_bam) will run if sorted bam output is already present in run_gatk_flow.py
+    #The SAM and unsorted BAM files are removed after they are read, so with the sorted BAM file present bwa mem does not run either
+    @patch("run_gatk_tasks.run_subprocess", return_value=True)
+    @patch("run_gatk_tasks.run_subprocess_out_file", return_value=True)
     @patch("os.path.exists")
     @patch("run_gatk_flows.sort_bam")
     @patch("run_gatk_flows.run_subprocess_out_file")
-    def test_run_sorted_bam_exists(self, mock_run_subprocess_out_file, mock_convert_sort_bam, mock_exists):
+    def test_run_sorted_bam_exists(self, mock_run_subprocess_out_file, mock_convert_sort_bam, mock_exists, mock_task_run_subprocess_out_file, mock_task_run_subprocess):
         
         mock_exists.side_effect=lambda x: x == "gatk_pipeline_sorted.bam"  # BAM and SAM files exist
         
         run_bwa("file1.fastq", "file2.fastq", "ref_genome.fasta", 4)
 
         mock_convert_sort_bam.assert_not_called()
-        mock_run_subprocess_out_file.assert_called_once()
+        mock_run_subprocess_out_file.assert_not_called()
+
+    #Test for run_bwa
+    #Using patch to mock if run_bwa in stream mode pipes bwa mem into samtools sort without writing the SAM and unsorted BAM files in run_gatk_flow.py
+    @patch("run_gatk_resources.RESOURCE_BUDGET", ResourceBudget(8, 16000))
+    @patch("os.path.exists")
+    @patch("run_gatk_flows.convert_sam_to_bam")
+    @patch("run_gatk_flows.run_subprocess_out_file")
+    @patch("run_gatk_flows.run_subprocess_pipe")
+    def test_run_bwa_stream(self, mock_run_subprocess_pipe, mock_run_subprocess_out_file, mock_convert_sam_to_bam, mock_exists):
+
+        mock_exists.return_value=False
+
+        run_bwa("file1.fastq", "file2.fastq", "ref_genome.fasta", 4, stream=True)
+
+        commands=mock_run_subprocess_pipe.call_args[0][0]
+        self.assertEqual(commands[0][:4], ["bwa", "mem", "-t", "4"])
+        self.assertEqual(commands[1], ["samtools", "sort", "-@", "3", "-m", "832M", "-T", step_scratch_name("samtools_sort", "gatk_pipeline_sorted.bam"), "-o", "gatk_pipeline_sorted.bam", "-"])
+        mock_run_subprocess_out_file.assert_not_called()
+        mock_convert_sam_to_bam.assert_not_called()
+
+    #Test for run_bwa
+    #Using patch to mock if run_bwa with a CRAM output streams bwa mem into samtools sort, which writes the CRAM file compressed against the reference genome with the compression threads in run_gatk_flow.py
+    @patch("run_gatk_resources.RESOURCE_BUDGET", ResourceBudget(8, 16000))
+    @patch("run_gatk_flows.output_ready", return_value=False)
+    @patch("run_gatk_flows.convert_sam_to_bam")
+    @patch("run_gatk_flows.run_subprocess_out_file")
+    @patch("run_gatk_flows.run_subprocess_pipe", return_value=True)
+    def test_run_bwa_cram(self, mock_run_subprocess_pipe, mock_run_subprocess_out_file, mock_convert_sam_to_bam, mock_output_ready):
+
+        run_bwa("file1.fastq", "file2.fastq", "ref_genome.fasta", 4, bam_sorted="sorted.cram", compression_threads=2)
+
+        commands=mock_run_subprocess_pipe.call_args[0][0]
+        self.assertEqual(commands[1], ["samtools", "sort", "-@", "1", "-m", "1664M", "-T", step_scratch_name("samtools_sort", "sorted.cram"), "-O", "cram", "--reference", "ref_genome.fasta", "-o", "sorted.cram", "-"])
+        mock_run_subprocess_out_file.assert_not_called()
+        mock_convert_sam_to_bam.assert_not_called()
+
+    #Test for run_bwa
+    #Using patch to mock if run_bwa with mark_duplicates pipes bwa mem into samtools fixmate, sort and markdup, which write the sorted BAM and the duplication metrics in run_gatk_flow.py
+    @patch("run_gatk_resources.RESOURCE_BUDGET", ResourceBudget(8, 16000))
+    @patch("run_gatk_flows.read_duplicate_metrics")
+    @patch("run_gatk_flows.output_ready", return_value=False)
+    @patch("run_gatk_flows.convert_sam_to_bam")
+    @patch("run_gatk_flows.run_subprocess_pipe", return_value=True)
+    def test_run_bwa_mark_duplicates(self, mock_run_subprocess_pipe, mock_convert_sam_to_bam, mock_output_ready, mock_read_duplicate_metrics):
+
+        run_bwa("file1.fastq", "file2.fastq", "ref_genome.fasta", 4, mark_duplicates=True, dup_metrics="dup_metrics.txt")
+
+        commands=mock_run_subprocess_pipe.call_args[0][0]
+        self.assertEqual(commands[0][:4], ["bwa", "mem", "-t", "4"])
+        self.assertEqual(commands[1], ["samtools", "fixmate", "-m", "-u", "-@", "3", "-", "-"])
+        self.assertEqual(commands[2], ["samtools", "sort", "-u", "-@", "3", "-m", "832M", "-T", step_scratch_name("samtools_sort", "gatk_pipeline_sorted.bam"), "-"])
+        self.assertEqual(commands[3], ["samtools", "markdup", "-@", "3", "-f", "dup_metrics.txt", "-", "gatk_pipeline_sorted.bam"])
+        self.assertEqual(mock_run_subprocess_pipe.call_args.kwargs["outputs"], ["gatk_pipeline_sorted.bam", "dup_metrics.txt"])
+        mock_read_duplicate_metrics.assert_called_once_with("dup_metrics.txt")
+        mock_convert_sam_to_bam.assert_not_called()
+
+    #Test for run_bwa
+    #Using patch to mock if run_bwa still skips the steps whose output files exist when a step cache is configured in run_gatk_flow.py
+    @patch("run_gatk_extras.STEP_CACHE")
+    @patch("os.path.exists")
+    @patch("run_gatk_flows.sort_bam")
+    @patch("run_gatk_flows.convert_sam_to_bam")
+    @patch("run_gatk_flows.run_subprocess_out_file")
+    def test_run_bwa_step_cache(self, mock_run_subprocess_out_file, mock_convert_sam_to_bam, mock_sort_bam, mock_exists, mock_step_cache):
+
+        mock_exists.side_effect=lambda x: x == "gatk_pipeline_sorted.bam"
+
+        run_bwa("file1.fastq", "file2.fastq", "ref_genome.fasta", 4)
+
+        mock_run_subprocess_out_file.assert_not_called()
+        mock_convert_sam_to_bam.assert_not_called()
+        mock_sort_bam.assert_not_called()
 
     #Test for run_HaplotypeCaller
-    # Using patch to mock if the run_HaplotypeCaller (run_subprocess_out_file) will run if output vcf file is already present in run_gatk_flows.py
+    # Using patch to mock if the run_HaplotypeCaller (haplotype_caller) will run if output vcf file is already present in run_gatk_flows.py
+    @patch("run_gatk_tasks.run_subprocess", return_value=True)
+    @patch("run_gatk_tasks.run_subprocess_out_file", return_value=True)
     @patch("os.path.exists")
     @patch("os.path.getsize")
-    @patch("run_gatk_flows.run_subprocess_out_file")
-    def test_run_haplotype_caller_not_called_if_vcf_exists_and_non_empty(self, mock_run_subprocess_out_file, mock_getsize, mock_exists):
+    @patch("run_gatk_flows.haplotype_caller")
+    def test_run_haplotype_caller_not_called_if_vcf_exists_and_non_empty(self, mock_haplotype_caller, mock_getsize, mock_exists, mock_task_run_subprocess_out_file, mock_task_run_subprocess):
     
         mock_exists.side_effect = lambda x: "output_vcf" in x
         mock_getsize.side_effect = lambda x: 100 
 
         run_HaplotypeCaller("ref_genome.fasta", "output_vcf")
 
-        mock_run_subprocess_out_file.assert_not_called()
+        mock_haplotype_caller.assert_not_called()
 
     #Test for run_HaplotypeCaller
     #Using patch to mock if the run_HaplotypeCaller (index_reference) will run if the ref index file is already present in run_gatk_flows.py
+    @patch("run_gatk_tasks.run_subprocess", return_value=True)
+    @patch("run_gatk_tasks.run_subprocess_out_file", return_value=True)
     @patch("os.path.exists")
     @patch("run_gatk_flows.index_reference")  # Change "your_module" to the actual module name
-    @patch("run_gatk_flows.run_subprocess_out_file")
-    def test_index_reference_exists(self, mock_run_subprocess_out_file, mock_index_reference, mock_exists):
+    @patch("run_gatk_flows.haplotype_caller")
+    def test_index_reference_exists(self, mock_haplotype_caller, mock_index_reference, mock_exists, mock_task_run_subprocess_out_file, mock_task_run_subprocess):
     
-        mock_exists.side_effect=lambda x: x == "data/Homo_sapiens_assembly38.fasta.fai"
+        mock_exists.side_effect=lambda x: x == "ref_genome.fasta.fai"
         
         run_HaplotypeCaller("ref_genome.fasta", "output_vcf")
 
         mock_index_reference.assert_not_called()
-        mock_run_subprocess_out_file.assert_called_once()
+        mock_haplotype_caller.assert_called_once()
     
     #Test for run_HaplotypeCaller
     #Using patch to mock if the run_HaplotypeCaller (dict_reference) will run if the dict file is already present in run_gatk_flows.py
+    @patch("run_gatk_tasks.run_subprocess", return_value=True)
+    @patch("run_gatk_tasks.run_subprocess_out_file", return_value=True)
     @patch("os.path.exists")
     @patch("run_gatk_flows.dict_reference")
-    @patch("run_gatk_flows.run_subprocess_out_file")
-    def test_dict_reference_exists(self, mock_run_subprocess_out_file, mock_dict_reference, mock_exists):
+    @patch("run_gatk_flows.haplotype_caller")
+    def test_dict_reference_exists(self, mock_haplotype_caller, mock_dict_reference, mock_exists, mock_task_run_subprocess_out_file, mock_task_run_subprocess):
 
-        mock_exists.side_effect=lambda x: x == "data/Homo_sapiens_assembly38.dict"
+        mock_exists.side_effect=lambda x: x == "ref_genome.dict"
         
         run_HaplotypeCaller("ref_genome.fasta", "output_vcf")
 
         mock_dict_reference.assert_not_called()
-        mock_run_subprocess_out_file.assert_called_once()
+        mock_haplotype_caller.assert_called_once()
     
     #Test for run_HaplotypeCaller
     # Using patch to mock if the run_HaplotypeCaller (index_bam) will run if the index BAM file is already present in run_gatk_flows.py
+    @patch("run_gatk_tasks.run_subprocess", return_value=True)
+    @patch("run_gatk_tasks.run_subprocess_out_file", return_value=True)
     @patch("os.path.exists")
     @patch("run_gatk_flows.index_bam")
-    @patch("run_gatk_flows.run_subprocess_out_file")
-    def test_index_bam_exists(self, mock_run_subprocess_out_file, mock_index_bam_reference, mock_exists):
+    @patch("run_gatk_flows.haplotype_caller")
+    def test_index_bam_exists(self, mock_haplotype_caller, mock_index_bam_reference, mock_exists, mock_task_run_subprocess_out_file, mock_task_run_subprocess):
     
-        mock_exists.side_effect=lambda x: x == "data/Homo_sapiens_assembly38.dict"
+        mock_exists.side_effect=lambda x: x == "ref_genome.dict"
         
         run_HaplotypeCaller("ref_genome.fasta", "output_vcf")
 
         mock_index_bam_reference.assert_not_called()
-        mock_run_subprocess_out_file.assert_called_once()
+        mock_haplotype_caller.assert_called_once()
+
+
+    #Test for run_native_qc
+    #Using patch to mock if run_native_qc reuses the QC report only when it is newer than both FASTQ files in run_gatk_flows.py
+    @patch("run_gatk_qc.run_fastq_qc")
+    def test_run_native_qc_newer_fastq(self, mock_run_fastq_qc):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fastq_1, fastq_2=os.path.join(tmp_dir, "reads_1.fastq.gz"), os.path.join(tmp_dir, "reads_2.fastq.gz")
+            qc_report=os.path.join(tmp_dir, "qc_results", "reads_1_qc.json")
+            os.makedirs(os.path.dirname(qc_report))
+            for path in (fastq_1, fastq_2, qc_report):
+                with open(path, "w") as output:
+                    output.write("{}\n")
+                os.utime(path, (100, 100))
+
+            run_native_qc(fastq_1, fastq_2, workers=1, qc_output_dir=os.path.dirname(qc_report))
+            mock_run_fastq_qc.assert_not_called()
+
+            #A FASTQ file replaced after the QC report
+            os.utime(fastq_2, (200, 200))
+            run_native_qc(fastq_1, fastq_2, workers=1, qc_output_dir=os.path.dirname(qc_report))
+            mock_run_fastq_qc.assert_called_once_with(fastq_1, fastq_2, qc_report, workers=1)
+
+    #Test for run_HaplotypeCaller_scatter
+    #Using patch to mock if run_HaplotypeCaller_scatter calls one HaplotypeCaller per shard with its share of the resource budget and gathers the shard VCF files in reference order in run_gatk_flows.py
+    @patch("run_gatk_resources.RESOURCE_BUDGET", ResourceBudget(8, 16000))
+    @patch("run_gatk_flows.index_vcf")
+    @patch("run_gatk_flows.gather_vcfs")
+    @patch("run_gatk_flows.haplotype_caller_shard")
+    @patch("run_gatk_flows.remove_intermediates")
+    def test_run_HaplotypeCaller_scatter(self, mock_remove_intermediates, mock_haplotype_caller_shard, mock_gather_vcfs, mock_index_vcf):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fai_file=os.path.join(tmp_dir, "reference.fasta.fai")
+            with open(fai_file, "w") as fai:
+                for i in range(1, 5):
+                    fai.write(f"chr{i}\t25\t{i * 40}\t60\t61\n")
+            shard_dir=os.path.join(tmp_dir, "shards")
+
+            run_HaplotypeCaller_scatter("reference.fasta", "output.vcf.gz", "sorted.bam", fai_file, 4, shard_concurrency=2, shard_dir=shard_dir)
+
+            with open(os.path.join(shard_dir, "shard_0002.intervals")) as intervals:
+                self.assertEqual(intervals.read(), "chr2:1-25\n")
+
+        self.assertEqual(mock_haplotype_caller_shard.submit.call_count, 4)
+        self.assertEqual(mock_haplotype_caller_shard.submit.call_args.kwargs, {"threads": 4, "memory_mb": 8000, "process_group": ANY})
+        mock_gather_vcfs.assert_called_once_with([os.path.join(shard_dir, f"shard_{i:04d}.vcf") for i in range(1, 5)], "output.vcf.gz", threads=1, memory_mb=8192)
+        #The gathered VCF file is indexed
+        mock_index_vcf.assert_called_once_with("output.vcf.gz", "output.vcf.gz.tbi", threads=1, memory_mb=ANY)
+        #The shards are removed after the gather
+        mock_remove_intermediates.assert_called_once_with(shard_dir)
+
+    #Test for run_HaplotypeCaller_scatter
+    #Using patch to mock if run_HaplotypeCaller_scatter does not gather the shard VCF files when a shard fails in run_gatk_flows.py
+    @patch("run_gatk_flows.gather_vcfs")
+    @patch("run_gatk_flows.haplotype_caller_shard")
+    def test_run_HaplotypeCaller_scatter_shard_fails(self, mock_haplotype_caller_shard, mock_gather_vcfs):
+
+        mock_haplotype_caller_shard.submit.return_value.result.return_value=False
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fai_file=os.path.join(tmp_dir, "reference.fasta.fai")
+            with open(fai_file, "w") as fai:
+                fai.write("chr1\t100\t6\t60\t61\n")
+
+            result=run_HaplotypeCaller_scatter("reference.fasta", "output.vcf", "sorted.bam", fai_file, 2, shard_dir=os.path.join(tmp_dir, "shards"))
+
+        self.assertFalse(result)
+        mock_gather_vcfs.assert_not_called()
+
+    #Test for run_HaplotypeCaller_scatter
+    #Using patch to mock if the shard VCF files of a failed run are reused only for the same intervals and an older sorted BAM file in run_gatk_flows.py
+    @patch("run_gatk_flows.index_vcf", return_value=True)
+    @patch("run_gatk_flows.gather_vcfs", return_value=False)
+    @patch("run_gatk_flows.haplotype_caller_shard")
+    @patch("run_gatk_extras.check_output", return_value=(True, None))
+    def test_run_HaplotypeCaller_scatter_resume(self, mock_check_output, mock_haplotype_caller_shard, mock_gather_vcfs, mock_index_vcf):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fai_file=os.path.join(tmp_dir, "reference.fasta.fai")
+            with open(fai_file, "w") as fai:
+                for i in range(1, 4):
+                    fai.write(f"chr{i}\t100\t{i * 110}\t60\t61\n")
+            bam_sorted=os.path.join(tmp_dir, "sorted.bam")
+            open(bam_sorted, "w").close()
+            os.utime(bam_sorted, (0, 0))
+            shard_dir=os.path.join(tmp_dir, "shards")
+
+            #The gather of the first run fails and leaves the shard VCF files of 2 shards behind
+            run_HaplotypeCaller_scatter("reference.fasta", "output.vcf", bam_sorted, fai_file, 2, shard_dir=shard_dir)
+            for i in [1, 2]:
+                with open(os.path.join(shard_dir, f"shard_{i:04d}.vcf"), "w") as shard_vcf:
+                    shard_vcf.write("##fileformat=VCFv4.2\n")
+
+            mock_haplotype_caller_shard.reset_mock()
+            run_HaplotypeCaller_scatter("reference.fasta", "output.vcf", bam_sorted, fai_file, 2, shard_dir=shard_dir)
+            mock_haplotype_caller_shard.submit.assert_not_called()
+
+            #Other shard count: the shard VCF files of the first split are removed and every shard is called again
+            run_HaplotypeCaller_scatter("reference.fasta", "output.vcf", bam_sorted, fai_file, 3, shard_dir=shard_dir)
+            self.assertEqual(mock_haplotype_caller_shard.submit.call_count, 3)
+            self.assertFalse(os.path.exists(os.path.join(shard_dir, "shard_0001.vcf")))
+
+            #Same shard count, but a sorted BAM file newer than the shard VCF files
+            for i in [1, 2, 3]:
+                with open(os.path.join(shard_dir, f"shard_{i:04d}.vcf"), "w") as shard_vcf:
+                    shard_vcf.write("##fileformat=VCFv4.2\n")
+            os.utime(bam_sorted, (100, 100))
+            os.utime(os.path.join(shard_dir, "shard_0001.vcf"), (50, 50))
+            mock_haplotype_caller_shard.reset_mock()
+            run_HaplotypeCaller_scatter("reference.fasta", "output.vcf", bam_sorted, fai_file, 3, shard_dir=shard_dir)
+            self.assertEqual(mock_haplotype_caller_shard.submit.call_count, 1)
+
+    #Test for run_cohort
+    #Using patch to mock if run_cohort processes every sample with its own read group and joint genotypes the sample GVCF files in run_gatk_flows.py
+    @patch("run_gatk_tasks.run_subprocess", return_value=True)
+    @patch("run_gatk_tasks.run_subprocess_out_file", return_value=True)
+    @patch("run_gatk_resources.RESOURCE_BUDGET", ResourceBudget(8, 16000))
+    @patch("run_gatk_flows.genotype_gvcfs")
+    @patch("run_gatk_flows.combine_gvcfs")
+    @patch("run_gatk_flows.haplotype_caller_gvcf")
+    @patch("run_gatk_flows.index_bam")
+    @patch("run_gatk_flows.run_bwa")
+    def test_run_cohort(self, mock_run_bwa, mock_index_bam, mock_haplotype_caller_gvcf, mock_combine_gvcfs, mock_genotype_gvcfs, mock_task_run_subprocess_out_file, mock_task_run_subprocess):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ref_genome=os.path.join(tmp_dir, "reference.fasta")
+            for ref_file in [f"{ref_genome}.fai", os.path.join(tmp_dir, "reference.dict")]:
+                open(ref_file, "w").close()
+            sample_sheet=os.path.join(tmp_dir, "samples.tsv")
+            with open(sample_sheet, "w") as sheet:
+                sheet.write("sample\tfastq1\tfastq2\n")
+                sheet.write("S1\tS1_1.fastq.gz\tS1_2.fastq.gz\n")
+                sheet.write("S2\tS2_1.fastq.gz\tS2_2.fastq.gz\n")
+            cohort_dir=os.path.join(tmp_dir, "cohort")
+
+            #The mocked alignment creates the sorted BAM file
+            mock_run_bwa.side_effect=lambda *args, **kwargs: open(kwargs["bam_sorted"], "w").close()
+
+            run_cohort(sample_sheet, ref_genome, "cohort.vcf", 2, sample_concurrency=1, cohort_dir=cohort_dir)
+
+        read_groups=sorted(call.kwargs["read_group_info"] for call in mock_run_bwa.call_args_list)
+        self.assertEqual(read_groups, [build_read_group("S1", "S1"), build_read_group("S2", "S2")])
+        self.assertEqual(mock_haplotype_caller_gvcf.call_count, 2)
+        mock_combine_gvcfs.assert_called_once_with(ref_genome, [os.path.join(cohort_dir, "S1", "S1.g.vcf.gz"), os.path.join(cohort_dir, "S2", "S2.g.vcf.gz")], os.path.join(cohort_dir, "cohort.g.vcf.gz"), threads=1, memory_mb=8192)
+        mock_genotype_gvcfs.assert_called_once_with(ref_genome, os.path.join(cohort_dir, "cohort.g.vcf.gz"), "cohort.vcf", threads=1, memory_mb=8192)
+
+    #Test for run_cohort
+    #Using patch to mock if run_cohort skips the joint genotyping when the alignment of a sample fails in run_gatk_flows.py
+    @patch("run_gatk_tasks.run_subprocess", return_value=True)
+    @patch("run_gatk_tasks.run_subprocess_out_file", return_value=True)
+    @patch("run_gatk_flows.combine_gvcfs")
+    @patch("run_gatk_flows.haplotype_caller_gvcf")
+    @patch("run_gatk_flows.run_bwa")
+    def test_run_cohort_sample_fails(self, mock_run_bwa, mock_haplotype_caller_gvcf, mock_combine_gvcfs, mock_task_run_subprocess_out_file, mock_task_run_subprocess):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ref_genome=os.path.join(tmp_dir, "reference.fasta")
+            for ref_file in [f"{ref_genome}.fai", os.path.join(tmp_dir, "reference.dict")]:
+                open(ref_file, "w").close()
+            sample_sheet=os.path.join(tmp_dir, "samples.tsv")
+            with open(sample_sheet, "w") as sheet:
+                sheet.write("sample\tfastq1\tfastq2\n")
+                sheet.write("S1\tS1_1.fastq.gz\tS1_2.fastq.gz\n")
+
+            result=run_cohort(sample_sheet, ref_genome, "cohort.vcf", 2, cohort_dir=os.path.join(tmp_dir, "cohort"))
+
+        self.assertFalse(result)
+        mock_haplotype_caller_gvcf.assert_not_called()
+        mock_combine_gvcfs.assert_not_called()
+
+    #Test for run_bwa_sharded
+    #Using patch to mock if run_bwa_sharded aligns only the chunks without sorted BAM file and merges all the chunks in run_gatk_flows.py
+    @patch("run_gatk_flows.merge_bams")
+    @patch("run_gatk_flows.align_chunk")
+    @patch("run_gatk_flows.split_fastq_pair")
+    def test_run_bwa_sharded(self, mock_split_fastq_pair, mock_align_chunk, mock_merge_bams):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            chunk_pairs=[(os.path.join(tmp_dir, f"chunk_{i:04d}_1.fastq.gz"), os.path.join(tmp_dir, f"chunk_{i:04d}_2.fastq.gz")) for i in [1, 2, 3]]
+            chunk_bams=[os.path.join(tmp_dir, f"chunk_{i:04d}_sorted.bam") for i in [1, 2, 3]]
+            mock_split_fastq_pair.return_value=chunk_pairs
+            mock_align_chunk.submit.return_value.result.return_value=True
+            #The second chunk was aligned by a previous run
+            with open(chunk_bams[1], "wb") as chunk_bam:
+                chunk_bam.write(BGZF_EOF)
+
+            run_bwa_sharded("file1.fastq.gz", "file2.fastq.gz", "ref_genome.fasta", 6, "sorted.bam", 3, "@RG\\tID:S1\\tSM:S1", chunk_dir=tmp_dir)
+
+        aligned_bams=[call.args[4] for call in mock_align_chunk.submit.call_args_list]
+        self.assertEqual(aligned_bams, [chunk_bams[0], chunk_bams[2]])
+        self.assertEqual(mock_merge_bams.call_args.args, (chunk_bams, "sorted.bam"))
+
+    #Test for run_bwa_lanes
+    #Using patch to mock if run_bwa_lanes aligns every lane with its own read group, and then only aligns a new lane and merges it into the sorted BAM file of the sample in run_gatk_flows.py
+    @patch("run_gatk_flows.merge_bams")
+    @patch("run_gatk_flows.align_chunk")
+    def test_run_bwa_lanes(self, mock_align_chunk, mock_merge_bams):
+
+        #The mocked tasks create their output files
+        def align(chunk_1, chunk_2, ref_genome, read_group_info, out_chunk_bam, **kwargs):
+            with open(out_chunk_bam, "wb") as lane_bam:
+                lane_bam.write(BGZF_EOF)
+            return MagicMock(**{"result.return_value": True})
+        def merge(bams, out_bam, **kwargs):
+            with open(out_bam, "wb") as merged_bam:
+                merged_bam.write(BGZF_EOF)
+            return True
+        mock_align_chunk.submit.side_effect=align
+        mock_merge_bams.side_effect=merge
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            lane_dir=os.path.join(tmp_dir, "lanes")
+            bam_sorted=os.path.join(tmp_dir, "S1_sorted.bam")
+            lanes=[{"lane": lane, "fastq1": f"S1_{lane}_1.fastq.gz", "fastq2": f"S1_{lane}_2.fastq.gz"} for lane in ["L001", "L002", "L003"]]
+            lane_bams=[os.path.join(lane_dir, f"S1_{lane}_sorted.bam") for lane in ["L001", "L002", "L003"]]
+
+            self.assertTrue(run_bwa_lanes("S1", lanes[:2], "ref_genome.fasta", 4, bam_sorted, lane_dir))
+            read_groups=[call.args[3] for call in mock_align_chunk.submit.call_args_list]
+            self.assertEqual(read_groups, [build_read_group("S1", "S1.L001", platform_unit="L001"), build_read_group("S1", "S1.L002", platform_unit="L002")])
+            self.assertEqual(mock_merge_bams.call_args.args, (lane_bams[:2], bam_sorted))
+
+            #A new lane arrives
+            mock_align_chunk.submit.reset_mock()
+            self.assertTrue(run_bwa_lanes("S1", lanes, "ref_genome.fasta", 4, bam_sorted, lane_dir))
+            self.assertEqual([call.args[4] for call in mock_align_chunk.submit.call_args_list], [lane_bams[2]])
+            self.assertEqual(mock_merge_bams.call_args.args, ([os.path.join(lane_dir, "previous.S1_sorted.bam"), lane_bams[2]], bam_sorted))
+            self.assertEqual(read_lane_manifest(bam_sorted), ["L001", "L002", "L003"])
+            self.assertFalse(os.path.exists(os.path.join(lane_dir, "previous.S1_sorted.bam")))
+
+            #Nothing is aligned or merged again
+            mock_align_chunk.submit.reset_mock()
+            mock_merge_bams.reset_mock()
+            self.assertTrue(run_bwa_lanes("S1", lanes, "ref_genome.fasta", 4, bam_sorted, lane_dir))
+            mock_align_chunk.submit.assert_not_called()
+            mock_merge_bams.assert_not_called()
+
+    #Test for run_bwa_sharded
+    #Using patch to mock if run_bwa_sharded does not merge the chunks when a chunk fails in run_gatk_flows.py
+    @patch("run_gatk_flows.merge_bams")
+    @patch("run_gatk_flows.align_chunk")
+    @patch("run_gatk_flows.split_fastq_pair")
+    def test_run_bwa_sharded_chunk_fails(self, mock_split_fastq_pair, mock_align_chunk, mock_merge_bams):
+
+        mock_split_fastq_pair.return_value=[("chunk_0001_1.fastq.gz", "chunk_0001_2.fastq.gz")]
+        mock_align_chunk.submit.return_value.result.return_value=RuntimeError("Alignment of chunk failed.")
+
+        result=run_bwa_sharded("file1.fastq.gz", "file2.fastq.gz", "ref_genome.fasta", 2, "sorted.bam", 1, "@RG\\tID:S1\\tSM:S1")
+
+        self.assertFalse(result)
+        mock_merge_bams.assert_not_called()
+
 
-    
-    
 if __name__ == "__main__":
     unittest.main()
 
@@ -0,0 +1,98 @@
+import unittest
+from unittest.mock import patch
+import subprocess
+import tempfile
+import json
+import csv
+import os
+from run_gatk_metrics import *
+
+#------------------------------------------------------------------------
+#Tests for run_gatk_metrics.py
+#------------------------------------------------------------------------
+class test_metrics(unittest.TestCase):
+
+    def setUp(self):
+        STEP_METRICS.clear()
+
+    def tearDown(self):
+        STEP_METRICS.clear()
+
+    #Test for run_measured
+    #Using a real command to check that the resource usage and the output size of a tool are recorded
+    def test_run_measured(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_file=os.path.join(tmp_dir, "output.txt")
+            with open(out_file, "w") as out_handle:
+                run_measured(["echo", "reads"], "Echo", outputs=[out_file], stdout=out_handle)
+
+        self.assertEqual(len(STEP_METRICS), 1)
+        metrics=STEP_METRICS[0]
+        self.assertEqual(metrics["tool"], "Echo")
+        self.assertEqual(metrics["command"], "echo reads")
+        self.assertEqual(metrics["returncode"], 0)
+        self.assertEqual(metrics["output_bytes"], 6)
+        self.assertGreater(metrics["peak_rss_mb"], 0)
+        self.assertFalse(metrics["cached"])
+
+    #Test for run_measured
+    #Using a real command to check that a failing tool raises CalledProcessError and is still recorded
+    def test_run_measured_error(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            run_measured(["false"], "False")
+
+        self.assertEqual(STEP_METRICS[0]["returncode"], 1)
+        self.assertIsNone(STEP_METRICS[0]["output_bytes"])
+
+    #Test for run_measured and gc_time_s
+    #Using a real command with a GC log in its Java options to check that the GC pauses of the JVM are added up in the metrics of the step
+    def test_run_measured_gc_time(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gc_log=os.path.join(tmp_dir, "gc.log")
+            with open(gc_log, "w") as log:
+                log.write("[0.010s][info][gc] Using G1\n")
+                log.write("[1.204s][info][gc] GC(0) Pause Young (Normal) (G1 Evacuation Pause) 24M->4M(256M) 250.500ms\n")
+                log.write("[2.010s][info][gc] GC(1) Concurrent Mark Cycle 80.000ms\n")
+                log.write("[3.521s][info][gc] GC(2) Pause Full (G1 Compaction Pause) 200M->100M(256M) 1000.000ms\n")
+            run_measured(["echo", "--java-options", f"-Xmx100m -XX:+UseG1GC -Xlog:gc:file={gc_log}", "HaplotypeCaller"], "GATK HaplotypeCaller")
+
+        self.assertEqual(STEP_METRICS[0]["gc_time_s"], 1.25)
+        self.assertIsNone(gc_time_s(["samtools", "index", "sorted.bam"]))
+
+    #Test for write_metrics_report
+    #Checking that the metrics are written as JSON or CSV depending on the extension of the report file
+    def test_write_metrics_report(self):
+        run_measured(["true"], "True")
+        record_cached_step([["bwa", "mem"]], "BWA mem", None)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            json_report=os.path.join(tmp_dir, "metrics.json")
+            write_metrics_report(json_report)
+            with open(json_report) as report:
+                steps=json.load(report)["steps"]
+
+            csv_report=os.path.join(tmp_dir, "metrics.csv")
+            write_metrics_report(csv_report)
+            with open(csv_report, newline="") as report:
+                rows=list(csv.DictReader(report))
+
+        self.assertEqual([step["tool"] for step in steps], ["True", "BWA mem"])
+        self.assertEqual([row["cached"] for row in rows], ["False", "True"])
+        self.assertEqual(list(rows[0].keys()), METRICS_FIELDS)
+
+    #Test for log_metrics_summary
+    #Using patch to mock if the summary table has a header line and one line per step
+    @patch("run_gatk_metrics.logging.info")
+    def test_log_metrics_summary(self, mock_info):
+        run_measured(["true"], "True")
+        record_cached_step([["bwa", "mem"]], "BWA mem", None)
+
+        log_metrics_summary()
+
+        lines=[call.args[0] for call in mock_info.call_args_list[-3:]]
+        self.assertTrue(lines[0].startswith("Tool"))
+        self.assertTrue(lines[1].startswith("True "))
+        self.assertTrue(lines[2].startswith("BWA mem (cached)"))
+
+if __name__ == "__main__":
+    unittest.main()
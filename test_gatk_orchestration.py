@@ -0,0 +1,101 @@
+import unittest
+import subprocess
+import threading
+import time
+import sys
+import os
+import run_gatk_orchestration
+from run_gatk_orchestration import *
+
+#Flows and tasks of the tests
+@task
+def add(a, b):
+    return a + b
+
+@task
+def fail():
+    raise ValueError("task failed")
+
+@task
+def record_thread(threads):
+    threads.append(threading.current_thread().name)
+    time.sleep(0.2)
+
+ATTEMPTS=[]
+
+@task(retries=2, retry_delay_seconds=0)
+def flaky():
+    ATTEMPTS.append(1)
+    if len(ATTEMPTS) < 3:
+        raise RuntimeError("not yet")
+    return "done"
+
+@flow(task_runner=ThreadPoolTaskRunner())
+def add_flow():
+    first=add.submit(1, 2)
+    second=add.submit(first.result(), 3, wait_for=[first])
+    return second.result() + add(0, 4)
+
+@flow
+def upstream_flow():
+    failed=fail.submit()
+    after=add.submit(1, 1, wait_for=[failed])
+    return failed.result(raise_on_failure=False), after.result(raise_on_failure=False)
+
+@flow
+def threads_flow(threads, tasks):
+    for i in range(tasks):
+        record_thread.submit(threads)
+
+#------------------------------------------------------------------------
+#Tests for run_gatk_orchestration.py
+#------------------------------------------------------------------------
+class test_orchestration(unittest.TestCase):
+
+    def setUp(self):
+        configure_orchestration("local")
+
+    def tearDown(self):
+        configure_orchestration("prefect")
+
+    #Test for Flow and Task with the local engine
+    #Checking that submitted tasks, wait_for and direct task calls give the results of the functions
+    def test_local_flow(self):
+        self.assertEqual(add_flow(), 10)
+
+    #Test for Task.submit with the local engine
+    #Checking that a failed task gives its exception with raise_on_failure=False and that the tasks waiting for it do not run
+    def test_local_upstream_failed(self):
+        failed, after=upstream_flow()
+
+        self.assertIsInstance(failed, ValueError)
+        self.assertIsInstance(after, UpstreamFailed)
+
+    #Test for Task with the local engine
+    #Checking that a failed task is retried
+    def test_local_retries(self):
+        ATTEMPTS.clear()
+
+        self.assertEqual(flaky(), "done")
+        self.assertEqual(len(ATTEMPTS), 3)
+
+    #Test for Flow.with_options with the local engine
+    #Checking that the task runner of a flow limits its threads and that the flow waits for its submitted tasks
+    def test_local_task_runner(self):
+        threads=[]
+        threads_flow.with_options(task_runner=ThreadPoolTaskRunner(max_workers=2))(threads, 4)
+
+        self.assertEqual(len(threads), 4)
+        self.assertEqual(len(set(threads)), 2)
+
+    #Test for the lazy import of Prefect
+    #Using a new interpreter to check that importing the pipeline does not import Prefect
+    def test_prefect_not_imported(self):
+        package_dir=os.path.dirname(os.path.abspath(run_gatk_orchestration.__file__))
+        check="import sys, run_gatk_pipe; print(any(module.split('.')[0] == 'prefect' for module in sys.modules))"
+        result=subprocess.run([sys.executable, "-c", check], cwd=package_dir, capture_output=True, text=True)
+
+        self.assertEqual(result.stdout.strip(), "False", result.stderr)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import unittest
+from unittest.mock import patch
+import argparse
+import tempfile
+import os
+import run_gatk_resources
+from run_gatk_planner import *
+
+#Step metrics of a finished run (as recorded by the process engine)
+RUN_STEP_METRICS=[
+    {"tool": "BWA mem chunk_0001_1.fastq.gz", "command": "bwa mem -t 4 -R @RG ref.fasta chunk_0001_1.fastq.gz chunk_0001_2.fastq.gz", "wall_time_s": 100.0, "user_cpu_s": 300.0, "system_cpu_s": 20.0, "peak_rss_mb": 6000.0, "returncode": 0, "cached": False},
+    {"tool": "BWA mem chunk_0002_1.fastq.gz", "command": "bwa mem -t 4 -R @RG ref.fasta chunk_0002_1.fastq.gz chunk_0002_2.fastq.gz", "wall_time_s": 100.0, "user_cpu_s": 300.0, "system_cpu_s": 20.0, "peak_rss_mb": 6100.0, "returncode": 0, "cached": False},
+    {"tool": "Samtools sort", "command": "samtools sort -@ 3 -m 768M -o sorted.bam -", "wall_time_s": 50.0, "user_cpu_s": 100.0, "system_cpu_s": 0.0, "peak_rss_mb": 3000.0, "returncode": 0, "cached": False},
+    {"tool": "GATK HaplotypeCaller", "command": "gatk HaplotypeCaller -R ref.fasta -I sorted.bam -O out.vcf.gz --native-pair-hmm-threads 4", "wall_time_s": 1000.0, "user_cpu_s": 2000.0, "system_cpu_s": 0.0, "peak_rss_mb": 5000.0, "returncode": 0, "cached": False},
+    {"tool": "Samtools index", "command": "samtools index sorted.bam", "wall_time_s": 0.0, "user_cpu_s": 0.0, "system_cpu_s": 0.0, "peak_rss_mb": 0.0, "returncode": 0, "cached": True}]
+
+#------------------------------------------------------------------------
+#Tests for run_gatk_planner.py
+#------------------------------------------------------------------------
+class test_planner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir=tempfile.TemporaryDirectory()
+        self.fastqs=[os.path.join(self.tmp_dir.name, f"reads_{i}.fastq.gz") for i in (1, 2)]
+        for fastq in self.fastqs:
+            with open(fastq, "wb") as fastq_file:
+                fastq_file.write(b"x" * 500)
+        self.ref_genome=os.path.join(self.tmp_dir.name, "reference.fasta")
+        with open(self.ref_genome, "w") as reference:
+            reference.write(">chr1\nACGT\n")
+        self.work_dir=os.path.join(self.tmp_dir.name, "run")
+
+    def tearDown(self):
+        configure_resources(os.cpu_count() or 1)
+        self.tmp_dir.cleanup()
+
+    def run_args(self, **options):
+        args={"fastq1": self.fastqs[0], "fastq2": self.fastqs[1], "sample_sheet": None, "sample_concurrency": None, "ref_genome": self.ref_genome, "out_vcf": "out.vcf.gz", "vcf_format": None, "threads": 8, "memory_gb": 32, "shards": 1, "shard_concurrency": None,
+              "align_chunks": 1, "reference_store": None, "qc_engine": "fastqc", "stream": False, "mark_duplicates": False, "dup_metrics": "gatk_pipeline_markdup_metrics.txt", "alignment_format": "bam", "work_dir": self.work_dir}
+        args.update(options)
+        return argparse.Namespace(**args)
+
+    #Test for append_run_history and read_run_history
+    #Checking that the metrics of a run are added up by step (without the file of the invocation and without the cached steps) with the input sizes of the run
+    def test_run_history(self):
+        history_file=os.path.join(self.tmp_dir.name, "history.jsonl")
+        with patch("run_gatk_planner.STEP_METRICS", RUN_STEP_METRICS):
+            append_run_history(history_file, self.run_args(align_chunks=2))
+        with open(history_file, "a") as history:
+            history.write("not a record\n")
+
+        history=read_run_history(history_file)
+
+        self.assertEqual(len(history), 1)
+        self.assertEqual(history[0]["inputs"], {"samples": 1, "fastq_bytes": 1000, "reference_bases": 11, "alignment_bytes": None})
+        self.assertEqual(history[0]["steps"]["BWA mem"], {"cpu_s": 640.0, "wall_s": 200.0, "invocations": 2, "threads": 4, "peak_rss_mb": 6100.0})
+        self.assertEqual(history[0]["steps"]["Samtools sort"]["threads"], 4)
+        self.assertNotIn("Samtools index", history[0]["steps"])
+
+    #Test for StepModel
+    #Checking that the CPU time of a step grows with its input size and that the wall time is divided by the cores the step gets with the parallel efficiency of the history
+    def test_step_model(self):
+        history=[{"inputs": {"fastq_bytes": 1000, "alignment_bytes": 500}, "steps": {"BWA mem": {"cpu_s": 640.0, "wall_s": 200.0, "invocations": 2, "threads": 4, "peak_rss_mb": 6100.0}}}]
+        model=StepModel(history)
+
+        self.assertEqual(model.predict("BWA mem", 2000, threads=8), {"cpu_s": 1280.0, "wall_s": 200.0, "peak_rss_mb": 6100.0})
+        self.assertEqual(model.predict("BWA mem", 2000, threads=4, invocations=2, concurrency=2)["wall_s"], 200.0)
+        self.assertEqual(model.alignment_bytes(3000), 1500)
+        self.assertIsNone(model.predict("GATK HaplotypeCaller", 500)["wall_s"])
+
+    #Test for plan_run
+    #Checking that the steps whose outputs are ready are skipped, that the steps after a step that runs also run, that no file is written and that the shards are recommended for the cores and memory of the node without changing the budget of the run
+    def test_plan_run(self):
+        history_file=os.path.join(self.tmp_dir.name, "history.jsonl")
+        with open(history_file, "w") as history:
+            history.write(json.dumps({"inputs": {"fastq_bytes": 1000, "reference_bases": 11, "alignment_bytes": 500}, "steps": {"GATK HaplotypeCaller": {"cpu_s": 200000.0, "wall_s": 100000.0, "invocations": 1, "threads": 2, "peak_rss_mb": 5000.0}}}) + "\n")
+        #The reference index is ready
+        with open(f"{self.ref_genome}.fai", "w") as fai:
+            fai.write("chr1\t4\t6\t4\t5\n")
+
+        plan=plan_run(self.run_args(shards=4), history_file, node_cores=32, node_memory=65536)
+
+        actions={step["step"]: step["action"] for step in plan["steps"]}
+        self.assertEqual(actions["Samtools faidx"], "skip")
+        self.assertEqual(actions["Samtools dict"], "run")
+        self.assertEqual(actions["GATK HaplotypeCaller"], "run")
+        self.assertEqual(plan["inputs"]["alignment_bytes"], 500)
+        hc_step=[step for step in plan["steps"] if step["step"] == "GATK HaplotypeCaller"][0]
+        self.assertEqual((hc_step["invocations"], hc_step["threads"], hc_step["predicted_wall_s"]), (4, 2, 25000.0))
+        self.assertIn("BWA mem", plan["unpredicted_steps"])
+        self.assertFalse(os.path.exists(self.work_dir))
+        self.assertEqual((plan["recommendation"]["threads"], plan["recommendation"]["shards"]), (32, 8))
+        #The recommendation for the node does not replace the resource budget of the run
+        self.assertEqual((run_gatk_resources.RESOURCE_BUDGET.cores, run_gatk_resources.RESOURCE_BUDGET.memory_mb), (8, 32768))
+        self.assertIn("GATK HaplotypeCaller", format_plan(plan))
+
+if __name__ == "__main__":
+    unittest.main()
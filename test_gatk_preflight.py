@@ -0,0 +1,107 @@
+import unittest
+import tempfile
+import hashlib
+import gzip
+import os
+from run_gatk_preflight import *
+
+#Reference genome of the tests: two sequences with 4 bases per line
+REFERENCE=""">chr1 first
+ACGT
+ACGT
+AC
+>chr2
+ggcc
+GG
+"""
+
+#------------------------------------------------------------------------
+#Tests for run_gatk_preflight.py
+#------------------------------------------------------------------------
+class test_preflight(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir=tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_file(self, name, text, compressed=False):
+        path=os.path.join(self.tmp_dir.name, name)
+        with (gzip.open(path, "wt") if compressed else open(path, "w")) as out_file:
+            out_file.write(text)
+        return path
+
+    def write_fastq(self, name, read, names):
+        return self.write_file(name, "".join(f"@{name}/{read} 1:N:0\nACGT\n+\nIIII\n" for name in names), compressed=True)
+
+    #Test for scan_file
+    #Checking that a FASTQ file is summarized with its read count and read names, and that truncated compressed data and incomplete or malformed records are errors
+    def test_scan_fastq(self):
+        fastq=self.write_fastq("reads_1.fastq.gz", 1, ["r1", "r2", "r3"])
+
+        summary=scan_file("fastq", fastq, block_bytes=16)
+        self.assertEqual((summary["reads"], summary["first_read"], summary["last_read"]), (3, "r1", "r3"))
+        self.assertEqual(summary["names_sha256"], hashlib.sha256(b"r1\nr2\nr3\n").hexdigest())
+
+        with open(fastq, "rb") as reads:
+            data=reads.read()
+        truncated=os.path.join(self.tmp_dir.name, "truncated.fastq.gz")
+        with open(truncated, "wb") as reads:
+            reads.write(data[:len(data) // 2])
+        self.assertIn("truncated", scan_file("fastq", truncated)["error"])
+
+        incomplete=self.write_file("incomplete.fastq", "@r1\nACGT\n+\nIIII\n@r2\nACGT\n")
+        self.assertIn("incomplete", scan_file("fastq", incomplete)["error"])
+        malformed=self.write_file("malformed.fastq", "@r1\nACGT\n+\nIII\n")
+        self.assertIn("lengths differ", scan_file("fastq", malformed)["error"])
+
+    #Test for scan_fasta and check_reference_indexes
+    #Checking that the layout of the reference genome is found like samtools faidx does, and that an index, a dictionary or a bwa index of another reference is an error
+    def test_reference_indexes(self):
+        ref_genome=self.write_file("reference.fasta", REFERENCE)
+
+        sequences=scan_file("fasta", ref_genome)["sequences"]
+        self.assertEqual([(sequence["name"], sequence["length"], sequence["offset"], sequence["line_bases"], sequence["line_width"]) for sequence in sequences], [("chr1", 10, 12, 4, 5), ("chr2", 6, 31, 4, 5)])
+        self.assertEqual(sequences[1]["md5"], hashlib.md5(b"GGCCGG").hexdigest())
+
+        self.write_file("reference.fasta.fai", "chr1\t10\t12\t4\t5\nchr2\t6\t31\t4\t5\n")
+        self.write_file("reference.dict", f"@HD\tVN:1.0\n@SQ\tSN:chr1\tLN:10\n@SQ\tSN:chr2\tLN:6\tM5:{hashlib.md5(b'GGCCGG').hexdigest()}\n")
+        self.assertEqual(check_reference_indexes(ref_genome, sequences), [])
+
+        self.write_file("reference.fasta.fai", "chr1\t10\t12\t4\t5\nchr2\t7\t31\t4\t5\n")
+        self.write_file("reference.dict", "@HD\tVN:1.0\n@SQ\tSN:chr1\tLN:10\n@SQ\tSN:chr2\tLN:6\tM5:0123\n")
+        for extension in [".amb", ".bwt", ".pac", ".sa"]:
+            self.write_file(f"reference.fasta{extension}", "index")
+        self.write_file("reference.fasta.ann", "16 2 11\n0 chr1 (null)\n0 10 0\n0 chr3 (null)\n10 6 0\n")
+        errors=check_reference_indexes(ref_genome, sequences)
+        self.assertEqual(len(errors), 3)
+        self.assertIn("reference.fasta.fai", errors[0])
+        self.assertIn("MD5", errors[1])
+        self.assertIn("bwa index", errors[2])
+
+        self.assertIn("different lengths", scan_file("fasta", self.write_file("ragged.fasta", ">chr1\nACGT\nAC\nACGT\n"))["error"])
+
+    #Test for preflight_inputs
+    #Checking that the inputs are scanned in worker processes, that FASTQ pairs with other read names are an error, and that unchanged files are taken from the cache on the next run
+    def test_preflight_inputs(self):
+        ref_genome=self.write_file("reference.fasta", REFERENCE)
+        pair=(self.write_fastq("s1_1.fastq.gz", 1, ["r1", "r2"]), self.write_fastq("s1_2.fastq.gz", 2, ["r1", "r2"]))
+        other_pair=(self.write_fastq("s2_1.fastq.gz", 1, ["r1", "r2"]), self.write_fastq("s2_2.fastq.gz", 2, ["r1", "r9"]))
+        cache_file=os.path.join(self.tmp_dir.name, "preflight_cache.json")
+
+        report=preflight_inputs([pair, other_pair], ref_genome, workers=2, cache_file=cache_file)
+        self.assertEqual((report["files"], report["scanned"], report["cached"]), (5, 5, 0))
+        self.assertEqual(len(report["errors"]), 1)
+        self.assertIn("read names", report["errors"][0])
+
+        #The pair is fixed: only the new file is scanned again
+        other_pair=(other_pair[0], self.write_fastq("s2_2.fastq.gz", 2, ["r1", "r2"]))
+        report=preflight_inputs([pair, other_pair], ref_genome, workers=2, cache_file=cache_file)
+        self.assertEqual((report["scanned"], report["cached"], report["errors"]), (1, 4, []))
+
+        missing=preflight_inputs([pair], os.path.join(self.tmp_dir.name, "missing.fasta"), workers=1)
+        self.assertIn("cannot be read", missing["errors"][0])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import urllib.request
+import unittest
+import subprocess
+import threading
+import tempfile
+import time
+import sys
+import os
+from run_gatk_engine import ProcessEngine
+from run_gatk_progress import *
+
+#------------------------------------------------------------------------
+#Tests for run_gatk_progress.py
+#------------------------------------------------------------------------
+class test_progress(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir=tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        stop_progress_reporting()
+        self.tmp_dir.cleanup()
+
+    #Test for BwaProgress and StepProgress.snapshot
+    #Checking that the processed reads are summed from the bwa mem lines and that the throughput is measured over the progress updates
+    def test_bwa_progress(self):
+        progress=progress_tracker(["bwa", "mem", "-t", "4", "ref.fasta", "reads_1.fastq.gz", "reads_2.fastq.gz"], "BWA mem", 0)
+        progress.parse_line("[M::process] read 100000 sequences (10000000 bp)...")
+        progress.parse_line("[M::mem_process_seqs] Processed 100000 reads in 80.2 CPU sec, 20.1 real sec")
+        progress.update(progress.processed + 100000, now=progress.start_time + 10)
+
+        snapshot=progress.snapshot(now=progress.start_time + 10)
+        self.assertEqual(snapshot["unit"], "reads")
+        self.assertEqual(snapshot["processed"], 200000)
+        self.assertEqual(snapshot["rate_per_s"], 20000)
+        self.assertIsNone(snapshot["eta_s"])
+
+    #Test for HaplotypeCallerProgress
+    #Checking that the ProgressMeter loci are counted against the intervals of the step, which gives the progress and the estimated remaining time
+    def test_haplotypecaller_progress(self):
+        intervals_file=os.path.join(self.tmp_dir.name, "shard_0001.intervals")
+        with open(intervals_file, "w") as intervals:
+            intervals.write("chr1:1-1000\nchr2:1-1000\n")
+        progress=progress_tracker(["gatk", "--java-options", "-Xmx4g", "HaplotypeCaller", "-R", "ref.fasta", "-I", "sorted.bam", "-L", intervals_file, "-O", "shard.vcf"], "GATK HaplotypeCaller", 0)
+        progress.parse_line("12:00:11.123 INFO  ProgressMeter -       Current Locus  Elapsed Minutes     Regions Processed   Regions/Minute")
+        progress.parse_line("12:00:21.123 INFO  ProgressMeter -            chr2:500              0.2                  1500           7500.0")
+        progress.samples[-1]=(progress.start_time + 15, progress.processed)
+
+        snapshot=progress.snapshot(now=progress.start_time + 15)
+        self.assertEqual((snapshot["processed"], snapshot["total"], snapshot["progress"]), (1500, 2000, 0.75))
+        self.assertEqual(snapshot["eta_s"], 5.0)
+
+        progress.parse_line("12:01:00.000 INFO  ProgressMeter - Traversal complete. Processed 2000 total regions in 1.0 minutes.")
+        self.assertEqual(progress.processed, 2000)
+
+    #Test for SortProgress and input_fraction
+    #Using real files to check that the spills of samtools sort are the temporary files of its -T prefix and that the read position of an open input file is found
+    def test_sort_spills_input_fraction(self):
+        prefix=os.path.join(self.tmp_dir.name, "samtools_sort.sorted.bam")
+        for i in range(3):
+            open(f"{prefix}.{i:04d}.bam", "w").close()
+        progress=progress_tracker(["samtools", "sort", "-@", "2", "-T", prefix, "-o", "sorted.bam", "-"], "Samtools sort", 0)
+        self.assertEqual(progress.snapshot()["processed"], 3)
+
+        fastq=os.path.join(self.tmp_dir.name, "reads_1.fastq")
+        with open(fastq, "wb") as fastq_file:
+            fastq_file.write(b"x" * 1000)
+        reader=subprocess.Popen([sys.executable, "-c", f"import sys, time; f=open({fastq!r}, 'rb', buffering=0); f.read(250); print(flush=True); time.sleep(30)"], stdout=subprocess.PIPE)
+        try:
+            reader.stdout.readline()
+            self.assertEqual(input_fraction(reader.pid, [fastq]), 0.25)
+        finally:
+            reader.kill()
+            reader.wait()
+            reader.stdout.close()
+
+    #Test for start_progress_reporting and the process engine
+    #Using a fake bwa tool to check that the progress of a running step is served at the metrics endpoint and that the step is finished when its process exits
+    def test_metrics_endpoint(self):
+        bwa=os.path.join(self.tmp_dir.name, "bwa")
+        with open(bwa, "w") as bwa_file:
+            bwa_file.write("#!/bin/sh\necho '[M::mem_process_seqs] Processed 5000 reads in 1.0 CPU sec, 1.0 real sec' >&2\nsleep 2\n")
+        os.chmod(bwa, 0o755)
+        reporter=start_progress_reporting(port=0, interval=0)
+        engine=ProcessEngine()
+        finished_steps=PROGRESS.finished_steps
+        job=threading.Thread(target=engine.run, args=([[bwa, "mem", "ref.fasta", "reads_1.fastq", "reads_2.fastq"]], ["BWA mem"]))
+        job.start()
+        try:
+            for i in range(50):
+                time.sleep(0.1)
+                metrics=urllib.request.urlopen(f"http://127.0.0.1:{reporter.address[1]}/metrics").read().decode()
+                if "gatk_step_processed{" in metrics:
+                    break
+        finally:
+            job.join()
+            engine.stop()
+
+        self.assertIn('gatk_step_processed{step="BWA mem"', metrics)
+        self.assertIn('unit="reads"} 5000', metrics)
+        self.assertIn("gatk_running_steps 1", metrics)
+        self.assertEqual(PROGRESS.finished_steps, finished_steps + 1)
+        self.assertIn("gatk_running_steps 0", prometheus_metrics())
+
+if __name__ == "__main__":
+    unittest.main()
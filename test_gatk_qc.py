@@ -0,0 +1,76 @@
+import unittest
+import tempfile
+import json
+import gzip
+import os
+from run_gatk_qc import *
+
+#------------------------------------------------------------------------
+#Tests for run_gatk_qc.py
+#------------------------------------------------------------------------
+class test_qc(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir=tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_fastq(self, name, reads):
+        path=os.path.join(self.tmp_dir.name, name)
+        with gzip.open(path, "wt") as fastq:
+            for read_name, sequence, quality in reads:
+                fastq.write(f"@{read_name}\n{sequence}\n+\n{quality}\n")
+        return path
+
+    #Test for summarize_batch
+    #Checking the per position quality, N and GC counts of a batch with reads of different lengths
+    def test_summarize_batch(self):
+        lines=b"@r1\nGGCCN\n+\nIIII#\n@r2\nAATT\n+\n5555\n".split(b"\n")[:8]
+
+        summary=summarize_batch(lines)
+
+        self.assertEqual(summary["reads"], 2)
+        self.assertEqual(summary["bases"], 9)
+        self.assertEqual(summary["length_counts"].tolist(), [0, 0, 0, 0, 1, 1])
+        self.assertEqual(summary["n_counts"].tolist(), [0, 0, 0, 0, 1])
+        self.assertEqual(summary["gc_bases"], 4)
+        self.assertEqual(summary["quality_counts"][0, 40], 1)
+        self.assertEqual(summary["quality_counts"][0, 20], 1)
+        self.assertEqual(summary["quality_counts"][4, 2], 1)
+
+    #Test for run_fastq_qc
+    #Checking if small batches and several workers give the same report as the whole file, and if the read pairs are consistent
+    def test_run_fastq_qc(self):
+        reads_1=[(f"read{i}/1", "ACGT" * 5 if i % 3 else "ACGN" * 4, "I" * 20 if i % 3 else "#" * 16) for i in range(60)]
+        reads_2=[(f"read{i}/2", "TTTT" * 5, "5" * 20) for i in range(60)]
+        fastq_1=self.write_fastq("sample_1.fastq.gz", reads_1)
+        fastq_2=self.write_fastq("sample_2.fastq.gz", reads_2)
+        out_report=os.path.join(self.tmp_dir.name, "qc.json")
+
+        run_fastq_qc(fastq_1, fastq_2, out_report, workers=2, batch_bytes=100)
+
+        with open(out_report) as report_file:
+            report=json.load(report_file)
+        self.assertEqual(report["read_1"]["reads"], 60)
+        self.assertEqual(report["read_1"]["length_distribution"], {"16": 20, "20": 40})
+        self.assertEqual(report["read_1"]["n_percent_per_position"][3], round(100 * 20 / 60, 3))
+        self.assertEqual(report["read_1"]["median_quality_per_position"][0], 40)
+        self.assertEqual(report["read_1"]["mean_quality_per_position"][18], 40)
+        self.assertEqual(report["read_2"]["gc_percent"], 0)
+        self.assertEqual(report["read_2"]["mean_quality_per_position"][0], 20)
+        self.assertTrue(report["pairs"]["consistent"])
+
+    #Test for run_fastq_qc
+    #Checking if a pair of files with different read counts is not consistent
+    def test_run_fastq_qc_inconsistent_pairs(self):
+        fastq_1=self.write_fastq("sample_1.fastq.gz", [(f"read{i}/1", "ACGT", "IIII") for i in range(5)])
+        fastq_2=self.write_fastq("sample_2.fastq.gz", [(f"read{i}/2", "ACGT", "IIII") for i in range(4)])
+
+        report=run_fastq_qc(fastq_1, fastq_2, os.path.join(self.tmp_dir.name, "qc.json"), workers=1)
+
+        self.assertEqual((report["pairs"]["read_1_count"], report["pairs"]["read_2_count"]), (5, 4))
+        self.assertFalse(report["pairs"]["consistent"])
+
+if __name__ == "__main__":
+    unittest.main()
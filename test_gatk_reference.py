@@ -0,0 +1,99 @@
+import unittest
+from unittest.mock import patch
+import threading
+import tempfile
+import time
+import os
+from run_gatk_reference import *
+
+#------------------------------------------------------------------------
+#Tests for run_gatk_reference.py
+#------------------------------------------------------------------------
+#The reference tools are replaced by a function that writes the temporary output files of the command
+def fake_build(command, tool, outputs=None, stdout=None):
+    time.sleep(0.1)
+    for output in outputs:
+        with open(output, "w") as out_file:
+            out_file.write(tool)
+
+class test_reference(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir=tempfile.TemporaryDirectory()
+        self.ref_genome=os.path.join(self.tmp_dir.name, "reference.fasta")
+        with open(self.ref_genome, "w") as reference:
+            reference.write(">chr1\nACGTACGTAC\n")
+        self.store=ReferenceStore(os.path.join(self.tmp_dir.name, "store"))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    #Test for ReferenceStore.reference_path
+    #Checking if copies of the same reference under another file name share their directory and their fasta file in the store, named by the checksum of the reference
+    def test_reference_path(self):
+        copy_genome=os.path.join(self.tmp_dir.name, "copy.fasta")
+        with open(copy_genome, "w") as reference:
+            reference.write(">chr1\nACGTACGTAC\n")
+
+        reference_path=self.store.reference_path(self.ref_genome)
+
+        checksum=reference_checksum(self.ref_genome)
+        self.assertEqual(os.path.basename(reference_path), f"{checksum}.fasta")
+        self.assertEqual(os.path.basename(os.path.dirname(reference_path)), checksum)
+        self.assertEqual(self.store.reference_path(copy_genome), reference_path)
+        with open(reference_path) as reference:
+            self.assertEqual(reference.read(), ">chr1\nACGTACGTAC\n")
+
+    #Test for ReferenceStore.checksum
+    #Using patch to mock if the checksum of a reference is read from the checksum cache of the store by the next runs, and computed again when the reference changed
+    def test_checksum_cache(self):
+        checksum=self.store.checksum(self.ref_genome)
+
+        with patch("run_gatk_reference._file_checksum", return_value="new checksum") as mock_file_checksum:
+            self.assertEqual(ReferenceStore(self.store.store_dir).checksum(self.ref_genome), checksum)
+            self.assertEqual(reference_checksum(self.ref_genome, os.path.join(self.store.store_dir, CHECKSUM_CACHE)), checksum)
+            mock_file_checksum.assert_not_called()
+
+            os.utime(self.ref_genome, (0, 0))
+            self.assertEqual(ReferenceStore(self.store.store_dir).checksum(self.ref_genome), "new checksum")
+            mock_file_checksum.assert_called_once()
+
+    #Test for reference_dict_path
+    #Checking if the sequence dictionary of a compressed reference replaces its .fasta.gz extension
+    def test_reference_dict_path(self):
+        self.assertEqual(reference_dict_path("data/reference.fasta"), "data/reference.dict")
+        self.assertEqual(reference_dict_path("data/reference.fasta.gz"), "data/reference.dict")
+
+    #Test for ReferenceStore.build
+    #Using patch to mock if concurrent builds of the same asset run the tool only once and create the asset files next to the reference
+    @patch("run_gatk_reference.run_measured", side_effect=fake_build)
+    def test_build_once(self, mock_run_measured):
+        reference_path=self.store.reference_path(self.ref_genome)
+        results=[]
+        builds=[threading.Thread(target=lambda: results.append(self.store.build(reference_path, "bwa"))) for i in range(4)]
+        for build in builds:
+            build.start()
+        for build in builds:
+            build.join(timeout=5)
+
+        self.assertEqual(results, [True] * 4)
+        mock_run_measured.assert_called_once()
+        self.assertEqual(mock_run_measured.call_args.args[0][:3], ["bwa", "index", "-p"])
+        for extension in BWA_INDEX_EXTENSIONS:
+            self.assertTrue(os.path.exists(f"{reference_path}{extension}"))
+
+        self.assertTrue(ReferenceStore(self.store.store_dir).build(reference_path, "bwa"))
+        mock_run_measured.assert_called_once()
+
+    #Test for ReferenceStore.build
+    #Using patch to mock if a failed build is not marked as built, so the next run builds it again
+    @patch("run_gatk_reference.run_measured", side_effect=FileNotFoundError)
+    def test_build_fails(self, mock_run_measured):
+        reference_path=self.store.reference_path(self.ref_genome)
+
+        self.assertFalse(self.store.build(reference_path, "dict"))
+        self.assertFalse(self.store.is_built(reference_path, "dict"))
+        self.assertFalse(os.path.exists(reference_dict_path(reference_path)))
+
+if __name__ == "__main__":
+    unittest.main()
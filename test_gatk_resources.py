@@ -0,0 +1,84 @@
+import unittest
+from unittest.mock import patch
+import threading
+import time
+from run_gatk_resources import *
+
+#------------------------------------------------------------------------
+#Tests for run_gatk_resources.py
+#------------------------------------------------------------------------
+class test_resources(unittest.TestCase):
+
+    #Test for allocate
+    #Checking if the threads of a tool are limited by its profile and its memory by its share of the budget, and if the GATK tools get their share of the memory for their Java heap
+    @patch("run_gatk_resources.RESOURCE_BUDGET", ResourceBudget(16, 32000))
+    def test_allocate(self):
+        self.assertEqual(allocate("bwa mem"), {"threads": 16, "memory_mb": 6144 + 256 * 16})
+        self.assertEqual(allocate("gatk HaplotypeCaller"), {"threads": 4, "memory_mb": 16384})
+        self.assertEqual(allocate("gatk HaplotypeCaller", cores=4), {"threads": 4, "memory_mb": 8000})
+        self.assertEqual(allocate("gatk HaplotypeCaller", share=8), {"threads": 2, "memory_mb": 4000})
+        self.assertEqual(allocate("samtools sort", cores=2), {"threads": 2, "memory_mb": 256 + 768 * 2})
+        self.assertEqual(allocate("gatk GatherVcfs"), {"threads": 1, "memory_mb": 8192})
+
+    #Test for ResourceBudget.reserve
+    #Checking if a tool waits until the cores it needs are released by a running tool
+    def test_reserve_waits_for_free_cores(self):
+        budget=ResourceBudget(4, 1000)
+        order=[]
+
+        def second_tool():
+            with budget.reserve(2, 100):
+                order.append("second starts")
+
+        with budget.reserve(3, 100):
+            waiting_tool=threading.Thread(target=second_tool)
+            waiting_tool.start()
+            time.sleep(0.2)
+            order.append("first ends")
+        waiting_tool.join(timeout=5)
+
+        self.assertEqual(order, ["first ends", "second starts"])
+        self.assertEqual((budget.free_cores, budget.free_memory_mb), (4, 1000))
+
+    #Test for ResourceBudget.reserve
+    #Checking if a request bigger than the whole budget can still run alone
+    def test_reserve_more_than_budget(self):
+        budget=ResourceBudget(2, 1000)
+
+        with budget.reserve(8, 5000):
+            self.assertEqual((budget.free_cores, budget.free_memory_mb), (0, 0))
+
+    #Test for the tool arguments
+    #Checking if the thread and memory arguments of samtools and gatk are built correctly
+    @patch("run_gatk_resources.cpu_flags", return_value=frozenset({"sse4_2", "avx", "avx2"}))
+    def test_tool_arguments(self, mock_cpu_flags):
+        self.assertEqual(samtools_thread_args(1), [])
+        self.assertEqual(samtools_thread_args(4), ["-@", "3"])
+        self.assertEqual(samtools_sort_memory_args(4, 4096), ["-m", "1024M"])
+        self.assertEqual(samtools_sort_memory_args(4, None), [])
+        self.assertEqual(pair_hmm_args(None), [])
+        self.assertEqual(pair_hmm_args(2), ["--pair-hmm-implementation", "AVX_LOGLESS_CACHING_OMP", "--native-pair-hmm-threads", "2"])
+        self.assertEqual(gatk_base_command(None), ["gatk"])
+        self.assertEqual(gatk_base_command(4000), ["gatk", "--java-options", "-Xmx3400m -XX:+UseParallelGC -XX:ParallelGCThreads=1"])
+
+    #Test for the GATK execution profile
+    #Checking if the garbage collector and its threads follow the heap and threads of the step, if the GC log is added and if the PairHMM implementation follows the CPU and the profile of the run
+    @patch.dict("run_gatk_resources.GATK_PROFILE")
+    @patch("run_gatk_resources.cpu_flags")
+    def test_gatk_profile(self, mock_cpu_flags):
+        self.assertEqual(gatk_base_command(20000, threads=8, gc_log="scratch/gc.log"), ["gatk", "--java-options", "-Xmx17000m -XX:+UseG1GC -XX:ParallelGCThreads=8 -XX:ConcGCThreads=2 -Xlog:gc:file=scratch/gc.log"])
+        self.assertEqual(java_gc_options(2, 8000), ["-XX:+UseParallelGC", "-XX:ParallelGCThreads=2"])
+
+        mock_cpu_flags.return_value=frozenset({"sse4_2"})
+        self.assertEqual(pair_hmm_implementation(4), "LOGLESS_CACHING")
+        mock_cpu_flags.return_value=None
+        self.assertEqual(pair_hmm_implementation(4), "FASTEST_AVAILABLE")
+
+        configure_gatk_profile("g1", "AVX_LOGLESS_CACHING")
+        self.assertEqual(java_gc_options(2, 8000)[0], "-XX:+UseG1GC")
+        self.assertEqual(pair_hmm_implementation(4), "AVX_LOGLESS_CACHING")
+        with self.assertRaises(ValueError):
+            configure_gatk_profile("serial")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,33 +1,276 @@
 import unittest
 from unittest.mock import patch
 import argparse
+import tempfile
 import os
 from run_gatk_pipe import *
+import run_gatk_orchestration
 
 #------------------------------------------------------------------------
 #Tests for run_gatk_pipe.py
 #------------------------------------------------------------------------
 #Using patch to mock the external main functions from run_gatk_pipe.py as well as argument parser
 class test_pipe(unittest.TestCase):
+
+    #The runs write their outputs, scratch directory and metrics report to a temporary work directory
+    def setUp(self):
+        self.tmp_dir=tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        #A failed stage stops the process engine of the run
+        configure_process_engine()
+        configure_orchestration("prefect")
+        configure_workspace(".", ".")
+        self.tmp_dir.cleanup()
+
+    def work_file(self, *names):
+        return os.path.join(self.tmp_dir.name, *names)
+
+    @patch("run_gatk_pipe.run_preflight")
+    @patch("run_gatk_pipe.run_vcf_summary")
+    @patch("run_gatk_pipe.prepare_reference")
     @patch("run_gatk_pipe.run_HaplotypeCaller")
     @patch("run_gatk_pipe.run_bwa")
     @patch("run_gatk_pipe.run_fastqc")
     @patch("argparse.ArgumentParser.parse_args")
-    def test_gatk_pipe(self, mock_parse_args, mock_run_fastqc, mock_run_bwa, mock_run_haplotypecaller):
+    def test_gatk_pipe(self, mock_parse_args, mock_run_fastqc, mock_run_bwa, mock_run_haplotypecaller, mock_prepare_reference, mock_run_vcf_summary, mock_run_preflight):
         
         mock_parse_args.return_value = argparse.Namespace(
             fastq1="sample1.fastq",
             fastq2="sample2.fastq",
+            sample_sheet=None,
+            work_dir=self.tmp_dir.name,
+            scratch_dir=None,
+            keep_intermediates=False,
+            workers=[],
+            progress_port=None,
+            progress_interval=0,
+            sample_concurrency=None,
             ref_genome="reference.fasta",
-            out_vcf="output.vcf",
-            threads=4
+            out_vcf="output.vcf.gz",
+            vcf_format=None,
+            metrics_history=None,
+            skip_preflight=False,
+            preflight_cache="gatk_preflight_cache.json",
+            java_gc="auto",
+            pair_hmm="auto",
+            plan=False,
+            threads=4,
+            memory_gb=None,
+            qc_engine="fastqc",
+            qc_workers=None,
+            stream=False,
+            mark_duplicates=False,
+            alignment_format="bam",
+            compression_threads=None,
+            dup_metrics="gatk_pipeline_markdup_metrics.txt",
+            align_chunks=1,
+            reference_store=None,
+            bwa_shm=False,
+            cache_dir=None,
+            cache_max_gb=500,
+            cache_checksum=False,
+            metrics_report=self.work_file("gatk_pipe_metrics.json"),
+            metrics_summary=False,
+            shards=1,
+            shard_concurrency=None,
+            max_processes=64,
+            step_timeout=[],
+            engine="prefect"
         )
 
         gatk()
 
         mock_run_fastqc.assert_called_once_with("sample1.fastq", "sample2.fastq")
-        mock_run_bwa.assert_called_once_with("sample1.fastq", "sample2.fastq", "reference.fasta", 4)
-        mock_run_haplotypecaller.assert_called_once_with("reference.fasta", "output.vcf")
+        mock_run_bwa.assert_called_once_with("sample1.fastq", "sample2.fastq", "reference.fasta", 4, out_sam=self.work_file("scratch", "gatk_pipeline.sam"), bam=self.work_file("scratch", "gatk_pipeline.bam"), bam_sorted=self.work_file("gatk_pipeline_sorted.bam"), stream=False, chunks=1, mark_duplicates=False, dup_metrics=self.work_file("gatk_pipeline_markdup_metrics.txt"), compression_threads=None)
+        mock_run_haplotypecaller.assert_called_once_with("reference.fasta", self.work_file("output.vcf.gz"), bam_sorted=self.work_file("gatk_pipeline_sorted.bam"), shards=1, shard_concurrency=None)
+        mock_prepare_reference.assert_called_once_with("reference.fasta")
+        mock_run_vcf_summary.assert_called_once_with(self.work_file("output.vcf.gz"))
+        mock_run_preflight.assert_called_once_with([("sample1.fastq", "sample2.fastq")], "reference.fasta", cache_file=self.work_file("gatk_preflight_cache.json"))
+
+    #Using patch to mock if the local engine runs the same stages in process, without Prefect
+    @patch("run_gatk_pipe.run_vcf_summary")
+    @patch("run_gatk_pipe.prepare_reference")
+    @patch("run_gatk_pipe.run_HaplotypeCaller")
+    @patch("run_gatk_pipe.run_bwa")
+    @patch("run_gatk_pipe.run_fastqc")
+    @patch("argparse.ArgumentParser.parse_args")
+    def test_gatk_pipe_local_engine(self, mock_parse_args, mock_run_fastqc, mock_run_bwa, mock_run_haplotypecaller, mock_prepare_reference, mock_run_vcf_summary):
+        
+        mock_parse_args.return_value = argparse.Namespace(
+            fastq1="sample1.fastq",
+            fastq2="sample2.fastq",
+            sample_sheet=None,
+            work_dir=self.tmp_dir.name,
+            scratch_dir=None,
+            keep_intermediates=False,
+            workers=[],
+            progress_port=None,
+            progress_interval=0,
+            sample_concurrency=None,
+            ref_genome="reference.fasta",
+            out_vcf="output.vcf.gz",
+            vcf_format=None,
+            metrics_history=None,
+            skip_preflight=True,
+            preflight_cache=None,
+            java_gc="auto",
+            pair_hmm="auto",
+            plan=False,
+            threads=4,
+            memory_gb=None,
+            qc_engine="fastqc",
+            qc_workers=None,
+            stream=False,
+            mark_duplicates=False,
+            alignment_format="bam",
+            compression_threads=None,
+            dup_metrics="gatk_pipeline_markdup_metrics.txt",
+            align_chunks=1,
+            reference_store=None,
+            bwa_shm=False,
+            cache_dir=None,
+            cache_max_gb=500,
+            cache_checksum=False,
+            metrics_report=self.work_file("gatk_pipe_metrics.json"),
+            metrics_summary=False,
+            shards=1,
+            shard_concurrency=None,
+            max_processes=64,
+            step_timeout=[],
+            engine="local"
+        )
+
+        gatk()
+
+        self.assertEqual(run_gatk_orchestration.ORCHESTRATION_ENGINE, "local")
+
+        mock_run_fastqc.assert_called_once_with("sample1.fastq", "sample2.fastq")
+        mock_run_bwa.assert_called_once_with("sample1.fastq", "sample2.fastq", "reference.fasta", 4, out_sam=self.work_file("scratch", "gatk_pipeline.sam"), bam=self.work_file("scratch", "gatk_pipeline.bam"), bam_sorted=self.work_file("gatk_pipeline_sorted.bam"), stream=False, chunks=1, mark_duplicates=False, dup_metrics=self.work_file("gatk_pipeline_markdup_metrics.txt"), compression_threads=None)
+        mock_run_haplotypecaller.assert_called_once_with("reference.fasta", self.work_file("output.vcf.gz"), bam_sorted=self.work_file("gatk_pipeline_sorted.bam"), shards=1, shard_concurrency=None)
+        mock_prepare_reference.assert_called_once_with("reference.fasta")
+        mock_run_vcf_summary.assert_called_once_with(self.work_file("output.vcf.gz"))
+
+    #Using patch to mock if the variant calling does not run when the alignment fails, while FASTQC still runs
+    @patch("run_gatk_pipe.run_vcf_summary")
+    @patch("run_gatk_pipe.prepare_reference")
+    @patch("run_gatk_pipe.run_HaplotypeCaller")
+    @patch("run_gatk_pipe.run_bwa", side_effect=RuntimeError("alignment failed"))
+    @patch("run_gatk_pipe.run_fastqc")
+    @patch("argparse.ArgumentParser.parse_args")
+    def test_gatk_pipe_alignment_fails(self, mock_parse_args, mock_run_fastqc, mock_run_bwa, mock_run_haplotypecaller, mock_prepare_reference, mock_run_vcf_summary):
+
+        mock_parse_args.return_value = argparse.Namespace(
+            fastq1="sample1.fastq",
+            fastq2="sample2.fastq",
+            sample_sheet=None,
+            work_dir=self.tmp_dir.name,
+            scratch_dir=None,
+            keep_intermediates=False,
+            workers=[],
+            progress_port=None,
+            progress_interval=0,
+            sample_concurrency=None,
+            ref_genome="reference.fasta",
+            out_vcf="output.vcf.gz",
+            vcf_format=None,
+            metrics_history=None,
+            skip_preflight=True,
+            preflight_cache=None,
+            java_gc="auto",
+            pair_hmm="auto",
+            plan=False,
+            threads=4,
+            memory_gb=None,
+            qc_engine="fastqc",
+            qc_workers=None,
+            stream=False,
+            mark_duplicates=False,
+            alignment_format="bam",
+            compression_threads=None,
+            dup_metrics="gatk_pipeline_markdup_metrics.txt",
+            align_chunks=1,
+            reference_store=None,
+            bwa_shm=False,
+            cache_dir=None,
+            cache_max_gb=500,
+            cache_checksum=False,
+            metrics_report=self.work_file("gatk_pipe_metrics.json"),
+            metrics_summary=False,
+            shards=1,
+            shard_concurrency=None,
+            max_processes=64,
+            step_timeout=[],
+            engine="prefect"
+        )
+
+        with self.assertRaises(Exception):
+            gatk()
+
+        mock_run_fastqc.assert_called_once_with("sample1.fastq", "sample2.fastq")
+        mock_run_haplotypecaller.assert_not_called()
+        mock_run_vcf_summary.assert_not_called()
+
+    #Using patch to mock if the cohort analysis runs instead of the single sample analysis when a sample sheet is given
+    @patch("run_gatk_pipe.run_vcf_summary")
+    @patch("run_gatk_pipe.run_cohort")
+    @patch("run_gatk_pipe.run_HaplotypeCaller")
+    @patch("run_gatk_pipe.run_bwa")
+    @patch("run_gatk_pipe.run_fastqc")
+    @patch("argparse.ArgumentParser.parse_args")
+    def test_gatk_pipe_sample_sheet(self, mock_parse_args, mock_run_fastqc, mock_run_bwa, mock_run_haplotypecaller, mock_run_cohort, mock_run_vcf_summary):
+
+        mock_parse_args.return_value = argparse.Namespace(
+            fastq1=None,
+            fastq2=None,
+            sample_sheet="samples.tsv",
+            work_dir=self.tmp_dir.name,
+            scratch_dir=None,
+            keep_intermediates=False,
+            workers=[],
+            progress_port=None,
+            progress_interval=0,
+            sample_concurrency=8,
+            ref_genome="reference.fasta",
+            out_vcf="cohort.vcf.gz",
+            vcf_format=None,
+            metrics_history=None,
+            skip_preflight=True,
+            preflight_cache=None,
+            java_gc="auto",
+            pair_hmm="auto",
+            plan=False,
+            threads=4,
+            memory_gb=None,
+            qc_engine="fastqc",
+            qc_workers=None,
+            stream=True,
+            mark_duplicates=False,
+            alignment_format="bam",
+            compression_threads=None,
+            dup_metrics="gatk_pipeline_markdup_metrics.txt",
+            align_chunks=1,
+            reference_store=None,
+            bwa_shm=False,
+            cache_dir=None,
+            cache_max_gb=500,
+            cache_checksum=False,
+            metrics_report=self.work_file("gatk_pipe_metrics.json"),
+            metrics_summary=False,
+            shards=1,
+            shard_concurrency=None,
+            max_processes=64,
+            step_timeout=[],
+            engine="prefect"
+        )
+
+        gatk()
+
+        mock_run_vcf_summary.assert_called_once_with(self.work_file("cohort.vcf.gz"))
+        mock_run_cohort.assert_called_once_with("samples.tsv", "reference.fasta", self.work_file("cohort.vcf.gz"), 4, sample_concurrency=8, stream=True, cohort_dir=self.work_file("cohort"), mark_duplicates=False, alignment_format="bam", compression_threads=None)
+        mock_run_fastqc.assert_not_called()
+        mock_run_bwa.assert_not_called()
+        mock_run_haplotypecaller.assert_not_called()
 
 if __name__ == '__main__':
     unittest.main()
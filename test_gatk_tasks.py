@@ -1,5 +1,6 @@
 import unittest
 from unittest.mock import patch
+import tempfile
 from run_gatk_pipe import *
 
 #------------------------------------------------------------------------
@@ -33,26 +34,25 @@ class test_tasks(unittest.TestCase):
         sort_bam(bam_file, out_sorted_bam_file)
 
         mock_run_subprocess_out_file.assert_called_once_with(
-            ["samtools", "sort", bam_file],
+            ["samtools", "sort", "-T", step_scratch_name("samtools_sort", "sorted_output.bam"), bam_file],
             out_sorted_bam_file,
             tool="Samtools sort",
             out_name="sorted_bam_output")
 
     #Test for index_reference
     #Using patch to mock if index_reference function constructs the correct command and parameters when called
-    @patch("run_gatk_tasks.run_subprocess_out_file")
-    def test_index_reference(self, mock_run_subprocess_out_file):
+    @patch("run_gatk_tasks.run_subprocess")
+    def test_index_reference(self, mock_run_subprocess):
         
         reference_genome="reference.fasta"
         out_reference_genome_index="reference.fasta.fai"
         
         index_reference(reference_genome, out_reference_genome_index)
 
-        mock_run_subprocess_out_file.assert_called_once_with(
-            ["samtools", "faidx", reference_genome],
-            out_reference_genome_index,
+        mock_run_subprocess.assert_called_once_with(
+            ["samtools", "faidx", reference_genome, "--fai-idx", out_reference_genome_index],
             tool="Samtools faidx",
-            out_name="ref_index")
+            outputs=[out_reference_genome_index])
 
     #Test for dict_reference
     #Using patch to mock if the dictionary file is already present
@@ -75,7 +75,7 @@ class test_tasks(unittest.TestCase):
     #Using patch to mock if dict_reference function constructs the correct command and parameters when called
     @patch("os.path.exists")
     @patch("os.path.getsize")
-    @patch("run_gatk_extras.run_subprocess_out_file")
+    @patch("run_gatk_tasks.run_subprocess_out_file")
     def test_dict_reference_create_dict(self, mock_run_subprocess_out_file, mock_getsize, mock_exists):
 
         reference_genome="reference.fasta"
@@ -86,19 +86,168 @@ class test_tasks(unittest.TestCase):
 
         dict_reference(reference_genome, reference_genome_dict)
 
-        mock_run_subprocess_out_file.assert_not_called()
+        mock_run_subprocess_out_file.assert_called_once_with(["samtools", "dict", reference_genome], reference_genome_dict, tool="Samtools dict", out_name="ref_dict")
+
+    #Test for dict_reference
+    #Using patch to mock if dict_reference raises an error when Samtools dict fails, so that the pipeline stops
+    @patch("os.path.exists")
+    @patch("run_gatk_tasks.run_subprocess_out_file")
+    def test_dict_reference_fails(self, mock_run_subprocess_out_file, mock_exists):
+
+        mock_exists.return_value=False
+        mock_run_subprocess_out_file.return_value=False
+
+        with self.assertRaises(RuntimeError):
+            dict_reference("reference.fasta", "reference.dict")
 
     #Test for index_bam
     #Using patch to mock if index_bam function constructs the correct command and parameters when called
-    @patch("run_gatk_extras.run_subprocess_out_file")
-    def test_index_bam(self, mock_run_subprocess_out_file):
+    @patch("run_gatk_tasks.run_subprocess")
+    def test_index_bam(self, mock_run_subprocess):
 
         bam_sorted="sorted.bam"
         out_index_bam_file="sorted.bam.bai"
         
         index_bam(bam_sorted, out_index_bam_file)
 
-        mock_run_subprocess_out_file.assert_not_called()
+        mock_run_subprocess.assert_called_once_with(["samtools", "index", bam_sorted, "-o", out_index_bam_file], tool="Samtools index", outputs=[out_index_bam_file])
+
+    #Test for haplotype_caller_shard
+    #Using patch to mock if haplotype_caller_shard function constructs the correct command and parameters when called
+    @patch("run_gatk_tasks.run_subprocess")
+    def test_haplotype_caller_shard(self, mock_run_subprocess):
+
+        haplotype_caller_shard("reference.fasta", "sorted.bam", "shards/shard_0001.intervals", "shards/shard_0001.vcf")
+
+        mock_run_subprocess.assert_called_once_with(
+            ["gatk", "HaplotypeCaller", "-R", "reference.fasta", "-I", "sorted.bam", "-L", "shards/shard_0001.intervals", "-O", "shards/shard_0001.vcf"],
+            tool="GATK HaplotypeCaller shard_0001.intervals",
+            outputs=["shards/shard_0001.vcf"],
+            process_group=None)
+
+    #Test for gather_vcfs
+    #Using patch to mock if gather_vcfs function constructs the correct command and parameters when called
+    @patch("run_gatk_tasks.run_subprocess")
+    def test_gather_vcfs(self, mock_run_subprocess):
+
+        gather_vcfs(["shard_0001.vcf", "shard_0002.vcf"], "output.vcf")
+
+        mock_run_subprocess.assert_called_once_with(
+            ["gatk", "GatherVcfs", "-O", "output.vcf", "-I", "shard_0001.vcf", "-I", "shard_0002.vcf"],
+            tool="GATK GatherVcfs",
+            outputs=["output.vcf"])
+
+    #Test for haplotype_caller_gvcf
+    #Using patch to mock if haplotype_caller_gvcf function constructs the correct command and parameters when called
+    @patch("run_gatk_tasks.run_subprocess")
+    def test_haplotype_caller_gvcf(self, mock_run_subprocess):
+
+        haplotype_caller_gvcf("reference.fasta", "S1_sorted.bam", "S1.g.vcf.gz")
+
+        mock_run_subprocess.assert_called_once_with(
+            ["gatk", "HaplotypeCaller", "-R", "reference.fasta", "-I", "S1_sorted.bam", "-O", "S1.g.vcf.gz", "-ERC", "GVCF"],
+            tool="GATK HaplotypeCaller GVCF S1_sorted.bam",
+            outputs=["S1.g.vcf.gz", "S1.g.vcf.gz.tbi"])
+
+    #Test for combine_gvcfs
+    #Using patch to mock if combine_gvcfs function constructs the correct command and parameters when called
+    @patch("run_gatk_tasks.run_subprocess")
+    def test_combine_gvcfs(self, mock_run_subprocess):
+
+        combine_gvcfs("reference.fasta", ["S1.g.vcf.gz", "S2.g.vcf.gz"], "cohort.g.vcf.gz")
+
+        mock_run_subprocess.assert_called_once_with(
+            ["gatk", "CombineGVCFs", "-R", "reference.fasta", "-O", "cohort.g.vcf.gz", "-V", "S1.g.vcf.gz", "-V", "S2.g.vcf.gz"],
+            tool="GATK CombineGVCFs",
+            outputs=["cohort.g.vcf.gz", "cohort.g.vcf.gz.tbi"])
+
+    #Test for genotype_gvcfs
+    #Using patch to mock if genotype_gvcfs function constructs the correct command and parameters when called
+    @patch("run_gatk_tasks.run_subprocess")
+    def test_genotype_gvcfs(self, mock_run_subprocess):
+
+        genotype_gvcfs("reference.fasta", "cohort.g.vcf.gz", "cohort.vcf")
+
+        mock_run_subprocess.assert_called_once_with(
+            ["gatk", "GenotypeGVCFs", "-R", "reference.fasta", "-V", "cohort.g.vcf.gz", "-O", "cohort.vcf"],
+            tool="GATK GenotypeGVCFs",
+            outputs=["cohort.vcf", "cohort.vcf.idx"])
+
+    #Test for sort_bam
+    #Using patch to mock if sort_BAM function adds the thread and memory arguments of samtools sort when called with resources
+    @patch("run_gatk_tasks.run_subprocess_out_file")
+    def test_sort_bam_resources(self, mock_run_subprocess_out_file):
+
+        sort_bam("input.bam", "sorted_output.bam", threads=4, memory_mb=4096)
+
+        mock_run_subprocess_out_file.assert_called_once_with(
+            ["samtools", "sort", "-@", "3", "-m", "1024M", "-T", step_scratch_name("samtools_sort", "sorted_output.bam"), "input.bam"],
+            "sorted_output.bam",
+            tool="Samtools sort",
+            out_name="sorted_bam_output")
+
+    #Test for haplotype_caller_gvcf
+    #Using patch to mock if haplotype_caller_gvcf function adds the JVM options, the PairHMM arguments and the temporary directory of the step in the scratch directory when called with resources, and removes that directory afterwards
+    @patch("run_gatk_resources.cpu_flags", return_value=frozenset({"avx"}))
+    @patch("run_gatk_tasks.run_subprocess")
+    def test_haplotype_caller_gvcf_resources(self, mock_run_subprocess, mock_cpu_flags):
+
+        with tempfile.TemporaryDirectory() as scratch_dir:
+            with patch("run_gatk_workspace.WORKSPACE", Workspace(scratch_dir, scratch_dir)):
+                haplotype_caller_gvcf("reference.fasta", "S1_sorted.bam", "S1.g.vcf.gz", threads=2, memory_mb=4000)
+
+            step_dir=os.path.join(scratch_dir, step_scratch_name("gatk", "S1.g.vcf.gz"))
+            self.assertEqual(mock_run_subprocess.call_args[0][0],
+                ["gatk", "--java-options", f"-Xmx3400m -XX:+UseParallelGC -XX:ParallelGCThreads=2 -Xlog:gc:file={step_dir}/gc.log", "HaplotypeCaller", "-R", "reference.fasta", "-I", "S1_sorted.bam", "-O", "S1.g.vcf.gz", "-ERC", "GVCF",
+                 "--pair-hmm-implementation", "AVX_LOGLESS_CACHING_OMP", "--native-pair-hmm-threads", "2", "--tmp-dir", step_dir])
+            self.assertFalse(os.path.exists(step_dir))
+
+    #Test for haplotype_caller and vcf_output_path
+    #Using patch to mock if haplotype_caller function lets HaplotypeCaller write the block gzipped VCF file and its tabix index when called, and that the format of the output VCF file comes from its extension
+    @patch("run_gatk_tasks.run_subprocess")
+    def test_haplotype_caller(self, mock_run_subprocess):
+
+        out_vcf=vcf_output_path("output")
+        haplotype_caller("reference.fasta", "sorted.bam", out_vcf)
+
+        mock_run_subprocess.assert_called_once_with(
+            ["gatk", "HaplotypeCaller", "-R", "reference.fasta", "-I", "sorted.bam", "-O", "output.vcf.gz"],
+            tool="GATK HaplotypeCaller",
+            outputs=["output.vcf.gz", "output.vcf.gz.tbi"])
+        #The extension of the output VCF file decides its format and is never replaced
+        self.assertEqual(vcf_output_path("output.vcf"), "output.vcf")
+        self.assertEqual(vcf_output_path("output.vcf.gz", "vcf.gz"), "output.vcf.gz")
+        self.assertEqual(vcf_output_path("output", "vcf"), "output.vcf")
+        with self.assertRaises(ValueError):
+            vcf_output_path("output.vcf", "vcf.gz")
+
+    #Test for align_chunk
+    #Using patch to mock if align_chunk function pipes bwa mem into samtools sort for the chunk when called
+    @patch("run_gatk_tasks.run_subprocess_pipe")
+    def test_align_chunk(self, mock_run_subprocess_pipe):
+
+        mock_run_subprocess_pipe.return_value=True
+
+        align_chunk("chunk_0001_1.fastq.gz", "chunk_0001_2.fastq.gz", "reference.fasta", "@RG\\tID:S1\\tSM:S1", "chunk_0001_sorted.bam", threads=2, memory_mb=6656, sort_memory_mb=1792)
+
+        mock_run_subprocess_pipe.assert_called_once_with(
+            [["bwa", "mem", "-t", "2", "-R", "@RG\\tID:S1\\tSM:S1", "reference.fasta", "chunk_0001_1.fastq.gz", "chunk_0001_2.fastq.gz"],
+             ["samtools", "sort", "-@", "1", "-m", "896M", "-T", step_scratch_name("samtools_sort", "chunk_0001_sorted.bam"), "-o", "chunk_0001_sorted.bam", "-"]],
+            tools=["BWA mem chunk_0001_1.fastq.gz", "Samtools sort"],
+            outputs=["chunk_0001_sorted.bam"])
+
+    #Test for merge_bams
+    #Using patch to mock if merge_bams function constructs the correct command and parameters when called
+    @patch("run_gatk_tasks.run_subprocess")
+    def test_merge_bams(self, mock_run_subprocess):
+
+        merge_bams(["chunk_0001_sorted.bam", "chunk_0002_sorted.bam"], "sorted.bam", threads=4)
+
+        mock_run_subprocess.assert_called_once_with(
+            ["samtools", "merge", "-f", "-@", "3", "sorted.bam", "chunk_0001_sorted.bam", "chunk_0002_sorted.bam"],
+            tool="Samtools merge",
+            outputs=["sorted.bam"])
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
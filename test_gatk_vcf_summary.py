@@ -0,0 +1,76 @@
+import unittest
+import tempfile
+import json
+import gzip
+import os
+from run_gatk_vcf_summary import *
+
+#Records of the test VCF file: two SNV transitions, one SNV transversion, an insertion, a deletion, a multiallelic record and a GVCF reference block
+VCF_RECORDS=[
+    "chr1\t100\t.\tA\tG\t50.5\tPASS\t.",
+    "chr1\t200\t.\tC\tT\t120\tPASS\t.",
+    "chr1\t300\t.\tA\tC\t8\tLowQual\t.",
+    "chr2\t100\t.\tA\tAT\t.\t.\t.",
+    "chr2\t200\t.\tGTC\tG\t1500\tPASS\t.",
+    "chr2\t300\t.\tG\tA,T,<NON_REF>\t30\tPASS\t.",
+    "chr2\t400\t.\tG\t<NON_REF>\t.\t.\t."]
+
+#------------------------------------------------------------------------
+#Tests for run_gatk_vcf_summary.py
+#------------------------------------------------------------------------
+class test_vcf_summary(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir=tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_vcf(self, name, records):
+        path=os.path.join(self.tmp_dir.name, name)
+        opener=gzip.open if name.endswith(".gz") else open
+        with opener(path, "wt") as vcf:
+            vcf.write("##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+            for record in records:
+                vcf.write(record + "\n")
+        return path
+
+    #Test for allele_type
+    #Checking the type of SNV, MNV, insertion, deletion, complex, symbolic and spanning deletion alleles
+    def test_allele_type(self):
+        cases={("A", "G"): "snv", ("AC", "GT"): "mnv", ("A", "AT"): "insertion", ("ATC", "A"): "deletion", ("AT", "GCC"): "complex", ("A", "<DEL>"): "symbolic", ("A", "A]chr2:100]"): "symbolic", ("A", "*"): "spanning_deletion"}
+        for (ref, alt), kind in cases.items():
+            self.assertEqual(allele_type(ref, alt), kind)
+
+    #Test for write_vcf_summary
+    #Checking the counts by type and chromosome, the Ti/Tv ratio and the QUAL distribution of a block gzipped VCF file, and that the report is written as JSON
+    def test_write_vcf_summary(self):
+        vcf=self.write_vcf("calls.vcf.gz", VCF_RECORDS)
+        out_report=os.path.join(self.tmp_dir.name, "calls_summary.json")
+
+        report=write_vcf_summary(vcf, out_report)
+
+        with open(out_report) as report_file:
+            self.assertEqual(json.load(report_file), report)
+        self.assertEqual((report["records"], report["alleles"], report["multiallelic_records"], report["passed_records"]), (7, 7, 1, 6))
+        self.assertEqual(report["variant_types"], {"deletion": 1, "insertion": 1, "snv": 5})
+        self.assertEqual(report["chromosomes"], {"chr1": 3, "chr2": 4})
+        self.assertEqual(report["filters"], {".": 2, "LowQual": 1, "PASS": 4})
+        self.assertEqual((report["transitions"], report["transversions"], report["ti_tv_ratio"]), (3, 2, 1.5))
+        self.assertEqual(report["qual"]["missing"], 2)
+        self.assertEqual((report["qual"]["min"], report["qual"]["max"], report["qual"]["mean"]), (8, 1500, 341.7))
+        self.assertEqual(report["qual"]["histogram"], {"0-10": 1, "30-40": 1, "50-60": 1, "120-130": 1, ">=1000": 1})
+        self.assertEqual(report["qual"]["median_bin"], 50)
+
+    #Test for read_vcf_batches and merge_summaries
+    #Checking that summarizing a plain VCF file in small batches gives the same report as one batch
+    def test_batches(self):
+        vcf=self.write_vcf("calls.vcf", VCF_RECORDS)
+
+        self.assertEqual([len(batch) for batch in read_vcf_batches(vcf, batch_records=3)], [3, 3, 1])
+        one_batch=write_vcf_summary(vcf, os.path.join(self.tmp_dir.name, "one.json"))
+        small_batches=write_vcf_summary(vcf, os.path.join(self.tmp_dir.name, "small.json"), batch_records=2)
+        self.assertEqual(small_batches, one_batch)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import unittest
+import subprocess
+import tempfile
+import sys
+import os
+import run_gatk_workers
+from run_gatk_orchestration import *
+from run_gatk_extras import run_subprocess
+from run_gatk_metrics import STEP_METRICS
+from run_gatk_workers import *
+
+#Distributed tasks of the tests
+@task(distributed=True, locality=["path"])
+def where(path):
+    return os.environ.get("GATK_WORKER"), os.getcwd()
+
+@task(distributed=True)
+def remote_fail():
+    raise ValueError("remote task failed")
+
+@task(distributed=True)
+def remote_budget(threads=None, memory_mb=None):
+    import run_gatk_resources
+    return run_gatk_resources.RESOURCE_BUDGET.cores, run_gatk_resources.RESOURCE_BUDGET.memory_mb
+
+@task(distributed=True)
+def remote_tool():
+    return run_subprocess([sys.executable, "-c", "pass"], tool="Python remote")
+
+#------------------------------------------------------------------------
+#Tests for run_gatk_workers.py
+#Two worker processes on this node stand in for the worker nodes
+#------------------------------------------------------------------------
+class test_workers(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        os.environ[WORKER_AUTHKEY_ENV]="test-key"
+        cls.tmp_dir=tempfile.TemporaryDirectory()
+        cls.data_dirs=[os.path.join(cls.tmp_dir.name, f"node{i}") for i in (1, 2)]
+        worker_script=os.path.abspath(run_gatk_workers.__file__)
+        cls.workers=[]
+        cls.addresses=[]
+        for data_dir in cls.data_dirs:
+            os.makedirs(data_dir)
+            worker=subprocess.Popen([sys.executable, worker_script, "--listen", "127.0.0.1:0", "--slots", "2", "--cores", "4", "--memory_gb", "2", "--data_dir", data_dir, "--log_file", os.path.join(data_dir, "worker.log")], stdout=subprocess.PIPE, text=True)
+            cls.workers.append(worker)
+            cls.addresses.append(worker.stdout.readline().strip())
+
+    @classmethod
+    def tearDownClass(cls):
+        for worker in cls.workers:
+            worker.terminate()
+            worker.wait()
+            worker.stdout.close()
+        cls.tmp_dir.cleanup()
+
+    def setUp(self):
+        configure_orchestration("local")
+        self.pool=configure_worker_pool(self.addresses)
+
+    def tearDown(self):
+        configure_worker_pool(None)
+        configure_orchestration("prefect")
+
+    #Test for configure_worker_pool and dispatch
+    #Checking that the distributed tasks run on the workers in the current directory of the run, that the locality hints choose the worker holding the input file and that tasks without local inputs use both workers
+    def test_distributed_locality(self):
+        names=[worker["name"] for worker in self.pool.workers]
+
+        for name, data_dir in zip(names, self.data_dirs):
+            worker, cwd=where(os.path.join(data_dir, "chunk_0001_1.fastq.gz"))
+            self.assertEqual(worker, name)
+            self.assertEqual(cwd, os.getcwd())
+
+        results=[where.submit("/elsewhere/shard.intervals") for i in range(4)]
+        self.assertEqual({future.result()[0] for future in results}, set(names))
+
+    #Test for WorkerPool.run
+    #Checking that the exception of a failed remote task is raised in the run and that the step metrics of a remote task are added to the metrics of the run with its worker
+    def test_remote_errors_metrics(self):
+        with self.assertRaisesRegex(ValueError, "remote task failed"):
+            remote_fail()
+
+        self.assertTrue(remote_tool())
+        self.assertIn(STEP_METRICS[-1]["worker"], [worker["name"] for worker in self.pool.workers])
+        self.assertEqual(STEP_METRICS[-1]["tool"], "Python remote")
+
+    #Test for Worker.task_budget and WorkerPool.acquire
+    #Checking that a task gets its threads and memory from the budget of its worker as its resource budget (a task without memory_mb the share of its threads, a task with more threads than the worker the whole worker), and that the pool only sends a task to a worker with the cores of its threads free
+    def test_worker_budget(self):
+        self.assertEqual([(worker["cores"], worker["memory_mb"]) for worker in self.pool.workers], [(4, 2048)] * 2)
+        self.assertEqual(remote_budget(threads=2, memory_mb=1000), (2, 1000))
+        self.assertEqual(remote_budget(threads=1), (1, 512))
+        self.assertEqual(remote_budget(threads=8, memory_mb=4096), (4, 2048))
+
+        first=self.pool.acquire([], threads=3)
+        second=self.pool.acquire([], threads=3)
+        self.assertNotEqual(first["name"], second["name"])
+        self.assertEqual(self.pool.acquire([], threads=1)["reserved_cores"], 4)
+
+    #Test for WorkerPool
+    #Checking that a worker that cannot be reached is reported
+    def test_unreachable_worker(self):
+        with self.assertRaises(WorkerLost):
+            configure_worker_pool(["127.0.0.1:1"])
+
+    #Test for parse_address and the worker command line
+    #Checking that a worker listens on the loopback interface by default and on all interfaces only with --all_interfaces
+    def test_listen_address(self):
+        self.assertEqual(parse_address(":7078"), ("127.0.0.1", 7078))
+        worker_script=os.path.abspath(run_gatk_workers.__file__)
+        result=subprocess.run([sys.executable, worker_script, "--listen", "0.0.0.0:0", "--log_file", os.path.join(self.tmp_dir.name, "all.log")], capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.returncode, 2)
+        self.assertIn("--all_interfaces", result.stderr)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+import tempfile
+import os
+from run_gatk_workspace import *
+
+#------------------------------------------------------------------------
+#Tests for run_gatk_workspace.py
+#------------------------------------------------------------------------
+class test_workspace(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir=tempfile.TemporaryDirectory()
+        self.work_dir=os.path.join(self.tmp_dir.name, "work")
+
+    def tearDown(self):
+        configure_workspace(".", ".")
+        self.tmp_dir.cleanup()
+
+    #Test for configure_workspace
+    #Checking that the final outputs go to the work directory, the transient files to the scratch directory (default <work_dir>/scratch) and samtools sort writes its temporary files to the scratch directory
+    def test_workspace_paths(self):
+        configure_workspace(self.work_dir)
+
+        self.assertEqual(work_path("gatk_pipeline_sorted.bam"), os.path.join(self.work_dir, "gatk_pipeline_sorted.bam"))
+        self.assertEqual(scratch_path("samples", "S1", "S1.sam"), os.path.join(self.work_dir, "scratch", "samples", "S1", "S1.sam"))
+        self.assertTrue(os.path.isdir(os.path.join(self.work_dir, "scratch", "samples", "S1")))
+        self.assertEqual(work_path("/data/output.vcf"), "/data/output.vcf")
+        self.assertEqual(sort_temp_args("/data/sorted.bam"), ["-T", os.path.join(self.work_dir, "scratch", step_scratch_name("samtools_sort", "/data/sorted.bam"))])
+        #Outputs with the same name in other directories (e.g. the lanes of two samples) get their own temporary files
+        self.assertTrue(step_scratch_name("samtools_sort", "/data/sorted.bam").startswith("samtools_sort.sorted.bam."))
+        self.assertNotEqual(sort_temp_args("/data/S1/sorted.bam"), sort_temp_args("/data/S2/sorted.bam"))
+        self.assertNotEqual(gatk_scratch_dir("S1/lanes/L1.g.vcf.gz"), gatk_scratch_dir("S2/lanes/L1.g.vcf.gz"))
+
+    #Test for remove_intermediates and stop_scratch_monitor
+    #Using real files to check that the intermediates are removed, that the peak scratch usage includes them and that the empty default scratch directory is removed at the end
+    def test_remove_intermediates_peak(self):
+        configure_workspace(self.work_dir)
+        start_scratch_monitor()
+        sam=scratch_path("gatk_pipeline.sam")
+        with open(sam, "wb") as sam_file:
+            sam_file.write(os.urandom(256 * 1024))
+        chunk_dir=os.path.dirname(scratch_path("alignment_chunks", "chunk_0001_1.fastq.gz"))
+
+        remove_intermediates(sam, chunk_dir)
+        peak_bytes=stop_scratch_monitor()
+
+        self.assertFalse(os.path.exists(sam))
+        self.assertFalse(os.path.exists(chunk_dir))
+        self.assertGreaterEqual(peak_bytes, 256 * 1024)
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, "scratch")))
+
+    #Test for remove_intermediates
+    #Checking that the intermediates are kept with keep_intermediates
+    def test_keep_intermediates(self):
+        configure_workspace(self.work_dir, os.path.join(self.tmp_dir.name, "scratch"), keep_intermediates=True)
+        sam=scratch_path("gatk_pipeline.sam")
+        open(sam, "w").close()
+
+        remove_intermediates(sam)
+
+        self.assertTrue(os.path.exists(sam))
+
+if __name__ == "__main__":
+    unittest.main()